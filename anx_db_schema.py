@@ -75,4 +75,14 @@ CREATE TABLE tb_themes (
   text_color TEXT,
   background_image_path TEXT
 );
-"""
\ No newline at end of file
+"""
+
+# 服务端为热点查询额外创建的索引。
+# 只做加法（CREATE INDEX IF NOT EXISTS），不改动任何表结构，Anx 应用可以照常读写；
+# 统一使用 acm_ 前缀，避免与 Anx 应用自身的迁移冲突。
+ANX_DB_INDEXES = [
+    ("acm_idx_books_file_md5", "CREATE INDEX IF NOT EXISTS acm_idx_books_file_md5 ON tb_books (file_md5)"),
+    ("acm_idx_reading_time_book_date", "CREATE INDEX IF NOT EXISTS acm_idx_reading_time_book_date ON tb_reading_time (book_id, date)"),
+    ("acm_idx_reading_time_date", "CREATE INDEX IF NOT EXISTS acm_idx_reading_time_date ON tb_reading_time (date)"),
+    ("acm_idx_notes_book_id", "CREATE INDEX IF NOT EXISTS acm_idx_notes_book_id ON tb_notes (book_id)"),
+]
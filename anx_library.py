@@ -9,6 +9,9 @@ from config_manager import config
 from anx_db_schema import ANX_DB_SCHEMA
 from utils.ebook_utils import extract_ebook_metadata, generate_cover_image
 from utils.text import safe_title, safe_author
+from utils.anx_db import connect_anx_db
+from utils.anx_aggregates import get_book_aggregates
+from utils.progress_buffer import flush_progress
 
 def initialize_anx_user_data(username):
     """Creates the necessary directory structure and initializes an empty Anx database for a new user."""
@@ -62,6 +65,11 @@ def get_anx_user_dirs(username):
         "already_in": os.path.join(base_dir, "alreadyin"),
     }
 
+def get_anx_db(username):
+    """Borrows a cached connection to the user's Anx database (rows are sqlite3.Row). close() returns it to the cache."""
+    dirs = get_anx_user_dirs(username)
+    return connect_anx_db(username, dirs["db_path"])
+
 def get_anx_books(username):
     """Fetches all non-deleted books for a user from their Anx database."""
     dirs = get_anx_user_dirs(username)
@@ -71,33 +79,20 @@ def get_anx_books(username):
         print(f"ANX DB not found for user {username} at {db_path}")
         return []
 
+    # 先写入缓冲中的阅读进度和时长，列表排序和统计才是最新的
+    flush_progress(username)
+
     books = []
     try:
-        with closing(sqlite3.connect(db_path)) as db:
-            db.row_factory = sqlite3.Row
-            cursor = db.cursor()
-            query = """
-                SELECT
-                    b.*,
-                    COALESCE(SUM(rt.reading_time), 0) as total_reading_time,
-                    COALESCE(COUNT(DISTINCT n.id), 0) as note_count
-                FROM
-                    tb_books b
-                LEFT JOIN
-                    tb_reading_time rt ON b.id = rt.book_id
-                LEFT JOIN
-                    tb_notes n ON b.id = n.book_id
-                WHERE
-                    b.is_deleted = 0
-                GROUP BY
-                    b.id
-                ORDER BY
-                    b.update_time DESC
-            """
-            cursor.execute(query)
-            rows = cursor.fetchall()
+        with closing(get_anx_db(username)) as db:
+            rows = db.execute("SELECT * FROM tb_books WHERE is_deleted = 0 ORDER BY update_time DESC").fetchall()
+            # 阅读时长和笔记数来自增量维护的聚合缓存，避免整库 JOIN + GROUP BY
+            reading_times, note_counts = get_book_aggregates(username, db, db_path)
             for row in rows:
-                books.append(dict(row))
+                book = dict(row)
+                book['total_reading_time'] = reading_times.get(book['id'], 0)
+                book['note_count'] = note_counts.get(book['id'], 0)
+                books.append(book)
     except Exception as e:
         print(f"Error reading Anx database for user {username}: {e}")
         return []
@@ -110,14 +105,88 @@ def get_anx_book_path(username, book_id):
     if not dirs or not os.path.exists(dirs["db_path"]):
         raise FileNotFoundError("Anx database not found.")
     
-    with closing(sqlite3.connect(dirs["db_path"])) as db:
-        db.row_factory = sqlite3.Row
+    with closing(get_anx_db(username)) as db:
         book_row = db.execute("SELECT file_path FROM tb_books WHERE id = ?", (book_id,)).fetchone()
         if not book_row or not book_row['file_path']:
             raise FileNotFoundError(f"Anx book file with ID {book_id} not found.")
         
         return os.path.join(dirs["workspace"], book_row['file_path'])
 
+# 由写回缓冲维护的列，查询这些列前需要先 flush
+PROGRESS_COLUMNS = ('last_read_position', 'reading_percentage', 'update_time')
+
+# tb_books 中可以按需查询的列
+ANX_BOOK_COLUMNS = (
+    'id', 'title', 'cover_path', 'file_path', 'last_read_position', 'reading_percentage', 'author',
+    'is_deleted', 'description', 'create_time', 'update_time', 'rating', 'group_id', 'file_md5'
+)
+
+def get_anx_books_by_ids(username, ids, columns=None, with_aggregates=False):
+    """
+    按 id 批量获取未删除的 Anx 书籍，只查询需要的列。
+
+    Args:
+        username: 用户名
+        ids: 书籍 ID 列表
+        columns: 需要的 tb_books 列（必须在 ANX_BOOK_COLUMNS 中），为 None 时返回全部列
+        with_aggregates: 为 True 时附带 total_reading_time 和 note_count（只统计这些书）
+
+    Returns:
+        {book_id: dict}，不存在或已删除的书籍不会出现在结果中
+    """
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return {}
+    if columns is None:
+        select = '*'
+    else:
+        unknown = [c for c in columns if c not in ANX_BOOK_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown tb_books columns: {unknown}")
+        select = ', '.join(dict.fromkeys(['id', *columns]))
+
+    dirs = get_anx_user_dirs(username)
+    if not dirs or not os.path.exists(dirs["db_path"]):
+        print(f"ANX DB not found for user {username}")
+        return {}
+
+    if with_aggregates or columns is None or any(c in PROGRESS_COLUMNS for c in columns):
+        flush_progress(username)
+
+    books = {}
+    try:
+        with closing(get_anx_db(username)) as db:
+            # 分批查询，避免超过 SQLite 的参数数量上限
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                rows = db.execute(
+                    f"SELECT {select} FROM tb_books WHERE id IN ({placeholders}) AND is_deleted = 0", chunk
+                ).fetchall()
+                for row in rows:
+                    books[row['id']] = dict(row)
+
+                if with_aggregates:
+                    for book_id in chunk:
+                        if book_id in books:
+                            books[book_id]['total_reading_time'] = 0
+                            books[book_id]['note_count'] = 0
+                    for book_id, total in db.execute(
+                        f"SELECT book_id, SUM(reading_time) FROM tb_reading_time WHERE book_id IN ({placeholders}) GROUP BY book_id", chunk
+                    ):
+                        if book_id in books:
+                            books[book_id]['total_reading_time'] = total or 0
+                    for book_id, count in db.execute(
+                        f"SELECT book_id, COUNT(*) FROM tb_notes WHERE book_id IN ({placeholders}) GROUP BY book_id", chunk
+                    ):
+                        if book_id in books:
+                            books[book_id]['note_count'] = count
+    except sqlite3.Error as e:
+        print(f"Error reading Anx database for user {username}: {e}")
+        return {}
+
+    return books
+
 def get_anx_book_details(username, book_id, as_dict=False):
     """
     Fetches the details for a single Anx book by its ID.
@@ -125,24 +194,19 @@ def get_anx_book_details(username, book_id, as_dict=False):
     Args:
         username: 用户名
         book_id: 书籍ID
-        as_dict: 如果为True，返回完整的字典；如果为False，返回(title, author)元组
+        as_dict: 如果为True，返回完整的字典（含 total_reading_time、note_count）；如果为False，返回(title, author)元组
     
     Returns:
         如果 as_dict=True: 返回完整的书籍字典，未找到返回 None
         如果 as_dict=False: 返回 (title, author) 元组，未找到返回 (None, None)
     """
-    all_books = get_anx_books(username)
-    for book in all_books:
-        if book['id'] == book_id:
-            if as_dict:
-                return book
-            else:
-                return book.get('title'), book.get('author')
-    
     if as_dict:
-        return None
-    else:
-        return None, None
+        return get_anx_books_by_ids(username, [book_id], with_aggregates=True).get(book_id)
+
+    book = get_anx_books_by_ids(username, [book_id], columns=('title', 'author')).get(book_id)
+    if book:
+        return book.get('title'), book.get('author')
+    return None, None
 
 def _calculate_md5(file_path):
     hash_md5 = hashlib.md5()
@@ -184,7 +248,10 @@ def process_anx_import_folder(username):
         else:
             other_files.append(filename)
 
-    # Process ebooks and their matching covers
+    # 先读取元数据和计算 MD5（耗时的部分），再逐本写入：封面在写事务之外准备，每本书移动文件后
+    # 立即提交，写锁只在插入 / 更新一行时持有，不会阻塞 Anx 的 WebDAV 同步；
+    # 某本书失败时回滚这本书并把已移动的文件放回 import/，之前的书已经提交，不会成为孤儿文件
+    prepared = []
     for base_name, ebook_filename in ebook_files.items():
         file_path = os.path.join(dirs["import"], ebook_filename)
         
@@ -205,90 +272,84 @@ def process_anx_import_folder(username):
         
         # 3. Calculate MD5
         file_md5 = _calculate_md5(file_path)
+        prepared.append((base_name, ebook_filename, file_path, metadata, title, author, file_md5))
 
-        with closing(sqlite3.connect(dirs["db_path"])) as db:
-            cursor = db.cursor()
+    # Process ebooks and their matching covers
+    with closing(get_anx_db(username)) as db:
+        cursor = db.cursor()
+        for base_name, ebook_filename, file_path, metadata, title, author, file_md5 in prepared:
             cursor.execute("SELECT id, is_deleted FROM tb_books WHERE file_md5 = ?", (file_md5,))
             existing = cursor.fetchone()
 
             cover_filename = cover_files.pop(base_name, None)
-            cover_relative_path = ""
+            moved = []
 
-            # --- Book Processing (Reactivate or Add New) ---
-            if existing:
-                existing_id, is_deleted = existing
-                if is_deleted == 1: # Reactivate soft-deleted book
-                    print(f"Reactivating deleted book with MD5: {file_md5}")
-                    
-                    dest_file_path = os.path.join(dirs["file"], ebook_filename)
-                    shutil.move(file_path, dest_file_path)
-                    file_relative_path = 'file/' + ebook_filename
+            def place(source, dest):
+                shutil.move(source, dest)
+                moved.append((source, dest))
 
-                    # --- Cover Handling for Reactivation ---
-                    if cover_filename:
-                        cover_path = os.path.join(dirs["import"], cover_filename)
-                        dest_cover_path = os.path.join(dirs["cover"], cover_filename)
-                        shutil.move(cover_path, dest_cover_path)
-                        cover_relative_path = 'cover/' + cover_filename
-                    else:
-                        cover_data = metadata.get('cover') if metadata else None
-                        if not cover_data:
-                            cover_data = generate_cover_image(title, author)
-                        if cover_data:
-                            new_cover_filename = f"{base_name}.jpg"
-                            dest_cover_path = os.path.join(dirs["cover"], new_cover_filename)
-                            with open(dest_cover_path, 'wb') as f: f.write(cover_data)
-                            cover_relative_path = 'cover/' + new_cover_filename
-                    
-                    current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-                    cursor.execute("""
-                        UPDATE tb_books
-                        SET is_deleted = 0, update_time = ?, file_path = ?, cover_path = ?, title = ?, author = ?
-                        WHERE id = ?
-                    """, (current_time, file_relative_path, cover_relative_path, title, author, existing_id))
-                    db.commit()
-                    processed_count += 1
-                else: # True duplicate
-                    shutil.move(file_path, os.path.join(dirs["already_in"], ebook_filename))
+            try:
+                if existing and existing[1] != 1: # True duplicate
+                    place(file_path, os.path.join(dirs["already_in"], ebook_filename))
                     if cover_filename:
-                        shutil.move(os.path.join(dirs["import"], cover_filename), os.path.join(dirs["already_in"], cover_filename))
+                        place(os.path.join(dirs["import"], cover_filename), os.path.join(dirs["already_in"], cover_filename))
                     skipped_count += 1
-                continue
-
-            # --- Add New Book ---
-            dest_file_path = os.path.join(dirs["file"], ebook_filename)
-            shutil.move(file_path, dest_file_path)
-            file_relative_path = 'file/' + ebook_filename
-
-            # --- Cover Handling for New Book ---
-            if cover_filename:
-                cover_path = os.path.join(dirs["import"], cover_filename)
-                dest_cover_path = os.path.join(dirs["cover"], cover_filename)
-                shutil.move(cover_path, dest_cover_path)
-                cover_relative_path = 'cover/' + cover_filename
-            else:
-                cover_data = metadata.get('cover') if metadata else None
-                if not cover_data:
-                    cover_data = generate_cover_image(title, author)
-                if cover_data:
+                    continue
+
+                # --- Cover Handling (prepared outside the write transaction) ---
+                cover_data = None
+                if not cover_filename:
+                    cover_data = metadata.get('cover') if metadata else None
+                    if not cover_data:
+                        cover_data = generate_cover_image(title, author)
+
+                dest_file_path = os.path.join(dirs["file"], ebook_filename)
+                place(file_path, dest_file_path)
+                file_relative_path = 'file/' + ebook_filename
+
+                cover_relative_path = ""
+                if cover_filename:
+                    place(os.path.join(dirs["import"], cover_filename), os.path.join(dirs["cover"], cover_filename))
+                    cover_relative_path = 'cover/' + cover_filename
+                elif cover_data:
                     new_cover_filename = f"{base_name}.jpg"
                     dest_cover_path = os.path.join(dirs["cover"], new_cover_filename)
                     with open(dest_cover_path, 'wb') as f: f.write(cover_data)
+                    moved.append((None, dest_cover_path))
                     cover_relative_path = 'cover/' + new_cover_filename
-            
-            current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-            cursor.execute("""
-                INSERT INTO tb_books (
-                    title, author, cover_path, file_path, file_md5, create_time, update_time,
-                    is_deleted, last_read_position, reading_percentage, rating, group_id, description
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                title, author, cover_relative_path, file_relative_path, file_md5,
-                current_time, current_time, 0, '', 0.0, 0.0, 0, ''
-            ))
-            db.commit()
-            processed_count += 1
+
+                current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+                if existing: # Reactivate soft-deleted book
+                    print(f"Reactivating deleted book with MD5: {file_md5}")
+                    cursor.execute("""
+                        UPDATE tb_books
+                        SET is_deleted = 0, update_time = ?, file_path = ?, cover_path = ?, title = ?, author = ?
+                        WHERE id = ?
+                    """, (current_time, file_relative_path, cover_relative_path, title, author, existing[0]))
+                else: # Add New Book
+                    cursor.execute("""
+                        INSERT INTO tb_books (
+                            title, author, cover_path, file_path, file_md5, create_time, update_time,
+                            is_deleted, last_read_position, reading_percentage, rating, group_id, description
+                        )
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, (
+                        title, author, cover_relative_path, file_relative_path, file_md5,
+                        current_time, current_time, 0, '', 0.0, 0.0, 0, ''
+                    ))
+                db.commit()
+                processed_count += 1
+            except Exception:
+                db.rollback()
+                for source, dest in reversed(moved):
+                    try:
+                        if source:
+                            shutil.move(dest, source)
+                        else:
+                            os.remove(dest)
+                    except OSError as e:
+                        print(f"Failed to restore {dest} after import error: {e}")
+                raise
 
     # Move remaining files (unmatched covers and other files) to already_in
     remaining_files = other_files + list(cover_files.values())
@@ -320,8 +381,10 @@ def update_anx_book_metadata(username, book_id, data):
     values.append(book_id)
     query = f"UPDATE tb_books SET {set_clause} WHERE id = ?"
 
+    # 这里会刷新 update_time，先写入缓冲中的进度，否则之后的 flush 会用缓冲中较旧的 update_time 覆盖它
+    flush_progress(username)
     try:
-        with closing(sqlite3.connect(db_path)) as db:
+        with closing(get_anx_db(username)) as db:
             cursor = db.cursor()
             cursor.execute(query, tuple(values))
             db.commit()
@@ -338,9 +401,9 @@ def delete_anx_book(username, book_id):
     if not dirs or not os.path.exists(dirs["db_path"]):
         return False, "Anx 数据库未找到。"
 
+    flush_progress(username)
     try:
-        with closing(sqlite3.connect(dirs["db_path"])) as db:
-            db.row_factory = sqlite3.Row
+        with closing(get_anx_db(username)) as db:
             cursor = db.cursor()
             
             cursor.execute("SELECT file_path, cover_path FROM tb_books WHERE id = ?", (book_id,))
@@ -377,7 +440,7 @@ def add_book_to_anx_db(username, book_data, new_file_path, new_cover_path):
     if not dirs or not os.path.exists(dirs["db_path"]):
         raise FileNotFoundError("Anx database not found.")
 
-    with closing(sqlite3.connect(dirs["db_path"])) as db:
+    with closing(get_anx_db(username)) as db:
         cursor = db.cursor()
         
         cursor.execute("SELECT id, is_deleted FROM tb_books WHERE file_md5 = ?", (book_data['file_md5'],))
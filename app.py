@@ -8,9 +8,11 @@ from logging.handlers import RotatingFileHandler
 # Add the project root to the Python path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from flask_babel import Babel
-from contextlib import closing
 import database
 import config_manager
+from utils.user_cache import get_user_row, has_users
+from utils.progress_buffer import flush_progress
+from utils import prewarm
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 from werkzeug.middleware.proxy_fix import ProxyFix
 from wsgidav.wsgidav_app import WsgiDAVApp
@@ -99,6 +101,10 @@ class AnxDomainController(BaseDomainController):
             os.makedirs(user_dir)
             logging.info(f"Created WebDAV directory for user '{user_name}' at {user_dir}")
 
+        # Anx 应用通过 WebDAV 同步 database7.db，先写入缓冲中的阅读进度
+        if 'database7.db' in path_info:
+            flush_progress(user_name)
+
         return True
 
 
@@ -139,11 +145,10 @@ def create_app():
             return session['language']
         # 3. Check for language in user settings
         if 'user_id' in session:
-            with closing(database.get_db()) as db:
-                user = db.execute("SELECT language FROM users WHERE id = ?", (session['user_id'],)).fetchone()
-                if user and user['language']:
-                    session['language'] = user['language']
-                    return user['language']
+            user = get_user_row(session['user_id'])
+            if user and user['language']:
+                session['language'] = user['language']
+                return user['language']
         # 4. Fallback to browser's preferred language
         return request.accept_languages.best_match(list(LANGUAGES.keys()))
 
@@ -166,6 +171,14 @@ def create_app():
     from utils.audiobook_tasks_db import cleanup_incomplete_tasks
     cleanup_incomplete_tasks()
 
+    # 执行进程已经退出（worker 重启、容器重启）的后台任务标记为中断
+    from utils.conversion_jobs import interrupt_orphaned_jobs as interrupt_orphaned_conversions
+    interrupt_orphaned_conversions()
+    from utils.upload_jobs import interrupt_orphaned_jobs as interrupt_orphaned_uploads
+    interrupt_orphaned_uploads()
+    from utils.book_jobs import interrupt_orphaned_jobs as interrupt_orphaned_book_jobs
+    interrupt_orphaned_book_jobs()
+
     from blueprints.main import main_bp
     from blueprints.auth import auth_bp
     from blueprints.mcp import mcp_bp
@@ -179,6 +192,9 @@ def create_app():
     from blueprints.api.email_service import email_bp
     from blueprints.api.books import books_bp
     from blueprints.api.calibre import calibre_bp
+    from blueprints.api.upload_jobs import upload_jobs_bp
+    from blueprints.api.book_jobs import book_jobs_bp
+    from blueprints.api.conversion_jobs import conversion_jobs_bp
     from blueprints.api.tokens import tokens_bp
     from blueprints.api.auth_2fa import auth_2fa_bp
     from blueprints.api.invite import invite_bp
@@ -205,6 +221,9 @@ def create_app():
     app.register_blueprint(email_bp)
     app.register_blueprint(books_bp)
     app.register_blueprint(calibre_bp)
+    app.register_blueprint(upload_jobs_bp)
+    app.register_blueprint(book_jobs_bp)
+    app.register_blueprint(conversion_jobs_bp)
     app.register_blueprint(tokens_bp)
     app.register_blueprint(auth_2fa_bp)
     app.register_blueprint(invite_bp)
@@ -233,16 +252,16 @@ def create_app():
     def before_request_handler():
         g.user = get_current_user()
         g.app = app
-        with closing(database.get_db()) as db:
-            user_count = db.execute('SELECT COUNT(id) FROM users').fetchone()[0]
-            if user_count == 0 and request.endpoint and not request.endpoint.startswith('auth.') and not request.endpoint == 'static':
-                 return redirect(url_for('auth.setup'))
+        prewarm.note_activity()
+        prewarm.maybe_start(app)
+        # 用户记录和"是否已初始化"标志都来自内存缓存，稳态下不访问数据库
+        if not has_users() and request.endpoint and not request.endpoint.startswith('auth.') and not request.endpoint == 'static':
+             return redirect(url_for('auth.setup'))
 
     def get_current_user():
         user_row = None
         if 'user_id' in session:
-            with closing(database.get_db()) as db:
-                user_row = db.execute("SELECT * FROM users WHERE id = ?", (session['user_id'],)).fetchone()
+            user_row = get_user_row(session['user_id'])
         return User(user_row)
 
     webdav_root = config_manager.config.get("WEBDAV_ROOT", "/webdav")
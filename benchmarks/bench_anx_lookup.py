@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark for Anx book detail lookups on a large library.
+
+Builds a throwaway Anx library with --books books (default 10000), each with
+some reading-time rows and notes, then times:
+
+  * scan      - the old get_anx_book_details: load every book with its
+                aggregates (the pre-sidecar JOIN query) and pick one id
+  * listing   - get_anx_books() followed by a linear search
+  * point     - get_anx_book_details(as_dict=True), a single-row query
+  * title     - get_anx_book_details() returning (title, author)
+  * batch     - get_anx_books_by_ids() for --batch ids with two columns
+
+Usage (from the project root):
+    python benchmarks/bench_anx_lookup.py [--books 10000] [--lookups 200] [--batch 50]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+LEGACY_QUERY = """
+    SELECT
+        b.*,
+        COALESCE(SUM(rt.reading_time), 0) as total_reading_time,
+        COALESCE(COUNT(DISTINCT n.id), 0) as note_count
+    FROM
+        tb_books b
+    LEFT JOIN
+        tb_reading_time rt ON b.id = rt.book_id
+    LEFT JOIN
+        tb_notes n ON b.id = n.book_id
+    WHERE
+        b.is_deleted = 0
+    GROUP BY
+        b.id
+    ORDER BY
+        b.update_time DESC
+"""
+
+
+def seed(db_path, num_books):
+    import sqlite3
+    from anx_db_schema import ANX_DB_SCHEMA
+    conn = sqlite3.connect(db_path)
+    conn.executescript(ANX_DB_SCHEMA)
+    conn.executemany(
+        "INSERT INTO tb_books (id, title, author, file_path, cover_path, is_deleted, update_time, file_md5) VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+        [(i, f"Book {i}", f"Author {i % 500}", f"file/{i}.epub", f"cover/{i}.png", f"2025-01-01 00:00:{i % 60:02d}", f"{i:032x}")
+         for i in range(1, num_books + 1)]
+    )
+    conn.executemany(
+        "INSERT INTO tb_reading_time (book_id, date, reading_time) VALUES (?, ?, ?)",
+        [(random.randint(1, num_books), f"2025-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}", random.randint(60, 3600))
+         for _ in range(num_books * 3)]
+    )
+    conn.executemany(
+        "INSERT INTO tb_notes (book_id, content) VALUES (?, ?)",
+        [(random.randint(1, num_books), "note") for _ in range(num_books * 2)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def timed(label, lookups, fn):
+    start = time.perf_counter()
+    for _ in range(lookups):
+        fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<8} {elapsed / lookups * 1000:10.3f} ms/op")
+    return elapsed / lookups
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=50)
+    args = parser.parse_args()
+
+    tmp_root = tempfile.mkdtemp(prefix='anx_lookup_')
+    os.environ['CONFIG_DIR'] = os.path.join(tmp_root, 'config')
+    os.environ['WEBDAV_DIR'] = os.path.join(tmp_root, 'webdav')
+    os.environ['ANX_AGGREGATES_DIR'] = os.path.join(tmp_root, 'aggregates')
+    sys.path.insert(0, PROJECT_ROOT)
+    try:
+        import config_manager
+        config_manager.config.load_config()
+        import anx_library
+        from contextlib import closing
+
+        username = 'bench'
+        anx_library.initialize_anx_user_data(username)
+        db_path = anx_library.get_anx_user_dirs(username)['db_path']
+        os.remove(db_path)
+        seed(db_path, args.books)
+
+        ids = list(range(1, args.books + 1))
+
+        def legacy_scan():
+            book_id = random.choice(ids)
+            with closing(anx_library.get_anx_db(username)) as db:
+                for row in db.execute(LEGACY_QUERY).fetchall():
+                    if row['id'] == book_id:
+                        return dict(row)
+
+        def listing_scan():
+            book_id = random.choice(ids)
+            for book in anx_library.get_anx_books(username):
+                if book['id'] == book_id:
+                    return book
+
+        print(f"{args.books} books, {args.lookups} lookups")
+        lookups = max(1, args.lookups // 20)
+        scan = timed('scan', lookups, legacy_scan)
+        timed('listing', lookups, listing_scan)
+        point = timed('point', args.lookups, lambda: anx_library.get_anx_book_details(username, random.choice(ids), as_dict=True))
+        timed('title', args.lookups, lambda: anx_library.get_anx_book_details(username, random.choice(ids)))
+        timed('batch', args.lookups, lambda: anx_library.get_anx_books_by_ids(username, random.sample(ids, args.batch), columns=('title', 'author')))
+        print(f"point lookup is {scan / point:.0f}x faster than the full scan")
+    finally:
+        shutil.rmtree(tmp_root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
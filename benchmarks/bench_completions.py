@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark for metadata field completions.
+
+Builds --items synthetic author names (default 50000, with some accented
+names), then times per-keystroke lookups for a set of queries:
+
+  * linear  - the old completion endpoint: `query in item.lower()` over every item
+  * index   - CompletionIndex.search() (prefix, word-start and trigram substring)
+
+Also reports the index build time, which is paid once per refresh.
+
+Usage (from the project root):
+    python benchmarks/bench_completions.py [--items 50000] [--rounds 200]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+FIRST = ['Jean', 'José', 'Ana', 'Émile', 'John', 'Mary', 'Haruki', 'Søren', 'Olga', 'Li', 'Chloé', 'Ivan']
+LAST = ['Tolkien', 'García', 'Müller', 'Dupont', 'Murakami', 'Kierkegaard', 'Smith', 'Brontë', 'Zhang', 'Nabokov']
+QUERIES = ['j', 'jo', 'tol', 'garcia', 'muller', 'murak', 'kierk', 'smith 12', 'zzz', 'ana g']
+
+
+def make_items(count, seed=1):
+    rng = random.Random(seed)
+    items = set()
+    while len(items) < count:
+        items.add(f"{rng.choice(FIRST)} {rng.choice(LAST)} {rng.randrange(count * 4)}")
+    return list(items)
+
+
+def timed(fn, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=50000)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    # utils.completion_index imports config_manager, which needs a writable CONFIG_DIR
+    os.environ.setdefault('CONFIG_DIR', tempfile.mkdtemp(prefix='anx-bench-'))
+    sys.path.insert(0, PROJECT_ROOT)
+    from utils.completion_index import CompletionIndex
+
+    items = make_items(args.items)
+    start = time.perf_counter()
+    index = CompletionIndex(items)
+    print(f"{len(index)} items, index built in {(time.perf_counter() - start) * 1000:.0f} ms")
+    print(f"{'query':<12}{'linear ms':>12}{'index ms':>12}{'results':>10}")
+
+    for query in QUERIES:
+        q = query.lower()
+        linear = timed(lambda: [item for item in items if q in item.lower()][:20], max(1, args.rounds // 20))
+        indexed = timed(lambda: index.search(query), args.rounds)
+        print(f"{query:<12}{linear:>12.3f}{indexed:>12.3f}{len(index.search(query)):>10}")
+
+
+if __name__ == '__main__':
+    main()
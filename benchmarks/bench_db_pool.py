@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Requests/sec benchmark for the central app.db connection pool.
+
+Runs the Flask test client against `/` and `/api/reader/progress/anx/<id>`
+twice: once with DB_POOL_SIZE=0 (a fresh sqlite3 connection per get_db()
+call, i.e. the old behaviour) and once with the pool enabled.
+
+Usage (from the project root):
+    python benchmarks/bench_db_pool.py [--requests 500]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def run_worker(num_requests):
+    sys.path.insert(0, PROJECT_ROOT)
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    import bcrypt
+    import app as app_module
+    import database
+    from anx_library import initialize_anx_user_data, get_anx_user_dirs
+    from contextlib import closing
+    import sqlite3
+
+    app = app_module.create_app()
+    with closing(database.get_db()) as db:
+        db.execute(
+            "INSERT INTO users (username, password_hash, role) VALUES (?, ?, 'admin')",
+            ('bench', bcrypt.hashpw(b'bench', bcrypt.gensalt(4)))
+        )
+        user_id = db.execute("SELECT id FROM users WHERE username = 'bench'").fetchone()['id']
+    initialize_anx_user_data('bench')
+    with closing(sqlite3.connect(get_anx_user_dirs('bench')['db_path'])) as anx_db:
+        anx_db.execute(
+            "INSERT INTO tb_books (title, author, file_path, file_md5, is_deleted, last_read_position, reading_percentage, update_time) "
+            "VALUES ('Bench', 'Bench', 'file/bench.epub', 'md5', 0, '', 0.0, '2024-01-01T00:00:00.000Z')"
+        )
+        anx_db.commit()
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+        sess['language'] = 'en'
+
+    results = {}
+    for name, path in [('/', '/'), ('/api/reader/progress', '/api/reader/progress/anx/1')]:
+        client.get(path)  # warm-up
+        start = time.perf_counter()
+        for _ in range(num_requests):
+            client.get(path)
+        elapsed = time.perf_counter() - start
+        results[name] = num_requests / elapsed
+    print(json.dumps(results))
+
+
+def run_mode(pool_size, num_requests):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env.update({
+            'CONFIG_DIR': os.path.join(tmp, 'config'),
+            'WEBDAV_DIR': os.path.join(tmp, 'webdav'),
+            'LOG_DIR': os.path.join(tmp, 'logs'),
+            # An unused local port makes the Calibre part of `/` fail fast and identically in both modes.
+            'CALIBRE_URL': 'http://127.0.0.1:9',
+            'DB_POOL_SIZE': str(pool_size),
+        })
+        output = subprocess.run(
+            [sys.executable, __file__, '--worker', '--requests', str(num_requests)],
+            env=env, capture_output=True, text=True, check=True
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.requests)
+        return
+
+    before = run_mode(0, args.requests)
+    after = run_mode(8, args.requests)
+    print(f"{'endpoint':<24}{'before (req/s)':>16}{'after (req/s)':>16}{'speedup':>10}")
+    for name in before:
+        print(f"{name:<24}{before[name]:>16.1f}{after[name]:>16.1f}{after[name] / before[name]:>9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
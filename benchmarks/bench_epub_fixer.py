@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the Kindle EPUB fixer on image-heavy books.
+
+Builds a synthetic EPUB with --chapters XHTML chapters (one of them missing
+its XML declaration, so the fixer has something to do) and --images
+incompressible JPEG-sized images, then times:
+
+  * legacy    - the previous strategy: decode every text member into memory,
+                then rewrite the whole archive with ZIP_DEFLATED
+  * streaming - epub_fixer.EPUBFixer: scan members one at a time, rewrite only
+                the members that changed, copy everything else as raw
+                compressed data
+
+Peak Python heap usage (tracemalloc) is reported for each run.
+
+Usage (from the project root):
+    python benchmarks/bench_epub_fixer.py [--chapters 200] [--images 150] [--image-kb 400] [--rounds 3]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+CONTAINER = ('<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+             '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles></container>')
+
+
+def make_epub(path, chapters, images, image_kb, seed=1):
+    rng = random.Random(seed)
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit']
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        z.writestr('META-INF/container.xml', CONTAINER)
+        z.writestr('OEBPS/content.opf', (
+            '<?xml version="1.0" encoding="utf-8"?><package xmlns="http://www.idpf.org/2007/opf" version="2.0">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Bench</dc:title>'
+            '<dc:language>zh</dc:language></metadata><manifest/><spine/></package>'
+        ))
+        for i in range(chapters):
+            text = ''.join(f"<p>{' '.join(rng.choice(words) for _ in range(60))}</p>" for _ in range(40))
+            declaration = '' if i == 0 else '<?xml version="1.0" encoding="utf-8"?>\n'
+            z.writestr(f'OEBPS/chapter{i}.xhtml', (
+                f'{declaration}<html xmlns="http://www.w3.org/1999/xhtml"><head><title>{i}</title></head>'
+                f'<body>{text}<img src="image{i % max(images, 1)}.jpg"/></body></html>'
+            ))
+        for i in range(images):
+            z.writestr(f'OEBPS/image{i}.jpg', rng.randbytes(image_kb * 1024))
+
+
+def legacy_fix(input_path, output_path):
+    """The previous approach: decode every text member into memory, recompress every member."""
+    files, binary_files = {}, {}
+    with zipfile.ZipFile(input_path, 'r') as zip_ref:
+        for filename in zip_ref.namelist():
+            ext = filename.split('.')[-1].lower()
+            if filename == 'mimetype' or ext in ['html', 'xhtml', 'htm', 'xml', 'svg', 'css', 'opf', 'ncx']:
+                files[filename] = zip_ref.read(filename).decode('utf-8')
+            else:
+                binary_files[filename] = zip_ref.read(filename)
+    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr('mimetype', files['mimetype'], compress_type=zipfile.ZIP_STORED)
+        for filename, content in files.items():
+            if filename != 'mimetype':
+                zip_ref.writestr(filename, content.encode('utf-8'))
+        for filename, content in binary_files.items():
+            zip_ref.writestr(filename, content)
+
+
+def measure(fn, rounds):
+    best = None
+    peak = 0
+    for _ in range(rounds):
+        tracemalloc.start()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, peak / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chapters', type=int, default=200)
+    parser.add_argument('--images', type=int, default=150)
+    parser.add_argument('--image-kb', type=int, default=400)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    sys.path.insert(0, PROJECT_ROOT)
+    from epub_fixer import EPUBFixer
+
+    with tempfile.TemporaryDirectory(prefix='anx-bench-') as temp_dir:
+        source = os.path.join(temp_dir, 'book.epub')
+        make_epub(source, args.chapters, args.images, args.image_kb)
+        print(f"{args.chapters} chapters, {args.images} images, {os.path.getsize(source) / (1024 * 1024):.1f} MB")
+
+        legacy_out = os.path.join(temp_dir, 'legacy.epub')
+        streaming_out = os.path.join(temp_dir, 'streaming.epub')
+        legacy_ms, legacy_mb = measure(lambda: legacy_fix(source, legacy_out), args.rounds)
+        streaming_ms, streaming_mb = measure(
+            lambda: EPUBFixer().process(source, streaming_out, force_language='zh'), args.rounds
+        )
+
+        print(f"{'':<12}{'ms':>10}{'peak MB':>10}")
+        print(f"{'legacy':<12}{legacy_ms:>10.0f}{legacy_mb:>10.1f}")
+        print(f"{'streaming':<12}{streaming_ms:>10.0f}{streaming_mb:>10.1f}")
+        print(f"speedup {legacy_ms / streaming_ms:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+EXPLAIN QUERY PLAN check for the hot queries on a user's Anx database7.db.
+
+Builds a throwaway database from ANX_DB_SCHEMA (or opens the one given with
+--db), applies the server-side acm_ indexes via ensure_anx_indexes(), and
+fails with exit code 1 if any hot query scans a table it should be
+searching by index.
+
+Usage (from the project root):
+    python benchmarks/check_anx_query_plans.py [--db /webdav/<user>/anx/database7.db]
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, PROJECT_ROOT)
+
+from anx_db_schema import ANX_DB_SCHEMA
+from utils.anx_db import ensure_anx_indexes
+
+# (name, sql, tables/aliases that are allowed to be scanned)
+HOT_QUERIES = [
+    ("koreader document lookup",
+     "SELECT * FROM tb_books WHERE file_md5 = ? AND is_deleted = 0", set()),
+    ("import duplicate check",
+     "SELECT id, is_deleted FROM tb_books WHERE file_md5 = ?", set()),
+    ("book by id",
+     "SELECT file_path, title FROM tb_books WHERE id = ?", set()),
+    ("reading time upsert lookup",
+     "SELECT id, reading_time FROM tb_reading_time WHERE book_id = ? AND date = ?", set()),
+    ("reading time per book",
+     "SELECT date, reading_time FROM tb_reading_time WHERE book_id = ?", set()),
+    ("daily reading time in range",
+     "SELECT date, SUM(reading_time) as total_time FROM tb_reading_time WHERE date >= ? AND date <= ? GROUP BY date ORDER BY date", set()),
+    # 书库列表需要返回全部书籍，允许扫描 tb_books
+    ("library listing",
+     "SELECT * FROM tb_books WHERE is_deleted = 0 ORDER BY update_time DESC", {"tb_books"}),
+    ("aggregates live window",
+     "SELECT book_id, reading_time FROM tb_reading_time WHERE date >= ?", set()),
+    ("aggregates dirty book recompute",
+     "SELECT COALESCE(SUM(reading_time), 0) FROM tb_reading_time WHERE book_id = ? AND date < ? AND rowid <= ?", set()),
+]
+
+
+def find_full_scans(conn):
+    """Returns a list of (query name, plan detail) for every disallowed table scan."""
+    problems = []
+    for name, sql, allowed in HOT_QUERIES:
+        params = (None,) * sql.count('?')
+        for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+            detail = row[3]
+            if not detail.startswith('SCAN '):
+                continue
+            table = detail.split()[1]
+            if table not in allowed:
+                problems.append((name, detail))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='Check a copy of an existing database7.db instead of a fresh one.')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='anx_plans_')
+    try:
+        db_path = os.path.join(tmp_dir, 'database7.db')
+        if args.db:
+            # 在副本上操作，不修改真实的用户数据库
+            shutil.copyfile(args.db, db_path)
+        conn = sqlite3.connect(db_path)
+        if not args.db:
+            conn.executescript(ANX_DB_SCHEMA)
+        created = ensure_anx_indexes(conn)
+        conn.execute('ANALYZE')
+        if created:
+            print(f"Created indexes: {', '.join(created)}")
+
+        problems = find_full_scans(conn)
+        conn.close()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if problems:
+        for name, detail in problems:
+            print(f"FULL SCAN in '{name}': {detail}")
+        sys.exit(1)
+    print(f"OK: {len(HOT_QUERIES)} hot queries use indexes.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,6 @@
 import os
 import logging
 import re
-import sqlite3
 from flask import Blueprint, jsonify, g, request, send_file, Response
 from flask_babel import gettext as _
 from contextlib import closing
@@ -10,8 +9,9 @@ from utils.audio_metadata import extract_m4b_metadata
 from anx_library import get_anx_user_dirs
 from datetime import datetime
 from utils.activity_logger import log_activity, ActivityType
-from anx_library import get_anx_book_path, get_anx_user_dirs
+from anx_library import get_anx_book_path, get_anx_user_dirs, get_anx_db
 from utils.epub_cfi_utils import get_cfi_for_chapter, get_chapter_from_cfi, get_total_chapters
+from utils.progress_buffer import record_progress, add_reading_time, get_buffered_progress
 
 logger = logging.getLogger(__name__)
 audio_player_bp = Blueprint('audio_player', __name__, url_prefix='/api/audioplayer')
@@ -165,12 +165,10 @@ def handle_progress(task_id):
                         percentage = ((chapter_index + 1) / total_chapters) if total_chapters > 0 else 0
                         dirs = get_anx_user_dirs(g.user.username)
                         if dirs and os.path.exists(dirs["db_path"]):
-                            with closing(sqlite3.connect(dirs["db_path"])) as anx_db:
-                                current_time_str = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-                                anx_db.execute("UPDATE tb_books SET last_read_position = ?, reading_percentage = ?, update_time = ? WHERE id = ?", (epubcfi, percentage, current_time_str, book_id))
-                                anx_db.commit()
-                                if is_user_action:
-                                    log_activity(ActivityType.PLAY_AUDIOBOOK_UPDATE_READING_PROGRESS, book_id=book_id, library_type='anx', success=True)
+                            current_time_str = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+                            record_progress(g.user.username, book_id, epubcfi, percentage, current_time_str)
+                            if is_user_action:
+                                log_activity(ActivityType.PLAY_AUDIOBOOK_UPDATE_READING_PROGRESS, book_id=book_id, library_type='anx', success=True)
                 except Exception as e:
                     logger.error(f"Failed to update Anx DB for book {task['book_id']}: {e}")
                     if is_user_action:
@@ -202,14 +200,19 @@ def handle_progress(task_id):
                 try:
                     dirs = get_anx_user_dirs(g.user.username)
                     if dirs and os.path.exists(dirs["db_path"]):
-                        with closing(sqlite3.connect(dirs["db_path"])) as anx_db:
-                            anx_book = anx_db.execute("SELECT last_read_position FROM tb_books WHERE id = ?", (task['book_id'],)).fetchone()
-                            if anx_book and anx_book[0]:
-                                epub_path = get_anx_book_path(g.user.username, task['book_id'])
-                                reader_chapter_index = get_chapter_from_cfi(epub_path, anx_book[0])
-                                if reader_chapter_index > audiobook_chapter_index:
-                                    final_chapter_index = reader_chapter_index
-                                    final_time_sec = 0 # Start from beginning of chapter
+                        pending = get_buffered_progress(g.user.username, task['book_id'])
+                        if pending:
+                            last_read_position = pending[0]
+                        else:
+                            with closing(get_anx_db(g.user.username)) as anx_db:
+                                anx_book = anx_db.execute("SELECT last_read_position FROM tb_books WHERE id = ?", (task['book_id'],)).fetchone()
+                            last_read_position = anx_book[0] if anx_book else None
+                        if last_read_position:
+                            epub_path = get_anx_book_path(g.user.username, task['book_id'])
+                            reader_chapter_index = get_chapter_from_cfi(epub_path, last_read_position)
+                            if reader_chapter_index > audiobook_chapter_index:
+                                final_chapter_index = reader_chapter_index
+                                final_time_sec = 0 # Start from beginning of chapter
                 except Exception as e:
                     logger.error(f"Failed to get Anx progress for book {task['book_id']}: {e}")
 
@@ -237,6 +240,7 @@ def log_listen_time():
         return jsonify({'error': 'book_id and listen_duration_seconds are required.'}), 400
 
     try:
+        book_id = int(book_id)
         listen_duration = int(listen_duration_seconds)
         if listen_duration <= 0:
             return jsonify({'message': 'Duration must be positive.'})
@@ -249,24 +253,11 @@ def log_listen_time():
 
     date_str = datetime.utcnow().strftime('%Y-%m-%d')
 
-    with closing(sqlite3.connect(dirs["db_path"])) as db:
-        cursor = db.cursor()
-        
-        # Check if a record for this book and date already exists
-        cursor.execute("SELECT id, reading_time FROM tb_reading_time WHERE book_id = ? AND date = ?", (book_id, date_str))
-        existing_record = cursor.fetchone()
+    add_reading_time(g.user.username, book_id, date_str, listen_duration)
 
-        if existing_record:
-            new_reading_time = existing_record[1] + listen_duration
-            cursor.execute("UPDATE tb_reading_time SET reading_time = ? WHERE id = ?", (new_reading_time, existing_record[0]))
-        else:
-            cursor.execute("INSERT INTO tb_reading_time (book_id, date, reading_time) VALUES (?, ?, ?)", (book_id, date_str, listen_duration))
-        
-        db.commit()
-        
-        # 只在用户主动操作时记录活动日志
-        if is_user_action:
-            log_activity(ActivityType.PLAY_AUDIOBOOK_UPDATE_READING_TIME, book_id=book_id, library_type='anx', success=True, detail=f'{listen_duration}s')
+    # 只在用户主动操作时记录活动日志
+    if is_user_action:
+        log_activity(ActivityType.PLAY_AUDIOBOOK_UPDATE_READING_TIME, book_id=book_id, library_type='anx', success=True, detail=f'{listen_duration}s')
 
     return jsonify({'message': 'Listen time logged successfully.'})
 
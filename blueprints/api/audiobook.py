@@ -3,6 +3,7 @@ import threading
 import uuid
 import os
 import tempfile
+import shutil
 import sqlite3
 from contextlib import closing
 from flask import Blueprint, request, jsonify, g, send_file
@@ -13,7 +14,7 @@ import json
 import config_manager
 import database
 from utils.audiobook_generator import AudiobookGenerator, TTSConfig, EdgeTTSProvider, OpenAITTSProvider
-from .books import _get_processed_epub_for_book
+from .books import _processed_epub, _conversion_job_response
 from .calibre import get_calibre_book_details
 from anx_library import get_anx_user_dirs, get_anx_book_path, get_anx_book_details
 from utils.text import generate_audiobook_filename
@@ -39,20 +40,21 @@ def get_tts_voices():
     })
 
 def get_calibre_book_as_temp_file(user_dict, book_id):
-    """获取 Calibre 书籍的 EPUB 内容并存入临时文件"""
+    """把处理过的 Calibre 书籍 EPUB（来自磁盘缓存或现场处理）复制到临时文件"""
     language = (user_dict.get('language') or 'zh').split('_')[0]
-    content, filename, _unused = _get_processed_epub_for_book(book_id, user_dict, language=language)
-    
-    if filename == 'CONVERTER_NOT_FOUND':
-        raise RuntimeError("ebook-converter tool is missing.")
-    if not content or not filename:
-        raise FileNotFoundError(f"Could not get or process Calibre book ID {book_id}.")
-
-    # 创建一个临时文件来保存 EPUB 内容
-    # 注意：需要确保这个文件在任务结束后被删除
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".epub")
-    temp_file.write(content)
-    temp_file.close()
+    with _processed_epub(book_id, user_dict, language=language) as (path, error, _unused, _details):
+        if error == 'CONVERTER_NOT_FOUND':
+            raise RuntimeError("ebook-converter tool is missing.")
+        if error == 'CONVERSION_PENDING':
+            raise RuntimeError("The book is still being converted to EPUB. Please try again later.")
+        if error:
+            raise FileNotFoundError(f"Could not get or process Calibre book ID {book_id}.")
+
+        # 创建一个临时文件来保存 EPUB 内容
+        # 注意：需要确保这个文件在任务结束后被删除
+        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".epub")
+        temp_file.close()
+        shutil.copyfile(path, temp_file.name)
     return temp_file.name
 
 def run_async_task(target, *args, **kwargs):
@@ -88,6 +90,11 @@ def generate_audiobook_route():
         details = get_calibre_book_details(book_id)
         if details:
             book_title = details.get('title')
+        # 需要转换时先返回 202 和转换任务，转换完成后前端重新提交，不在请求中等待 ebook-converter
+        user_dict = {'id': g.user.id, 'username': g.user.username, 'kindle_email': g.user.kindle_email, 'send_format_priority': g.user.send_format_priority, 'force_epub_conversion': g.user.force_epub_conversion, 'language': g.user.language}
+        pending = _conversion_job_response(book_id, user_dict, (g.user.language or 'zh').split('_')[0])
+        if pending:
+            return pending
 
     existing_task = get_audiobook_task_by_book(g.user.id, book_id, library)
     if existing_task:
@@ -133,7 +140,7 @@ def generate_audiobook_route():
         if library == 'anx':
             book_path_or_temp_file = get_anx_book_path(g.user.username, book_id)
         elif library == 'calibre':
-            user_dict = {'username': g.user.username, 'kindle_email': g.user.kindle_email, 'send_format_priority': g.user.send_format_priority, 'force_epub_conversion': g.user.force_epub_conversion, 'language': g.user.language}
+            user_dict = {'id': g.user.id, 'username': g.user.username, 'kindle_email': g.user.kindle_email, 'send_format_priority': g.user.send_format_priority, 'force_epub_conversion': g.user.force_epub_conversion, 'language': g.user.language}
             book_path_or_temp_file = get_calibre_book_as_temp_file(user_dict, book_id)
         else:
             error_msg = _("Invalid 'library' type")
@@ -7,6 +7,7 @@ from flask_babel import gettext as _
 from contextlib import closing
 import database
 from utils.activity_logger import log_activity, ActivityType
+from utils.user_cache import bump_users_generation
 
 auth_2fa_bp = Blueprint('auth_2fa', __name__, url_prefix='/api')
 
@@ -33,6 +34,7 @@ def verify_2fa():
         with closing(database.get_db()) as db:
             db.execute('UPDATE users SET otp_secret = ? WHERE id = ?', (secret, g.user.id))
             db.commit()
+            bump_users_generation()
         session.pop('2fa_secret_pending', None)
         log_activity(ActivityType.ENABLE_2FA, success=True)
         return jsonify({'message': _('2FA has been successfully enabled!')})
@@ -45,5 +47,6 @@ def disable_2fa():
     with closing(database.get_db()) as db:
         db.execute('UPDATE users SET otp_secret = NULL WHERE id = ?', (g.user.id,))
         db.commit()
+        bump_users_generation()
     log_activity(ActivityType.DISABLE_2FA, success=True)
     return jsonify({'message': _('2FA has been disabled.')})
\ No newline at end of file
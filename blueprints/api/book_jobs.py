@@ -0,0 +1,160 @@
+import os
+import requests
+from flask import Blueprint, request, jsonify, g
+from flask_babel import gettext as _
+
+import config_manager
+from utils.book_jobs import (
+    ACTIONS, BOOK_JOB_MAX_BOOKS, create_book_job, get_book_job, get_book_job_row,
+    job_spool_dir, record_item_result, submit_books, update_job_item
+)
+from utils.calibre_mirror import fetch_books, search_book_ids
+from utils.activity_logger import log_activity, ActivityType
+from utils.decorators import login_required_api
+from .books import _send_to_kindle_logic, _prepare_calibre_book_for_anx, _import_prepared_books_to_anx
+from .email_service import SMTPSession
+from .upload_jobs import _in_request_locale
+
+book_jobs_bp = Blueprint('book_jobs', __name__, url_prefix='/api')
+
+
+def _kindle_job(user_dict, user_id, titles):
+    # 整个任务共用一个 SMTP 连接，全部发送完后关闭
+    smtp_session = SMTPSession(config_manager.config)
+
+    def process(book_id, on_stage):
+        on_stage('sending')
+        result = _send_to_kindle_logic(user_dict, book_id, smtp_session=smtp_session)
+        if result['success']:
+            log_activity(ActivityType.PUSH_TO_KINDLE, username=user_dict['username'], user_id=user_id, book_id=book_id, book_title=titles.get(book_id), library_type='calibre', success=True)
+        else:
+            log_activity(ActivityType.PUSH_TO_KINDLE, username=user_dict['username'], user_id=user_id, book_id=book_id, book_title=titles.get(book_id), library_type='calibre', success=False, failure_reason=result.get('error', '')[:200])
+        return result
+
+    def finished(results):
+        smtp_session.close()
+
+    return _in_request_locale(process), finished
+
+
+def _anx_job(job_id, user_dict, user_id, titles):
+    # 每本书先在任务目录中准备好，全部完成后一次性导入（一个 Anx 数据库事务）
+    def process(book_id, on_stage):
+        on_stage('preparing')
+        dest_dir = os.path.join(job_spool_dir(job_id), str(book_id))
+        os.makedirs(dest_dir, exist_ok=True)
+        prepared = _prepare_calibre_book_for_anx(user_dict, book_id, dest_dir)
+        if not prepared['success']:
+            log_activity(ActivityType.PUSH_TO_ANX, username=user_dict['username'], user_id=user_id, book_id=book_id, book_title=titles.get(book_id), library_type='calibre', success=False, failure_reason=prepared.get('error'))
+            return prepared
+        on_stage('waiting_for_import')
+        return dict(prepared, pending=True)
+
+    def finished(results):
+        pending = [r for r in results if r.get('pending')]
+        if not pending:
+            return
+        for r in pending:
+            update_job_item(r['item_id'], 'processing', stage='importing')
+        imported = _import_prepared_books_to_anx(
+            user_dict['username'], [(r['item_id'], r['path'], r['filename']) for r in pending]
+        )
+        for r in pending:
+            result = imported[r['item_id']]
+            record_item_result(r['item_id'], result)
+            if result['success']:
+                log_activity(ActivityType.PUSH_TO_ANX, username=user_dict['username'], user_id=user_id, book_id=r['book_id'], book_title=titles.get(r['book_id']), library_type='calibre', success=True, detail=result.get('message'))
+            else:
+                log_activity(ActivityType.PUSH_TO_ANX, username=user_dict['username'], user_id=user_id, book_id=r['book_id'], book_title=titles.get(r['book_id']), library_type='calibre', success=False, failure_reason=result.get('error'))
+
+    return _in_request_locale(process), _in_request_locale(finished)
+
+
+def start_book_job(user_dict, user_id, action, book_ids=None, search=None):
+    """
+    创建并启动批量任务，供 API 和 MCP 共用。
+    user_dict 需要 username、kindle_email、send_format_priority、force_epub_conversion、language。
+    返回 (结果字典, None, 状态码) 或 (None, 错误信息, 状态码)。
+    """
+    if action not in ACTIONS:
+        return None, _('Invalid action.'), 400
+    # 转换任务按用户限制并发
+    user_dict = dict(user_dict, id=user_id)
+    if action == 'send_to_kindle' and not user_dict.get('kindle_email'):
+        return None, _('Please configure your Kindle email in user settings first.'), 400
+
+    try:
+        if search:
+            book_ids = search_book_ids(search, limit=BOOK_JOB_MAX_BOOKS + 1)
+        elif isinstance(book_ids, str):
+            # MCP 工具以逗号分隔的字符串传入
+            book_ids = [book_id for book_id in book_ids.split(',') if book_id.strip()]
+        book_ids = list(dict.fromkeys(int(book_id) for book_id in (book_ids or [])))
+    except (TypeError, ValueError):
+        return None, _('Invalid book ID list.'), 400
+    except requests.exceptions.RequestException as e:
+        return None, _('Error searching Calibre: %(error)s', error=e), 502
+
+    if not book_ids:
+        return None, _('No books selected.'), 400
+    if len(book_ids) > BOOK_JOB_MAX_BOOKS:
+        return None, _('A job can contain at most %(count)s books.', count=BOOK_JOB_MAX_BOOKS), 400
+
+    try:
+        # 只取标题，同时确认书籍存在
+        metadata = fetch_books(book_ids, fields='title')
+    except requests.exceptions.RequestException as e:
+        return None, _('Error getting book details from Calibre: %(error)s', error=e), 502
+    titles = {book_id: data.get('title') for book_id, data in metadata.items() if data}
+    missing = [book_id for book_id in book_ids if book_id not in titles]
+    books = [(book_id, titles[book_id]) for book_id in book_ids if book_id in titles]
+    if not books:
+        return None, _('Book details not found.'), 404
+
+    job_id, items = create_book_job(user_id, action, books)
+    if action == 'send_to_kindle':
+        process, finished = _kindle_job(user_dict, user_id, titles)
+    else:
+        process, finished = _anx_job(job_id, user_dict, user_id, titles)
+    submit_books(job_id, items, process, on_finished=finished)
+
+    return {
+        'job_id': job_id,
+        'action': action,
+        'items': [{'id': item_id, 'book_id': book_id, 'title': title} for item_id, book_id, title in items],
+        'missing': missing,
+    }, None, 202
+
+
+@book_jobs_bp.route('/book_jobs', methods=['POST'])
+@login_required_api
+def create_book_job_api():
+    """
+    批量推送到 Anx 或发送到 Kindle。
+    JSON：action ('push_to_anx' / 'send_to_kindle')，以及 book_ids (ID 列表) 或 search (Calibre 搜索表达式) 之一。
+    书籍登记后立即返回，进度通过 GET /api/book_jobs/<job_id> 查询。
+    """
+    data = request.get_json(silent=True) or {}
+    user_dict = {
+        'username': g.user.username,
+        'kindle_email': g.user.kindle_email,
+        'send_format_priority': g.user.send_format_priority,
+        'force_epub_conversion': g.user.force_epub_conversion,
+        'language': g.user.language
+    }
+    result, error, status = start_book_job(
+        user_dict, g.user.id, data.get('action'),
+        book_ids=data.get('book_ids'), search=(data.get('search') or '').strip() or None
+    )
+    if error:
+        return jsonify({'error': error}), status
+    return jsonify(result), status
+
+
+@book_jobs_bp.route('/book_jobs/<job_id>', methods=['GET'])
+@login_required_api
+def get_book_job_api(job_id):
+    job = get_book_job_row(job_id)
+    if not job or job['user_id'] != g.user.id:
+        return jsonify({'error': _('Task not found')}), 404
+    return jsonify(get_book_job(job_id))
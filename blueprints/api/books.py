@@ -1,30 +1,35 @@
 import json
-import io
 import os
+import re
 import logging
 import shutil
-import subprocess
 import tempfile
+import threading
 import mimetypes
 import uuid
 import requests
-from flask import Blueprint, request, jsonify, g, send_file, send_from_directory
+from urllib.parse import quote
+from flask import Blueprint, Response, request, jsonify, g, send_file, send_from_directory, stream_with_context
 from flask_babel import gettext as _
-from contextlib import closing
-import sqlite3
+from contextlib import closing, contextmanager
 import config_manager
 from anx_library import (
     get_anx_user_dirs,
+    get_anx_db,
     process_anx_import_folder,
     update_anx_book_metadata,
     delete_anx_book,
-    get_anx_book_details
+    get_anx_book_details,
+    get_anx_books_by_ids
 )
-from .calibre import download_calibre_book, get_calibre_book_details
+from .calibre import open_calibre_book_stream, save_calibre_book, get_calibre_book_details, add_book_to_calibre
 from .email_service import send_email_with_config
-from epub_fixer import fix_epub_for_kindle
-from utils.auth import get_calibre_auth
+from epub_fixer import fix_epub_for_kindle, FIXER_VERSION
+from utils.calibre_client import STREAM_CHUNK_SIZE
 from utils.covers import get_calibre_cover_data
+from utils.conversion_jobs import ConversionFailed, ConversionQueueFull, run_converter, submit_conversion, sync_wait_timeout, wait_for_conversion_job
+from utils.epub_cache import calibre_artifact_key, file_artifact_key, get_artifact, has_artifact, store_artifact
+from utils.single_flight import single_flight
 from utils.text import random_english_text, safe_title, safe_author
 from utils.activity_logger import log_activity, ActivityType
 
@@ -39,8 +44,7 @@ def download_anx_book_api(book_id):
         return jsonify({'error': error_msg}), 404
         
     try:
-        with closing(sqlite3.connect(dirs["db_path"])) as db:
-            db.row_factory = sqlite3.Row
+        with closing(get_anx_db(g.user.username)) as db:
             cursor = db.cursor()
             cursor.execute("SELECT file_path, title FROM tb_books WHERE id = ?", (book_id,))
             book_row = cursor.fetchone()
@@ -60,98 +64,253 @@ def download_anx_book_api(book_id):
         log_activity(ActivityType.DOWNLOAD_BOOK, book_id=book_id, library_type='anx', success=False, failure_reason=error_msg)
         return jsonify({'error': error_msg}), 500
 
-def _get_processed_epub_for_book(book_id, user_dict, filename_format='title - author', language='zh'):
+def _processed_epub_filename(details, filename_format='title - author'):
+    # Sanitize title and authors for use in filename
+    title = safe_title(details.get('title', 'Untitled'))
+    if filename_format == 'title':
+        return f"{title}.epub"
+    # Default to 'title - author'
+    authors = safe_author(" & ".join(details.get('authors', [])))
+    if authors:
+        return f"{title} - {authors}.epub"
+    return f"{title}.epub"
+
+def _calibre_epub_plan(book_id, user_dict, language):
     """
-    Core logic to get a processed EPUB for a book.
-    It handles downloading, converting (if necessary), and fixing the EPUB.
-    Returns a tuple: (content, filename, needs_conversion_flag) or (None, None, None) on error.
+    决定如何得到处理过的 EPUB：返回 (details, needs_conversion, source_format, cache_key)。
+    拿不到书籍详情时 details 为 None。
     """
     details = get_calibre_book_details(book_id)
     if not details:
-        logging.error(f"Could not get details for book_id {book_id}")
-        return None, None, False
+        return None, False, None, None
 
     available_formats = [f.lower() for f in details.get('formats', [])]
-    needs_conversion = False
-    
-    with tempfile.TemporaryDirectory() as temp_dir:
-        epub_to_process_path = None
-        
-        # Check if EPUB already exists
-        if 'epub' in available_formats:
-            logging.info(f"Book ID {book_id} has EPUB format. Downloading directly.")
-            content, filename = download_calibre_book(book_id, 'epub')
-            if not content:
-                logging.error(f"Failed to download existing EPUB for book_id {book_id}")
-                return None, None, False
-            
-            epub_to_process_path = os.path.join(temp_dir, filename)
-            with open(epub_to_process_path, 'wb') as f:
-                f.write(content)
-        else:
-            # If no EPUB, convert from another format
-            needs_conversion = True
-            if not shutil.which('ebook-converter'):
-                logging.error("ebook-converter not found, but conversion is needed.")
-                return None, "CONVERTER_NOT_FOUND", False
-
-            priority_str = user_dict.get('send_format_priority') or '[]'
-            priority = json.loads(priority_str)
-            format_to_convert = next((f for f in priority if f.lower() in available_formats), available_formats[0] if available_formats else None)
-
-            if not format_to_convert:
-                logging.error(f"No suitable format found to convert from for book_id {book_id}")
-                return None, None, False
+    needs_conversion = 'epub' not in available_formats
+    if needs_conversion:
+        priority_str = user_dict.get('send_format_priority') or '[]'
+        priority = json.loads(priority_str)
+        source_format = next((f.lower() for f in priority if f.lower() in available_formats), available_formats[0] if available_formats else None)
+    else:
+        source_format = 'epub'
 
-            logging.info(f"Book ID {book_id} needs conversion. Converting from {format_to_convert}.")
-            original_content, original_filename = download_calibre_book(book_id, format_to_convert)
-            if not original_content:
-                logging.error(f"Failed to download source format {format_to_convert} for book_id {book_id}")
-                return None, None, False
+    cache_key = calibre_artifact_key(book_id, details, source_format, language, FIXER_VERSION) if source_format else None
+    return details, needs_conversion, source_format, cache_key
 
-            source_path = os.path.join(temp_dir, original_filename)
-            with open(source_path, 'wb') as f:
-                f.write(original_content)
+def _build_processed_epub(book_id, source_format, language, temp_dir, job=None):
+    """
+    下载源格式，必要时用 ebook-converter 转换，再经过 Kindle 修复，返回 temp_dir 中的 EPUB 路径。
+    job 为转换任务句柄时报告步骤并在任务的槽位中转换；失败时抛出异常。
+    """
+    if job:
+        job.stage('downloading')
+    source_path, original_filename = save_calibre_book(book_id, source_format, temp_dir)
+    if not source_path:
+        raise RuntimeError(f"Failed to download {source_format} for book_id {book_id}")
+
+    epub_to_process_path = source_path
+    if source_format != 'epub':
+        base_name, _unused = os.path.splitext(original_filename)
+        dest_path = os.path.join(temp_dir, f"{base_name}.epub")
+        logging.info(f"Running ebook-converter: {source_path} -> {dest_path}")
+        if job:
+            job.convert(source_path, dest_path)
+        else:
+            run_converter(source_path, dest_path)
+        epub_to_process_path = dest_path
+
+    if not os.path.exists(epub_to_process_path):
+        raise RuntimeError(f"Could not find EPUB to process for book_id {book_id}")
+
+    # --- Fix the EPUB ---
+    if job:
+        job.stage('fixing')
+    logging.info(f"Processing EPUB with kindle-epub-fixer: {epub_to_process_path}")
+    fixed_epub_path = fix_epub_for_kindle(epub_to_process_path, force_language=language)
+    if fixed_epub_path != epub_to_process_path:
+        # 修复后的文件在系统临时目录中，移入本次的临时目录，结束时一起删除
+        moved_path = os.path.join(temp_dir, 'fixed.epub')
+        shutil.move(fixed_epub_path, moved_path)
+        fixed_epub_path = moved_path
+    return fixed_epub_path
+
+def _build_and_cache_processed_epub(book_id, source_format, language, cache_key, job=None):
+    """
+    在 single-flight 锁中生成处理过的 EPUB 并写入缓存，返回缓存中的路径（缓存不可用时为 None）。
+    同一缓存键已有别的请求或 worker 在处理时等它完成，直接使用它的结果。
+    """
+    check_cancelled = job.check_cancelled if job else None
+    on_wait = (lambda: job.stage('waiting')) if job else None
+    with single_flight(f"processed-epub|{cache_key}", check_cancelled=check_cancelled, on_wait=on_wait) as waited:
+        cached_path = get_artifact(cache_key) if waited else None
+        if cached_path:
+            logging.info(f"Processed EPUB for book_id {book_id} was produced by a concurrent request.")
+            return cached_path
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fixed_epub_path = _build_processed_epub(book_id, source_format, language, temp_dir, job=job)
+            if job:
+                job.stage('caching')
+            return store_artifact(cache_key, fixed_epub_path, move=True)
+
+def _submit_calibre_conversion(book_id, user_dict, details, source_format, language, cache_key):
+    """登记转换任务：在后台转换、修复并写入缓存，返回任务字典"""
+    def work(job):
+        if not _build_and_cache_processed_epub(book_id, source_format, language, cache_key, job=job):
+            raise RuntimeError("Failed to store the converted EPUB in the cache.")
+
+    logging.info(f"Book ID {book_id} needs conversion. Converting from {source_format} in the background.")
+    return submit_conversion(user_dict.get('id'), cache_key, work, book_type='calibre', book_id=book_id, title=details.get('title'))
+
+def _start_processed_epub_job(book_id, user_dict, language):
+    """
+    需要转换且没有缓存时启动（或复用）转换任务并返回任务字典；否则返回 None，调用方照常同步处理
+    （缓存命中、源文件本来就是 EPUB，或者由同步流程给出错误信息）。
+    """
+    details, needs_conversion, source_format, cache_key = _calibre_epub_plan(book_id, user_dict, language)
+    if not details or not needs_conversion or not source_format or not cache_key:
+        return None
+    if not shutil.which('ebook-converter') or has_artifact(cache_key):
+        return None
+    return _submit_calibre_conversion(book_id, user_dict, details, source_format, language, cache_key)
+
+def _conversion_job_response(book_id, user_dict, language):
+    """Web 接口在处理前调用：需要等待转换时返回 202（或 429）响应，可以立即处理时返回 None"""
+    try:
+        job = _start_processed_epub_job(book_id, user_dict, language)
+    except ConversionQueueFull:
+        return jsonify({'error': _('Too many conversions are waiting. Please try again later.')}), 429
+    if not job:
+        return None
+    status_url = f"/api/conversion_jobs/{job['job_id']}"
+    response = jsonify({
+        'message': _('The book is being converted to EPUB. Request it again when the conversion has finished.'),
+        'job_id': job['job_id'],
+        'job': job,
+        'status_url': status_url,
+        'events_url': f"{status_url}/events",
+    })
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+@contextmanager
+def _processed_epub(book_id, user_dict, language='zh'):
+    """
+    得到处理过（必要时转换，并经过 Kindle 修复）的 EPUB 文件，优先使用 utils.epub_cache 中的缓存。
+    需要转换时通过 utils.conversion_jobs 登记任务并等待它完成（请求中最多等待 sync_wait_timeout() 秒）。
+    产出 (路径, 错误, needs_conversion, details)：错误为 None、'CONVERTER_NOT_FOUND'、'CONVERSION_PENDING'
+    （等待超时，任务仍在后台运行）或 'FAILED'。
+    路径只在 with 块内有效且只读，需要保留或修改时请复制。
+    """
+    details, needs_conversion, source_format, cache_key = _calibre_epub_plan(book_id, user_dict, language)
+    if not details:
+        logging.error(f"Could not get details for book_id {book_id}")
+        yield None, 'FAILED', False, None
+        return
+
+    cached_path = get_artifact(cache_key)
+    if cached_path:
+        logging.info(f"Using cached processed EPUB for book_id {book_id}.")
+        yield cached_path, None, needs_conversion, details
+        return
+
+    if needs_conversion:
+        if not shutil.which('ebook-converter'):
+            logging.error("ebook-converter not found, but conversion is needed.")
+            yield None, 'CONVERTER_NOT_FOUND', False, details
+            return
+        if not source_format:
+            logging.error(f"No suitable format found to convert from for book_id {book_id}")
+            yield None, 'FAILED', False, details
+            return
+        if cache_key:
+            try:
+                job = _submit_calibre_conversion(book_id, user_dict, details, source_format, language, cache_key)
+            except ConversionQueueFull:
+                logging.error(f"Too many conversions queued, cannot convert book_id {book_id}")
+                yield None, 'FAILED', False, details
+                return
+            job = wait_for_conversion_job(job['job_id'], timeout=sync_wait_timeout())
+            if job and not job['finished']:
+                logging.info(f"Conversion job {job['job_id']} for book_id {book_id} is still running.")
+                yield None, 'CONVERSION_PENDING', False, details
+                return
+            cached_path = get_artifact(cache_key) if job and job['status'] == 'success' else None
+            if not cached_path:
+                logging.error(f"Conversion job for book_id {book_id} did not succeed: {job and job.get('message')}")
+                yield None, 'FAILED', False, details
+                return
+            yield cached_path, None, needs_conversion, details
+            return
+
+    # 不需要转换时在当前线程中处理
+    if cache_key:
+        try:
+            cached_path = _build_and_cache_processed_epub(book_id, source_format, language, cache_key)
+        except Exception as e:
+            logging.error(f"Failed to process EPUB for book_id {book_id}: {e}")
+            yield None, 'FAILED', False, details
+            return
+        if cached_path:
+            yield cached_path, None, needs_conversion, details
+            return
+
+    # 无法缓存（没有大小和 mtime，或者缓存不可用）时只在本次请求的临时目录中处理
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            fixed_epub_path = _build_processed_epub(book_id, source_format, language, temp_dir)
+        except Exception as e:
+            logging.error(f"Failed to process EPUB for book_id {book_id}: {e}")
+            yield None, 'FAILED', False, details
+            return
 
-            base_name, _unused = os.path.splitext(original_filename)
-            epub_filename = f"{base_name}.epub"
-            dest_path = os.path.join(temp_dir, epub_filename)
+        cached_path = store_artifact(cache_key, fixed_epub_path, move=True)
+        yield cached_path or fixed_epub_path, None, needs_conversion, details
 
-            try:
-                logging.info(f"Running ebook-converter: {source_path} -> {dest_path}")
-                subprocess.run(
-                    ['ebook-converter', source_path, dest_path],
-                    capture_output=True, text=True, check=True, timeout=3600
-                )
-                epub_to_process_path = dest_path
-            except Exception as e:
-                logging.error(f"An unexpected error occurred during conversion for book_id {book_id}: {e}")
-                return None, None, False
-
-        if not epub_to_process_path or not os.path.exists(epub_to_process_path):
-            logging.error(f"Could not find EPUB to process for book_id {book_id}")
+def _get_processed_epub_for_book(book_id, user_dict, filename_format='title - author', language='zh'):
+    """
+    Core logic to get a processed EPUB for a book.
+    It handles downloading, converting (if necessary), and fixing the EPUB; results are cached on disk.
+    Returns a tuple: (content, filename, needs_conversion_flag) or (None, None, None) on error.
+    """
+    with _processed_epub(book_id, user_dict, language=language) as (path, error, needs_conversion, details):
+        if error in ('CONVERTER_NOT_FOUND', 'CONVERSION_PENDING'):
+            return None, error, False
+        if error:
             return None, None, False
-
-        # --- Fix the EPUB ---
-        logging.info(f"Processing EPUB with kindle-epub-fixer: {epub_to_process_path}")
-        fixed_epub_path = fix_epub_for_kindle(epub_to_process_path, force_language=language)
-        
-        with open(fixed_epub_path, 'rb') as f:
+        with open(path, 'rb') as f:
             content_to_send = f.read()
+        return content_to_send, _processed_epub_filename(details, filename_format), needs_conversion
 
-        # Sanitize title and authors for use in filename
-        title = safe_title(details.get('title', 'Untitled'))
-        
-        if filename_format == 'title':
-            filename_to_send = f"{title}.epub"
-        else: # Default to 'title - author'
-            authors = safe_author(" & ".join(details.get('authors', [])))
-            if authors:
-                filename_to_send = f"{title} - {authors}.epub"
-            else:
-                filename_to_send = f"{title}.epub"
-
-        return content_to_send, filename_to_send, needs_conversion
+def _content_disposition(filename):
+    try:
+        filename.encode('ascii')
+        return f'attachment; filename="{filename}"'
+    except UnicodeEncodeError:
+        base, ext = os.path.splitext(filename)
+        fallback = base.encode('ascii', 'ignore').decode('ascii').strip(' -_') or 'book'
+        fallback = f"{fallback}{ext}".replace('"', '')
+        return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename)}"
+
+def _proxy_calibre_download(upstream, filename):
+    """
+    把 Calibre 的下载响应分块转发给浏览器，内存中最多只有一个 STREAM_CHUNK_SIZE 大小的块。
+    透传状态码 (200/206)、Content-Length、Content-Range 和 Accept-Ranges。
+    """
+    def generate():
+        with closing(upstream):
+            for chunk in upstream.iter_content(STREAM_CHUNK_SIZE):
+                yield chunk
+
+    mimetype = mimetypes.guess_type(filename)[0] or upstream.headers.get('Content-Type') or 'application/octet-stream'
+    response = Response(stream_with_context(generate()), status=upstream.status_code, mimetype=mimetype, direct_passthrough=True)
+    for header in ('Content-Length', 'Content-Range', 'Accept-Ranges', 'Last-Modified', 'ETag'):
+        if upstream.headers.get(header):
+            response.headers[header] = upstream.headers[header]
+    if upstream.headers.get('Content-Encoding'):
+        # iter_content 会解压，长度与原始响应不一致
+        response.headers.pop('Content-Length', None)
+    response.headers['Content-Disposition'] = _content_disposition(filename)
+    return response
 
 @books_bp.route('/download_book/<int:book_id>', methods=['GET'])
 def download_book_api(book_id):
@@ -161,6 +320,7 @@ def download_book_api(book_id):
     if g.user.force_epub_conversion:
         logging.info(f"Force EPUB conversion is ON for user {g.user.username} for book {book_id}")
         user_dict = {
+            'id': g.user.id,
             'username': g.user.username,
             'kindle_email': g.user.kindle_email,
             'send_format_priority': g.user.send_format_priority,
@@ -169,19 +329,27 @@ def download_book_api(book_id):
         }
         
         language = (user_dict.get('language') or 'zh').split('_')[0]
-        content, filename, needs_conversion = _get_processed_epub_for_book(book_id, user_dict, language=language)
-        
-        if filename == 'CONVERTER_NOT_FOUND':
-            error_msg = _('This book needs to be converted to EPUB, but the `ebook-converter` tool is missing in the current environment.')
-            log_activity(ActivityType.DOWNLOAD_BOOK, book_id=book_id, book_title=book_title, library_type='calibre', success=False, failure_reason=error_msg)
-            return jsonify({'error': error_msg}), 412
-        if content and filename:
-            log_activity(ActivityType.DOWNLOAD_BOOK, book_id=book_id, book_title=book_title, library_type='calibre', success=True)
-            return send_file(io.BytesIO(content), as_attachment=True, download_name=filename)
-        else:
-            error_msg = _('Unable to process or convert the book.')
-            log_activity(ActivityType.DOWNLOAD_BOOK, book_id=book_id, book_title=book_title, library_type='calibre', success=False, failure_reason=error_msg)
-            return jsonify({'error': error_msg}), 500
+        # 需要转换且没有缓存时返回 202 和转换任务，转换完成后重新请求直接从缓存发送
+        pending = _conversion_job_response(book_id, user_dict, language)
+        if pending:
+            return pending
+        with _processed_epub(book_id, user_dict, language=language) as (path, error, _unused, processed_details):
+            if error == 'CONVERTER_NOT_FOUND':
+                error_msg = _('This book needs to be converted to EPUB, but the `ebook-converter` tool is missing in the current environment.')
+                log_activity(ActivityType.DOWNLOAD_BOOK, book_id=book_id, book_title=book_title, library_type='calibre', success=False, failure_reason=error_msg)
+                return jsonify({'error': error_msg}), 412
+            if error == 'CONVERSION_PENDING':
+                # 预检之后才开始转换（例如缓存刚被淘汰），同样返回 202
+                pending = _conversion_job_response(book_id, user_dict, language)
+                if pending:
+                    return pending
+            if not error:
+                log_activity(ActivityType.DOWNLOAD_BOOK, book_id=book_id, book_title=book_title, library_type='calibre', success=True)
+                # send_file 立即打开文件，之后临时文件被删除也不影响发送
+                return send_file(path, mimetype='application/epub+zip', as_attachment=True, download_name=_processed_epub_filename(processed_details))
+        error_msg = _('Unable to process or convert the book.')
+        log_activity(ActivityType.DOWNLOAD_BOOK, book_id=book_id, book_title=book_title, library_type='calibre', success=False, failure_reason=error_msg)
+        return jsonify({'error': error_msg}), 500
     else:
         # Original logic
         if not details:
@@ -202,17 +370,31 @@ def download_book_api(book_id):
                 log_activity(ActivityType.DOWNLOAD_BOOK, book_id=book_id, book_title=book_title, library_type='calibre', success=False, failure_reason=error_msg)
                 return jsonify({'error': error_msg}), 400
 
-        content, filename = download_calibre_book(book_id, format_to_download)
-        if content:
-            log_activity(ActivityType.DOWNLOAD_BOOK, book_id=book_id, book_title=book_title, library_type='calibre', success=True)
-            return send_file(io.BytesIO(content), as_attachment=True, download_name=filename)
+        range_header = request.headers.get('Range')
+        upstream, filename = open_calibre_book_stream(book_id, format_to_download, range_header=range_header)
+        if upstream and upstream.status_code == 416:
+            # Range 超出文件大小：透传 416 和 Content-Range（bytes */文件大小），客户端据此重新开始
+            content_range = upstream.headers.get('Content-Range')
+            upstream.close()
+            response = Response(status=416)
+            if content_range:
+                response.headers['Content-Range'] = content_range
+            return response
+        if upstream:
+            # 续传请求只在从头开始时记录一次下载
+            if not range_header or re.match(r'bytes=0-', range_header):
+                log_activity(ActivityType.DOWNLOAD_BOOK, book_id=book_id, book_title=book_title, library_type='calibre', success=True)
+            return _proxy_calibre_download(upstream, filename)
         
         error_msg = _('Unable to download the book.')
         log_activity(ActivityType.DOWNLOAD_BOOK, book_id=book_id, book_title=book_title, library_type='calibre', success=False, failure_reason=error_msg)
         return jsonify({'error': error_msg}), 404
 
-def _send_to_kindle_logic(user_dict, book_id):
-    """Core logic to send a Calibre book to a user's Kindle. Expects user as a dict."""
+def _send_to_kindle_logic(user_dict, book_id, smtp_session=None):
+    """
+    Core logic to send a Calibre book to a user's Kindle. Expects user as a dict.
+    批量发送时传入共用的 SMTPSession。
+    """
     if not user_dict.get('kindle_email'):
         return {'success': False, 'error': _('Please configure your Kindle email in user settings first.')}
 
@@ -222,7 +404,9 @@ def _send_to_kindle_logic(user_dict, book_id):
 
     if filename_to_send == 'CONVERTER_NOT_FOUND':
         return {'success': False, 'error': _('This book needs to be converted to EPUB, but the `ebook-converter` tool is missing. Please install it in the system PATH.'), 'code': 'CONVERTER_NOT_FOUND'}
-    
+    if filename_to_send == 'CONVERSION_PENDING':
+        return {'success': False, 'error': _('The book is still being converted to EPUB. Please try again later.'), 'code': 'CONVERSION_PENDING'}
+
     if not content_to_send:
         return {'success': False, 'error': _('Unable to get or process the EPUB file for the book.')}
 
@@ -235,7 +419,8 @@ def _send_to_kindle_logic(user_dict, book_id):
         body, 
         config_manager.config, # Use the global config
         content_to_send, 
-        filename_to_send
+        filename_to_send,
+        smtp_session=smtp_session
     )
 
     if success:
@@ -249,13 +434,22 @@ def send_to_kindle_api(book_id):
     book_title = details.get('title') if details else None
     
     user_dict = {
+        'id': g.user.id,
         'username': g.user.username,
         'kindle_email': g.user.kindle_email,
         'send_format_priority': g.user.send_format_priority,
         'force_epub_conversion': g.user.force_epub_conversion,
         'language': g.user.language
     }
+    if user_dict['kindle_email']:
+        pending = _conversion_job_response(book_id, user_dict, (user_dict.get('language') or 'zh').split('_')[0])
+        if pending:
+            return pending
     result = _send_to_kindle_logic(user_dict, book_id)
+    if result.get('code') == 'CONVERSION_PENDING':
+        pending = _conversion_job_response(book_id, user_dict, (user_dict.get('language') or 'zh').split('_')[0])
+        if pending:
+            return pending
     if result['success']:
         log_activity(ActivityType.PUSH_TO_KINDLE, book_id=book_id, book_title=book_title, library_type='calibre', success=True)
         return jsonify({'message': result['message'], 'needs_conversion': result.get('needs_conversion', False)})
@@ -268,17 +462,26 @@ def send_to_kindle_api(book_id):
             return jsonify({'error': result['error']}), 400
         return jsonify({'error': result['error']}), 500
 
-def _push_calibre_to_anx_logic(user_dict, book_id):
-    """Core logic to push a Calibre book to a user's Anx library. Expects user as a dict."""
-    book_content, book_filename = None, None
+def _prepare_calibre_book_for_anx(user_dict, book_id, dest_dir):
+    """
+    把 Calibre 书籍（开启强制 EPUB 时为处理过的 EPUB，否则按格式优先级选择）和同名封面写入 dest_dir。
+    返回 {'success': True, 'path', 'filename'} 或 {'success': False, 'error'}。
+    """
+    book_file_path, book_filename = None, None
 
     if user_dict.get('force_epub_conversion'):
         logging.info(f"Force EPUB conversion is ON for user {user_dict['username']} for book {book_id} push to Anx.")
         language = (user_dict.get('language') or 'zh').split('_')[0]
-        content, filename, _unused = _get_processed_epub_for_book(book_id, user_dict, language=language)
-        if filename == 'CONVERTER_NOT_FOUND':
-            return {'success': False, 'error': _('This book needs to be converted to EPUB, but the `ebook-converter` tool is missing.')}
-        book_content, book_filename = content, filename
+        with _processed_epub(book_id, user_dict, language=language) as (path, error, _unused, details):
+            if error == 'CONVERTER_NOT_FOUND':
+                return {'success': False, 'error': _('This book needs to be converted to EPUB, but the `ebook-converter` tool is missing.')}
+            if error == 'CONVERSION_PENDING':
+                return {'success': False, 'error': _('The book is still being converted to EPUB. Please try again later.'), 'code': 'CONVERSION_PENDING'}
+            if not error:
+                # 缓存中的文件只读，复制一份交给导入流程
+                book_filename = _processed_epub_filename(details)
+                book_file_path = os.path.join(dest_dir, book_filename)
+                shutil.copyfile(path, book_file_path)
     else:
         # Original logic
         details = get_calibre_book_details(book_id)
@@ -292,13 +495,25 @@ def _push_calibre_to_anx_logic(user_dict, book_id):
         if not format_to_push:
             return {'success': False, 'error': _('No pushable format found.')}
         
-        book_content, book_filename = download_calibre_book(book_id, format_to_push)
+        # 直接分块写入目标目录
+        book_file_path, book_filename = save_calibre_book(book_id, format_to_push, dest_dir)
 
-    if not book_content:
+    if not book_file_path:
         return {'success': False, 'error': _('Error downloading or processing the book.')}
 
     cover_content = get_calibre_cover_data(book_id)
 
+    if cover_content:
+        base_name, _unused = os.path.splitext(book_filename)
+        cover_filename = f"{base_name}.jpg"
+        cover_file_path = os.path.join(dest_dir, cover_filename)
+        with open(cover_file_path, 'wb') as f:
+            f.write(cover_content)
+
+    return {'success': True, 'path': book_file_path, 'filename': book_filename}
+
+def _push_calibre_to_anx_logic(user_dict, book_id):
+    """Core logic to push a Calibre book to a user's Anx library. Expects user as a dict."""
     dirs = get_anx_user_dirs(user_dict['username'])
     if not dirs:
         return {'success': False, 'error': _('User directory not configured.')}
@@ -306,40 +521,85 @@ def _push_calibre_to_anx_logic(user_dict, book_id):
     import_dir = dirs["import"]
     os.makedirs(import_dir, exist_ok=True)
 
-    book_file_path = os.path.join(import_dir, book_filename)
-    with open(book_file_path, 'wb') as f:
-        f.write(book_content)
+    prepared = _prepare_calibre_book_for_anx(user_dict, book_id, import_dir)
+    if not prepared['success']:
+        return prepared
 
-    if cover_content:
-        base_name, _unused = os.path.splitext(book_filename)
-        cover_filename = f"{base_name}.jpg"
-        cover_file_path = os.path.join(import_dir, cover_filename)
-        with open(cover_file_path, 'wb') as f:
-            f.write(cover_content)
-
-    result = process_anx_import_folder(user_dict['username'])
+    with _anx_import_lock(user_dict['username']):
+        result = process_anx_import_folder(user_dict['username'])
     
     return {
         'success': True,
         'message': _("Book '%(filename)s' pushed. Processed: %(processed)s, Skipped: %(skipped)s.",
-                     filename=book_filename,
+                     filename=prepared['filename'],
                      processed=result.get('processed', 0),
                      skipped=result.get('skipped', 0))
     }
 
+def _import_prepared_books_to_anx(username, prepared):
+    """
+    批量推送的收尾：把各自目录中准备好的书（prepared 为 [(key, 路径, filename)]）移入导入目录，
+    然后只处理一次导入目录。返回 {key: {'success', 'duplicate', 'message'/'error'}}。
+    """
+    dirs = get_anx_user_dirs(username)
+    if not dirs:
+        return {key: {'success': False, 'error': _('User directory not configured.')} for key, _path, _filename in prepared}
+    os.makedirs(dirs["import"], exist_ok=True)
+
+    results = {}
+    moved = []
+    with _anx_import_lock(username):
+        for key, path, filename in prepared:
+            dest_path = os.path.join(dirs["import"], filename)
+            if os.path.exists(dest_path):
+                results[key] = {'success': False, 'error': _('A file named %(filename)s is already waiting to be imported.', filename=filename)}
+                continue
+            base_name, _unused = os.path.splitext(filename)
+            cover_path = os.path.join(os.path.dirname(path), f"{base_name}.jpg")
+            shutil.move(path, dest_path)
+            if os.path.exists(cover_path):
+                shutil.move(cover_path, os.path.join(dirs["import"], f"{base_name}.jpg"))
+            # 导入时文件在同一文件系统内移动，inode 不变，据此判断每本书最后去了书库还是 alreadyin
+            moved.append((key, filename, os.stat(dest_path).st_ino))
+        process_anx_import_folder(username)
+
+    def same_file(path, inode):
+        try:
+            return os.stat(path).st_ino == inode
+        except OSError:
+            return False
+
+    for key, filename, inode in moved:
+        if same_file(os.path.join(dirs["already_in"], filename), inode):
+            results[key] = {'success': True, 'duplicate': True, 'message': _('Book already exists in the library.')}
+        elif same_file(os.path.join(dirs["file"], filename), inode):
+            results[key] = {'success': True, 'message': _("Book '%(filename)s' pushed.", filename=filename)}
+        else:
+            results[key] = {'success': False, 'error': _('Error downloading or processing the book.')}
+    return results
+
 @books_bp.route('/push_to_anx/<int:book_id>', methods=['POST'])
 def push_to_anx_api(book_id):
     details = get_calibre_book_details(book_id)
     book_title = details.get('title') if details else None
     
     user_dict = {
+        'id': g.user.id,
         'username': g.user.username,
         'kindle_email': g.user.kindle_email,
         'send_format_priority': g.user.send_format_priority,
         'force_epub_conversion': g.user.force_epub_conversion,
         'language': g.user.language
     }
+    if user_dict['force_epub_conversion']:
+        pending = _conversion_job_response(book_id, user_dict, (user_dict.get('language') or 'zh').split('_')[0])
+        if pending:
+            return pending
     result = _push_calibre_to_anx_logic(user_dict, book_id)
+    if result.get('code') == 'CONVERSION_PENDING':
+        pending = _conversion_job_response(book_id, user_dict, (user_dict.get('language') or 'zh').split('_')[0])
+        if pending:
+            return pending
     if result['success']:
         log_activity(ActivityType.PUSH_TO_ANX, book_id=book_id, book_title=book_title, library_type='calibre', success=True)
         return jsonify({'message': result['message']})
@@ -366,8 +626,36 @@ def edit_anx_metadata_api():
         log_activity(ActivityType.EDIT_METADATA, book_id=book_id, book_title=book_title, library_type='anx', success=False, failure_reason=message, detail=json.dumps(data))
         return jsonify({'error': message}), 500
 
-def _get_processed_epub_for_anx_book(id: int, username: str):
-    book_details = get_anx_book_details(username, id, as_dict=True)
+def _build_anx_processed_epub(full_file_path, needs_conversion, temp_dir, job=None):
+    """按需转换并经过 Kindle 修复，返回 temp_dir 中的 EPUB 路径；job 为转换任务句柄时在任务的槽位中转换"""
+    base_name, _unused = os.path.splitext(os.path.basename(full_file_path))
+    epub_path = os.path.join(temp_dir, f"{base_name}.epub")
+    if needs_conversion:
+        if job:
+            job.convert(full_file_path, epub_path, timeout=300)
+        else:
+            run_converter(full_file_path, epub_path, timeout=300)
+    else:
+        shutil.copy2(full_file_path, epub_path)
+    if not os.path.exists(epub_path):
+        raise RuntimeError(f"Could not find EPUB to process for {full_file_path}")
+
+    if job:
+        job.stage('fixing')
+    fixed_epub_path = fix_epub_for_kindle(epub_path, force_language='zh')
+    if fixed_epub_path != epub_path:
+        moved_path = os.path.join(temp_dir, 'fixed.epub')
+        shutil.move(fixed_epub_path, moved_path)
+        fixed_epub_path = moved_path
+    return fixed_epub_path
+
+def _get_processed_epub_for_anx_book(id: int, username: str, user_id=None):
+    """
+    返回 Anx 书籍处理过（必要时转换，并经过 Kindle 修复）的 EPUB：(内容, 文件名, needs_conversion)，
+    失败时内容为 None，文件名位置为错误代码。结果缓存在 utils.epub_cache 中；需要转换时登记转换任务，
+    请求中最多等待 sync_wait_timeout() 秒，仍未完成时返回 'CONVERSION_PENDING'（任务继续在后台运行）。
+    """
+    book_details = get_anx_books_by_ids(username, [id], columns=('title', 'file_path')).get(id)
     if not book_details:
         return None, "BOOK_NOT_FOUND", False
 
@@ -375,7 +663,6 @@ def _get_processed_epub_for_anx_book(id: int, username: str):
     if not file_path:
         return None, "FILE_PATH_MISSING", False
 
-    from anx_library import get_anx_user_dirs
     dirs = get_anx_user_dirs(username)
     if not dirs:
         return None, "USER_DIR_NOT_FOUND", False
@@ -385,39 +672,51 @@ def _get_processed_epub_for_anx_book(id: int, username: str):
         return None, "FILE_NOT_FOUND", False
 
     needs_conversion = not full_file_path.lower().endswith('.epub')
-
+    if needs_conversion and not shutil.which('ebook-converter'):
+        return None, "CONVERTER_NOT_FOUND", False
+
+    base_name, _unused = os.path.splitext(os.path.basename(full_file_path))
+    final_filename = f"{base_name}.epub"
+    cache_key = file_artifact_key(full_file_path, 'zh', FIXER_VERSION)
+    cached_path = get_artifact(cache_key)
+
+    if not cached_path and needs_conversion and cache_key:
+        def work(job):
+            with tempfile.TemporaryDirectory() as temp_dir:
+                fixed_epub_path = _build_anx_processed_epub(full_file_path, True, temp_dir, job=job)
+                job.stage('caching')
+                if not store_artifact(cache_key, fixed_epub_path, move=True):
+                    raise RuntimeError("Failed to store the converted EPUB in the cache.")
+
+        try:
+            job = submit_conversion(user_id, cache_key, work, book_type='anx', book_id=id, title=book_details.get('title'))
+        except ConversionQueueFull:
+            return None, "CONVERSION_FAILED", False
+        job = wait_for_conversion_job(job['job_id'], timeout=sync_wait_timeout())
+        if job and not job['finished']:
+            return None, "CONVERSION_PENDING", False
+        cached_path = get_artifact(cache_key) if job and job['status'] == 'success' else None
+        if not cached_path:
+            logging.error(f"Conversion job for anx book {id} did not succeed: {job and job.get('message')}")
+            return None, "CONVERSION_FAILED", False
+
+    if cached_path:
+        with open(cached_path, 'rb') as f:
+            return f.read(), final_filename, needs_conversion
+
+    # 不需要转换（只做修复）或无法缓存时在当前线程中处理
     with tempfile.TemporaryDirectory() as temp_dir:
-        epub_to_process_path = None
-        
-        if not needs_conversion:
-            epub_to_process_path = os.path.join(temp_dir, os.path.basename(full_file_path))
-            shutil.copy2(full_file_path, epub_to_process_path)
-        else:
-            if not shutil.which('ebook-converter'):
-                return None, "CONVERTER_NOT_FOUND", False
-
-            base_name, _unused = os.path.splitext(os.path.basename(full_file_path))
-            epub_filename = f"{base_name}.epub"
-            dest_path = os.path.join(temp_dir, epub_filename)
-
-            try:
-                subprocess.run(
-                    ['ebook-converter', full_file_path, dest_path],
-                    capture_output=True, text=True, check=True, timeout=300
-                )
-                epub_to_process_path = dest_path
-            except Exception:
-                return None, "CONVERSION_FAILED", False
-
-        if not epub_to_process_path or not os.path.exists(epub_to_process_path):
+        try:
+            fixed_epub_path = _build_anx_processed_epub(full_file_path, needs_conversion, temp_dir)
+        except ConversionFailed:
+            return None, "CONVERSION_FAILED", False
+        except Exception as e:
+            logging.error(f"Failed to process anx book {id}: {e}")
             return None, "PROCESSING_FAILED", False
 
-        fixed_epub_path = fix_epub_for_kindle(epub_to_process_path, force_language='zh')
-        
         with open(fixed_epub_path, 'rb') as f:
             content_to_send = f.read()
-
-        final_filename = os.path.basename(fixed_epub_path)
+        store_artifact(cache_key, fixed_epub_path, move=True)
         return content_to_send, final_filename, needs_conversion
 
 @books_bp.route('/delete_anx_book/<int:book_id>', methods=['DELETE'])
@@ -439,11 +738,9 @@ def _push_anx_to_calibre_logic(user_dict, book_id):
     if not username:
         return {'success': False, 'error': 'Username not found in user_dict.'}
 
-    book_title, _unused = get_anx_book_details(username, book_id)
-    if not book_title:
+    book_details = get_anx_books_by_ids(username, [book_id], columns=('title', 'file_path')).get(book_id)
+    if not book_details or not book_details.get('title'):
         return {'success': False, 'error': _('Anx book with ID %(book_id)s not found.', book_id=book_id)}
-    
-    book_details = get_anx_book_details(username, book_id, as_dict=True)
 
     file_path = book_details.get('file_path')
     if not file_path:
@@ -457,47 +754,22 @@ def _push_anx_to_calibre_logic(user_dict, book_id):
     if not os.path.exists(full_file_path):
         return {'success': False, 'error': _('Book file not found at path: %(path)s', path=full_file_path)}
 
-    try:
-        with open(full_file_path, 'rb') as f:
-            file_content = f.read()
-    except IOError as e:
-        return {'success': False, 'error': _('Failed to read book file: %(error)s', error=str(e))}
-
     filename = os.path.basename(full_file_path)
     mimetype, _unused = mimetypes.guess_type(filename)
 
-    job_id = str(uuid.uuid4())
-    library_id = config_manager.config.get('CALIBRE_DEFAULT_LIBRARY_ID', 'Calibre_Library')
-    add_duplicates = config_manager.config.get('CALIBRE_ADD_DUPLICATES', False)
-    add_duplicates_flag = 'y' if add_duplicates else 'n'
-    encoded_filename = requests.utils.quote(filename)
-    url = f"{config_manager.config['CALIBRE_URL']}/cdb/add-book/{job_id}/{add_duplicates_flag}/{encoded_filename}/{library_id}"
-
     try:
-        headers = {'Content-Type': mimetype or 'application/octet-stream'}
-        response = requests.post(url, data=file_content, auth=get_calibre_auth(), headers=headers)
-        response.raise_for_status()
-        res_json = response.json()
+        # 以文件对象作为请求体，requests 按文件大小设置 Content-Length 并分块发送
+        with open(full_file_path, 'rb') as f:
+            res_json = add_book_to_calibre(f, filename, mimetype or 'application/octet-stream', username)
 
         if res_json.get("book_id"):
             uploaded_book_id = res_json["book_id"]
-            try:
-                uploaded_book_details = get_calibre_book_details(uploaded_book_id)
-                if (uploaded_book_details and "user_metadata" in uploaded_book_details and
-                        "#library" in uploaded_book_details["user_metadata"]):
-                    update_payload = {"changes": {"#library": username}}
-                    update_url = f"{config_manager.config['CALIBRE_URL']}/cdb/set-fields/{uploaded_book_id}/{library_id}"
-                    update_response = requests.post(update_url, json=update_payload, auth=get_calibre_auth())
-                    update_response.raise_for_status()
-                    logging.info(f"Successfully updated #library for book {uploaded_book_id}")
-            except Exception as e:
-                logging.error(f"Failed to update #library for book {uploaded_book_id}: {e}")
+            if res_json.get('library_update_failed'):
                 return {
                     'success': True,
                     'message': _("Book '%(title)s' uploaded successfully, ID: %(book_id)s (but failed to update source).",
                                  title=res_json.get('title'), book_id=uploaded_book_id)
                 }
-
             return {
                 'success': True,
                 'message': _("Book '%(title)s' uploaded successfully, ID: %(book_id)s.",
@@ -517,6 +789,8 @@ def _push_anx_to_calibre_logic(user_dict, book_id):
         return {'success': False, 'error': error_message, 'code': 500}
     except requests.exceptions.RequestException as e:
         return {'success': False, 'error': _("Error connecting to Calibre server: %(error)s", error=e), 'code': 500}
+    except IOError as e:
+        return {'success': False, 'error': _('Failed to read book file: %(error)s', error=str(e))}
 
 
 import hashlib
@@ -525,52 +799,55 @@ from utils.ebook_utils import process_uploaded_ebook
 from utils.text import safe_title, safe_author, sanitize_filename
 from anx_library import add_book_to_anx_db
 
-def _upload_to_anx_logic(user_dict, uploaded_files):
-    """Core logic to upload books to a user's Anx library."""
-    username = user_dict.get('username')
-    if not username:
-        return {'success': False, 'error': _('Username not found in user_dict.')}
+_anx_import_locks = {}
+_anx_import_locks_guard = threading.Lock()
 
-    if not uploaded_files:
-        return {'success': False, 'error': _('No files were uploaded.')}
+def _anx_import_lock(username):
+    """同一用户的导入在写 Anx 数据库和移动文件时串行，避免同一批次中的重复文件都被当作新书"""
+    with _anx_import_locks_guard:
+        return _anx_import_locks.setdefault(username, threading.Lock())
+
+def _file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
 
+def _import_file_to_anx(user_dict, temp_filepath, original_filename, on_stage=None):
+    """
+    把已保存到磁盘的文件导入 Anx 书库：按需转换为 EPUB、提取元数据和封面、计算 MD5 并写入数据库。
+    temp_filepath 由本函数接管（移动到书库或删除）。on_stage(stage) 用于报告当前步骤。
+    """
+    username = user_dict.get('username')
     dirs = get_anx_user_dirs(username)
     if not dirs:
+        os.unlink(temp_filepath)
         return {'success': False, 'error': _('User directory not configured.')}
 
-    # Since the frontend sends one file at a time, we process the first one.
-    file = uploaded_files[0]
-    if not file.filename:
-        return {'success': False, 'error': _('No files selected for uploading.')}
-
-    original_filename = os.path.basename(file.filename)
+    on_stage = on_stage or (lambda stage: None)
     _unused, ext = os.path.splitext(original_filename)
-    temp_filepath = None
 
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as temp_file:
-            file.save(temp_file.name)
-            temp_filepath = temp_file.name
-
         # Force EPUB conversion if the user setting is enabled
         if user_dict.get('force_epub_conversion') and ext.lower() != '.epub':
             if not shutil.which('ebook-converter'):
+                os.unlink(temp_filepath)
                 return {'success': False, 'error': _('`ebook-converter` tool is missing, cannot convert file.'), 'code': 412}
 
+            on_stage('converting')
             converted_epub_path = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}.epub")
             try:
-                result = subprocess.run(
-                    ['ebook-converter', temp_filepath, converted_epub_path],
-                    capture_output=True, text=True, check=True, timeout=300
-                )
-            except subprocess.CalledProcessError as e:
-                error_details = e.stderr or e.stdout or str(e)
-                return {'success': False, 'error': _('Conversion failed: %(details)s', details=error_details), 'code': 500}
+                run_converter(temp_filepath, converted_epub_path, timeout=300)
+            except (ConversionFailed, OSError) as e:
+                os.unlink(temp_filepath)
+                return {'success': False, 'error': _('Conversion failed: %(details)s', details=str(e)), 'code': 500}
             
             os.unlink(temp_filepath)
             temp_filepath = converted_epub_path
             ext = '.epub'
 
+        on_stage('extracting')
         metadata = process_uploaded_ebook(temp_filepath, original_filename=original_filename)
         
         title = safe_title(metadata['title'])
@@ -591,8 +868,8 @@ def _upload_to_anx_logic(user_dict, uploaded_files):
         cover_dest_path = os.path.join(cover_dir, new_cover_filename)
 
         # Calculate MD5 before moving
-        with open(temp_filepath, 'rb') as f:
-            file_md5 = hashlib.md5(f.read()).hexdigest()
+        on_stage('hashing')
+        file_md5 = _file_md5(temp_filepath)
 
         # Prepare data for DB
         book_data_for_db = {
@@ -606,17 +883,19 @@ def _upload_to_anx_logic(user_dict, uploaded_files):
         db_file_path = posixpath.join('file', new_book_filename)
         db_cover_path = posixpath.join('cover', new_cover_filename)
 
-        success, status = add_book_to_anx_db(username, book_data_for_db, db_file_path, db_cover_path)
+        on_stage('importing')
+        with _anx_import_lock(username):
+            success, status = add_book_to_anx_db(username, book_data_for_db, db_file_path, db_cover_path)
 
-        if status == "DUPLICATE":
-            os.unlink(temp_filepath) # Clean up temp file
-            return {'success': True, 'message': _("Book '%(title)s' already exists in the library.", title=title)}
-        
-        # If reactivated or new, move/save the files
-        shutil.move(temp_filepath, book_dest_path)
-        if metadata['cover']:
-            with open(cover_dest_path, 'wb') as f:
-                f.write(metadata['cover'])
+            if status == "DUPLICATE":
+                os.unlink(temp_filepath) # Clean up temp file
+                return {'success': True, 'duplicate': True, 'message': _("Book '%(title)s' already exists in the library.", title=title)}
+            
+            # If reactivated or new, move/save the files
+            shutil.move(temp_filepath, book_dest_path)
+            if metadata['cover']:
+                with open(cover_dest_path, 'wb') as f:
+                    f.write(metadata['cover'])
 
         if status == "REACTIVATED":
             return {'success': True, 'message': _("Reactivated previously deleted book '%(title)s'.", title=title)}
@@ -629,6 +908,36 @@ def _upload_to_anx_logic(user_dict, uploaded_files):
             os.unlink(temp_filepath)
         return {'success': False, 'error': _("Failed to process '%(filename)s': %(error)s", filename=original_filename, error=str(e)), 'code': 500}
 
+def _upload_to_anx_logic(user_dict, uploaded_files):
+    """Core logic to upload books to a user's Anx library."""
+    username = user_dict.get('username')
+    if not username:
+        return {'success': False, 'error': _('Username not found in user_dict.')}
+
+    if not uploaded_files:
+        return {'success': False, 'error': _('No files were uploaded.')}
+
+    if not get_anx_user_dirs(username):
+        return {'success': False, 'error': _('User directory not configured.')}
+
+    # Since the frontend sends one file at a time, we process the first one.
+    file = uploaded_files[0]
+    if not file.filename:
+        return {'success': False, 'error': _('No files selected for uploading.')}
+
+    original_filename = os.path.basename(file.filename)
+    _unused, ext = os.path.splitext(original_filename)
+
+    try:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as temp_file:
+            file.save(temp_file.name)
+            temp_filepath = temp_file.name
+    except Exception as e:
+        logging.error(f"Failed to save uploaded file {original_filename} for user {username}: {e}")
+        return {'success': False, 'error': _("Failed to process '%(filename)s': %(error)s", filename=original_filename, error=str(e)), 'code': 500}
+
+    return _import_file_to_anx(user_dict, temp_filepath, original_filename)
+
 
 @books_bp.route('/upload_to_anx', methods=['POST'])
 def upload_to_anx_api():
@@ -650,6 +959,26 @@ def upload_to_anx_api():
         'username': g.user.username,
         'force_epub_conversion': g.user.force_epub_conversion
     }
+
+    first_file = uploaded_files[0]
+    needs_conversion = user_dict['force_epub_conversion'] and first_file.filename and not first_file.filename.lower().endswith('.epub')
+    if needs_conversion and shutil.which('ebook-converter') and get_anx_user_dirs(g.user.username):
+        # 需要转换时不在请求中等待 ebook-converter：交给批量上传任务处理，返回 202 和任务地址
+        from utils.upload_jobs import create_upload_job, spool_files, submit_files
+        from .upload_jobs import _anx_processor
+        job_id = create_upload_job(g.user.id, 'anx')
+        submit_files(spool_files(job_id, [first_file]), _anx_processor(user_dict, g.user.id))
+        status_url = f"/api/upload_jobs/{job_id}"
+        response = jsonify([{
+            'success': True,
+            'message': _('The book is being converted to EPUB and will be imported in the background.'),
+            'job_id': job_id,
+            'status_url': status_url,
+        }])
+        response.status_code = 202
+        response.headers['Location'] = status_url
+        return response
+
     result = _upload_to_anx_logic(user_dict, uploaded_files)
 
     # The frontend expects a list of results, even for a single file.
@@ -670,8 +999,7 @@ def upload_to_anx_api():
 
 @books_bp.route('/push_anx_to_calibre/<int:book_id>', methods=['POST'])
 def push_anx_to_calibre_api(book_id):
-    book_details = get_anx_book_details(g.user.username, book_id, as_dict=True)
-    book_title = book_details.get('title') if book_details else None
+    book_title, _unused = get_anx_book_details(g.user.username, book_id)
 
     # Permission check for normal users
     if config_manager.config.get('DISABLE_NORMAL_USER_UPLOAD') and g.user.role == 'user':
@@ -1,20 +1,103 @@
 import json
+import os
+import time
 import requests
 import uuid
 import logging
-from functools import lru_cache
 from urllib.parse import quote
 from flask import Blueprint, request, jsonify, g, send_from_directory
 from flask_babel import gettext as _
 from contextlib import closing
 import config_manager
-from utils.auth import get_calibre_auth
+from utils.calibre_client import calibre_get, calibre_post, get_calibre_health, STREAM_CHUNK_SIZE
+from utils.calibre_mirror import refresh_mirror_books
+from utils.calibre_details_cache import get_book_details, invalidate_book_details
+from utils.completion_index import SUPPORTED_FIELDS, get_completions
 from utils.text import safe_title, safe_author
-from utils.decorators import maintainer_required_api
+from utils.decorators import login_required_api, maintainer_required_api
 from utils.activity_logger import log_activity, ActivityType
 
 calibre_bp = Blueprint('calibre', __name__, url_prefix='/api')
 
+LIBRARY_COLUMN_TTL = 300
+_library_column_cache = {}  # library_id -> (是否有 #library 列, 检查时间)
+
+def _calibre_has_library_column(library_id):
+    """Calibre 书库是否有 #library 自定义列，结果缓存 LIBRARY_COLUMN_TTL 秒；无法判断时返回 None"""
+    now = time.time()
+    cached = _library_column_cache.get(library_id)
+    if cached and now - cached[1] < LIBRARY_COLUMN_TTL:
+        return cached[0]
+    try:
+        response = calibre_get(f"{config_manager.config['CALIBRE_URL']}/ajax/field_metadata/{quote(library_id)}")
+        response.raise_for_status()
+        has_column = '#library' in (response.json() or {})
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.warning(f"Could not read Calibre field metadata: {e}")
+        return None
+    _library_column_cache[library_id] = (has_column, now)
+    return has_column
+
+def add_book_to_calibre(fileobj, filename, mimetype, username, refresh_mirror=True):
+    """
+    把文件对象分块上传到 Calibre，成功时把 #library 设置为上传者。
+    返回 Calibre 的 add-book 响应 (dict)；网络或 HTTP 错误时抛出 requests 异常。
+    批量上传时传入 refresh_mirror=False，由调用方在最后统一刷新镜像。
+    """
+    config = config_manager.config
+    job_id = str(uuid.uuid4())
+    library_id = config.get('CALIBRE_DEFAULT_LIBRARY_ID', 'Calibre_Library')
+    add_duplicates_flag = 'y' if config.get('CALIBRE_ADD_DUPLICATES', False) else 'n'
+    encoded_filename = requests.utils.quote(filename)
+    url = f"{config['CALIBRE_URL']}/cdb/add-book/{job_id}/{add_duplicates_flag}/{encoded_filename}/{library_id}"
+
+    headers = {'Content-Type': mimetype} if mimetype else {}
+    response = calibre_post(url, kind='transfer', data=fileobj, headers=headers)
+    response.raise_for_status()
+    res_json = response.json()
+
+    book_id = res_json.get("book_id")
+    if book_id:
+        # Try to update #library tag, but don't fail the entire request if this part fails
+        try:
+            has_column = _calibre_has_library_column(library_id)
+            if has_column is None:
+                book_details = get_calibre_book_details(book_id)
+                has_column = bool(book_details and "#library" in book_details.get("user_metadata", {}))
+            if has_column:
+                update_payload = {"changes": {"#library": username}}
+                update_url = f"{config['CALIBRE_URL']}/cdb/set-fields/{book_id}/{library_id}"
+                update_response = calibre_post(update_url, json=update_payload)
+                update_response.raise_for_status()
+                logging.info(f"Successfully updated #library for book {book_id}")
+        except Exception as e:
+            logging.error(f"Failed to update #library for book {book_id}: {e}")
+            res_json['library_update_failed'] = True
+        invalidate_book_details([book_id])
+        if refresh_mirror:
+            refresh_mirror_books([book_id])
+    return res_json
+
+def _calibre_upload_result(res_json, filename, username=None, user_id=None):
+    """把 add-book 响应转换成上传接口的结果，并记录活动日志"""
+    if res_json.get("book_id"):
+        book_id = res_json["book_id"]
+        book_title = res_json.get('title', filename)
+        log_activity(ActivityType.UPLOAD_BOOK, username=username, user_id=user_id, book_id=book_id, book_title=book_title, library_type='calibre', success=True)
+        return {"success": True, "filename": filename, "book_id": book_id, "message": _("Book '%(title)s' uploaded successfully, ID: %(book_id)s.", title=book_title, book_id=book_id)}
+
+    error_msg = _("Upload failed, book may already exist.")
+    log_activity(ActivityType.UPLOAD_BOOK, username=username, user_id=user_id, book_title=filename, library_type='calibre', success=False, failure_reason=error_msg, detail=json.dumps(res_json.get("duplicates")))
+    return {"success": False, "filename": filename, "error": error_msg, "details": res_json.get("duplicates")}
+
+def _calibre_upload_error(e, filename, username=None, user_id=None):
+    if isinstance(e, requests.exceptions.HTTPError):
+        error_message = _("Calibre server returned an error: %(code)s - %(text)s", code=e.response.status_code, text=e.response.text)
+    else:
+        error_message = _("Error connecting to Calibre server: %(error)s", error=e)
+    log_activity(ActivityType.UPLOAD_BOOK, username=username, user_id=user_id, book_title=filename, library_type='calibre', success=False, failure_reason=error_message)
+    return {"success": False, "filename": filename, "error": error_message}
+
 @calibre_bp.route('/upload_to_calibre', methods=['POST'])
 def upload_to_calibre_api():
     # Permission check for normal users
@@ -34,57 +117,14 @@ def upload_to_calibre_api():
     for file in files:
         if file:
             filename = file.filename
-            
-            job_id = str(uuid.uuid4())
-            library_id = config_manager.config.get('CALIBRE_DEFAULT_LIBRARY_ID', 'Calibre_Library')
-            add_duplicates = config_manager.config.get('CALIBRE_ADD_DUPLICATES', False)
-            add_duplicates_flag = 'y' if add_duplicates else 'n'
-            encoded_filename = requests.utils.quote(filename)
-            url = f"{config_manager.config['CALIBRE_URL']}/cdb/add-book/{job_id}/{add_duplicates_flag}/{encoded_filename}/{library_id}"
-            
             try:
-                headers = {'Content-Type': file.mimetype} if file.mimetype else {}
-                
-                # We must read the file content into memory before passing it to requests,
-                # as the file object will be closed after the first iteration.
-                file.seek(0)
-                file_content = file.read()
-                
-                response = requests.post(url, data=file_content, auth=get_calibre_auth(), headers=headers)
-                response.raise_for_status()
-                
-                res_json = response.json()
-                if res_json.get("book_id"):
-                    book_id = res_json["book_id"]
-                    book_title = res_json.get('title', filename)
-                    log_activity(ActivityType.UPLOAD_BOOK, book_id=book_id, book_title=book_title, library_type='calibre', success=True)
-
-                    # Try to update #library tag, but don't fail the entire request if this part fails
-                    try:
-                        book_details = get_calibre_book_details(book_id)
-                        if (book_details and "user_metadata" in book_details and "#library" in book_details["user_metadata"]):
-                            update_payload = {"changes": {"#library": g.user.username}}
-                            update_url = f"{config_manager.config['CALIBRE_URL']}/cdb/set-fields/{book_id}/{library_id}"
-                            update_response = requests.post(update_url, json=update_payload, auth=get_calibre_auth())
-                            update_response.raise_for_status()
-                            logging.info(f"Successfully updated #library for book {book_id}")
-                    except Exception as e:
-                        logging.error(f"Failed to update #library for book {book_id}: {e}")
-                    
-                    results.append({"success": True, "filename": filename, "message": _("Book '%(title)s' uploaded successfully, ID: %(book_id)s.", title=book_title, book_id=book_id)})
-                else:
-                    error_msg = _("Upload failed, book may already exist.")
-                    log_activity(ActivityType.UPLOAD_BOOK, book_title=filename, library_type='calibre', success=False, failure_reason=error_msg, detail=json.dumps(res_json.get("duplicates")))
-                    results.append({"success": False, "filename": filename, "error": error_msg, "details": res_json.get("duplicates")})
-            
-            except requests.exceptions.HTTPError as e:
-                error_message = _("Calibre server returned an error: %(code)s - %(text)s", code=e.response.status_code, text=e.response.text)
-                log_activity(ActivityType.UPLOAD_BOOK, book_title=filename, library_type='calibre', success=False, failure_reason=error_message)
-                results.append({"success": False, "filename": filename, "error": error_message})
+                # 直接把上传的文件对象交给 requests 分块发送（Content-Length 由文件大小得出），
+                # 不在 worker 内存中保留整本书
+                file.stream.seek(0)
+                res_json = add_book_to_calibre(file.stream, filename, file.mimetype, g.user.username)
+                results.append(_calibre_upload_result(res_json, filename))
             except requests.exceptions.RequestException as e:
-                error_message = _("Error connecting to Calibre server: %(error)s", error=e)
-                log_activity(ActivityType.UPLOAD_BOOK, book_title=filename, library_type='calibre', success=False, failure_reason=error_message)
-                results.append({"success": False, "filename": filename, "error": error_message})
+                results.append(_calibre_upload_error(e, filename))
 
     return jsonify(results)
 
@@ -143,13 +183,15 @@ def update_calibre_book_api(book_id):
     url = f"{config_manager.config['CALIBRE_URL']}/cdb/set-fields/{book_id}/{library_id}"
     
     try:
-        response = requests.post(url, json=payload, auth=get_calibre_auth())
+        response = calibre_post(url, json=payload)
         response.raise_for_status()
         
         try:
             result = response.json()
             # The cdb endpoint returns the updated metadata for the book
             if str(book_id) in result:
+                invalidate_book_details([book_id])
+                refresh_mirror_books([book_id])
                 log_activity(ActivityType.EDIT_METADATA, book_id=book_id, book_title=book_title, library_type='calibre', success=True, detail=json.dumps(changes))
                 return jsonify({'message': _('Metadata updated successfully.'), 'updated_metadata': result[str(book_id)]})
             else:
@@ -171,46 +213,29 @@ def update_calibre_book_api(book_id):
         return jsonify({'error': error_message}), 500
 
 # --- Completions API ---
-@lru_cache(maxsize=16)
-def get_all_items_for_field(library_id, field):
-    """
-    Fetches all items for a given field from the Calibre server.
-    Results are cached to avoid repeated requests for the same field.
-    """
-    encoded_field = quote(field)
-    url = f"{config_manager.config['CALIBRE_URL']}/interface-data/field-names/{encoded_field}?library_id={library_id}"
-    try:
-        response = requests.get(url, auth=get_calibre_auth())
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Could not fetch completions for field '{field}': {e}")
-        return []
-
 @calibre_bp.route('/calibre/completions', methods=['GET'])
 @maintainer_required_api
 def calibre_completions_api():
     field = request.args.get('field')
-    query = request.args.get('query', '').lower()
+    query = request.args.get('query', '')
     
     if not field:
         return jsonify({'error': _('Field parameter is required.')}), 400
 
-    supported_fields = ['authors', 'publisher', 'tags', '#library']
-    if field not in supported_fields:
+    if field not in SUPPORTED_FIELDS:
         return jsonify({'error': _("Completions not supported for field: %(field)s", field=field)}), 400
 
-    library_id = config_manager.config.get('CALIBRE_DEFAULT_LIBRARY_ID', 'Calibre_Library')
-    
-    all_items = get_all_items_for_field(library_id, field)
-    
-    if not query:
-        # Return a small subset if query is empty
-        return jsonify(all_items[:20])
+    # 前缀 / 词首 / 子串匹配，忽略大小写和重音；索引过期后在后台刷新
+    return jsonify(get_completions(field, query, limit=20)) # Return max 20 results
 
-    filtered_items = [item for item in all_items if query in item.lower()]
-    
-    return jsonify(filtered_items[:20]) # Return max 20 results
+@calibre_bp.route('/calibre/health', methods=['GET'])
+@login_required_api
+def calibre_health_api():
+    """Calibre 是否可用；不可用时页面使用缓存数据，前端可据此禁用需要 Calibre 的操作"""
+    health = get_calibre_health()
+    if not g.user.is_maintainer:
+        health.pop('last_error', None)
+    return jsonify(health)
 
 @calibre_bp.route('/download_koreader_plugin', methods=['GET'])
 def download_koreader_plugin():
@@ -218,31 +243,54 @@ def download_koreader_plugin():
     return send_from_directory('static', 'anx-calibre-manager-koreader-plugin.zip', as_attachment=True)
 
 def get_calibre_book_details(book_id):
-    config = config_manager.config
-    try:
-        response = requests.get(f"{config['CALIBRE_URL']}/ajax/book/{book_id}?fields=all", auth=get_calibre_auth())
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Error getting book details for {book_id}: {e}")
-        return None
+    # 经过跨 worker 的详情缓存，同一次操作中多次调用不会重复请求 Calibre
+    return get_book_details(book_id)
 
-def download_calibre_book(book_id, download_format='mobi'):
-    details = get_calibre_book_details(book_id)
-    if not details: return None, None
+def _calibre_book_filename(details, download_format):
     title = safe_title(details.get('title', 'Unknown Title'))
     authors = safe_author(" & ".join(details.get('authors', ['Unknown Author'])))
     if authors:
-        filename = f"{title} - {authors}.{download_format}"
-    else:
-        filename = f"{title}.{download_format}"
-    
-    config = config_manager.config
+        return f"{title} - {authors}.{download_format}"
+    return f"{title}.{download_format}"
+
+def open_calibre_book_stream(book_id, download_format='mobi', range_header=None):
+    """
+    打开 Calibre 书籍文件的流式响应，不把文件读入内存。
+    返回 (requests.Response, filename)，失败时返回 (None, None)；调用方负责关闭响应。
+    range_header 会原样转发给 Calibre，响应可能是 206；范围无法满足时返回 Calibre 的 416 响应，由调用方转发。
+    """
+    details = get_calibre_book_details(book_id)
+    if not details: return None, None
+    filename = _calibre_book_filename(details, download_format)
+
+    url = f"{config_manager.config['CALIBRE_URL']}/get/{download_format.lower()}/{book_id}"
+    headers = {'Range': range_header} if range_header else {}
+    response = None
     try:
-        url = f"{config['CALIBRE_URL']}/get/{download_format.lower()}/{book_id}"
-        response = requests.get(url, auth=get_calibre_auth(), stream=True)
+        response = calibre_get(url, kind='transfer', stream=True, headers=headers)
+        if range_header and response.status_code == 416:
+            return response, filename
         response.raise_for_status()
-        return response.content, filename
+        return response, filename
     except requests.exceptions.RequestException as e:
         print(f"Error downloading book {book_id} in format {download_format} from URL {url}: {e}")
-        return None, None
\ No newline at end of file
+        # 流式响应不读完也不关闭时，连接不会回到连接池
+        if response is not None:
+            response.close()
+        return None, None
+
+def save_calibre_book(book_id, download_format, dest_dir):
+    """把 Calibre 书籍文件分块写入 dest_dir，返回 (文件路径, filename)，失败时返回 (None, None)"""
+    response, filename = open_calibre_book_stream(book_id, download_format)
+    if not response: return None, None
+    dest_path = os.path.join(dest_dir, filename)
+    try:
+        with closing(response), open(dest_path, 'wb') as f:
+            for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+                f.write(chunk)
+        return dest_path, filename
+    except (requests.exceptions.RequestException, OSError) as e:
+        print(f"Error downloading book {book_id} in format {download_format} to {dest_path}: {e}")
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        return None, None
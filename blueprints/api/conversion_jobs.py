@@ -0,0 +1,95 @@
+import json
+import os
+import time
+from flask import Blueprint, Response, request, jsonify, g, stream_with_context
+from flask_babel import gettext as _
+
+from utils.conversion_jobs import cancel_conversion_job, get_conversion_job
+from utils.decorators import login_required_api
+from .books import _conversion_job_response
+
+conversion_jobs_bp = Blueprint('conversion_jobs', __name__, url_prefix='/api')
+
+# SSE 连接会占用一个同步 worker，每个连接最多保持这么多秒，之后由 EventSource 自动重连
+CONVERSION_SSE_MAX_SECONDS = int(os.environ.get('CONVERSION_SSE_MAX_SECONDS', 30))
+
+
+def _own_job(job_id):
+    job = get_conversion_job(job_id)
+    if not job or job['user_id'] != g.user.id:
+        return None
+    return job
+
+
+@conversion_jobs_bp.route('/conversion_jobs', methods=['POST'])
+@login_required_api
+def prepare_book_api():
+    """
+    为当前用户的下载准备 Calibre 书籍。JSON：book_id。
+    需要转换且没有缓存时返回 202 和转换任务，否则返回 200 {'ready': true}，可以直接请求下载。
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        book_id = int(data.get('book_id'))
+    except (TypeError, ValueError):
+        return jsonify({'error': _('Missing book ID.')}), 400
+
+    if g.user.force_epub_conversion:
+        user_dict = {
+            'id': g.user.id,
+            'username': g.user.username,
+            'send_format_priority': g.user.send_format_priority,
+            'language': g.user.language
+        }
+        pending = _conversion_job_response(book_id, user_dict, (g.user.language or 'zh').split('_')[0])
+        if pending:
+            return pending
+    return jsonify({'ready': True})
+
+
+@conversion_jobs_bp.route('/conversion_jobs/<job_id>', methods=['GET'])
+@login_required_api
+def get_conversion_job_api(job_id):
+    job = _own_job(job_id)
+    if not job:
+        return jsonify({'error': _('Task not found')}), 404
+    return jsonify(job)
+
+
+@conversion_jobs_bp.route('/conversion_jobs/<job_id>/cancel', methods=['POST'])
+@login_required_api
+def cancel_conversion_job_api(job_id):
+    if not _own_job(job_id):
+        return jsonify({'error': _('Task not found')}), 404
+    return jsonify(cancel_conversion_job(job_id))
+
+
+@conversion_jobs_bp.route('/conversion_jobs/<job_id>/events', methods=['GET'])
+@login_required_api
+def conversion_job_events_api(job_id):
+    """
+    以 Server-Sent Events 推送任务状态：状态变化时发送 progress 事件，结束时发送 done 事件并关闭。
+    """
+    if not _own_job(job_id):
+        return jsonify({'error': _('Task not found')}), 404
+
+    def generate():
+        deadline = time.monotonic() + CONVERSION_SSE_MAX_SECONDS
+        last = None
+        yield "retry: 1000\n\n"
+        while True:
+            job = get_conversion_job(job_id)
+            if not job:
+                return
+            payload = json.dumps(job, ensure_ascii=False)
+            if payload != last:
+                last = payload
+                yield f"event: {'done' if job['finished'] else 'progress'}\ndata: {payload}\n\n"
+            if job['finished'] or time.monotonic() > deadline:
+                return
+            time.sleep(1)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
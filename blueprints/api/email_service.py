@@ -1,6 +1,7 @@
 import smtplib
 import logging
 import mimetypes
+import threading
 from flask import Blueprint, request, jsonify, g
 from flask_babel import gettext as _
 import config_manager
@@ -10,9 +11,61 @@ from utils.activity_logger import log_activity, ActivityType
 
 email_bp = Blueprint('email', __name__, url_prefix='/api')
 
-def send_email_with_config(to_address, subject, body, config, attachment_content=None, attachment_filename=None):
+def _connect_smtp(config):
+    """按配置连接 SMTP 服务器并登录，返回 smtplib.SMTP 对象"""
+    encryption = config.get('SMTP_ENCRYPTION', 'none').lower()
+    port = int(config['SMTP_PORT'])
+
+    logging.info(f"Connecting to SMTP server with encryption: {encryption} on port {port}")
+    if encryption == 'ssl':
+        server = smtplib.SMTP_SSL(config['SMTP_SERVER'], port)
+    else:
+        server = smtplib.SMTP(config['SMTP_SERVER'], port)
+        if encryption == 'starttls':
+            logging.info("Starting TLS...")
+            server.starttls()
+
+    #server.set_debuglevel(1) # Log SMTP conversation
+
+    if config.get('SMTP_PASSWORD'):
+        logging.info(f"Logging in as {config['SMTP_USERNAME']}...")
+        server.login(config['SMTP_USERNAME'], config['SMTP_PASSWORD'])
+    return server
+
+class SMTPSession:
     """
-    Send email using provided configuration
+    批量发送时共用的 SMTP 连接：第一次发送时连接，之后复用；多个线程的发送串行进行，
+    连接被服务器断开时重连一次。用完后调用 close()。
+    """
+    def __init__(self, config):
+        self.config = config
+        self._server = None
+        self._lock = threading.Lock()
+
+    def send_message(self, msg, from_address, to_addresses):
+        with self._lock:
+            if self._server is None:
+                self._server = _connect_smtp(self.config)
+            try:
+                self._server.send_message(msg, from_address, to_addresses)
+            except smtplib.SMTPServerDisconnected:
+                logging.info("SMTP connection was closed by the server, reconnecting...")
+                self._server = _connect_smtp(self.config)
+                self._server.send_message(msg, from_address, to_addresses)
+
+    def close(self):
+        with self._lock:
+            if self._server is not None:
+                try:
+                    self._server.quit()
+                except smtplib.SMTPException as e:
+                    logging.warning(f"Error closing SMTP connection: {e}")
+                self._server = None
+
+def send_email_with_config(to_address, subject, body, config, attachment_content=None, attachment_filename=None, smtp_session=None):
+    """
+    Send email using provided configuration.
+    smtp_session 为 SMTPSession 时复用它的连接，否则单独连接一次。
     """
     logging.info(f"Attempting to send email to {to_address} via {config.get('SMTP_SERVER')}:{config.get('SMTP_PORT')}")
     
@@ -42,29 +95,14 @@ def send_email_with_config(to_address, subject, body, config, attachment_content
     )
         
     try:
-        server = None
-        encryption = config.get('SMTP_ENCRYPTION', 'none').lower()
-        port = int(config['SMTP_PORT'])
-        
-        logging.info(f"Connecting to SMTP server with encryption: {encryption} on port {port}")
-        if encryption == 'ssl':
-            server = smtplib.SMTP_SSL(config['SMTP_SERVER'], port)
-        else:
-            server = smtplib.SMTP(config['SMTP_SERVER'], port)
-            if encryption == 'starttls':
-                logging.info("Starting TLS...")
-                server.starttls()
-        
-        #server.set_debuglevel(1) # Log SMTP conversation
-        
-        if config.get('SMTP_PASSWORD'):
-            logging.info(f"Logging in as {config['SMTP_USERNAME']}...")
-            server.login(config['SMTP_USERNAME'], config['SMTP_PASSWORD'])
-            
         logging.info("Sending email...")
-        server.send_message(msg, from_address, [to_address])
+        if smtp_session is not None:
+            smtp_session.send_message(msg, from_address, [to_address])
+        else:
+            server = _connect_smtp(config)
+            server.send_message(msg, from_address, [to_address])
+            server.quit()
         logging.info("Email sent successfully.")
-        server.quit()
         return True, _("Email sent successfully.")
     except Exception as e:
         logging.error(f"Failed to send email: {e}", exc_info=True)
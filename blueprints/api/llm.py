@@ -295,7 +295,8 @@ def regenerate_chat_response():
         log_activity(ActivityType.LLM_CHAT_MESSAGE, book_id=msg_info['book_id'], book_title=msg_info['book_title'], library_type=msg_info['book_type'], success=True, detail=_('Regenerate response'))
     
     app = current_app._get_current_object()
-    user_obj = database.get_db().execute('SELECT * FROM users WHERE id = ?', (msg_info['user_id'],)).fetchone()
+    with closing(database.get_db()) as db:
+        user_obj = db.execute('SELECT * FROM users WHERE id = ?', (msg_info['user_id'],)).fetchone()
     user_info_dict = {key: user_obj[key] for key in user_obj.keys() if key not in ['llm_base_url', 'llm_api_key', 'llm_model']}
 
     # Load LLM settings with fallback to global defaults
@@ -401,22 +402,22 @@ def delete_chat_session(session_id):
 @llm_bp.route('/message/<int:message_id>', methods=['DELETE'])
 @login_required_api
 def delete_message(message_id):
-    db = database.get_db()
-    message = db.execute(
-        'SELECT s.user_id FROM llm_chat_messages m '
-        'JOIN llm_chat_sessions s ON m.session_id = s.id '
-        'WHERE m.id = ?',
-        (message_id,)
-    ).fetchone()
-
-    if message is None:
-        return jsonify({'status': 'error', 'message': 'Message not found'}), 404
-
-    if message['user_id'] != g.user.id:
-        return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
-
-    db.execute('DELETE FROM llm_chat_messages WHERE id = ?', (message_id,))
-    db.commit()
+    with closing(database.get_db()) as db:
+        message = db.execute(
+            'SELECT s.user_id FROM llm_chat_messages m '
+            'JOIN llm_chat_sessions s ON m.session_id = s.id '
+            'WHERE m.id = ?',
+            (message_id,)
+        ).fetchone()
+
+        if message is None:
+            return jsonify({'status': 'error', 'message': 'Message not found'}), 404
+
+        if message['user_id'] != g.user.id:
+            return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
+
+        db.execute('DELETE FROM llm_chat_messages WHERE id = ?', (message_id,))
+        db.commit()
     
     log_activity(ActivityType.LLM_DELETE_MESSAGE, success=True, detail=_('Message ID: %(message_id)s', message_id=message_id))
     return jsonify({'status': 'success', 'message': 'Message deleted successfully'})
\ No newline at end of file
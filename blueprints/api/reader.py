@@ -1,11 +1,11 @@
 from flask import Blueprint, jsonify, g, request
 from contextlib import closing
-import sqlite3
 import os
-from anx_library import get_anx_user_dirs
+from anx_library import get_anx_user_dirs, get_anx_db
 from datetime import datetime
 import logging
 from utils.activity_logger import log_activity, ActivityType
+from utils.progress_buffer import record_progress, add_reading_time, overlay_progress
 
 logger = logging.getLogger(__name__)
 reader_bp = Blueprint('reader', __name__, url_prefix='/api/reader')
@@ -19,15 +19,16 @@ def get_anx_progress(book_id):
     if not dirs or not os.path.exists(dirs["db_path"]):
         return jsonify({'error': 'Anx library not found.'}), 404
 
-    with closing(sqlite3.connect(dirs["db_path"])) as db:
-        db.row_factory = sqlite3.Row
+    with closing(get_anx_db(g.user.username)) as db:
         cursor = db.cursor()
-        cursor.execute("SELECT last_read_position, reading_percentage FROM tb_books WHERE id = ? AND is_deleted = 0", (book_id,))
+        cursor.execute("SELECT id, last_read_position, reading_percentage FROM tb_books WHERE id = ? AND is_deleted = 0", (book_id,))
         book = cursor.fetchone()
 
         if not book:
             return jsonify({'error': 'Book not found.'}), 404
 
+        # 叠加写回缓冲中尚未落盘的最新进度
+        book = overlay_progress(g.user.username, book)
         return jsonify({
             'cfi': book['last_read_position'],
             'percentage': book['reading_percentage']
@@ -50,41 +51,24 @@ def save_anx_progress(book_id):
     if not dirs or not os.path.exists(dirs["db_path"]):
         return jsonify({'error': 'Anx library not found.'}), 404
 
-    with closing(sqlite3.connect(dirs["db_path"])) as db:
-        cursor = db.cursor()
-        current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')
-        
-        # Update reading progress
-        cursor.execute("""
-            UPDATE tb_books
-            SET last_read_position = ?, reading_percentage = ?, update_time = ?
-            WHERE id = ? AND is_deleted = 0
-        """, (cfi, percentage, current_time, book_id))
-
-        if cursor.rowcount == 0:
-            logger.warning(f"Attempted to save progress for non-existent book_id {book_id} for user {g.user.username}")
-            return jsonify({'error': 'Book not found or no update was made.'}), 404
-        
-        # 记录阅读进度更新
-        log_activity(ActivityType.ONLINE_READING_UPDATE_READING_PROGRESS, book_id=book_id, library_type='anx', success=True)
-
-        # Update reading time
-        if reading_time_seconds and int(reading_time_seconds) > 0:
-            date_str = datetime.utcnow().strftime('%Y-%m-%d')
-            duration = int(reading_time_seconds)
-            
-            cursor.execute("SELECT id, reading_time FROM tb_reading_time WHERE book_id = ? AND date = ?", (book_id, date_str))
-            existing_record = cursor.fetchone()
-
-            if existing_record:
-                new_reading_time = existing_record[1] + duration
-                cursor.execute("UPDATE tb_reading_time SET reading_time = ? WHERE id = ?", (new_reading_time, existing_record[0]))
-            else:
-                cursor.execute("INSERT INTO tb_reading_time (book_id, date, reading_time) VALUES (?, ?, ?)", (book_id, date_str, duration))
-            
-
-        db.commit()
-        
+    with closing(get_anx_db(g.user.username)) as db:
+        book = db.execute("SELECT id FROM tb_books WHERE id = ? AND is_deleted = 0", (book_id,)).fetchone()
+
+    if not book:
+        logger.warning(f"Attempted to save progress for non-existent book_id {book_id} for user {g.user.username}")
+        return jsonify({'error': 'Book not found or no update was made.'}), 404
+
+    # 进度和阅读时长先写入缓冲，由后台线程合并后批量写入 Anx 数据库
+    record_progress(g.user.username, book_id, cfi, percentage)
+
+    # 记录阅读进度更新
+    log_activity(ActivityType.ONLINE_READING_UPDATE_READING_PROGRESS, book_id=book_id, library_type='anx', success=True)
+
+    # Update reading time
+    if reading_time_seconds and int(reading_time_seconds) > 0:
+        date_str = datetime.utcnow().strftime('%Y-%m-%d')
+        add_reading_time(g.user.username, book_id, date_str, int(reading_time_seconds))
+
         # 记录阅读时间更新
         log_activity(ActivityType.ONLINE_READING_UPDATE_READING_TIME, book_id=book_id, library_type='anx', success=True, detail=f'{int(reading_time_seconds)}s')
 
@@ -10,6 +10,7 @@ from utils.audiobook_tasks_db import cleanup_all_audiobooks
 from utils.decorators import admin_required_api
 from utils.audiobook_tasks_db import cleanup_incomplete_tasks
 from utils.activity_logger import log_activity, ActivityType
+from utils.user_cache import bump_users_generation
 
 settings_bp = Blueprint('settings', __name__, url_prefix='/api')
 
@@ -74,6 +75,7 @@ def user_settings_api():
                 params.append(g.user.id)
                 db.execute(query, tuple(params))
                 db.commit()
+                bump_users_generation()
                 
                 # 如果更新了语言设置，同步更新session中的语言
                 if 'language' in data:
@@ -163,7 +165,7 @@ def global_settings_api():
         # Handle checkbox boolean values - ensure they are properly converted
         # These checkboxes send boolean values from frontend, but we need to handle both
         # boolean and string 'true'/'false' for compatibility
-        for checkbox_field in ['CALIBRE_ADD_DUPLICATES', 'DISABLE_NORMAL_USER_UPLOAD', 'REQUIRE_INVITE_CODE', 'ENABLE_ACTIVITY_LOG']:
+        for checkbox_field in ['CALIBRE_ADD_DUPLICATES', 'DISABLE_NORMAL_USER_UPLOAD', 'REQUIRE_INVITE_CODE', 'ENABLE_ACTIVITY_LOG', 'ENABLE_PREWARM']:
             if checkbox_field in data:
                 value = data[checkbox_field]
                 # Convert to boolean: handle both boolean type and string 'true'
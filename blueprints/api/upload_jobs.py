@@ -0,0 +1,110 @@
+import requests
+from flask import Blueprint, request, jsonify, g, current_app
+from flask_babel import gettext as _, force_locale, get_locale
+
+import config_manager
+from utils.upload_jobs import create_upload_job, get_upload_job, get_upload_job_row, spool_files, submit_files
+from utils.calibre_mirror import refresh_mirror_books
+from utils.activity_logger import log_activity, ActivityType
+from utils.decorators import login_required_api
+from .calibre import add_book_to_calibre, _calibre_upload_result, _calibre_upload_error
+from .books import _import_file_to_anx
+
+upload_jobs_bp = Blueprint('upload_jobs', __name__, url_prefix='/api')
+
+
+def _in_request_locale(process):
+    """后台线程中没有请求上下文，用当前应用和请求语言包装处理函数，使结果消息与界面语言一致"""
+    app = current_app._get_current_object()
+    locale = str(get_locale() or 'en')
+
+    def wrapped(*args):
+        with app.app_context(), force_locale(locale):
+            return process(*args)
+    return wrapped
+
+
+def _calibre_processor(username, user_id):
+    def process(path, filename, mimetype, on_stage):
+        on_stage('uploading')
+        try:
+            with open(path, 'rb') as f:
+                res_json = add_book_to_calibre(f, filename, mimetype, username, refresh_mirror=False)
+            return _calibre_upload_result(res_json, filename, username=username, user_id=user_id)
+        except requests.exceptions.RequestException as e:
+            return _calibre_upload_error(e, filename, username=username, user_id=user_id)
+    return _in_request_locale(process)
+
+
+def _calibre_finished(results):
+    # 整批上传完成后一次性刷新镜像
+    book_ids = [r['book_id'] for r in results if r.get('book_id')]
+    if book_ids:
+        refresh_mirror_books(book_ids)
+
+
+def _anx_processor(user_dict, user_id):
+    def process(path, filename, mimetype, on_stage):
+        # _import_file_to_anx 会移动或删除 path
+        result = _import_file_to_anx(user_dict, path, filename, on_stage=on_stage)
+        if result['success']:
+            log_activity(ActivityType.UPLOAD_BOOK, username=user_dict['username'], user_id=user_id, library_type='anx', success=True, detail=result.get('message'))
+        else:
+            log_activity(ActivityType.UPLOAD_BOOK, username=user_dict['username'], user_id=user_id, library_type='anx', success=False, failure_reason=result.get('error'))
+        return result
+    return _in_request_locale(process)
+
+
+@upload_jobs_bp.route('/upload_jobs', methods=['POST'])
+@login_required_api
+def create_upload_job_api():
+    """
+    创建批量上传任务或向已有任务追加文件。
+    表单字段：target (calibre / anx)、books (多个文件)、job_id (可选，追加到已有任务)。
+    文件写入磁盘后立即返回，处理进度通过 GET /api/upload_jobs/<job_id> 查询。
+    """
+    target = request.form.get('target', 'calibre')
+    if target not in ('calibre', 'anx'):
+        return jsonify({'error': _("Invalid 'library' type")}), 400
+
+    # Permission check for normal users
+    if config_manager.config.get('DISABLE_NORMAL_USER_UPLOAD') and g.user.role == 'user':
+        error_msg = _('You do not have permission to upload books.')
+        log_activity(ActivityType.UPLOAD_BOOK, library_type=target, success=False, failure_reason=error_msg)
+        return jsonify({'error': error_msg}), 403
+
+    files = [f for f in request.files.getlist('books') if f and f.filename]
+    if not files:
+        return jsonify({'error': _('No files selected for uploading.')}), 400
+
+    job_id = request.form.get('job_id')
+    if job_id:
+        job = get_upload_job_row(job_id)
+        if not job or job['user_id'] != g.user.id or job['target'] != target:
+            return jsonify({'error': _('Task not found')}), 404
+    else:
+        job_id = create_upload_job(g.user.id, target)
+
+    spooled = spool_files(job_id, files)
+    if target == 'calibre':
+        submit_files(spooled, _calibre_processor(g.user.username, g.user.id), on_finished=_calibre_finished)
+    else:
+        user_dict = {
+            'username': g.user.username,
+            'force_epub_conversion': g.user.force_epub_conversion
+        }
+        submit_files(spooled, _anx_processor(user_dict, g.user.id))
+
+    return jsonify({
+        'job_id': job_id,
+        'files': [{'id': file_id, 'filename': filename} for file_id, _path, filename, _mimetype in spooled]
+    }), 202
+
+
+@upload_jobs_bp.route('/upload_jobs/<job_id>', methods=['GET'])
+@login_required_api
+def get_upload_job_api(job_id):
+    job = get_upload_job_row(job_id)
+    if not job or job['user_id'] != g.user.id:
+        return jsonify({'error': _('Task not found')}), 404
+    return jsonify(get_upload_job(job_id))
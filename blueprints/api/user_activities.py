@@ -8,7 +8,9 @@ from flask_babel import gettext as _
 from contextlib import closing
 import database
 from utils.decorators import admin_required_api
-from utils.activity_logger import log_activity, ActivityType, get_user_activities, get_activity_statistics
+from utils.activity_logger import log_activity, ActivityType, get_user_activities, get_activity_statistics, flush_activity_log
+from utils.user_cache import bump_users_generation
+from utils.activity_retention import delete_archived_activities
 
 user_activities_bp = Blueprint('user_activities', __name__, url_prefix='/api/admin')
 
@@ -21,6 +23,7 @@ def get_user_activities_summary():
     返回所有用户的活动统计信息
     """
     try:
+        flush_activity_log()
         with closing(database.get_db()) as db:
             # 获取所有用户基本信息
             users = db.execute('''
@@ -29,6 +32,38 @@ def get_user_activities_summary():
                 FROM users
                 ORDER BY last_login_at DESC NULLS LAST
             ''').fetchall()
+
+            activity_types = [
+                ActivityType.DOWNLOAD_BOOK,
+                ActivityType.UPLOAD_BOOK,
+                ActivityType.SEARCH_BOOKS,
+                ActivityType.ONLINE_READING_UPDATE_READING_PROGRESS,
+                ActivityType.PUSH_TO_KINDLE,
+                ActivityType.GENERATE_AUDIOBOOK
+            ]
+
+            # 计数和各类活动的最后时间都来自按天汇总表，一次查询覆盖所有用户
+            login_counts = {row['user_id']: row['count'] for row in db.execute('''
+                SELECT user_id, SUM(count) as count
+                FROM user_activity_daily
+                WHERE activity_type = ? AND success = 1
+                GROUP BY user_id
+            ''', (ActivityType.LOGIN_SUCCESS,))}
+
+            activity_counts = {row['user_id']: row['count'] for row in db.execute('''
+                SELECT user_id, SUM(count) as count
+                FROM user_activity_daily
+                GROUP BY user_id
+            ''')}
+
+            last_activity_times = {}
+            for row in db.execute(f'''
+                SELECT user_id, activity_type, MAX(last_at) as last_at
+                FROM user_activity_daily
+                WHERE activity_type IN ({', '.join('?' * len(activity_types))})
+                GROUP BY user_id, activity_type
+            ''', activity_types):
+                last_activity_times.setdefault(row['user_id'], {})[row['activity_type']] = row['last_at']
             
             user_list = []
             for user in users:
@@ -36,18 +71,10 @@ def get_user_activities_summary():
                 username = user['username']
                 
                 # 统计该用户的登录次数
-                login_count = db.execute('''
-                    SELECT COUNT(*) as count
-                    FROM user_activity_log
-                    WHERE user_id = ? AND activity_type = ? AND success = 1
-                ''', (user_id, ActivityType.LOGIN_SUCCESS)).fetchone()['count']
+                login_count = login_counts.get(user_id, 0)
                 
                 # 统计该用户的总活动次数
-                activity_count = db.execute('''
-                    SELECT COUNT(*) as count
-                    FROM user_activity_log
-                    WHERE user_id = ?
-                ''', (user_id,)).fetchone()['count']
+                activity_count = activity_counts.get(user_id, 0)
                 
                 # 获取最后一次登录失败信息
                 last_failed_login = db.execute('''
@@ -59,26 +86,11 @@ def get_user_activities_summary():
                 ''', (user_id, ActivityType.LOGIN_FAILED)).fetchone()
                 
                 # 获取各类活动的最后操作时间
-                last_activities = {}
-                activity_types = [
-                    ActivityType.DOWNLOAD_BOOK,
-                    ActivityType.UPLOAD_BOOK,
-                    ActivityType.SEARCH_BOOKS,
-                    ActivityType.ONLINE_READING_UPDATE_READING_PROGRESS,
-                    ActivityType.PUSH_TO_KINDLE,
-                    ActivityType.GENERATE_AUDIOBOOK
-                ]
-                
-                for act_type in activity_types:
-                    last_act = db.execute('''
-                        SELECT created_at
-                        FROM user_activity_log
-                        WHERE user_id = ? AND activity_type = ?
-                        ORDER BY created_at DESC
-                        LIMIT 1
-                    ''', (user_id, act_type)).fetchone()
-                    if last_act:
-                        last_activities[act_type] = last_act['created_at']
+                last_activities = {
+                    act_type: last_activity_times[user_id][act_type]
+                    for act_type in activity_types
+                    if act_type in last_activity_times.get(user_id, {})
+                }
                 
                 # 判断账户状态
                 is_locked = False
@@ -131,25 +143,25 @@ def get_user_activities_summary():
             # 全局统计信息
             total_users = len(users)
             
-            # 今天活跃用户数
-            today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+            # 今天活跃用户数（user_id 为 0 表示匿名）
+            today = datetime.utcnow().strftime('%Y-%m-%d')
             active_today = db.execute('''
-                SELECT COUNT(DISTINCT user_id) as count
-                FROM user_activity_log
-                WHERE created_at >= ?
-            ''', (today_start,)).fetchone()['count']
+                SELECT COUNT(DISTINCT NULLIF(user_id, 0)) as count
+                FROM user_activity_daily
+                WHERE day >= ?
+            ''', (today,)).fetchone()['count']
             
             # 总登录次数
             total_logins = db.execute('''
-                SELECT COUNT(*) as count
-                FROM user_activity_log
+                SELECT COALESCE(SUM(count), 0) as count
+                FROM user_activity_daily
                 WHERE activity_type = ? AND success = 1
             ''', (ActivityType.LOGIN_SUCCESS,)).fetchone()['count']
             
             # 总活动次数
             total_activities = db.execute('''
-                SELECT COUNT(*) as count
-                FROM user_activity_log
+                SELECT COALESCE(SUM(count), 0) as count
+                FROM user_activity_daily
             ''').fetchone()['count']
             
             # 获取全局各事件统计
@@ -176,20 +188,35 @@ def get_user_activities_summary():
 def get_activities_by_type(event_type):
     """
     获取特定事件类型的所有活动记录
+    除 limit/offset 外也支持游标分页：传入上一页最后一条的 before_time 和 before_id，
+    直接从 (activity_type, created_at) 索引定位，翻到很深的页也不需要跳过前面的记录。
     """
     try:
         limit = request.args.get('limit', 100, type=int)
         offset = request.args.get('offset', 0, type=int)
+        before_time = request.args.get('before_time')
+        before_id = request.args.get('before_id', type=int)
         
+        flush_activity_log()
         with closing(database.get_db()) as db:
-            activities = db.execute('''
-                SELECT id, created_at, username, success, failure_reason,
-                       book_title, library_type, detail, ip_address
-                FROM user_activity_log
-                WHERE activity_type = ?
-                ORDER BY created_at DESC
-                LIMIT ? OFFSET ?
-            ''', (event_type, limit, offset)).fetchall()
+            if before_time and before_id is not None:
+                activities = db.execute('''
+                    SELECT id, created_at, username, success, failure_reason,
+                           book_title, library_type, detail, ip_address
+                    FROM user_activity_log
+                    WHERE activity_type = ? AND (created_at, id) < (?, ?)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ?
+                ''', (event_type, before_time, before_id, limit)).fetchall()
+            else:
+                activities = db.execute('''
+                    SELECT id, created_at, username, success, failure_reason,
+                           book_title, library_type, detail, ip_address
+                    FROM user_activity_log
+                    WHERE activity_type = ?
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT ? OFFSET ?
+                ''', (event_type, limit, offset)).fetchall()
             
             return jsonify([{
                 'id': act['id'],
@@ -252,18 +279,19 @@ def get_event_statistics():
     """
     try:
         days = request.args.get('days', 30, type=int)
-        start_date = (datetime.now() - timedelta(days=days)).isoformat()
+        start_date = (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d')
         
+        flush_activity_log()
         with closing(database.get_db()) as db:
-            # 按事件类型统计
+            # 按事件类型统计（读取按天汇总表）
             event_stats = db.execute('''
                 SELECT 
                     activity_type,
-                    COUNT(*) as total_count,
-                    SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as success_count,
-                    SUM(CASE WHEN success = 0 THEN 1 ELSE 0 END) as failure_count
-                FROM user_activity_log
-                WHERE created_at >= ?
+                    SUM(count) as total_count,
+                    SUM(CASE WHEN success = 1 THEN count ELSE 0 END) as success_count,
+                    SUM(CASE WHEN success = 0 THEN count ELSE 0 END) as failure_count
+                FROM user_activity_daily
+                WHERE day >= ?
                 GROUP BY activity_type
                 ORDER BY total_count DESC
             ''', (start_date,)).fetchall()
@@ -271,12 +299,12 @@ def get_event_statistics():
             # 按日期统计活动趋势
             daily_stats = db.execute('''
                 SELECT
-                    substr(created_at, 1, 10) as date,
-                    COUNT(*) as count,
-                    COUNT(DISTINCT user_id) as unique_users
-                FROM user_activity_log
-                WHERE created_at >= ?
-                GROUP BY substr(created_at, 1, 10)
+                    day as date,
+                    SUM(count) as count,
+                    COUNT(DISTINCT NULLIF(user_id, 0)) as unique_users
+                FROM user_activity_daily
+                WHERE day >= ?
+                GROUP BY day
                 ORDER BY date
             ''', (start_date,)).fetchall()
             
@@ -321,6 +349,7 @@ def lock_user(user_id):
                 WHERE id = ?
             ''', (locked_until_str, user_id))
             db.commit()
+            bump_users_generation()
             
             lock_time_detail = _('permanently') if duration_minutes <= 0 else locked_until.strftime('%Y-%m-%d %H:%M:%S')
             
@@ -362,6 +391,7 @@ def unlock_user(user_id):
                 WHERE id = ?
             ''', (user_id,))
             db.commit()
+            bump_users_generation()
             
             log_activity(
                 ActivityType.UNLOCK_USER,
@@ -396,6 +426,7 @@ def reset_failed_attempts(user_id):
                 WHERE id = ?
             ''', (user_id,))
             db.commit()
+            bump_users_generation()
             
             log_activity(
                 ActivityType.UPDATE_USER,
@@ -419,13 +450,16 @@ def delete_user_activities(user_id):
     删除单个用户的所有活动记录
     """
     try:
+        flush_activity_log()
         with closing(database.get_db()) as db:
             user = db.execute('SELECT username FROM users WHERE id = ?', (user_id,)).fetchone()
             if not user:
                 return jsonify({'error': _('User not found')}), 404
             
             db.execute('DELETE FROM user_activity_log WHERE user_id = ?', (user_id,))
+            db.execute('DELETE FROM user_activity_daily WHERE user_id = ?', (user_id,))
             db.commit()
+            delete_archived_activities(user_id)
             
             log_activity(
                 ActivityType.DELETE_USER_ACTIVITY_LOG,
@@ -449,9 +483,12 @@ def delete_all_activities():
     删除所有用户的活动记录
     """
     try:
+        flush_activity_log()
         with closing(database.get_db()) as db:
             db.execute('DELETE FROM user_activity_log')
+            db.execute('DELETE FROM user_activity_daily')
             db.commit()
+            delete_archived_activities()
             
             log_activity(
                 ActivityType.DELETE_ALL_ACTIVITY_LOGS,
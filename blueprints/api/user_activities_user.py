@@ -5,7 +5,7 @@ from flask import Blueprint, jsonify, g
 from flask_babel import gettext as _
 from contextlib import closing
 import database
-from utils.activity_logger import ActivityType
+from utils.activity_logger import ActivityType, flush_activity_log
 from utils.decorators import login_required
 
 user_activities_user_bp = Blueprint('user_activities_user', __name__, url_prefix='/api/user')
@@ -20,6 +20,7 @@ def get_pushed_to_anx_books():
         return jsonify({'error': _('User not logged in')}), 401
 
     try:
+        flush_activity_log()
         with closing(database.get_db()) as db:
             activities = db.execute('''
                 SELECT DISTINCT book_id
@@ -9,7 +9,10 @@ from contextlib import closing
 import database
 from anx_library import initialize_anx_user_data, get_anx_user_dirs
 from utils.decorators import admin_required_api
+from utils.anx_db import evict_anx_db
+from utils.anx_aggregates import remove_aggregates
 from utils.activity_logger import log_activity, ActivityType
+from utils.user_cache import bump_users_generation
 
 users_bp = Blueprint('users', __name__, url_prefix='/api')
 
@@ -39,6 +42,7 @@ def add_user():
                 (username, hashed_pw, role, kosync_userkey)
             )
             db.commit()
+            bump_users_generation()
             
             # Initialize Anx data structure for the new user
             success, message = initialize_anx_user_data(username)
@@ -81,6 +85,7 @@ def update_user():
                 (username, role, user_id)
             )
         db.commit()
+        bump_users_generation()
         log_activity(ActivityType.UPDATE_USER, username=username, success=True, detail=_('Updated user ID: %(user_id)s, Role: %(role)s', user_id=user_id, role=role))
         return jsonify({'message': _('User updated successfully.')})
 
@@ -98,6 +103,9 @@ def delete_user():
         
         if user_to_delete:
             username = user_to_delete['username']
+            # 先关闭本进程缓存的 Anx 数据库连接，避免删除目录后仍持有已删除的文件句柄
+            evict_anx_db(username)
+            remove_aggregates(username)
             dirs = get_anx_user_dirs(username)
             if dirs and dirs.get('user_root') and os.path.exists(dirs['user_root']):
                 try:
@@ -112,5 +120,6 @@ def delete_user():
         # Now, delete the user from the database
         db.execute('DELETE FROM users WHERE id = ?', (user_id,))
         db.commit()
+        bump_users_generation()
         log_activity(ActivityType.DELETE_USER, username=username, success=True)
         return jsonify({'message': _('User and their data have been successfully deleted.')})
\ No newline at end of file
@@ -6,7 +6,8 @@ from flask_babel import gettext as _
 from contextlib import closing
 import database
 import config_manager
-from utils.activity_logger import log_activity, ActivityType
+from utils.activity_logger import log_activity, ActivityType, flush_activity_log
+from utils.user_cache import bump_users_generation
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -41,6 +42,7 @@ def login():
                     remaining = int((locked_until - datetime.now()).total_seconds() / 60)
                     
                     # 查询管理员设置的锁定原因
+                    flush_activity_log()
                     lock_log = db.execute('''
                         SELECT detail FROM user_activity_log
                         WHERE user_id = ? AND activity_type = ? AND success = 1
@@ -104,6 +106,7 @@ def login():
                     WHERE id = ?
                 ''', (request.remote_addr, user['id']))
                 db.commit()
+                bump_users_generation()
                 
                 session.clear()
                 session['user_id'] = user['id']
@@ -133,6 +136,7 @@ def login():
                         WHERE id = ?
                     ''', (new_attempts, locked_until, user['id']))
                     db.commit()
+                    bump_users_generation()
                     
                     error_msg = _('Too many failed login attempts. Account locked for 30 minutes.')
                     log_activity(
@@ -151,6 +155,7 @@ def login():
                         WHERE id = ?
                     ''', (new_attempts, user['id']))
                     db.commit()
+                    bump_users_generation()
                     
                     remaining_attempts = max_attempts - new_attempts if max_attempts > 0 else None
                     if remaining_attempts is not None and remaining_attempts > 0:
@@ -215,6 +220,7 @@ def setup():
         with closing(database.get_db()) as db:
             db.execute("INSERT INTO users (username, password_hash, role, force_epub_conversion, kosync_userkey) VALUES (?, ?, 'admin', 1, ?)", (username, hashed_password, kosync_userkey))
             db.commit()
+            bump_users_generation()
         
         from anx_library import initialize_anx_user_data
         success, message = initialize_anx_user_data(username)
@@ -303,6 +309,7 @@ def register():
                     ''', (new_uses, user_id, invite_record['id']))
                 
                 db.commit()
+                bump_users_generation()
                 
                 # 记录注册活动
                 log_activity(
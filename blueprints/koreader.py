@@ -1,16 +1,17 @@
 import bcrypt
 import hashlib
-import sqlite3
 from flask import Blueprint, request, jsonify, g
 from contextlib import closing
 import database
-from anx_library import get_anx_user_dirs
+from anx_library import get_anx_user_dirs, get_anx_db
 from utils.koreader import convert_koreader_progress
 import os
 import json
 from datetime import datetime
 import logging
 from utils.activity_logger import log_activity, ActivityType
+from utils.user_cache import bump_users_generation
+from utils.progress_buffer import record_progress, add_reading_time, overlay_progress, get_pending_reading_time
 
 koreader_bp = Blueprint('koreader', __name__, url_prefix='/koreader')
 
@@ -83,6 +84,7 @@ def create_user():
         with closing(database.get_db()) as db:
             db.execute("UPDATE users SET kosync_userkey = ? WHERE id = ?", (userkey, user['id']))
             db.commit()
+            bump_users_generation()
         return jsonify({'userkey': userkey}), 201
     else:
         return jsonify({'message': 'Invalid credentials.'}), 401
@@ -97,8 +99,7 @@ def get_progress(document):
     if not dirs or not os.path.exists(dirs["db_path"]):
         return jsonify({'message': 'Anx library not found.'}), 404
 
-    with closing(sqlite3.connect(dirs["db_path"])) as db:
-        db.row_factory = sqlite3.Row
+    with closing(get_anx_db(user['username'])) as db:
         cursor = db.cursor()
         cursor.execute("SELECT * FROM tb_books WHERE file_md5 = ? AND is_deleted = 0", (document,))
         book = cursor.fetchone()
@@ -106,6 +107,7 @@ def get_progress(document):
         if not book:
             return jsonify({'message': 'Document not found.'}), 404
 
+        book = overlay_progress(user['username'], book)
         cfi = book['last_read_position']
         if not cfi:
             return jsonify({'message': 'No progress found for this document.'}), 404
@@ -151,8 +153,7 @@ def update_progress():
     if not dirs or not os.path.exists(dirs["db_path"]):
         return jsonify({'message': 'Anx library not found.'}), 404
 
-    with closing(sqlite3.connect(dirs["db_path"])) as db:
-        db.row_factory = sqlite3.Row
+    with closing(get_anx_db(user['username'])) as db:
         cursor = db.cursor()
         cursor.execute("SELECT * FROM tb_books WHERE file_md5 = ? AND is_deleted = 0", (document_digest,))
         book = cursor.fetchone()
@@ -167,12 +168,7 @@ def update_progress():
             return jsonify({'message': f'Failed to convert progress: {err}'}), 500
 
         current_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')
-        cursor.execute("""
-            UPDATE tb_books
-            SET last_read_position = ?, reading_percentage = ?, update_time = ?
-            WHERE id = ?
-        """, (cfi, percentage, current_time, book['id']))
-        db.commit()
+        record_progress(user['username'], book['id'], cfi, percentage, current_time)
         
         # 记录KOReader同步进度活动
         log_activity(ActivityType.KOREADER_SYNC_PROGRESS, book_id=book['id'], library_type='anx', success=True)
@@ -197,8 +193,7 @@ def update_reading_time():
     if not dirs or not os.path.exists(dirs["db_path"]):
         return jsonify({'message': 'Anx library not found.'}), 404
 
-    with closing(sqlite3.connect(dirs["db_path"])) as db:
-        db.row_factory = sqlite3.Row
+    with closing(get_anx_db(user['username'])) as db:
         cursor = db.cursor()
         cursor.execute("SELECT * FROM tb_books WHERE file_md5 = ? AND is_deleted = 0", (document_digest,))
         book = cursor.fetchone()
@@ -206,18 +201,8 @@ def update_reading_time():
         if not book:
             return jsonify({'message': 'Document not found.'}), 404
 
-        # Check if a record for this book and date already exists
-        cursor.execute("SELECT id, reading_time FROM tb_reading_time WHERE book_id = ? AND date = ?", (book['id'], date))
-        existing_record = cursor.fetchone()
-
-        if existing_record:
-            # If it exists, update it
-            new_reading_time = existing_record['reading_time'] + reading_time
-            cursor.execute("UPDATE tb_reading_time SET reading_time = ? WHERE id = ?", (new_reading_time, existing_record['id']))
-        else:
-            # If not, insert a new record
-            cursor.execute("INSERT INTO tb_reading_time (book_id, date, reading_time) VALUES (?, ?, ?)", (book['id'], date, reading_time))
-        db.commit()
+        # 累加到写回缓冲，写入时再合并到 (book_id, date) 对应的记录
+        add_reading_time(user['username'], book['id'], date, reading_time)
         
         # 记录KOReader同步阅读时间活动
         log_activity(ActivityType.KOREADER_SYNC_READING_TIME, book_id=book['id'], library_type='anx', success=True, detail=f'{reading_time}s')
@@ -243,8 +228,7 @@ def update_summary():
     if not dirs or not os.path.exists(dirs["db_path"]):
         return jsonify({'message': 'Anx library not found.'}), 404
 
-    with closing(sqlite3.connect(dirs["db_path"])) as db:
-        db.row_factory = sqlite3.Row
+    with closing(get_anx_db(user['username'])) as db:
         cursor = db.cursor()
         cursor.execute("SELECT * FROM tb_books WHERE file_md5 = ? AND is_deleted = 0", (document_digest,))
         book = cursor.fetchone()
@@ -275,8 +259,7 @@ def get_book_details(document):
     if not dirs or not os.path.exists(dirs["db_path"]):
         return jsonify({'message': 'Anx library not found.'}), 404
 
-    with closing(sqlite3.connect(dirs["db_path"])) as db:
-        db.row_factory = sqlite3.Row
+    with closing(get_anx_db(user['username'])) as db:
         cursor = db.cursor()
         cursor.execute("SELECT * FROM tb_books WHERE file_md5 = ? AND is_deleted = 0", (document,))
         book = cursor.fetchone()
@@ -284,9 +267,7 @@ def get_book_details(document):
         if not book:
             return jsonify({'message': 'Document not found.'}), 404
 
-        # Fetch reading time records
-        cursor.execute("SELECT date, reading_time FROM tb_reading_time WHERE book_id = ?", (book['id'],))
-        reading_time_records = cursor.fetchall()
+        book = overlay_progress(user['username'], book)
 
         return jsonify({
             'rating': book['rating'],
@@ -304,8 +285,7 @@ def get_book_stats(document):
     if not dirs or not os.path.exists(dirs["db_path"]):
         return jsonify({'message': 'Anx library not found.'}), 404
 
-    with closing(sqlite3.connect(dirs["db_path"])) as db:
-        db.row_factory = sqlite3.Row
+    with closing(get_anx_db(user['username'])) as db:
         cursor = db.cursor()
         cursor.execute("SELECT * FROM tb_books WHERE file_md5 = ? AND is_deleted = 0", (document,))
         book = cursor.fetchone()
@@ -315,10 +295,12 @@ def get_book_stats(document):
 
         # Fetch reading time records
         cursor.execute("SELECT date, reading_time FROM tb_reading_time WHERE book_id = ?", (book['id'],))
-        reading_time_records = cursor.fetchall()
+        reading_time_by_date = {row['date']: row['reading_time'] for row in cursor.fetchall()}
+        for (_, date), seconds in get_pending_reading_time(user['username'], book['id']).items():
+            reading_time_by_date[date] = reading_time_by_date.get(date, 0) + seconds
 
-        total_days = len(reading_time_records)
-        total_time_book = sum(row['reading_time'] for row in reading_time_records)
+        total_days = len(reading_time_by_date)
+        total_time_book = sum(reading_time_by_date.values())
 
         return jsonify({
             'total_days': total_days,
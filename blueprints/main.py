@@ -1,27 +1,126 @@
 import math
 import re
 import requests
-import io
 import os
 from urllib.parse import urlencode
-from flask import Blueprint, render_template, request, g, redirect, url_for, send_from_directory, send_file, make_response
+from flask import Blueprint, render_template, request, g, redirect, url_for, send_from_directory, make_response
 from flask_babel import gettext as _
+from werkzeug.security import safe_join
 from requests.auth import HTTPDigestAuth
 import json
+import threading
+from collections import OrderedDict
+from contextlib import closing
 
 import config_manager
 from database import get_db
 from anx_library import get_anx_books
 from utils.text import safe_title, safe_author
-from utils.auth import get_calibre_auth
-from utils.covers import get_calibre_cover_data
+from utils.calibre_client import calibre_get, get_calibre_health
+from utils.calibre_mirror import query_mirror, fetch_books
+from utils.cover_thumbnails import pick_width, calibre_cover_version, resolve_calibre_cover, latest_calibre_cover, resolve_file_cover, cover_response
 from utils.decorators import login_required
 
 main_bp = Blueprint('main', __name__)
 
-def get_calibre_books(search_query="", page=1, page_size=20):
+def _add_format_sizes(books):
+    def format_bytes(size):
+        if not size or size == 0: return "0B"
+        power = 1024
+        n = 0
+        power_labels = {0: 'B', 1: 'KB', 2: 'MB', 3: 'GB', 4: 'TB'}
+        while size >= power and n < len(power_labels) - 1:
+            size /= power
+            n += 1
+        return f"{size:.1f} {power_labels[n]}"
+
+    for book in books:
+        formats_with_sizes = []
+        format_metadata = book.get('format_metadata', {})
+        if isinstance(format_metadata, dict):
+            for fmt, details in format_metadata.items():
+                size = details.get('size', 0)
+                formats_with_sizes.append(f"{fmt.upper()} ({format_bytes(size)})")
+        
+        book['formats_with_sizes'] = formats_with_sizes
+        book['formats'] = list(format_metadata.keys()) if isinstance(format_metadata, dict) else []
+
+# 各视图需要的 Calibre 字段：list 为首页书籍列表（模板和编辑表单），mcp 为 MCP 工具输出
+FIELD_PROFILES = {
+    'list': {
+        'fields': ('title', 'authors', 'tags', 'series', 'series_index', 'rating', 'publisher', 'pubdate',
+                   'comments', 'last_modified', 'format_metadata', 'user_metadata'),
+        'user_metadata': ('#library', '#readdate'),
+    },
+    'mcp': {
+        'fields': ('application_id', 'title', 'authors', 'tags', 'series', 'publisher', 'pubdate',
+                   'comments', 'rating', 'format_metadata'),
+        'user_metadata': (),
+    },
+}
+
+def _profile_fields_param(profile):
+    if profile not in FIELD_PROFILES:
+        return 'all'
+    return ','.join(FIELD_PROFILES[profile]['fields'])
+
+def project_book(book, profile):
+    """只保留 profile 需要的字段；format_metadata 只保留大小，自定义列只保留取值"""
+    spec = FIELD_PROFILES.get(profile)
+    if not spec or not book:
+        return book
+    projected = {'id': book.get('id')}
+    for field in spec['fields']:
+        if field in book:
+            projected[field] = book[field]
+    if 'formats_with_sizes' in book:
+        projected['formats_with_sizes'] = book['formats_with_sizes']
+    format_metadata = projected.get('format_metadata')
+    if isinstance(format_metadata, dict):
+        projected['format_metadata'] = {fmt: {'size': (details or {}).get('size', 0)} for fmt, details in format_metadata.items()}
+    if 'user_metadata' in spec['fields']:
+        user_metadata = book.get('user_metadata') or {}
+        projected['user_metadata'] = {
+            key: {'#value#': (user_metadata.get(key) or {}).get('#value#')}
+            for key in spec['user_metadata'] if key in user_metadata
+        }
+    return projected
+
+# 镜像处理不了的查询（Calibre 搜索语法、镜像未同步）最近的结果，Calibre 不可用时返回这些旧结果
+_LIVE_LISTINGS_MAX = 64
+_live_listings = OrderedDict()
+_live_listings_lock = threading.Lock()
+
+def _remember_listing(key, books, total):
+    with _live_listings_lock:
+        _live_listings[key] = (books, total)
+        _live_listings.move_to_end(key)
+        while len(_live_listings) > _LIVE_LISTINGS_MAX:
+            _live_listings.popitem(last=False)
+
+def _stale_listing(key, error):
+    unavailable = isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)) or (
+        isinstance(error, requests.exceptions.HTTPError) and error.response is not None and error.response.status_code >= 500)
+    if not unavailable:
+        return None
+    with _live_listings_lock:
+        return _live_listings.get(key)
+
+def get_calibre_books(search_query="", page=1, page_size=20, profile='list'):
+    """
+    返回 (books, total, error)。profile 决定每本书保留哪些字段（见 FIELD_PROFILES），
+    'all' 保留 Calibre 返回的全部字段。Calibre 不可用时尽量返回镜像或最近一次的结果。
+    """
+    # 列表和简单搜索优先使用本地镜像，不依赖 Calibre 服务器的响应速度
+    mirrored = query_mirror(search_query, page, page_size)
+    if mirrored is not None:
+        books, total_books = mirrored
+        _add_format_sizes(books)
+        return [project_book(book, profile) for book in books], total_books, None
+
     config = config_manager.config
     full_url = config.get('CALIBRE_URL', '')
+    listing_key = (full_url, config.get('CALIBRE_DEFAULT_LIBRARY_ID', 'Calibre_Library'), search_query, page, page_size, profile)
     try:
         library_id = config.get('CALIBRE_DEFAULT_LIBRARY_ID', 'Calibre_Library')
         offset = (page - 1) * page_size
@@ -31,59 +130,41 @@ def get_calibre_books(search_query="", page=1, page_size=20):
         base_url = f"{config['CALIBRE_URL']}/ajax/search"
         full_url = f"{base_url}?{urlencode(search_params)}"
 
-        search_response = requests.get(base_url, params=search_params, auth=get_calibre_auth(), headers=headers)
+        search_response = calibre_get(base_url, params=search_params, headers=headers)
         search_response.raise_for_status()
         search_data = search_response.json()
         book_ids = search_data.get('book_ids', [])
         total_books = search_data.get('total_num', 0)
-        if not book_ids: return [], 0, None
-        books_data = {}
-        chunk_size = 100
-        for i in range(0, len(book_ids), chunk_size):
-            chunk = book_ids[i:i + chunk_size]
-            if not chunk: continue
-            requested_fields = 'all'
-            books_params = {'ids': ",".join(map(str, chunk)), 'library_id': library_id, 'fields': requested_fields}
-            books_response = requests.get(f"{config['CALIBRE_URL']}/ajax/books", params=books_params, auth=get_calibre_auth(), headers=headers)
-            books_response.raise_for_status()
-            books_data.update(books_response.json())
+        if not book_ids:
+            _remember_listing(listing_key, [], total_books)
+            return [], 0, None
+        # 只请求当前视图需要的字段，多个块并行获取
+        books_data = fetch_books(book_ids, fields=_profile_fields_param(profile))
 
         books = []
         for bid in book_ids:
-            bid_str = str(bid)
-            if bid_str in books_data:
-                book_dict = books_data[bid_str]
-                if book_dict:
-                    book_dict['id'] = bid
-                    books.append(book_dict)
+            book_dict = books_data.get(bid)
+            if book_dict:
+                book_dict['id'] = bid
+                books.append(book_dict)
         
-        def format_bytes(size):
-            if not size or size == 0: return "0B"
-            power = 1024
-            n = 0
-            power_labels = {0: 'B', 1: 'KB', 2: 'MB', 3: 'GB', 4: 'TB'}
-            while size >= power and n < len(power_labels) - 1:
-                size /= power
-                n += 1
-            return f"{size:.1f} {power_labels[n]}"
-
-        for book in books:
-            formats_with_sizes = []
-            format_metadata = book.get('format_metadata', {})
-            if isinstance(format_metadata, dict):
-                for fmt, details in format_metadata.items():
-                    size = details.get('size', 0)
-                    formats_with_sizes.append(f"{fmt.upper()} ({format_bytes(size)})")
-            
-            book['formats_with_sizes'] = formats_with_sizes
-            book['formats'] = list(format_metadata.keys()) if isinstance(format_metadata, dict) else []
-
+        _add_format_sizes(books)
+        books = [project_book(book, profile) for book in books]
+        _remember_listing(listing_key, books, total_books)
         return books, total_books, None
-    except requests.exceptions.ConnectionError as e:
-        print(f"Error getting Calibre books: {e}")
+    except requests.exceptions.RequestException as e:
+        stale = _stale_listing(listing_key, e)
+        if stale is None:
+            return _calibre_books_error(e, full_url)
+        print(f"Calibre unavailable, serving cached listing: {e}")
+        books, total_books = stale
+        return [dict(book) for book in books], total_books, None
+
+def _calibre_books_error(e, full_url):
+    print(f"Error getting Calibre books: {e}")
+    if isinstance(e, requests.exceptions.ConnectionError):
         return [], 0, {'code': 'CONNECTION_ERROR', 'message': str(e), 'calibre_url': full_url}
-    except requests.exceptions.HTTPError as e:
-        print(f"Error getting Calibre books: {e}")
+    if isinstance(e, requests.exceptions.HTTPError):
         error_info = {'message': str(e), 'calibre_url': e.response.url}
         if e.response.status_code == 401:
             error_info['code'] = 'UNAUTHORIZED'
@@ -93,10 +174,8 @@ def get_calibre_books(search_query="", page=1, page_size=20):
             error_info['code'] = 'HTTP_ERROR'
             error_info['status_code'] = e.response.status_code
         return [], 0, error_info
-    except requests.exceptions.RequestException as e:
-        print(f"Error getting Calibre books: {e}")
-        url_from_req = e.request.url if e.request else full_url
-        return [], 0, {'code': 'REQUEST_EXCEPTION', 'message': str(e), 'calibre_url': url_from_req}
+    url_from_req = e.request.url if e.request else full_url
+    return [], 0, {'code': 'REQUEST_EXCEPTION', 'message': str(e), 'calibre_url': url_from_req}
 
 def format_reading_time(seconds):
     if not seconds or seconds == 0:
@@ -127,7 +206,8 @@ def index():
                            anx_books=anx_books,
                            search_query=search_query,
                            pagination=pagination,
-                           calibre_error=calibre_error))
+                           calibre_error=calibre_error,
+                           calibre_health=get_calibre_health()))
     response.headers['Accept-CH'] = 'Sec-CH-Prefers-Color-Scheme'
     return response
 @main_bp.route('/sw.js')
@@ -215,12 +295,30 @@ def audio_player_page():
 @main_bp.route('/calibre_cover/<int:book_id>')
 @login_required
 def calibre_cover(book_id):
-    cover_content = get_calibre_cover_data(book_id)
-    if cover_content:
-        return send_file(io.BytesIO(cover_content), mimetype='image/jpeg')
+    # ?w= 请求缩略图宽度；?v= 为书籍的 last_modified，与当前版本一致时允许浏览器长期缓存
+    width = pick_width(request.args.get('w'))
+    version = calibre_cover_version(book_id)
+    sha = resolve_calibre_cover(book_id, version)
+    if sha:
+        immutable = bool(version) and request.args.get('v') == version
+        response = cover_response(sha, width, immutable=immutable)
+        if response:
+            return response
+    # Calibre 不可用时使用旧版本的封面，不允许长期缓存，恢复后浏览器重新验证即可拿到新封面
+    sha = latest_calibre_cover(book_id)
+    response = cover_response(sha, width) if sha else None
+    if response:
+        return response
     return redirect("https://via.placeholder.com/150x220.png?text=Cover+Error")
 
 
+def _anx_cover_response(full_data_dir, cover_path):
+    cover_full_path = safe_join(full_data_dir, cover_path)
+    sha = resolve_file_cover(cover_full_path) if cover_full_path else None
+    response = cover_response(sha, pick_width(request.args.get('w'))) if sha else None
+    return response or redirect("https://via.placeholder.com/150x220.png?text=Cover+Error")
+
+
 @main_bp.route('/anx_cover/<path:cover_path>')
 @login_required
 def anx_cover(cover_path):
@@ -230,12 +328,12 @@ def anx_cover(cover_path):
     
     safe_username = os.path.basename(g.user.username)
     full_data_dir = os.path.join(webdav_root, safe_username, 'anx', 'data')
-    return send_from_directory(full_data_dir, cover_path)
+    return _anx_cover_response(full_data_dir, cover_path)
 
 @main_bp.route('/anx_cover_public/<username>/<path:cover_path>')
 def anx_cover_public(username, cover_path):
-    db = get_db()
-    user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+    with closing(get_db()) as db:
+        user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
 
     # Allow access if the user is logged in and accessing their own cover, or if the stats are public
     is_owner = g.user and hasattr(g.user, 'username') and g.user.username == username
@@ -248,8 +346,4 @@ def anx_cover_public(username, cover_path):
 
     safe_username = os.path.basename(user['username'])
     full_data_dir = os.path.join(webdav_root, safe_username, 'anx', 'data')
-    
-    if not os.path.exists(os.path.join(full_data_dir, cover_path)):
-        return redirect("https://via.placeholder.com/150x220.png?text=Cover+Error")
-
-    return send_from_directory(full_data_dir, cover_path)
\ No newline at end of file
+    return _anx_cover_response(full_data_dir, cover_path)
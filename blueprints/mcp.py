@@ -17,6 +17,8 @@ from .main import get_calibre_books
 # Rename the original function to avoid conflicts
 from .api.calibre import get_calibre_book_details as get_raw_calibre_book_details
 from .api.books import _push_calibre_to_anx_logic, _send_to_kindle_logic, _push_anx_to_calibre_logic
+from .api.book_jobs import start_book_job
+from utils.book_jobs import get_book_job, get_book_job_row
 from anx_library import get_anx_books, get_anx_book_details as get_raw_anx_book_details
 from utils.epub_chapter_parser import get_parsed_chapters
 from utils.epub_utils import _count_words
@@ -84,13 +86,13 @@ def search_calibre_books(search_expression: str, limit: int = 20):
     根据一个搜索表达式在 Calibre 书库中搜索书籍。
     该函数直接使用 Calibre 强大的搜索查询语言。
     """
-    books, _total_books, _error = get_calibre_books(search_query=search_expression, page=1, page_size=limit)
+    books, _total_books, _error = get_calibre_books(search_query=search_expression, page=1, page_size=limit, profile='mcp')
     return [format_calibre_book_data_for_mcp(book) for book in books if book]
 
 def get_recent_books(library_type: str, limit: int = 20):
     """获取指定书库（'anx' 或 'calibre'）中最近添加的书籍列表。"""
     if library_type == 'calibre':
-        books, _total_books, _error = get_calibre_books(page=1, page_size=limit)
+        books, _total_books, _error = get_calibre_books(page=1, page_size=limit, profile='mcp')
         return [format_calibre_book_data_for_mcp(book) for book in books if book]
     elif library_type == 'anx':
         books = get_anx_books(g.user['username'])
@@ -117,6 +119,22 @@ def send_calibre_book_to_kindle(book_id: int):
 def push_anx_book_to_calibre(book_id: int):
     return _push_anx_to_calibre_logic(dict(g.user), book_id)
 
+def bulk_push_calibre_books(action: str, book_ids: str, search_expression: str):
+    """批量推送到 Anx 或发送到 Kindle，立即返回任务 ID，进度用 get_book_job_status 查询。"""
+    result, error, _status = start_book_job(
+        dict(g.user), g.user['id'], action,
+        book_ids=book_ids, search=(search_expression or '').strip() or None
+    )
+    if error:
+        return {"error": error}
+    return result
+
+def get_book_job_status(job_id: str):
+    job = get_book_job_row(job_id)
+    if not job or job['user_id'] != g.user['id']:
+        return {"error": "任务不存在。"}
+    return get_book_job(job_id)
+
 def get_table_of_contents(library_type: str, book_id: int):
     """获取指定书籍的目录章节列表。如果书籍不是 EPUB 格式，会自动尝试转换。"""
     try:
@@ -127,8 +145,8 @@ def get_table_of_contents(library_type: str, book_id: int):
             book_details = get_raw_calibre_book_details(book_id)
             book_title = book_details.get('title', 'N/A')
         elif library_type == 'anx':
-            book_details = get_raw_anx_book_details(g.user['username'], book_id, as_dict=True)
-            book_title = book_details.get('title', 'N/A') if book_details else 'N/A'
+            book_title, _unused = get_raw_anx_book_details(g.user['username'], book_id)
+            book_title = book_title or 'N/A'
         else:
             return {"error": "无效的书库类型。请使用 'calibre' 或 'anx'。"}
 
@@ -155,8 +173,8 @@ def get_chapter_content(library_type: str, book_id: int, chapter_number: int):
             book_details = get_raw_calibre_book_details(book_id)
             book_title = book_details.get('title', 'N/A')
         elif library_type == 'anx':
-            book_details = get_raw_anx_book_details(g.user['username'], book_id, as_dict=True)
-            book_title = book_details.get('title', 'N/A') if book_details else 'N/A'
+            book_title, _unused = get_raw_anx_book_details(g.user['username'], book_id)
+            book_title = book_title or 'N/A'
         else:
             return {"error": "无效的书库类型。请使用 'calibre' 或 'anx'。"}
 
@@ -183,8 +201,8 @@ def get_entire_book_content(library_type: str, book_id: int):
             book_details = get_raw_calibre_book_details(book_id)
             book_title = book_details.get('title', 'N/A')
         elif library_type == 'anx':
-            book_details = get_raw_anx_book_details(g.user['username'], book_id, as_dict=True)
-            book_title = book_details.get('title', 'N/A') if book_details else 'N/A'
+            book_title, _unused = get_raw_anx_book_details(g.user['username'], book_id)
+            book_title = book_title or 'N/A'
         else:
             return {"error": "无效的书库类型。请使用 'calibre' 或 'anx'。"}
 
@@ -217,8 +235,8 @@ def get_word_count_statistics(library_type: str, book_id: int):
             book_details = get_raw_calibre_book_details(book_id)
             book_title = book_details.get('title', 'N/A')
         elif library_type == 'anx':
-            book_details = get_raw_anx_book_details(g.user['username'], book_id, as_dict=True)
-            book_title = book_details.get('title', 'N/A') if book_details else 'N/A'
+            book_title, _unused = get_raw_anx_book_details(g.user['username'], book_id)
+            book_title = book_title or 'N/A'
         else:
             return {"error": "无效的书库类型。请使用 'calibre' 或 'anx'。"}
 
@@ -370,6 +388,16 @@ TOOLS = {
         'params': {'book_id': int},
         'description': '将指定的 Calibre 书籍发送到当前用户配置的 Kindle 邮箱。'
     },
+    'bulk_push_calibre_books': {
+        'function': bulk_push_calibre_books,
+        'params': {'action': str, 'book_ids': str, 'search_expression': str},
+        'description': "批量处理多本 Calibre 书籍，作为一个后台任务运行。action: 'push_to_anx' (推送到用户的 Anx 书库) 或 'send_to_kindle' (发送到 Kindle 邮箱)。book_ids 为逗号分隔的书籍 ID（如 \"12,13,14\"），search_expression 为 Calibre 搜索表达式（如 series:\"三体\"），两者填一个，另一个留空；search_expression 优先。返回 job_id，用 get_book_job_status 查询每本书的进度。"
+    },
+    'get_book_job_status': {
+        'function': get_book_job_status,
+        'params': {'job_id': str},
+        'description': '通过任务 ID 获取批量推送 / 发送任务的状态，包括每本书的进度和结果。'
+    },
     'get_table_of_contents': {
         'function': get_table_of_contents,
         'params': {'library_type': str, 'book_id': int},
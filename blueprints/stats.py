@@ -1,5 +1,4 @@
 import datetime
-import sqlite3
 import os
 from flask import (
     Blueprint, render_template, g, abort
@@ -7,7 +6,8 @@ from flask import (
 from flask_babel import gettext as _
 from contextlib import closing
 import database
-from anx_library import get_anx_user_dirs
+from anx_library import get_anx_user_dirs, get_anx_db
+from utils.progress_buffer import flush_progress
 
 bp = Blueprint('stats', __name__, url_prefix='/stats')
 
@@ -22,8 +22,8 @@ def format_reading_time(seconds):
 
 @bp.route('/<username>')
 def user_stats(username):
-    db = database.get_db()
-    user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+    with closing(database.get_db()) as db:
+        user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
 
     if user is None:
         abort(404)
@@ -40,8 +40,8 @@ def user_stats(username):
     if not dirs or not os.path.exists(dirs["db_path"]):
         return _("Anx library not found for this user."), 404
 
-    with closing(sqlite3.connect(dirs["db_path"])) as user_db:
-        user_db.row_factory = sqlite3.Row
+    flush_progress(user['username'])
+    with closing(get_anx_db(user['username'])) as user_db:
         cursor = user_db.cursor()
 
         # --- 摘要统计 ---
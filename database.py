@@ -2,25 +2,139 @@ import sqlite3
 import os
 import json
 import fcntl
+import queue
+import threading
 import time
 from contextlib import closing
 from config_manager import DATABASE_PATH
 
 DEFAULT_FORMAT_PRIORITY = json.dumps(["azw3", "mobi", "epub", "fb2", "txt", "pdf"])
 
+# 连接池设置。DB_POOL_SIZE=0 时退回到每次调用都新建连接的旧行为。
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 8192))
+
+
+class PooledConnection:
+    """
+    借出的连接的轻量包装。
+    除 close() 外所有属性都转发给底层的 sqlite3.Connection，
+    close() 不会真正关闭连接，而是把它归还给连接池，
+    因此现有的 `with closing(get_db()) as db:` 写法无需修改。
+    """
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a connection that has been returned to the pool.")
+        return getattr(conn, name)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._conn.__exit__(exc_type, exc_value, traceback)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool.release(conn)
+
+    def __del__(self):
+        # 兜底：忘记关闭的连接在被回收时也会归还到池中
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    每个 worker 进程内共享的 app.db 连接池（LIFO，优先复用最热的连接）。
+    PRAGMA 只在新建连接时设置一次；池被借空时临时新建连接，
+    归还时如果池已满则直接关闭，因此嵌套的 get_db() 调用不会互相阻塞。
+    """
+    def __init__(self, database_path, size):
+        self.database_path = database_path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self.stats = {'opened': 0, 'reused': 0, 'closed': 0}
+
+    def _connect(self):
+        # isolation_level=None enables autocommit mode, which can help with write-then-read consistency.
+        conn = sqlite3.connect(self.database_path, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+        with self._lock:
+            self.stats['opened'] += 1
+        return conn
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self.stats['reused'] += 1
+        except queue.Empty:
+            conn = self._connect()
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+            with self._lock:
+                self.stats['closed'] += 1
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """获取当前进程的连接池。fork 之后（gunicorn worker）会重新创建，避免跨进程共享连接。"""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
+                _pool = ConnectionPool(DATABASE_PATH, DB_POOL_SIZE)
+                _pool_pid = pid
+    return _pool
+
 def get_db():
-    """获取数据库连接"""
-    db_dir = os.path.dirname(DATABASE_PATH)
-    os.makedirs(db_dir, exist_ok=True)
-    # isolation_level=None enables autocommit mode, which can help with write-then-read consistency.
-    conn = sqlite3.connect(DATABASE_PATH, isolation_level=None)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """从连接池借出一个数据库连接，调用 close() 即归还"""
+    if DB_POOL_SIZE <= 0:
+        os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
+        conn = sqlite3.connect(DATABASE_PATH, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+    return get_pool().acquire()
 
-def update_schema_if_needed(db):
-    """检查并添加新列或表，以实现简单的数据库迁移"""
-    cursor = db.cursor()
-    
+def _migrate_legacy_schema(cursor):
+    """
+    v1：把引入版本号之前创建的数据库补齐到当前结构。
+    这些探测原本每次启动都会执行，现在只会在 user_version 为 0 的旧库上执行一次。
+    """
     # 检查 users 表的列
     cursor.execute("PRAGMA table_info(users)")
     columns = [row['name'] for row in cursor.fetchall()]
@@ -31,56 +145,46 @@ def update_schema_if_needed(db):
         cursor.execute("UPDATE users SET role = 'admin' WHERE is_admin = 1")
         # We can drop the old column if we want, but it's safer to leave it for now.
         cursor.execute('ALTER TABLE users DROP COLUMN is_admin')
-        db.commit()
 
     if 'kindle_email' not in columns:
         print("Migrating database: adding 'kindle_email' column to users table.")
         cursor.execute('ALTER TABLE users ADD COLUMN kindle_email TEXT')
-        db.commit()
 
     if 'theme' not in columns:
         print("Migrating database: adding 'theme' column to users table.")
         cursor.execute("ALTER TABLE users ADD COLUMN theme TEXT DEFAULT 'auto'")
-        db.commit()
 
     if 'force_epub_conversion' not in columns:
         print("Migrating database: adding 'force_epub_conversion' column to users table.")
         cursor.execute('ALTER TABLE users ADD COLUMN force_epub_conversion INTEGER NOT NULL DEFAULT 1')
-        db.commit()
 
     if 'kosync_userkey' not in columns:
         print("Migrating database: adding 'kosync_userkey' column to users table.")
         cursor.execute('ALTER TABLE users ADD COLUMN kosync_userkey TEXT')
-        db.commit()
 
     # 检查 mcp_tokens 表是否存在
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='mcp_tokens'")
     if cursor.fetchone() is None:
         print("Migrating database: creating 'mcp_tokens' table.")
         create_mcp_tokens_table(cursor)
-        db.commit()
 
     # 检查 invite_codes 表是否存在
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='invite_codes'")
     if cursor.fetchone() is None:
         print("Migrating database: creating 'invite_codes' table.")
         create_invite_codes_table(cursor)
-        db.commit()
 
     if 'stats_enabled' not in columns:
         print("Migrating database: adding 'stats_enabled' column to users table.")
         cursor.execute('ALTER TABLE users ADD COLUMN stats_enabled INTEGER NOT NULL DEFAULT 1')
-        db.commit()
 
     if 'stats_public' not in columns:
         print("Migrating database: adding 'stats_public' column to users table.")
         cursor.execute('ALTER TABLE users ADD COLUMN stats_public INTEGER NOT NULL DEFAULT 0')
-        db.commit()
 
     if 'language' not in columns:
         print("Migrating database: adding 'language' column to users table.")
         cursor.execute("ALTER TABLE users ADD COLUMN language TEXT DEFAULT 'zh_Hans'")
-        db.commit()
 
     # Add TTS settings columns
     tts_columns = {
@@ -99,7 +203,6 @@ def update_schema_if_needed(db):
         if col not in columns:
             print(f"Migrating database: adding '{col}' column to users table.")
             cursor.execute(f"ALTER TABLE users ADD COLUMN {col} {col_type}")
-            db.commit()
 
     # Add LLM settings columns
     llm_columns = {
@@ -112,7 +215,6 @@ def update_schema_if_needed(db):
         if col not in columns:
             print(f"Migrating database: adding '{col}' column to users table.")
             cursor.execute(f"ALTER TABLE users ADD COLUMN {col} {col_type}")
-            db.commit()
     
     # Add login lockout columns
     lockout_columns = {
@@ -125,14 +227,12 @@ def update_schema_if_needed(db):
         if col not in columns:
             print(f"Migrating database: adding '{col}' column to users table.")
             cursor.execute(f"ALTER TABLE users ADD COLUMN {col} {col_type}")
-            db.commit()
 
     # 检查 audiobook_tasks 表是否存在
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='audiobook_tasks'")
     if cursor.fetchone() is None:
         print("Migrating database: creating 'audiobook_tasks' table.")
         create_audiobook_tasks_table(cursor)
-        db.commit()
     else:
         # 如果表已存在，检查是否需要迁移 message -> status_key
         cursor.execute("PRAGMA table_info(audiobook_tasks)")
@@ -142,19 +242,16 @@ def update_schema_if_needed(db):
             # 使用 ALTER TABLE RENAME COLUMN (SQLite 3.25.0+)
             cursor.execute("ALTER TABLE audiobook_tasks RENAME COLUMN message TO status_key")
             cursor.execute("ALTER TABLE audiobook_tasks ADD COLUMN status_params TEXT")
-            db.commit()
         elif 'status_key' not in task_columns:
              # 兼容非常旧的、没有 message 列的版本
              cursor.execute("ALTER TABLE audiobook_tasks ADD COLUMN status_key TEXT")
              cursor.execute("ALTER TABLE audiobook_tasks ADD COLUMN status_params TEXT")
-             db.commit()
 
     # 检查 audiobook_progress 表是否存在
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='audiobook_progress'")
     if cursor.fetchone() is None:
         print("Migrating database: creating 'audiobook_progress' table.")
         create_audiobook_progress_table(cursor)
-        db.commit()
     else:
         # 如果表已存在，检查是否需要添加 playback_rate 列
         cursor.execute("PRAGMA table_info(audiobook_progress)")
@@ -162,38 +259,119 @@ def update_schema_if_needed(db):
         if 'playback_rate' not in progress_columns:
             print("Migrating database: adding 'playback_rate' column to audiobook_progress table.")
             cursor.execute("ALTER TABLE audiobook_progress ADD COLUMN playback_rate REAL DEFAULT 1.0")
-            db.commit()
         if 'chapter_index' not in progress_columns:
             print("Migrating database: adding 'chapter_index' column to audiobook_progress table.")
             cursor.execute("ALTER TABLE audiobook_progress ADD COLUMN chapter_index INTEGER")
-            db.commit()
     
-        # 检查 LLM 聊天表是否存在
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='llm_chat_sessions'")
-        if cursor.fetchone() is None:
-            print("Migrating database: creating 'llm_chat_sessions' table.")
-            create_llm_chat_sessions_table(cursor)
-            db.commit()
+    # 检查 LLM 聊天表是否存在
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='llm_chat_sessions'")
+    if cursor.fetchone() is None:
+        print("Migrating database: creating 'llm_chat_sessions' table.")
+        create_llm_chat_sessions_table(cursor)
     
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='llm_chat_messages'")
-        if cursor.fetchone() is None:
-            print("Migrating database: creating 'llm_chat_messages' table.")
-            create_llm_chat_messages_table(cursor)
-            db.commit()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='llm_chat_messages'")
+    if cursor.fetchone() is None:
+        print("Migrating database: creating 'llm_chat_messages' table.")
+        create_llm_chat_messages_table(cursor)
     
-        # 检查用户服务配置表是否存在
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user_service_configs'")
-        if cursor.fetchone() is None:
-            print("Migrating database: creating 'user_service_configs' table.")
-            create_user_service_configs_table(cursor)
-            db.commit()
-        
-        # 检查用户活动日志表是否存在
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user_activity_log'")
-        if cursor.fetchone() is None:
-            print("Migrating database: creating 'user_activity_log' table.")
-            create_user_activity_log_table(cursor)
-            db.commit()
+    # 检查用户服务配置表是否存在
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user_service_configs'")
+    if cursor.fetchone() is None:
+        print("Migrating database: creating 'user_service_configs' table.")
+        create_user_service_configs_table(cursor)
+    
+    # 检查用户活动日志表是否存在
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user_activity_log'")
+    if cursor.fetchone() is None:
+        print("Migrating database: creating 'user_activity_log' table.")
+        create_user_activity_log_table(cursor)
+
+
+# 按顺序编号的迁移列表：(版本号, 说明, 函数)。
+# 新的结构变更只需在末尾追加一项，版本号递增；函数接收 cursor，不要自行 commit。
+def _migrate_activity_rollups(cursor):
+    """v2：活动日志改用复合索引，并从现有日志回填按天汇总表"""
+    for index in ('idx_activity_user_id', 'idx_activity_type', 'idx_activity_username'):
+        cursor.execute(f'DROP INDEX IF EXISTS {index}')
+    create_user_activity_log_indexes(cursor)
+    create_activity_rollup_table(cursor)
+    cursor.execute('DELETE FROM user_activity_daily')
+    cursor.execute('''
+        INSERT INTO user_activity_daily (day, user_id, username, activity_type, success, count, last_at)
+        SELECT substr(created_at, 1, 10), COALESCE(user_id, 0), username, activity_type, success, COUNT(*), MAX(created_at)
+        FROM user_activity_log
+        GROUP BY substr(created_at, 1, 10), COALESCE(user_id, 0), username, activity_type, success
+    ''')
+
+def _migrate_upload_jobs(cursor):
+    """v3：批量上传任务表"""
+    create_upload_jobs_tables(cursor)
+
+def _migrate_book_jobs(cursor):
+    """v4：批量推送 / 发送任务表"""
+    create_book_jobs_tables(cursor)
+
+def _migrate_conversion_jobs(cursor):
+    """v5：格式转换任务表"""
+    create_conversion_jobs_table(cursor)
+
+def _add_column_if_missing(cursor, table, column, definition):
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})").fetchall()]
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _migrate_conversion_job_owner(cursor):
+    """v6：转换任务记录执行进程的 pid 和启动时间，不再只记录 pid"""
+    _add_column_if_missing(cursor, 'conversion_jobs', 'owner', 'TEXT')
+
+def _migrate_upload_job_owner(cursor):
+    """v7：上传任务的文件记录暂存路径和处理它的进程，进程退出后可以标记为中断并清理"""
+    _add_column_if_missing(cursor, 'upload_job_files', 'spool_path', 'TEXT')
+    _add_column_if_missing(cursor, 'upload_job_files', 'owner', 'TEXT')
+
+def _migrate_book_job_owner(cursor):
+    """v8：批量推送 / 发送任务记录执行它的进程，进程退出后可以标记为中断"""
+    _add_column_if_missing(cursor, 'book_jobs', 'owner', 'TEXT')
+
+def _migrate_pending_progress(cursor):
+    """v9：阅读进度写回缓冲从各 worker 的内存移到 app.db，所有 worker 共用"""
+    create_pending_progress_tables(cursor)
+
+MIGRATIONS = [
+    (1, "bring pre-versioned databases up to date", _migrate_legacy_schema),
+    (2, "add activity log composite indexes and daily rollups", _migrate_activity_rollups),
+    (3, "add batch upload job tables", _migrate_upload_jobs),
+    (4, "add bulk push / send job tables", _migrate_book_jobs),
+    (5, "add conversion job table", _migrate_conversion_jobs),
+    (6, "record conversion job owner process", _migrate_conversion_job_owner),
+    (7, "record upload job file owner process", _migrate_upload_job_owner),
+    (8, "record book job owner process", _migrate_book_job_owner),
+    (9, "add shared reading progress buffer tables", _migrate_pending_progress),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(db):
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+def update_schema_if_needed(db):
+    """在一个事务中执行所有未应用的迁移，返回执行的迁移数量"""
+    current = get_schema_version(db)
+    pending = [m for m in MIGRATIONS if m[0] > current]
+    if not pending:
+        return 0
+
+    cursor = db.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        for version, description, migrate in pending:
+            print(f"Migrating database to v{version}: {description}")
+            migrate(cursor)
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    return len(pending)
 
 
 def create_audiobook_progress_table(cursor):
@@ -365,26 +543,185 @@ def create_user_activity_log_table(cursor):
         );
     ''')
     # 创建索引以提高查询效率
-    cursor.execute('CREATE INDEX idx_activity_user_id ON user_activity_log(user_id);')
-    cursor.execute('CREATE INDEX idx_activity_type ON user_activity_log(activity_type);')
-    cursor.execute('CREATE INDEX idx_activity_created_at ON user_activity_log(created_at);')
-    cursor.execute('CREATE INDEX idx_activity_username ON user_activity_log(username);')
+    create_user_activity_log_indexes(cursor)
+    create_activity_rollup_table(cursor)
+
+def create_user_activity_log_indexes(cursor):
+    """活动日志的复合索引，覆盖按类型分页、按用户查最近一条和按时间清理这几类查询"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_created_at ON user_activity_log(created_at);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_type_created ON user_activity_log(activity_type, created_at);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_user_type_created ON user_activity_log(user_id, activity_type, created_at);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_username_created ON user_activity_log(username, created_at);')
+
+def create_activity_rollup_table(cursor):
+    """
+    活动日志按天汇总表，每个 (日期, 用户, 活动类型, 是否成功) 一行，由日志写入线程增量维护。
+    user_id 为 0 表示匿名或未知用户。清理原始日志时不会删除汇总，统计接口只读这张表。
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_activity_daily (
+            day TEXT NOT NULL,
+            user_id INTEGER NOT NULL DEFAULT 0,
+            username TEXT NOT NULL,
+            activity_type TEXT NOT NULL,
+            success INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            last_at TIMESTAMP,
+            PRIMARY KEY (day, user_id, username, activity_type, success)
+        ) WITHOUT ROWID;
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_daily_user_type ON user_activity_daily(user_id, activity_type);')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_daily_type_day ON user_activity_daily(activity_type, day);')
+
+def create_upload_jobs_tables(cursor):
+    """创建批量上传任务表的辅助函数：每个任务一行，任务中的每个文件一行（owner 为处理它的进程，见 utils.job_owner）"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_jobs (
+            job_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            target TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        );
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_job_files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER,
+            status TEXT NOT NULL DEFAULT 'queued',
+            stage TEXT,
+            message TEXT,
+            book_id INTEGER,
+            spool_path TEXT,
+            owner TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (job_id) REFERENCES upload_jobs (job_id) ON DELETE CASCADE
+        );
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_upload_job_files_job ON upload_job_files(job_id, id)')
+
+def create_book_jobs_tables(cursor):
+    """创建批量推送 / 发送任务表的辅助函数：每个任务一行（owner 为执行它的进程，见 utils.job_owner），任务中的每本 Calibre 书一行"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS book_jobs (
+            job_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            owner TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        );
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS book_job_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            title TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            stage TEXT,
+            message TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (job_id) REFERENCES book_jobs (job_id) ON DELETE CASCADE
+        );
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_book_job_items_job ON book_job_items(job_id, id)')
+
+def create_conversion_jobs_table(cursor):
+    """创建格式转换任务表的辅助函数：每次 ebook-converter 转换一行，owner 为执行任务的进程（见 utils.job_owner）"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversion_jobs (
+            job_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            cache_key TEXT,
+            book_type TEXT NOT NULL DEFAULT 'calibre',
+            book_id INTEGER,
+            title TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            stage TEXT,
+            progress INTEGER NOT NULL DEFAULT 0,
+            message TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversion_jobs_user_status ON conversion_jobs(user_id, status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversion_jobs_cache_key ON conversion_jobs(cache_key, status)')
+
+def create_pending_progress_tables(cursor):
+    """创建阅读进度写回缓冲表的辅助函数（见 utils.progress_buffer）：每本书最新的进度，按天累加的阅读时长"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_progress (
+            username TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            cfi TEXT,
+            percentage REAL,
+            update_time TEXT,
+            PRIMARY KEY (username, book_id)
+        ) WITHOUT ROWID;
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_reading_time (
+            username TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            seconds INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (username, book_id, date)
+        ) WITHOUT ROWID;
+    ''')
+
+def interrupt_unfinished_jobs():
+    """
+    在 gunicorn 启动任何 worker 之前调用（python database.py migrate）：上一次运行留下的未完成任务
+    不会再有进程执行，全部标记为中断。worker 启动时只处理执行进程已退出的任务，见 utils.job_owner。
+    """
+    with closing(get_db()) as db:
+        db.execute(
+            "UPDATE conversion_jobs SET status = 'error', stage = NULL, message = ?, updated_at = CURRENT_TIMESTAMP "
+            "WHERE status IN ('queued', 'running')",
+            ('Conversion was interrupted because the server restarted.',)
+        )
+        for row in db.execute(
+            "SELECT spool_path FROM upload_job_files WHERE status IN ('queued', 'processing') AND spool_path IS NOT NULL"
+        ).fetchall():
+            if os.path.exists(row['spool_path']):
+                os.unlink(row['spool_path'])
+        db.execute(
+            "UPDATE upload_job_files SET status = 'error', stage = NULL, message = ?, updated_at = CURRENT_TIMESTAMP "
+            "WHERE status IN ('queued', 'processing')",
+            ('Processing was interrupted because the server restarted.',)
+        )
+        db.execute(
+            "UPDATE book_job_items SET status = 'error', stage = NULL, message = ?, updated_at = CURRENT_TIMESTAMP "
+            "WHERE status IN ('queued', 'processing')",
+            ('Processing was interrupted because the server restarted.',)
+        )
 
 def create_schema():
     """
     创建数据库和表结构，并执行必要的迁移。
-    使用文件锁来防止多进程并发问题。
+    数据库已是最新版本时只读取一次 PRAGMA user_version 就返回（worker 启动和 SIGHUP 重载走这条路径），
+    否则使用文件锁来防止多进程并发迁移。
     """
+    if os.path.exists(DATABASE_PATH):
+        with closing(get_db()) as db:
+            if get_schema_version(db) >= SCHEMA_VERSION:
+                return
+
     lock_path = DATABASE_PATH + '.lock'
     with open(lock_path, 'w') as lock_file:
         try:
             # 尝试获取锁，如果失败则等待
             fcntl.flock(lock_file, fcntl.LOCK_EX)
             
-            db_exists = os.path.exists(DATABASE_PATH)
-            
             with closing(get_db()) as db:
                 cursor = db.cursor()
+                # 用 users 表是否存在来判断新库，空文件也按新库处理
+                db_exists = cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'").fetchone() is not None
                 if not db_exists:
                     print("Creating new database...")
                     # Users Table
@@ -432,6 +769,12 @@ def create_schema():
                     create_llm_chat_messages_table(cursor)
                     create_user_service_configs_table(cursor)
                     create_user_activity_log_table(cursor)
+                    create_upload_jobs_tables(cursor)
+                    create_book_jobs_tables(cursor)
+                    create_conversion_jobs_table(cursor)
+                    create_pending_progress_tables(cursor)
+                    # 新建的库已经是最新结构，直接标记为最新版本
+                    cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
                     db.commit()
                     print("Database tables created.")
                 else:
@@ -442,5 +785,23 @@ def create_schema():
             fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 if __name__ == '__main__':
-    create_schema()
-    print("Database schema checked/created/migrated.")
\ No newline at end of file
+    # 在启动 gunicorn 之前执行迁移，例如：python database.py migrate
+    import argparse
+    parser = argparse.ArgumentParser(description="Manage the app.db schema.")
+    parser.add_argument('command', nargs='?', default='migrate', choices=['migrate', 'status'])
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        if not os.path.exists(DATABASE_PATH):
+            print(f"Database not found at {DATABASE_PATH}.")
+        else:
+            with closing(get_db()) as db:
+                current = get_schema_version(db)
+            print(f"Schema version: {current} (latest: {SCHEMA_VERSION})")
+            for version, description, _migrate in MIGRATIONS:
+                state = 'applied' if version <= current else 'pending'
+                print(f"  v{version} [{state}] {description}")
+    else:
+        create_schema()
+        interrupt_unfinished_jobs()
+        print("Database schema checked/created/migrated.")
\ No newline at end of file
@@ -131,5 +131,10 @@ if command -v calibre-server >/dev/null 2>&1; then
     echo "calibre-server started with PID $!"
 fi
 
+# Run pending app.db migrations once, before gunicorn forks its workers.
+# Workers then only do a constant-time schema version check on boot and on SIGHUP reload.
+echo "Running database migrations..."
+gosu appuser python database.py migrate || echo "Warning: database migration failed, workers will retry on startup"
+
 # Execute the command passed to this script (the Dockerfile's CMD)
 exec gosu appuser "$@"
\ No newline at end of file
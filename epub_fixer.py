@@ -1,105 +1,185 @@
+import copy
 import os
 import re
+import struct
 import zipfile
 import logging
 from xml.dom import minidom
 import tempfile
 
+# 修复逻辑变化时加一，处理过的 EPUB 缓存 (utils.epub_cache) 会随之失效
+FIXER_VERSION = 1
+
+TEXT_EXTENSIONS = ('html', 'xhtml', 'htm', 'xml', 'svg', 'css', 'opf', 'ncx')
+XHTML_EXTENSIONS = ('html', 'xhtml')
+ENCODING_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>'
+ENCODING_DECLARATION_RE = re.compile(r'^<\?xml\s+version=["\'][\d.]+["\']\s+encoding=["\'][a-zA-Z\d\-\.]+["\'].*?\?>', re.IGNORECASE)
+ALLOWED_LANGUAGES = {
+    'af', 'gsw', 'ar', 'eu', 'nb', 'br', 'ca', 'zh', 'kw', 'co', 'da', 'nl', 'stq', 'en', 'fi', 'fr', 'fy', 'gl',
+    'de', 'gu', 'hi', 'is', 'ga', 'it', 'ja', 'lb', 'mr', 'ml', 'gv', 'frr', 'nn', 'pl', 'pt', 'oc', 'rm',
+    'sco', 'gd', 'es', 'sv', 'ta', 'cy', 'afr', 'ara', 'eus', 'baq', 'nob', 'bre', 'cat', 'zho', 'chi', 'cor',
+    'cos', 'dan', 'nld', 'dut', 'eng', 'fin', 'fra', 'fre', 'fry', 'glg', 'deu', 'ger', 'guj', 'hin', 'isl',
+    'ice', 'gle', 'ita', 'jpn', 'ltz', 'mar', 'mal', 'glv', 'nor', 'nno', 'por', 'oci', 'roh', 'gla', 'spa',
+    'swe', 'tam', 'cym', 'wel'
+}
+
+# zipfile.structFileHeader：本地文件头
+_LOCAL_FILE_HEADER = struct.Struct('<4s2B4HL2L2H')
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _ext(filename):
+    return filename.split('.')[-1].lower()
+
+
+def _strip_zip64_extra(extra):
+    """去掉 extra 中的 ZIP64 字段，写入时由 zipfile 按实际大小重新生成"""
+    result = b''
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, size = struct.unpack('<HH', extra[pos:pos + 4])
+        if header_id != 0x0001:
+            result += extra[pos:pos + 4 + size]
+        pos += 4 + size
+    return result
+
+
+def _copy_member_raw(src, info, out):
+    """
+    把成员的压缩数据原样写入 out，不解压也不重新压缩。
+    zipfile 没有公开的接口，这里按 ZipFile.writestr 的方式写本地文件头，再登记到中央目录。
+    """
+    src.seek(info.header_offset)
+    fields = _LOCAL_FILE_HEADER.unpack(src.read(_LOCAL_FILE_HEADER.size))
+    if fields[0] != b'PK\x03\x04':
+        raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+    # 跳过本地文件头中的文件名和 extra
+    src.seek(fields[-2] + fields[-1], os.SEEK_CUR)
+
+    zinfo = copy.copy(info)
+    # 大小和 CRC 已知，直接写在本地文件头中，不需要数据描述符
+    zinfo.flag_bits &= ~0x08
+    zinfo.extra = _strip_zip64_extra(info.extra)
+    zinfo.header_offset = out.fp.tell()
+    out.fp.write(zinfo.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        chunk = src.read(min(remaining, _COPY_CHUNK_SIZE))
+        if not chunk:
+            raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+        out.fp.write(chunk)
+        remaining -= len(chunk)
+    out.filelist.append(zinfo)
+    out.NameToInfo[zinfo.filename] = zinfo
+    out.start_dir = out.fp.tell()
+
+
 class EPUBFixer:
     """
     A class to fix common issues in EPUB files that might cause problems with
     Amazon's Send-to-Kindle service.
     Adapted from https://github.com/innocenat/kindle-epub-fix
+
+    流式处理：先逐个扫描成员，找出需要修复的文本文件，再写出新文件；只有这些文件被重写，
+    其余成员（图片、字体等）按原压缩数据复制，不解压也不重新压缩。
+    同一时刻只有一个文本成员在内存中。
     """
     def __init__(self):
         self.fixed_problems = []
-        self.files = {}
-        self.binary_files = {}
         self.entries = []
+        self.text_entries = []
+        self.opf_filename = None
+        self.body_id_links = []
+        self.language_to_set = None
+        self.default_language = 'en'
+        self.force_language = None
+        self.rewrite = set()
 
-    def read_epub(self, epub_path):
-        """Read EPUB file contents into memory."""
-        with zipfile.ZipFile(epub_path, 'r') as zip_ref:
-            self.entries = zip_ref.namelist()
-            for filename in self.entries:
-                ext = filename.split('.')[-1].lower()
-                if filename == 'mimetype' or ext in ['html', 'xhtml', 'htm', 'xml', 'svg', 'css', 'opf', 'ncx']:
-                    self.files[filename] = zip_ref.read(filename).decode('utf-8')
-                else:
-                    self.binary_files[filename] = zip_ref.read(filename)
-
-    def fix_encoding(self):
-        """Add UTF-8 encoding declaration if missing from (x)html files."""
-        encoding_declaration = '<?xml version="1.0" encoding="utf-8"?>'
-        regex = r'^<\?xml\s+version=["\'][\d.]+["\']\s+encoding=["\'][a-zA-Z\d\-\.]+["\'].*?\?>'
-
-        for filename, content in self.files.items():
-            ext = filename.split('.')[-1].lower()
-            if ext in ['html', 'xhtml']:
-                stripped_content = content.lstrip()
-                if not re.match(regex, stripped_content, re.IGNORECASE):
-                    self.files[filename] = encoding_declaration + '\n' + stripped_content
-                    self.fixed_problems.append(f"Added missing UTF-8 encoding declaration to {filename}")
-
-    def fix_body_id_link(self):
+    def _read_text(self, zip_ref, filename):
+        return zip_ref.read(filename).decode('utf-8')
+
+    def scan_epub(self, zip_ref, default_language='en', force_language=None):
+        """扫描 EPUB，记录需要修复的问题和需要重写的成员，不修改任何内容"""
+        self.default_language = default_language
+        self.force_language = force_language
+        self.entries = zip_ref.namelist()
+        self.text_entries = [name for name in self.entries if name == 'mimetype' or _ext(name) in TEXT_EXTENSIONS]
+
+        stray_img_problems = []
+        encoding_problems = []
+        for filename in self.text_entries:
+            if _ext(filename) not in XHTML_EXTENSIONS:
+                continue
+            content = self._read_text(zip_ref, filename)
+            stray_imgs = 0
+            try:
+                dom = minidom.parseString(content)
+                body_elements = dom.getElementsByTagName('body')
+                if body_elements and body_elements[0].hasAttribute('id'):
+                    body_id = body_elements[0].getAttribute('id')
+                    if body_id:
+                        link_target = os.path.basename(filename) + '#' + body_id
+                        self.body_id_links.append((link_target, os.path.basename(filename)))
+                stray_imgs = len([img for img in dom.getElementsByTagName('img') if not img.getAttribute('src')])
+            except Exception:
+                pass # Ignore parsing errors
+            if stray_imgs:
+                # 重新序列化时会带上 XML 声明，不需要再补编码声明
+                self.rewrite.add(filename)
+                stray_img_problems.append(f"Removed {stray_imgs} stray image tag(s) in {filename}")
+            elif not ENCODING_DECLARATION_RE.match(content.lstrip()):
+                self.rewrite.add(filename)
+                encoding_problems.append(f"Added missing UTF-8 encoding declaration to {filename}")
+
+        self._scan_body_id_links(zip_ref)
+        self._scan_book_language(zip_ref)
+        self.fixed_problems.extend(stray_img_problems)
+        self.fixed_problems.extend(encoding_problems)
+
+    def _scan_body_id_links(self, zip_ref):
         """Fix linking to body ID showing up as an unresolved hyperlink."""
-        body_id_list = []
-        for filename, content in self.files.items():
-            ext = filename.split('.')[-1].lower()
-            if ext in ['html', 'xhtml']:
-                try:
-                    dom = minidom.parseString(content)
-                    body_elements = dom.getElementsByTagName('body')
-                    if body_elements and body_elements[0].hasAttribute('id'):
-                        body_id = body_elements[0].getAttribute('id')
-                        if body_id:
-                            link_target = os.path.basename(filename) + '#' + body_id
-                            body_id_list.append((link_target, os.path.basename(filename)))
-                except Exception:
-                    continue # Ignore parsing errors
-
-        if not body_id_list:
+        if not self.body_id_links:
             return
-
-        for filename in self.files:
-            for src, target in body_id_list:
-                if src in self.files[filename]:
-                    self.files[filename] = self.files[filename].replace(src, target)
+        for filename in self.text_entries:
+            content = self._read_text(zip_ref, filename)
+            for src, target in self.body_id_links:
+                if src in content:
+                    content = content.replace(src, target)
+                    self.rewrite.add(filename)
                     self.fixed_problems.append(f"Replaced body ID link target '{src}' with '{target}' in {filename}")
 
-    def fix_book_language(self, default_language='en', force_language=None):
-        """Fix language field not defined, not one of the Amazon-allowed languages, or force a specific language."""
-        allowed_languages = {
-            'af', 'gsw', 'ar', 'eu', 'nb', 'br', 'ca', 'zh', 'kw', 'co', 'da', 'nl', 'stq', 'en', 'fi', 'fr', 'fy', 'gl',
-            'de', 'gu', 'hi', 'is', 'ga', 'it', 'ja', 'lb', 'mr', 'ml', 'gv', 'frr', 'nn', 'pl', 'pt', 'oc', 'rm',
-            'sco', 'gd', 'es', 'sv', 'ta', 'cy', 'afr', 'ara', 'eus', 'baq', 'nob', 'bre', 'cat', 'zho', 'chi', 'cor',
-            'cos', 'dan', 'nld', 'dut', 'eng', 'fin', 'fra', 'fre', 'fry', 'glg', 'deu', 'ger', 'guj', 'hin', 'isl',
-            'ice', 'gle', 'ita', 'jpn', 'ltz', 'mar', 'mal', 'glv', 'nor', 'nno', 'por', 'oci', 'roh', 'gla', 'spa',
-            'swe', 'tam', 'cym', 'wel'
-        }
-
-        container_content = self.files.get('META-INF/container.xml')
-        if not container_content:
+    def _scan_book_language(self, zip_ref):
+        if 'META-INF/container.xml' not in self.entries:
             return
-
         try:
-            container_xml = minidom.parseString(container_content)
+            container_xml = minidom.parseString(self._read_text(zip_ref, 'META-INF/container.xml'))
             opf_filename = next(
                 rf.getAttribute('full-path') for rf in container_xml.getElementsByTagName('rootfile')
                 if rf.getAttribute('media-type') == 'application/oebps-package+xml'
             )
         except (Exception, StopIteration):
             return
-
-        opf_content = self.files.get(opf_filename)
-        if not opf_content:
+        if opf_filename not in self.entries:
             return
 
+        self.opf_filename = opf_filename
+        fixed_content, problems = self.fix_book_language(self._read_text(zip_ref, opf_filename))
+        if fixed_content is not None:
+            self.rewrite.add(opf_filename)
+            self.fixed_problems.extend(problems)
+
+    def fix_book_language(self, opf_content):
+        """
+        Fix language field not defined, not one of the Amazon-allowed languages, or force a specific language.
+        返回 (修复后的 OPF 内容, 问题列表)，不需要修复时内容为 None。
+        """
+        default_language, force_language = self.default_language, self.force_language
+        problems = []
         try:
             opf = minidom.parseString(opf_content)
             metadata_list = opf.getElementsByTagName('metadata')
             if not metadata_list:
-                return
+                return None, problems
             metadata = metadata_list[0]
             
             language_tags = opf.getElementsByTagName('dc:language')
@@ -109,7 +189,7 @@ class EPUBFixer:
             if force_language:
                 language_to_set = force_language
                 if not language_tags:
-                    self.fixed_problems.append(f"No dc:language tag found. Creating and forcing to '{language_to_set}'.")
+                    problems.append(f"No dc:language tag found. Creating and forcing to '{language_to_set}'.")
                     lang_tag = opf.createElement('dc:language')
                     lang_tag.appendChild(opf.createTextNode(language_to_set))
                     metadata.appendChild(lang_tag)
@@ -117,12 +197,12 @@ class EPUBFixer:
                     lang_tag = language_tags[0]
                     original_language = lang_tag.firstChild.nodeValue if lang_tag.firstChild else ''
                     if original_language != language_to_set:
-                         self.fixed_problems.append(f"Forcing language from '{original_language}' to '{language_to_set}'.")
+                         problems.append(f"Forcing language from '{original_language}' to '{language_to_set}'.")
                          lang_tag.firstChild.nodeValue = language_to_set
             else:
                 if not language_tags:
                     language_to_set = default_language
-                    self.fixed_problems.append(f"No dc:language tag found. Setting to default: '{default_language}'")
+                    problems.append(f"No dc:language tag found. Setting to default: '{default_language}'")
                     lang_tag = opf.createElement('dc:language')
                     lang_tag.appendChild(opf.createTextNode(language_to_set))
                     metadata.appendChild(lang_tag)
@@ -130,73 +210,86 @@ class EPUBFixer:
                     lang_tag = language_tags[0]
                     original_language = lang_tag.firstChild.nodeValue if lang_tag.firstChild else ''
                     simplified_lang = original_language.split('-')[0].lower()
-                    if simplified_lang not in allowed_languages:
+                    if simplified_lang not in ALLOWED_LANGUAGES:
                         language_to_set = default_language
-                        self.fixed_problems.append(f"Unsupported language '{original_language}'. Changed to '{default_language}'")
+                        problems.append(f"Unsupported language '{original_language}'. Changed to '{default_language}'")
                         lang_tag.firstChild.nodeValue = language_to_set
                     else:
                         language_to_set = original_language
 
             if original_language != language_to_set:
-                self.files[opf_filename] = opf.toxml(encoding='utf-8').decode('utf-8')
+                return opf.toxml(encoding='utf-8').decode('utf-8'), problems
 
         except Exception as e:
-            logging.warning(f"Could not parse or modify OPF file '{opf_filename}': {e}")
+            logging.warning(f"Could not parse or modify OPF file '{self.opf_filename}': {e}")
+        return None, problems
 
-    def fix_stray_img(self):
+    def fix_stray_img(self, content):
         """Remove stray <img> tags (those without a src attribute)."""
-        for filename, content in self.files.items():
-            ext = filename.split('.')[-1].lower()
-            if ext in ['html', 'xhtml']:
-                try:
-                    dom = minidom.parseString(content)
-                    stray_imgs = [img for img in dom.getElementsByTagName('img') if not img.getAttribute('src')]
-                    if stray_imgs:
-                        for img in stray_imgs:
-                            if img.parentNode:
-                                img.parentNode.removeChild(img)
-                        self.files[filename] = dom.toxml(encoding='utf-8').decode('utf-8')
-                        self.fixed_problems.append(f"Removed {len(stray_imgs)} stray image tag(s) in {filename}")
-                except Exception:
-                    continue # Ignore parsing errors
-
-    def write_epub(self, output_path):
-        """Write the modified contents to a new EPUB file."""
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
-            # mimetype must be the first file and uncompressed
-            if 'mimetype' in self.files:
-                zip_ref.writestr('mimetype', self.files['mimetype'], compress_type=zipfile.ZIP_STORED)
-            
-            sorted_files = sorted(self.files.items(), key=lambda item: item[0] != 'mimetype')
+        try:
+            dom = minidom.parseString(content)
+        except Exception:
+            return content # Ignore parsing errors
+        stray_imgs = [img for img in dom.getElementsByTagName('img') if not img.getAttribute('src')]
+        if not stray_imgs:
+            return content
+        for img in stray_imgs:
+            if img.parentNode:
+                img.parentNode.removeChild(img)
+        return dom.toxml(encoding='utf-8').decode('utf-8')
 
-            for filename, content in sorted_files:
-                if filename != 'mimetype':
-                    zip_ref.writestr(filename, content.encode('utf-8'))
+    def fix_member(self, filename, content):
+        """按扫描时相同的顺序修复一个文本成员：正文 ID 链接、语言、多余的 img、编码声明"""
+        for src, target in self.body_id_links:
+            if src in content:
+                content = content.replace(src, target)
+        if filename == self.opf_filename:
+            fixed_content, _problems = self.fix_book_language(content)
+            if fixed_content is not None:
+                content = fixed_content
+        if _ext(filename) in XHTML_EXTENSIONS:
+            content = self.fix_stray_img(content)
+            stripped_content = content.lstrip()
+            if not ENCODING_DECLARATION_RE.match(stripped_content):
+                content = ENCODING_DECLARATION + '\n' + stripped_content
+        return content
+
+    def write_epub(self, zip_ref, input_path, output_path):
+        """Write the fixed EPUB: rewrite only the members that changed and copy the rest as-is."""
+        with open(input_path, 'rb') as src, zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as out:
+            # mimetype must be the first file and uncompressed
+            if 'mimetype' in self.entries:
+                out.writestr('mimetype', zip_ref.read('mimetype'), compress_type=zipfile.ZIP_STORED)
 
-            for filename, content in self.binary_files.items():
-                zip_ref.writestr(filename, content)
+            for info in zip_ref.infolist():
+                if info.filename == 'mimetype':
+                    continue
+                if info.filename in self.rewrite:
+                    content = self.fix_member(info.filename, self._read_text(zip_ref, info.filename))
+                    zinfo = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                    zinfo.compress_type = zipfile.ZIP_DEFLATED
+                    zinfo.external_attr = info.external_attr
+                    out.writestr(zinfo, content.encode('utf-8'))
+                else:
+                    _copy_member_raw(src, info, out)
 
     def process(self, input_path, output_path, default_language='en', force_language=None):
         """
         Run all fixing procedures on an EPUB file.
         """
-        self.read_epub(input_path)
-        
-        self.fix_body_id_link()
-        self.fix_book_language(default_language, force_language)
-        self.fix_stray_img()
-        self.fix_encoding() # Run this last as other steps might alter XML content
-
-        if self.fixed_problems:
-            logging.info(f"EPUB Fixer found and fixed {len(self.fixed_problems)} issues in '{os.path.basename(input_path)}'.")
-            for problem in self.fixed_problems:
-                logging.info(f"  - {problem}")
-            self.write_epub(output_path)
-            return True
-        else:
-            logging.info(f"EPUB Fixer found no issues in '{os.path.basename(input_path)}'.")
-            # If no changes, we don't need to re-write the file.
-            return False
+        with zipfile.ZipFile(input_path, 'r') as zip_ref:
+            self.scan_epub(zip_ref, default_language, force_language)
+
+            if self.fixed_problems:
+                logging.info(f"EPUB Fixer found and fixed {len(self.fixed_problems)} issues in '{os.path.basename(input_path)}'.")
+                for problem in self.fixed_problems:
+                    logging.info(f"  - {problem}")
+                self.write_epub(zip_ref, input_path, output_path)
+                return True
+            else:
+                logging.info(f"EPUB Fixer found no issues in '{os.path.basename(input_path)}'.")
+                # If no changes, we don't need to re-write the file.
+                return False
 
 def fix_epub_for_kindle(epub_path, default_language='en', force_language=None):
     """
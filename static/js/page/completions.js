@@ -29,8 +29,14 @@ export function setupCompletions(form) {
                 .then(items => {
                     items.forEach(item => {
                         const itemDiv = document.createElement('div');
-                        itemDiv.innerHTML = "<strong>" + item.substr(0, query.length) + "</strong>";
-                        itemDiv.innerHTML += item.substr(query.length);
+                        // Matches may be prefixes, word starts or substrings; bold the matched part when found
+                        const start = item.toLowerCase().indexOf(query.toLowerCase());
+                        if (start >= 0) {
+                            itemDiv.innerHTML = item.substr(0, start) + "<strong>" + item.substr(start, query.length) + "</strong>";
+                            itemDiv.innerHTML += item.substr(start + query.length);
+                        } else {
+                            itemDiv.innerHTML = item;
+                        }
                         itemDiv.innerHTML += "<input type='hidden' value='" + item + "'>";
                         
                         itemDiv.addEventListener('click', function(e) {
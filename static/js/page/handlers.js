@@ -1,4 +1,4 @@
-import { fetch_with_token, showModal, hideModal, showLoaderAndNavigate } from './utils.js';
+import { fetch_with_token, fetchAfterConversion, waitForConversionJob, showModal, hideModal, showLoaderAndNavigate } from './utils.js';
 import {
     populateAnxEditForm,
     populateCalibreEditForm,
@@ -186,6 +186,129 @@ function handleSaveChanges(saveButton, editBookForm, currentEditing, anxBooksDat
     handleButtonAnimation(saveButton, apiCall);
 }
 
+const UPLOAD_BATCH_MAX_FILES = 20;
+const UPLOAD_BATCH_MAX_BYTES = 200 * 1024 * 1024;
+const UPLOAD_JOB_STALL_LIMIT_MS = 30 * 60 * 1000;
+
+/**
+ * Upload files to a batch upload job and follow per-file progress.
+ * Files are sent in batches (the server starts processing a batch while the next one uploads),
+ * then the job status is polled until every file has finished.
+ */
+async function runBatchUpload(files, progressElements, target) {
+    const batches = [];
+    let current = [];
+    let currentBytes = 0;
+    files.forEach((file, index) => {
+        if (current.length && (current.length >= UPLOAD_BATCH_MAX_FILES || currentBytes + file.size > UPLOAD_BATCH_MAX_BYTES)) {
+            batches.push(current);
+            current = [];
+            currentBytes = 0;
+        }
+        current.push(index);
+        currentBytes += file.size;
+    });
+    if (current.length) batches.push(current);
+
+    const fileIdToIndex = {};
+    let jobId = null;
+
+    const markError = (index, message) => {
+        const { wrapper, label } = progressElements[index];
+        label.textContent = '❌ ' + message;
+        wrapper.classList.add('error');
+    };
+
+    for (const batch of batches) {
+        const formData = new FormData();
+        formData.append('target', target);
+        if (jobId) formData.append('job_id', jobId);
+        batch.forEach(index => formData.append('books', files[index]));
+        batch.forEach(index => { progressElements[index].label.textContent = t.uploading; });
+
+        const response = await new Promise((resolve) => {
+            const xhr = new XMLHttpRequest();
+            xhr.open('POST', '/api/upload_jobs', true);
+            xhr.upload.onprogress = function(event) {
+                if (!event.lengthComputable) return;
+                // Spread the batch progress over its files in order
+                let remaining = event.loaded;
+                batch.forEach(index => {
+                    const { bar, label } = progressElements[index];
+                    const size = files[index].size || 1;
+                    const loaded = Math.max(0, Math.min(size, remaining));
+                    remaining -= size;
+                    bar.value = (loaded / size) * 100;
+                    label.textContent = loaded >= size ? t.processing : Math.round(bar.value) + '%';
+                });
+            };
+            xhr.onload = function() {
+                let data = null;
+                try { data = JSON.parse(xhr.responseText); } catch (e) { /* not JSON */ }
+                resolve({ ok: xhr.status >= 200 && xhr.status < 300, data, statusText: xhr.statusText });
+            };
+            xhr.onerror = function() {
+                resolve({ ok: false, data: null, statusText: t.networkError });
+            };
+            xhr.send(formData);
+        });
+
+        if (!response.ok || !response.data) {
+            const message = (response.data && response.data.error) || response.statusText;
+            batch.forEach(index => markError(index, `${t.uploadFailed}: ${message}`));
+            continue;
+        }
+        jobId = response.data.job_id;
+        response.data.files.forEach((file, i) => {
+            fileIdToIndex[file.id] = batch[i];
+            progressElements[batch[i]].bar.value = 100;
+            progressElements[batch[i]].label.textContent = t.processing;
+        });
+    }
+
+    if (!jobId) return;
+
+    // 服务端会把处理进程已退出的文件标记为中断；仍然长时间没有任何变化时放弃等待
+    let lastSnapshot = null;
+    let lastChange = Date.now();
+    while (Date.now() - lastChange < UPLOAD_JOB_STALL_LIMIT_MS) {
+        let job = null;
+        try {
+            const response = await fetch(`/api/upload_jobs/${jobId}`);
+            if (response.ok) job = await response.json();
+        } catch (e) {
+            // Retry on the next tick
+        }
+        if (job) {
+            const snapshot = JSON.stringify(job.files);
+            if (snapshot !== lastSnapshot) {
+                lastSnapshot = snapshot;
+                lastChange = Date.now();
+            }
+            job.files.forEach(file => {
+                const index = fileIdToIndex[file.id];
+                if (index === undefined) return;
+                const { wrapper, label } = progressElements[index];
+                if (file.status === 'success' || file.status === 'duplicate') {
+                    label.textContent = '✅ ' + file.message;
+                    wrapper.classList.add('success');
+                } else if (file.status === 'error') {
+                    markError(index, file.message);
+                } else {
+                    label.textContent = t.processing;
+                }
+            });
+            if (job.finished) return;
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+    progressElements.forEach(({ wrapper }, index) => {
+        if (!wrapper.classList.contains('success') && !wrapper.classList.contains('error')) {
+            markError(index, t.processingTimedOut);
+        }
+    });
+}
+
 export function setupEventHandlers(
     {
         uploadModal,
@@ -222,7 +345,8 @@ export function setupEventHandlers(
                 // Update button immediately with a status object
                 updateAudiobookButtonProgress(target, { status: 'queued', status_key: 'QUEUED', percentage: 0 });
 
-                fetch_with_token('/api/audiobook/generate', {
+                // 需要转换时服务端先返回 202，转换完成后再提交
+                fetchAfterConversion('/api/audiobook/generate', {
                     method: 'POST',
                     body: formData
                 })
@@ -292,7 +416,7 @@ export function setupEventHandlers(
                 }
                 break;
             case 'push-to-anx': {
-                const apiCall = fetch_with_token(`/api/push_to_anx/${id}`, { method: 'POST' })
+                const apiCall = fetchAfterConversion(`/api/push_to_anx/${id}`, { method: 'POST' })
                     .then(res => {
                         if (!res.ok) return res.json().then(err => { throw new Error(err.error) });
                         return res.json();
@@ -310,7 +434,7 @@ export function setupEventHandlers(
                 break;
             }
             case 'send-kindle': {
-                const apiCall = fetch_with_token(`/api/send_to_kindle/${id}`, { method: 'POST' })
+                const apiCall = fetchAfterConversion(`/api/send_to_kindle/${id}`, { method: 'POST' })
                     .then(async res => {
                         if (!res.ok) {
                             const err = await res.json();
@@ -329,9 +453,28 @@ export function setupEventHandlers(
             case 'download-anx':
                 window.location.href = `/api/download_anx_book/${id}`;
                 break;
-            case 'download-calibre':
-                window.location.href = `/api/download_book/${id}`;
+            case 'download-calibre': {
+                // 需要转换时先等转换任务完成，再下载缓存中的结果
+                const downloadUrl = `/api/download_book/${id}`;
+                fetch_with_token('/api/conversion_jobs', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ book_id: id })
+                })
+                    .then(async res => {
+                        if (res.status !== 202) {
+                            window.location.href = downloadUrl;
+                            return;
+                        }
+                        const { job_id } = await res.json();
+                        const apiCall = waitForConversionJob(job_id).then(job => {
+                            if (job.status !== 'success') throw new Error(job.message || job.status);
+                        });
+                        handleButtonAnimation(target, apiCall, () => { window.location.href = downloadUrl; });
+                    })
+                    .catch(() => { window.location.href = downloadUrl; });
                 break;
+            }
             case 'jump-to-page': {
                 const pageInput = document.getElementById('page-jump-input');
                 const totalPages = parseInt(document.querySelector('.pagination-controls').dataset.totalPages, 10);
@@ -424,59 +567,8 @@ export function setupEventHandlers(
             return { wrapper: progressWrapper, bar: progressBar, label: progressLabel };
         });
 
-        // --- Step 2: Process files sequentially ---
-        for (let i = 0; i < files.length; i++) {
-            const file = files[i];
-            const { wrapper, bar, label } = progressElements[i];
-            
-            label.textContent = t.uploading; // Update status before starting
-
-            await new Promise((resolve) => {
-                const formData = new FormData();
-                formData.append('books', file);
-
-                const xhr = new XMLHttpRequest();
-                xhr.open('POST', "/api/upload_to_calibre", true);
-
-                xhr.upload.onprogress = function(event) {
-                    if (event.lengthComputable) {
-                        const percentComplete = (event.loaded / event.total) * 100;
-                        bar.value = percentComplete;
-                        if (percentComplete >= 100) {
-                            label.textContent = t.processing;
-                        } else {
-                            label.textContent = Math.round(percentComplete) + '%';
-                        }
-                    }
-                };
-
-                xhr.onload = function() {
-                    if (xhr.status >= 200 && xhr.status < 300) {
-                        const results = JSON.parse(xhr.responseText);
-                        const result = results[0];
-                        if (result.success) {
-                            label.textContent = '✅ ' + result.message;
-                            wrapper.classList.add('success');
-                        } else {
-                            label.textContent = '❌ ' + result.error;
-                            wrapper.classList.add('error');
-                        }
-                    } else {
-                        label.textContent = `❌ ${t.uploadFailed}: ${xhr.statusText}`;
-                        wrapper.classList.add('error');
-                    }
-                    resolve(); // Resolve regardless of success or failure
-                };
-
-                xhr.onerror = function() {
-                    label.textContent = `❌ ${t.networkError}.`;
-                    wrapper.classList.add('error');
-                    resolve(); // Resolve regardless of success or failure
-                };
-
-                xhr.send(formData);
-            });
-        }
+        // --- Step 2: Upload in batches and follow the server-side processing ---
+        await runBatchUpload(files, progressElements, 'calibre');
 
         // --- Step 3: Show Done button ---
         doneButton.style.display = 'inline-block';
@@ -530,71 +622,8 @@ export function setupEventHandlers(
             return { wrapper: progressWrapper, bar: progressBar, label: progressLabel };
         });
 
-        // --- Step 2: Process files sequentially ---
-        for (let i = 0; i < files.length; i++) {
-            const file = files[i];
-            const { wrapper, bar, label } = progressElements[i];
-            
-            label.textContent = t.uploading; // Update status before starting
-
-            await new Promise((resolve) => {
-                const formData = new FormData();
-                formData.append('books', file);
-
-                const xhr = new XMLHttpRequest();
-                xhr.open('POST', "/api/upload_to_anx", true);
-
-                xhr.upload.onprogress = function(event) {
-                    if (event.lengthComputable) {
-                        const percentComplete = (event.loaded / event.total) * 100;
-                        bar.value = percentComplete;
-                        if (percentComplete >= 100) {
-                            label.textContent = t.processing;
-                        } else {
-                            label.textContent = Math.round(percentComplete) + '%';
-                        }
-                    }
-                };
-
-                xhr.onload = function() {
-                    if (xhr.status >= 200 && xhr.status < 300) {
-                        try {
-                            const results = JSON.parse(xhr.responseText);
-                            const result = results[0]; // Assuming single file upload response is an array
-                            if (result.success) {
-                                label.textContent = '✅ ' + result.message;
-                                wrapper.classList.add('success');
-                            } else {
-                                label.textContent = '❌ ' + result.error;
-                                wrapper.classList.add('error');
-                            }
-                        } catch (e) {
-                            label.textContent = `❌ ${t.uploadFailed}: Invalid server response.`;
-                            wrapper.classList.add('error');
-                        }
-                    } else {
-                        let errorMessage = xhr.statusText;
-                        try {
-                            const errorJson = JSON.parse(xhr.responseText);
-                            errorMessage = errorJson.error || errorMessage;
-                        } catch (e) {
-                            // Ignore if response is not JSON
-                        }
-                        label.textContent = `❌ ${t.uploadFailed}: ${errorMessage}`;
-                        wrapper.classList.add('error');
-                    }
-                    resolve(); // Resolve regardless of success or failure
-                };
-
-                xhr.onerror = function() {
-                    label.textContent = `❌ ${t.networkError}.`;
-                    wrapper.classList.add('error');
-                    resolve(); // Resolve regardless of success or failure
-                };
-
-                xhr.send(formData);
-            });
-        }
+        // --- Step 2: Upload in batches and follow the server-side processing ---
+        await runBatchUpload(files, progressElements, 'anx');
 
         // --- Step 3: Show Done button ---
         doneButton.style.display = 'inline-block';
@@ -33,6 +33,7 @@ export function initializeTranslations() {
         processing: _('Processing...'),
         uploadFailed: _('Upload failed'),
         networkError: _('Network Error'),
+        processingTimedOut: _('Processing timed out'),
         NETWORK_ERROR: _('Network error: Failed to connect to the server.'),
         allBooksUploaded: _('All books uploaded successfully!'),
         someFilesFailedUpload: _('Some files failed to upload. Please check the progress details.'),
@@ -18,4 +18,44 @@ export function showLoaderAndNavigate(url, calibreLoader) {
     setTimeout(() => {
         window.location.href = url;
     }, 50);
-}
\ No newline at end of file
+}
+// --- Conversion Jobs ---
+// 转换超时 (CONVERSION_TIMEOUT) 为一小时，再多等一会儿后放弃，任务不存在时立即放弃
+const CONVERSION_WAIT_LIMIT_MS = 65 * 60 * 1000;
+
+// 需要转换时接口返回 202 和转换任务，轮询到任务结束（同步 worker 下不长时间占用 SSE 连接）
+export async function waitForConversionJob(jobId, onProgress = null, timeoutMs = CONVERSION_WAIT_LIMIT_MS) {
+    const deadline = Date.now() + timeoutMs;
+    while (Date.now() < deadline) {
+        let job = null;
+        try {
+            const response = await fetch_with_token(`/api/conversion_jobs/${jobId}`);
+            if (response.status === 404) {
+                return { job_id: jobId, status: 'error', finished: true, message: 'Task not found' };
+            }
+            if (response.ok) job = await response.json();
+        } catch (e) {
+            // Retry on the next tick
+        }
+        if (job) {
+            if (onProgress) onProgress(job);
+            if (job.finished) return job;
+        }
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+    return { job_id: jobId, status: 'error', finished: true, message: 'Timed out waiting for the conversion' };
+}
+
+// 发起请求，遇到 202 时等待转换完成后重新请求，结果此时已在缓存中
+export async function fetchAfterConversion(url, options, onProgress = null) {
+    for (let attempt = 0; attempt < 3; attempt++) {
+        const response = await fetch_with_token(url, options);
+        if (response.status !== 202) return response;
+        const { job_id } = await response.json();
+        const job = await waitForConversionJob(job_id, onProgress);
+        if (job.status !== 'success') {
+            throw new Error(job.message || job.status);
+        }
+    }
+    return fetch_with_token(url, options);
+}
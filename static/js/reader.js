@@ -1,5 +1,6 @@
 import './foliate/view.js';
 import { createTOCView } from './foliate/ui/tree.js';
+import { fetchAfterConversion } from './page/utils.js';
 
 // --- Utility Functions ---
 const debounce = (func, delay) => {
@@ -146,7 +147,7 @@ document.addEventListener('DOMContentLoaded', () => {
     async function loadBook(url, bookType, bookId) {
         // The loading spinner is already visible, just proceed with loading
         try {
-            const response = await fetch(url);
+            const response = await fetchAfterConversion(url);
             if (!response.ok) {
                 throw new Error(t.failedToFetchBook.replace('{statusText}', response.statusText));
             }
@@ -16,6 +16,7 @@ window.saveGlobalSettings = async function(event, force = false) {
     data.DISABLE_NORMAL_USER_UPLOAD = form.querySelector('#DISABLE_NORMAL_USER_UPLOAD').checked;
     data.REQUIRE_INVITE_CODE = form.querySelector('#REQUIRE_INVITE_CODE').checked;
     data.ENABLE_ACTIVITY_LOG = form.querySelector('#ENABLE_ACTIVITY_LOG').checked;
+    data.ENABLE_PREWARM = form.querySelector('#ENABLE_PREWARM').checked;
 
 
     if (force) {
@@ -1,16 +1,48 @@
 """
 用户活动日志记录工具模块
 用于统一记录所有用户活动，包括登录、登出、书籍操作等
+
+log_activity 只把记录放入有界的内存队列，由后台线程用 executemany 批量写入中心数据库，
+请求线程不会等待日志写入。队列满时丢弃新记录并计数；进程退出时 (atexit) 写入剩余记录。
+读取日志的函数会先写入本进程的队列，其它 gunicorn worker 的记录最多晚一个刷新周期可见。
+
+每批记录在同一事务中累加到按天汇总表 user_activity_daily，统计接口读取汇总表而不扫描原始日志；
+写入线程同时驱动 utils.activity_retention 的保留期清理。
 """
+import atexit
+import os
+import queue
+import threading
 from datetime import datetime
 from contextlib import closing
 from flask import request, g
 import database
 import config_manager
+from utils.activity_retention import ActivityLogPruner, PRUNE_INTERVAL_SECONDS
 
 
 import json
 
+ACTIVITY_LOG_QUEUE_SIZE = int(os.environ.get('ACTIVITY_LOG_QUEUE_SIZE', 10000))
+ACTIVITY_LOG_BATCH_SIZE = int(os.environ.get('ACTIVITY_LOG_BATCH_SIZE', 200))
+ACTIVITY_LOG_FLUSH_SECONDS = float(os.environ.get('ACTIVITY_LOG_FLUSH_SECONDS', 1))
+
+INSERT_ACTIVITY_SQL = '''
+    INSERT INTO user_activity_log (
+        user_id, username, activity_type, success, failure_reason,
+        book_id, book_title, library_type, task_id, detail,
+        ip_address, user_agent, created_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+UPSERT_ROLLUP_SQL = '''
+    INSERT INTO user_activity_daily (day, user_id, username, activity_type, success, count, last_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(day, user_id, username, activity_type, success) DO UPDATE SET
+        count = count + excluded.count,
+        last_at = MAX(COALESCE(last_at, ''), excluded.last_at)
+'''
+
 SENSITIVE_KEYWORDS = [
    'password', 'api_key', 'secret', 'token',
    'smtp_password', 'calibre_password', 'tts_api_key', 'llm_api_key'
@@ -114,6 +146,121 @@ class ActivityType:
     DELETE_ALL_ACTIVITY_LOGS = 'delete_all_activity_logs'
 
 
+class ActivityLogWriter:
+    """有界队列 + 后台批量写入"""
+
+    def __init__(self, max_size, batch_size, flush_interval):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_size)
+        # 后台线程和 flush() 不能同时写同一批记录
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self._thread_lock = threading.Lock()
+        self.pruner = ActivityLogPruner(PRUNE_INTERVAL_SECONDS)
+        self.stats = {'enqueued': 0, 'written': 0, 'dropped': 0, 'batches': 0, 'errors': 0}
+
+    def enqueue(self, row):
+        try:
+            self._queue.put_nowait(row)
+            self.stats['enqueued'] += 1
+        except queue.Full:
+            # 溢出策略：丢弃新记录，不阻塞请求
+            self.stats['dropped'] += 1
+            if self.stats['dropped'] % 1000 == 1:
+                print(f"Activity log queue is full, dropped {self.stats['dropped']} records so far")
+        self._ensure_thread()
+
+    def _drain(self, first=None):
+        batch = [first] if first is not None else []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    @staticmethod
+    def _rollup(batch):
+        """把一批记录合并成 user_activity_daily 的增量行"""
+        totals = {}
+        for row in batch:
+            user_id, username, activity_type, success = row[0], row[1], row[2], row[3]
+            created_at = row[12]
+            key = (created_at[:10], user_id or 0, username, activity_type, success)
+            count, last_at = totals.get(key, (0, created_at))
+            totals[key] = (count + 1, max(last_at, created_at))
+        return [key + value for key, value in totals.items()]
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        try:
+            with closing(database.get_db()) as db:
+                # 连接处于自动提交模式，显式开启事务，整批记录和汇总只提交一次
+                db.execute('BEGIN')
+                try:
+                    db.executemany(INSERT_ACTIVITY_SQL, batch)
+                    db.executemany(UPSERT_ROLLUP_SQL, self._rollup(batch))
+                    db.commit()
+                except Exception:
+                    db.rollback()
+                    raise
+            self.stats['written'] += len(batch)
+            self.stats['batches'] += 1
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.stats['dropped'] += len(batch)
+            print(f"Failed to write {len(batch)} activity log records: {e}")
+
+    def flush(self):
+        """在当前线程写入队列中的全部记录"""
+        with self._write_lock:
+            while True:
+                batch = self._drain()
+                if not batch:
+                    return
+                self._write_batch(batch)
+
+    def _ensure_thread(self):
+        pid = os.getpid()
+        if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='activity-log-writer', daemon=True)
+            self._thread_pid = pid
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            # 清理未完成时不要等满一个周期，尽快处理下一批
+            timeout = 0.05 if self.pruner.active else self.flush_interval
+            try:
+                first = self._queue.get(timeout=timeout)
+                with self._write_lock:
+                    self._write_batch(self._drain(first))
+            except queue.Empty:
+                pass
+            self.pruner.step()
+
+
+_writer = ActivityLogWriter(ACTIVITY_LOG_QUEUE_SIZE, ACTIVITY_LOG_BATCH_SIZE, ACTIVITY_LOG_FLUSH_SECONDS)
+atexit.register(_writer.flush)
+
+
+def flush_activity_log():
+    """写入本进程中尚未写入的活动日志（读取日志前调用）"""
+    _writer.flush()
+
+
+def get_activity_log_stats():
+    """返回日志队列的计数器：enqueued、written、dropped、batches、errors 以及当前队列长度"""
+    return dict(_writer.stats, queued=_writer._queue.qsize(), pruned=_writer.pruner.stats['pruned'])
+
+
 def log_activity(
     activity_type,
     username=None,
@@ -168,20 +315,12 @@ def log_activity(
             clean_detail = filter_sensitive_data(detail)
             detail_to_log = json.dumps(clean_detail, ensure_ascii=False)
 
-        # 插入日志记录
-        with closing(database.get_db()) as db:
-            db.execute('''
-                INSERT INTO user_activity_log (
-                    user_id, username, activity_type, success, failure_reason,
-                    book_id, book_title, library_type, task_id, detail,
-                    ip_address, user_agent
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                user_id, username, activity_type, int(success), failure_reason,
-                book_id, book_title, library_type, task_id, detail_to_log,
-                ip_address, user_agent
-            ))
-            db.commit()
+        # 放入写入队列；created_at 取事件发生的时间（与 CURRENT_TIMESTAMP 格式一致，UTC）
+        _writer.enqueue((
+            user_id, username, activity_type, int(success), failure_reason,
+            book_id, book_title, library_type, task_id, detail_to_log,
+            ip_address, user_agent, datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        ))
     except Exception as e:
         # 记录日志失败不应该影响主业务流程
         print(f"Failed to log activity: {e}")
@@ -204,6 +343,7 @@ def get_user_activities(user_id=None, username=None, activity_type=None,
     Returns:
         活动日志记录列表
     """
+    flush_activity_log()
     with closing(database.get_db()) as db:
         query = 'SELECT * FROM user_activity_log WHERE 1=1'
         params = []
@@ -237,7 +377,7 @@ def get_user_activities(user_id=None, username=None, activity_type=None,
 
 def get_activity_statistics(user_id=None, start_date=None, end_date=None):
     """
-    获取活动统计信息
+    获取活动统计信息（读取按天汇总表，日期过滤精确到天）
     
     Args:
         user_id: 用户ID (可选，不提供则统计所有用户)
@@ -247,14 +387,15 @@ def get_activity_statistics(user_id=None, start_date=None, end_date=None):
     Returns:
         统计信息字典
     """
+    flush_activity_log()
     with closing(database.get_db()) as db:
         query = '''
             SELECT 
                 activity_type,
-                COUNT(*) as count,
-                SUM(CASE WHEN success = 1 THEN 1 ELSE 0 END) as success_count,
-                SUM(CASE WHEN success = 0 THEN 1 ELSE 0 END) as failure_count
-            FROM user_activity_log
+                SUM(count) as count,
+                SUM(CASE WHEN success = 1 THEN count ELSE 0 END) as success_count,
+                SUM(CASE WHEN success = 0 THEN count ELSE 0 END) as failure_count
+            FROM user_activity_daily
             WHERE 1=1
         '''
         params = []
@@ -264,12 +405,12 @@ def get_activity_statistics(user_id=None, start_date=None, end_date=None):
             params.append(user_id)
         
         if start_date is not None:
-            query += ' AND created_at >= ?'
-            params.append(start_date)
+            query += ' AND day >= ?'
+            params.append(str(start_date)[:10])
         
         if end_date is not None:
-            query += ' AND created_at <= ?'
-            params.append(end_date)
+            query += ' AND day <= ?'
+            params.append(str(end_date)[:10])
         
         query += ' GROUP BY activity_type'
         
@@ -297,6 +438,7 @@ def get_recent_login_attempts(username, minutes=30):
     Returns:
         登录尝试记录列表
     """
+    flush_activity_log()
     with closing(database.get_db()) as db:
         cursor = db.execute('''
             SELECT * FROM user_activity_log
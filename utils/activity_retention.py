@@ -0,0 +1,181 @@
+"""
+活动日志保留期与归档
+
+ACTIVITY_LOG_RETENTION_DAYS > 0 时，早于保留期的 user_activity_log 记录会在后台分批
+（每批 ACTIVITY_LOG_PRUNE_BATCH_SIZE 行）移出中心数据库：先按月份写入
+ACTIVITY_LOG_ARCHIVE_DIR 下的 activity-YYYY-MM.db，再从 app.db 删除。
+ACTIVITY_LOG_ARCHIVE=0 时直接删除不归档。默认 0 表示永久保留（与原来的行为一致）。
+
+按天汇总表 user_activity_daily 不受清理影响，统计数字仍包含已归档的记录。
+清理由日志写入线程驱动，每批之间会继续写入新日志；多个 worker 通过文件锁保证同一时间只有一个在清理。
+"""
+import fcntl
+import glob
+import os
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+import database
+from config_manager import CONFIG_DIR
+
+RETENTION_DAYS = int(os.environ.get('ACTIVITY_LOG_RETENTION_DAYS', 0))
+ARCHIVE_ENABLED = os.environ.get('ACTIVITY_LOG_ARCHIVE', '1') not in ('0', 'false', 'False')
+ARCHIVE_DIR = os.environ.get('ACTIVITY_LOG_ARCHIVE_DIR', os.path.join(CONFIG_DIR, 'activity_archive'))
+PRUNE_BATCH_SIZE = int(os.environ.get('ACTIVITY_LOG_PRUNE_BATCH_SIZE', 1000))
+PRUNE_INTERVAL_SECONDS = int(os.environ.get('ACTIVITY_LOG_PRUNE_INTERVAL', 3600))
+
+ARCHIVE_COLUMNS = (
+    'id', 'user_id', 'username', 'activity_type', 'success', 'failure_reason',
+    'book_id', 'book_title', 'library_type', 'task_id', 'detail',
+    'ip_address', 'user_agent', 'created_at'
+)
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_activity_log (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    username TEXT NOT NULL,
+    activity_type TEXT NOT NULL,
+    success INTEGER NOT NULL DEFAULT 1,
+    failure_reason TEXT,
+    book_id INTEGER,
+    book_title TEXT,
+    library_type TEXT,
+    task_id TEXT,
+    detail TEXT,
+    ip_address TEXT,
+    user_agent TEXT,
+    created_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_archive_user_id ON user_activity_log(user_id);
+"""
+
+
+def get_archive_path(month):
+    """month 形如 'YYYY-MM'"""
+    return os.path.join(ARCHIVE_DIR, f"activity-{month}.db")
+
+
+def list_archives():
+    return sorted(glob.glob(os.path.join(ARCHIVE_DIR, 'activity-*.db')))
+
+
+def _retention_cutoff():
+    # 与 CURRENT_TIMESTAMP 相同的格式 (UTC)，可以直接和 created_at 比较
+    return (datetime.utcnow() - timedelta(days=RETENTION_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _archive_rows(rows):
+    by_month = {}
+    for row in rows:
+        by_month.setdefault((row['created_at'] or '')[:7] or 'unknown', []).append(tuple(row[c] for c in ARCHIVE_COLUMNS))
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    placeholders = ', '.join('?' * len(ARCHIVE_COLUMNS))
+    for month, values in by_month.items():
+        with closing(sqlite3.connect(get_archive_path(month))) as archive:
+            archive.executescript(ARCHIVE_SCHEMA)
+            # INSERT OR IGNORE：上一次归档后还没来得及删除就中断时，重试不会产生重复记录
+            archive.executemany(
+                f"INSERT OR IGNORE INTO user_activity_log ({', '.join(ARCHIVE_COLUMNS)}) VALUES ({placeholders})",
+                values
+            )
+            archive.commit()
+
+
+def prune_batch(batch_size=None):
+    """归档并删除一批过期记录，返回处理的行数。未启用保留期时返回 0。"""
+    if RETENTION_DAYS <= 0:
+        return 0
+    batch_size = batch_size or PRUNE_BATCH_SIZE
+    with closing(database.get_db()) as db:
+        rows = db.execute(
+            f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM user_activity_log WHERE created_at < ? ORDER BY created_at LIMIT ?",
+            (_retention_cutoff(), batch_size)
+        ).fetchall()
+        if not rows:
+            return 0
+        if ARCHIVE_ENABLED:
+            _archive_rows(rows)
+        ids = [row['id'] for row in rows]
+        db.execute('BEGIN')
+        try:
+            db.executemany('DELETE FROM user_activity_log WHERE id = ?', [(i,) for i in ids])
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    return len(rows)
+
+
+def prune_all():
+    """一次性清理全部过期记录（命令行使用），返回处理的行数"""
+    total = 0
+    while True:
+        count = prune_batch()
+        total += count
+        if count < PRUNE_BATCH_SIZE:
+            return total
+
+
+def delete_archived_activities(user_id=None):
+    """删除归档中的记录；user_id 为 None 时删除全部归档文件"""
+    for path in list_archives():
+        if user_id is None:
+            os.remove(path)
+            continue
+        with closing(sqlite3.connect(path)) as archive:
+            archive.execute('DELETE FROM user_activity_log WHERE user_id = ?', (user_id,))
+            archive.commit()
+
+
+class ActivityLogPruner:
+    """
+    由日志写入线程周期性调用 step()。每次最多清理一批，清理未完成时 active 为 True，
+    写入线程会尽快再次调用，从而把清理分散成许多个短事务。
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.active = False
+        self._next_run = 0
+        self.stats = {'pruned': 0, 'errors': 0}
+
+    def step(self):
+        if RETENTION_DAYS <= 0:
+            return
+        if not self.active and time.time() < self._next_run:
+            return
+        lock_path = database.DATABASE_PATH + '.prune.lock'
+        try:
+            with open(lock_path, 'w') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # 其它 worker 正在清理
+                    self.active = False
+                    self._next_run = time.time() + self.interval
+                    return
+                try:
+                    count = prune_batch()
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        except Exception as e:
+            self.stats['errors'] += 1
+            self.active = False
+            self._next_run = time.time() + self.interval
+            print(f"Failed to prune activity log: {e}")
+            return
+
+        self.stats['pruned'] += count
+        self.active = count >= PRUNE_BATCH_SIZE
+        if not self.active:
+            self._next_run = time.time() + self.interval
+
+
+if __name__ == '__main__':
+    # 手动清理：python -m utils.activity_retention
+    if RETENTION_DAYS <= 0:
+        print("ACTIVITY_LOG_RETENTION_DAYS is not set; nothing to prune.")
+    else:
+        print(f"Pruned {prune_all()} activity log records older than {RETENTION_DAYS} days.")
@@ -0,0 +1,276 @@
+"""
+get_anx_books 使用的阅读时长 / 笔记数量聚合缓存
+
+原来的查询在每次加载首页时对 tb_books、tb_reading_time、tb_notes 做双重 LEFT JOIN + GROUP BY，
+而且阅读记录 × 笔记的笛卡尔积还会把阅读时长放大。这里把每本书的聚合结果保存在
+CONFIG_DIR 下的旁路数据库 (sidecar) 中，不改动 Anx 应用的 database7.db：
+
+- 早于"活跃窗口"(最近 ANX_AGGREGATES_LIVE_DAYS 天) 的阅读记录被视为冻结，按 rowid 和日期水位线增量累加；
+- 活跃窗口内的记录每次读取时实时汇总（走 acm_idx_reading_time_date 索引，数据量很小）；
+- 笔记数量在 (COUNT, MAX(id)) 指纹变化时重新按 book_id 分组统计；
+- 服务端写入了窗口之外日期的阅读记录时（例如 KOReader 同步旧数据），通过 mark_reading_time_changed 标记该书重算；
+- 数据库文件被替换或被原地重写（WebDAV 同步，按 inode、mtime 和大小判断）、记录变少或距离上次全量重建超过
+  ANX_AGGREGATES_REBUILD_SECONDS 时全量重建。服务端自己写入阅读进度后通过 note_own_write 更新记录的文件标识，
+  不会因此全量重建。
+"""
+import os
+import sqlite3
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+from config_manager import CONFIG_DIR
+
+AGGREGATES_DIR = os.environ.get('ANX_AGGREGATES_DIR', os.path.join(CONFIG_DIR, 'anx_aggregates'))
+LIVE_DAYS = int(os.environ.get('ANX_AGGREGATES_LIVE_DAYS', 7))
+FULL_REBUILD_SECONDS = int(os.environ.get('ANX_AGGREGATES_REBUILD_SECONDS', 86400))
+
+SIDECAR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS book_aggregates (
+  book_id INTEGER PRIMARY KEY,
+  frozen_reading_time INTEGER NOT NULL DEFAULT 0,
+  note_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS dirty_books (
+  book_id INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+"""
+
+_schema_ready = set()
+
+
+def get_sidecar_path(username):
+    return os.path.join(AGGREGATES_DIR, f"{os.path.basename(username)}.db")
+
+
+def _connect_sidecar(username):
+    os.makedirs(AGGREGATES_DIR, exist_ok=True)
+    path = get_sidecar_path(username)
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute('PRAGMA busy_timeout=5000')
+    # 建表和切换 WAL 都要写文件，每个进程每个 sidecar 只做一次
+    if path not in _schema_ready:
+        # sidecar 只有服务端使用，可以放心开启 WAL
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SIDECAR_SCHEMA)
+        _schema_ready.add(path)
+    return conn
+
+
+def _live_cutoff():
+    """活跃窗口的起始日期，早于该日期的阅读记录视为冻结"""
+    return (datetime.utcnow() - timedelta(days=LIVE_DAYS)).strftime('%Y-%m-%d')
+
+
+def _source_id(db_path):
+    """文件标识 inode:mtime_ns:size，文件被替换或被 WsgiDAV 原地重写时都会变化"""
+    try:
+        st = os.stat(db_path)
+    except OSError:
+        return ''
+    return f"{st.st_ino}:{st.st_mtime_ns}:{st.st_size}"
+
+
+def _full_rebuild(anx_db, side, cutoff, max_rowid, notes_fingerprint, source_id):
+    side.execute('DELETE FROM book_aggregates')
+    side.execute('DELETE FROM dirty_books')
+    frozen = anx_db.execute(
+        "SELECT book_id, SUM(reading_time) FROM tb_reading_time WHERE date < ? AND rowid <= ? GROUP BY book_id",
+        (cutoff, max_rowid)
+    ).fetchall()
+    side.executemany(
+        "INSERT INTO book_aggregates (book_id, frozen_reading_time) VALUES (?, ?)",
+        [(row[0], row[1] or 0) for row in frozen if row[0] is not None]
+    )
+    _refresh_note_counts(anx_db, side)
+    _write_meta(side, {
+        'source': source_id,
+        'frozen_before': cutoff,
+        'reading_max_rowid': max_rowid,
+        'notes_fingerprint': notes_fingerprint,
+        'rebuilt_at': time.time(),
+    })
+
+
+def _refresh_note_counts(anx_db, side):
+    counts = anx_db.execute("SELECT book_id, COUNT(*) FROM tb_notes GROUP BY book_id").fetchall()
+    side.execute('UPDATE book_aggregates SET note_count = 0')
+    side.executemany("""
+        INSERT INTO book_aggregates (book_id, note_count) VALUES (?, ?)
+        ON CONFLICT(book_id) DO UPDATE SET note_count = excluded.note_count
+    """, [(row[0], row[1]) for row in counts if row[0] is not None])
+
+
+def _write_meta(side, values):
+    side.executemany(
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        [(k, str(v)) for k, v in values.items()]
+    )
+
+
+def _current_state(anx_db, db_path):
+    """Anx 数据库当前的水位线：(活跃窗口起点, 文件标识, 阅读记录最大 rowid, 笔记指纹)"""
+    max_rowid = anx_db.execute('SELECT COALESCE(MAX(rowid), 0) FROM tb_reading_time').fetchone()[0]
+    notes_fingerprint = '|'.join(str(v) for v in anx_db.execute('SELECT COUNT(*), COALESCE(MAX(id), 0) FROM tb_notes').fetchone())
+    return _live_cutoff(), _source_id(db_path), max_rowid, notes_fingerprint
+
+
+def _needs_full_rebuild(meta, state):
+    cutoff, source_id, max_rowid, _notes_fingerprint = state
+    old_cutoff = meta.get('frozen_before')
+    return (old_cutoff is None
+            or meta.get('source') != source_id
+            or max_rowid < int(meta.get('reading_max_rowid', 0))
+            or cutoff < old_cutoff
+            or time.time() - float(meta.get('rebuilt_at', 0)) > FULL_REBUILD_SECONDS)
+
+
+def _is_current(side, state):
+    """sidecar 是否已经与 Anx 数据库一致；只读，不需要写事务"""
+    meta = dict(side.execute('SELECT key, value FROM meta').fetchall())
+    cutoff, _source_id, max_rowid, notes_fingerprint = state
+    return (not _needs_full_rebuild(meta, state)
+            and meta.get('frozen_before') == cutoff
+            and int(meta.get('reading_max_rowid', 0)) == max_rowid
+            and meta.get('notes_fingerprint') == notes_fingerprint
+            and side.execute('SELECT 1 FROM dirty_books LIMIT 1').fetchone() is None)
+
+
+def _refresh(anx_db, side, state):
+    """把 sidecar 更新到 Anx 数据库的当前状态 state，必须在 sidecar 的写事务中调用。"""
+    meta = dict(side.execute('SELECT key, value FROM meta').fetchall())
+    cutoff, source_id, max_rowid, notes_fingerprint = state
+
+    old_cutoff = meta.get('frozen_before')
+    old_max_rowid = int(meta.get('reading_max_rowid', 0))
+    if _needs_full_rebuild(meta, state):
+        _full_rebuild(anx_db, side, cutoff, max_rowid, notes_fingerprint, source_id)
+        return
+
+    if cutoff > old_cutoff or max_rowid > old_max_rowid:
+        # 新滑出活跃窗口的记录，以及之后才插入的旧日期记录，累加到冻结值上
+        delta = anx_db.execute("""
+            SELECT book_id, SUM(reading_time) FROM tb_reading_time
+            WHERE rowid <= :max_rowid
+              AND ((date >= :old_cutoff AND date < :cutoff) OR (rowid > :old_max_rowid AND date < :old_cutoff))
+            GROUP BY book_id
+        """, {'max_rowid': max_rowid, 'old_cutoff': old_cutoff, 'cutoff': cutoff, 'old_max_rowid': old_max_rowid}).fetchall()
+        side.executemany("""
+            INSERT INTO book_aggregates (book_id, frozen_reading_time) VALUES (?, ?)
+            ON CONFLICT(book_id) DO UPDATE SET frozen_reading_time = frozen_reading_time + excluded.frozen_reading_time
+        """, [(row[0], row[1] or 0) for row in delta if row[0] is not None])
+
+    dirty = [row[0] for row in side.execute('SELECT book_id FROM dirty_books').fetchall()]
+    for book_id in dirty:
+        total = anx_db.execute(
+            "SELECT COALESCE(SUM(reading_time), 0) FROM tb_reading_time WHERE book_id = ? AND date < ? AND rowid <= ?",
+            (book_id, cutoff, max_rowid)
+        ).fetchone()[0]
+        side.execute("""
+            INSERT INTO book_aggregates (book_id, frozen_reading_time) VALUES (?, ?)
+            ON CONFLICT(book_id) DO UPDATE SET frozen_reading_time = excluded.frozen_reading_time
+        """, (book_id, total))
+    if dirty:
+        side.execute('DELETE FROM dirty_books')
+
+    if notes_fingerprint != meta.get('notes_fingerprint'):
+        _refresh_note_counts(anx_db, side)
+
+    _write_meta(side, {'frozen_before': cutoff, 'reading_max_rowid': max_rowid, 'notes_fingerprint': notes_fingerprint})
+
+
+def _compute_directly(anx_db):
+    """sidecar 不可用时的退路：两次独立的 GROUP BY，不做 JOIN"""
+    reading_times = {row[0]: row[1] or 0 for row in anx_db.execute(
+        "SELECT book_id, SUM(reading_time) FROM tb_reading_time GROUP BY book_id")}
+    note_counts = {row[0]: row[1] for row in anx_db.execute(
+        "SELECT book_id, COUNT(*) FROM tb_notes GROUP BY book_id")}
+    return reading_times, note_counts
+
+
+def get_book_aggregates(username, anx_db, db_path):
+    """
+    返回 ({book_id: 总阅读秒数}, {book_id: 笔记数})。
+    anx_db 是调用方已经打开的 Anx 数据库连接。
+    """
+    try:
+        with closing(_connect_sidecar(username)) as side:
+            state = _current_state(anx_db, db_path)
+            # 稳态下水位线没有变化，只读不写；需要更新时才取写锁，拿到锁后再确认一次（别的请求可能刚更新过）
+            if not _is_current(side, state):
+                side.execute('BEGIN IMMEDIATE')
+                try:
+                    if not _is_current(side, state):
+                        _refresh(anx_db, side, state)
+                    side.execute('COMMIT')
+                except Exception:
+                    side.execute('ROLLBACK')
+                    raise
+            cutoff = side.execute("SELECT value FROM meta WHERE key = 'frozen_before'").fetchone()[0]
+            reading_times = {}
+            note_counts = {}
+            for book_id, frozen, notes in side.execute('SELECT book_id, frozen_reading_time, note_count FROM book_aggregates'):
+                reading_times[book_id] = frozen
+                note_counts[book_id] = notes
+        # 不在 SQL 里 GROUP BY book_id，否则优化器会改走 (book_id, date) 索引做全索引扫描
+        live = anx_db.execute("SELECT book_id, reading_time FROM tb_reading_time WHERE date >= ?", (cutoff,)).fetchall()
+        for book_id, seconds in live:
+            reading_times[book_id] = reading_times.get(book_id, 0) + (seconds or 0)
+        return reading_times, note_counts
+    except sqlite3.Error as e:
+        # sidecar 可能被删除后重新创建，下次连接时重新建表
+        _schema_ready.discard(get_sidecar_path(username))
+        print(f"Anx aggregate cache unavailable for user {username}, computing directly: {e}")
+        return _compute_directly(anx_db)
+
+
+def mark_reading_time_changed(username, book_id, date):
+    """
+    服务端写入 tb_reading_time 后调用。活跃窗口内的日期每次都会实时汇总，无需处理；
+    更早的日期需要标记该书，在下次读取时重算冻结值。
+    """
+    if not date or date >= _live_cutoff():
+        return
+    if not os.path.exists(get_sidecar_path(username)):
+        return
+    try:
+        with closing(_connect_sidecar(username)) as side:
+            side.execute("INSERT OR IGNORE INTO dirty_books (book_id) VALUES (?)", (book_id,))
+    except sqlite3.Error as e:
+        print(f"Failed to mark Anx aggregates dirty for user {username}: {e}")
+
+
+def get_source_id(db_path):
+    """写入 Anx 数据库之前调用，把结果传给 note_own_write"""
+    return _source_id(db_path)
+
+
+def note_own_write(username, db_path, source_before):
+    """
+    服务端写入 Anx 数据库并提交之后调用。写入前 sidecar 与文件一致时，把记录的文件标识更新为写入后的，
+    增量部分（新的阅读记录、mark_reading_time_changed 标记的书）照常在下次读取时处理，不必全量重建。
+    """
+    if not source_before or not os.path.exists(get_sidecar_path(username)):
+        return
+    try:
+        with closing(_connect_sidecar(username)) as side:
+            side.execute(
+                "UPDATE meta SET value = ? WHERE key = 'source' AND value = ?",
+                (_source_id(db_path), source_before)
+            )
+    except sqlite3.Error as e:
+        print(f"Failed to update Anx aggregate source for user {username}: {e}")
+
+
+def remove_aggregates(username):
+    """删除用户的 sidecar 数据库（删除用户时调用）"""
+    path = get_sidecar_path(username)
+    _schema_ready.discard(path)
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
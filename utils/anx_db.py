@@ -0,0 +1,197 @@
+"""
+用户 Anx 数据库 (database7.db) 的连接缓存
+按 (username, db_path) 缓存已打开的连接，LRU 淘汰，并在文件被 Anx 应用通过 WebDAV 替换时自动重新打开
+"""
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from anx_db_schema import ANX_DB_INDEXES
+
+ANX_DB_CACHE_SIZE = int(os.environ.get('ANX_DB_CACHE_SIZE', 32))
+ANX_DB_BUSY_TIMEOUT_MS = int(os.environ.get('ANX_DB_BUSY_TIMEOUT_MS', 5000))
+
+
+def ensure_anx_indexes(conn):
+    """
+    确保热点查询需要的 acm_ 索引存在，返回新建的索引名列表。
+    库中还没有对应的表（例如尚未初始化的空文件）时跳过该索引。
+    """
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('index', 'table')")}
+    created = []
+    for name, sql in ANX_DB_INDEXES:
+        table = sql.split(' ON ', 1)[1].split(' ', 1)[0]
+        if name in existing or table not in existing:
+            continue
+        conn.execute(sql)
+        created.append(name)
+    if conn.in_transaction:
+        conn.commit()
+    return created
+
+
+def _file_signature(db_path):
+    """返回用于检测文件被替换的 (inode, mtime_ns, size)，文件不存在时返回 None"""
+    try:
+        st = os.stat(db_path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class AnxConnection:
+    """
+    借出的 Anx 数据库连接。
+    close() 把连接放回缓存而不是真正关闭，因此可以继续使用 `with closing(...) as db:` 的写法。
+    """
+    def __init__(self, cache, key, conn):
+        self._cache = cache
+        self._key = key
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on an Anx connection that has been released.")
+        return getattr(conn, name)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._conn.__exit__(exc_type, exc_value, traceback)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._cache.release(self._key, conn)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class AnxConnectionCache:
+    """
+    进程内的 LRU 连接缓存。
+
+    每个 key 最多缓存一个空闲连接；借出期间再次请求同一个库时会临时新建连接，
+    所以后台线程和请求线程不会共用同一个连接。
+    注意：这里不能把 Anx 库切换到 WAL 模式，Anx 应用通过 WebDAV 只同步 database7.db 这一个文件，
+    写入 -wal 文件的数据它看不到。因此只设置与任何日志模式都兼容的 busy_timeout。
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._idle = OrderedDict()  # key -> (conn, signature)
+        self._lock = threading.Lock()
+        # db_path -> 检查索引时的文件签名 (inode, mtime_ns, size)。WebDAV 同步既可能替换文件，也可能原地重写
+        # （inode 不变），签名变化后重新打开连接时再检查一次，只是一次 sqlite_master 查询
+        self._indexed = {}
+        self.stats = {'opened': 0, 'reused': 0, 'reopened': 0, 'evicted': 0}
+
+    def _connect(self, db_path):
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA busy_timeout={ANX_DB_BUSY_TIMEOUT_MS}')
+        self.stats['opened'] += 1
+        self._ensure_indexes_once(conn, db_path)
+        return conn
+
+    def _ensure_indexes_once(self, conn, db_path):
+        signature = _file_signature(db_path)
+        if signature is None:
+            return
+        with self._lock:
+            if self._indexed.get(db_path) == signature:
+                return
+        try:
+            created = ensure_anx_indexes(conn)
+            if created:
+                print(f"Created Anx indexes {created} in {db_path}")
+        except sqlite3.Error as e:
+            # 只读或被锁住时不影响正常查询，只是少了索引
+            print(f"Could not ensure Anx indexes in {db_path}: {e}")
+            if conn.in_transaction:
+                conn.rollback()
+        # 无论成功与否都记录下来，文件不变时不再重试；新建索引会改变签名，记录之后的签名
+        with self._lock:
+            self._indexed[db_path] = _file_signature(db_path) or signature
+
+    def acquire(self, username, db_path):
+        key = (username, db_path)
+        signature = _file_signature(db_path)
+        stale = None
+        with self._lock:
+            entry = self._idle.pop(key, None)
+            if entry is not None:
+                conn, cached_signature = entry
+                if signature is not None and signature == cached_signature:
+                    self.stats['reused'] += 1
+                    return AnxConnection(self, key, conn)
+                # 文件被替换或在别处被修改过，丢弃旧连接以免读到已删除 inode 上的旧数据
+                stale = conn
+                self.stats['reopened'] += 1
+        if stale is not None:
+            stale.close()
+        return AnxConnection(self, key, self._connect(db_path))
+
+    def release(self, key, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+
+        # 在归还时记录文件签名，这样本进程自己的写入不会被误判为外部替换
+        signature = _file_signature(key[1])
+        if signature is None or self.max_size <= 0:
+            conn.close()
+            return
+
+        to_close = []
+        with self._lock:
+            if key in self._idle:
+                to_close.append(conn)
+            else:
+                self._idle[key] = (conn, signature)
+                while len(self._idle) > self.max_size:
+                    _unused, (old_conn, _sig) = self._idle.popitem(last=False)
+                    to_close.append(old_conn)
+                    self.stats['evicted'] += 1
+        for c in to_close:
+            c.close()
+
+    def evict(self, username=None):
+        """关闭某个用户（或全部用户）的缓存连接，例如在删除用户目录之前。"""
+        with self._lock:
+            keys = [k for k in self._idle if username is None or k[0] == username]
+            entries = [self._idle.pop(k) for k in keys]
+        for conn, _sig in entries:
+            conn.close()
+
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """获取当前进程的连接缓存（fork 之后重新创建）。"""
+    global _cache, _cache_pid
+    pid = os.getpid()
+    if _cache is None or _cache_pid != pid:
+        with _cache_lock:
+            if _cache is None or _cache_pid != pid:
+                _cache = AnxConnectionCache(ANX_DB_CACHE_SIZE)
+                _cache_pid = pid
+    return _cache
+
+def connect_anx_db(username, db_path):
+    """借出一个指向用户 Anx 数据库的连接 (row_factory 为 sqlite3.Row)，调用 close() 即归还。"""
+    return get_cache().acquire(username, db_path)
+
+def evict_anx_db(username=None):
+    get_cache().evict(username)
@@ -1,8 +1,8 @@
 import datetime
-import sqlite3
 import os
 from contextlib import closing
-from anx_library import get_anx_user_dirs
+from anx_library import get_anx_user_dirs, get_anx_db
+from utils.progress_buffer import flush_progress
 
 def format_reading_time(seconds):
     """将秒格式化为精确且易读的字符串。"""
@@ -44,8 +44,8 @@ def get_user_reading_stats(username, time_range):
     if not dirs or not os.path.exists(dirs["db_path"]):
         return {"error": "Anx library not found for this user."}
 
-    with closing(sqlite3.connect(dirs["db_path"])) as user_db:
-        user_db.row_factory = sqlite3.Row
+    flush_progress(username)
+    with closing(get_anx_db(username)) as user_db:
         cursor = user_db.cursor()
 
         # 1. --- 摘要统计 (始终计算) ---
@@ -1,8 +1,25 @@
+import threading
 from requests.auth import HTTPDigestAuth
 import config_manager
 
+_auth_lock = threading.Lock()
+_auth_cache = {}
+
 def get_calibre_auth():
+    """
+    返回 Calibre 的摘要认证对象。同一组用户名密码复用同一个对象，
+    HTTPDigestAuth 会按线程记住 nonce，后续请求可以直接带上认证头，省去 401 质询的往返。
+    """
     config = config_manager.config
-    if config.get('CALIBRE_USERNAME') and config.get('CALIBRE_PASSWORD'):
-        return HTTPDigestAuth(config['CALIBRE_USERNAME'], config['CALIBRE_PASSWORD'])
-    return None
\ No newline at end of file
+    username = config.get('CALIBRE_USERNAME')
+    password = config.get('CALIBRE_PASSWORD')
+    if not (username and password):
+        return None
+    key = (username, password)
+    auth = _auth_cache.get(key)
+    if auth is None:
+        with _auth_lock:
+            # 凭据修改后只保留最新的一个
+            _auth_cache.clear()
+            auth = _auth_cache[key] = HTTPDigestAuth(username, password)
+    return auth
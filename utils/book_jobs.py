@@ -0,0 +1,188 @@
+"""
+批量推送 / 发送任务
+
+推送到 Anx 和发送到 Kindle 原来每本书一个请求，每个请求都同步地走完
+详情 -> 下载 -> 转换 -> 修复 -> 写入 的流程，推送一整个丛书要发几百个阻塞的请求。这里改为：
+
+- 一个请求提交一批 Calibre 书籍（ID 列表或搜索表达式），登记到 book_job_items 后立即返回；
+- 每个进程一个有界线程池 (BOOK_JOB_WORKERS) 并行处理，每本书的状态和当前步骤写入 app.db，
+  任何 worker 都可以回答 GET /api/book_jobs/<job_id> 的查询；
+- 整批共用的准备工作只做一次：发送到 Kindle 共用一个 SMTP 连接，推送到 Anx 的书全部准备好后
+  只处理一次导入目录（一个 Anx 数据库事务），由调用方在 on_finished 中完成。
+
+任务记录执行它的进程 (owner，见 utils.job_owner)，这个进程退出后（worker 重启、容器重启）未完成的书
+在下次查询和 worker 启动时标记为中断。一个任务最多 BOOK_JOB_MAX_BOOKS 本书，任务记录保留 BOOK_JOB_RETENTION_DAYS 天，创建新任务时顺带清理。
+"""
+import os
+import shutil
+import threading
+import uuid
+from contextlib import closing
+from config_manager import CONFIG_DIR
+from database import get_db
+from utils.job_owner import current_owner
+from utils.job_runtime import JobExecutor, cleanup_old_jobs, expire_orphans, status_counts
+
+BOOK_JOB_WORKERS = int(os.environ.get('BOOK_JOB_WORKERS', 2))
+BOOK_JOB_MAX_BOOKS = int(os.environ.get('BOOK_JOB_MAX_BOOKS', 500))
+BOOK_JOB_SPOOL_DIR = os.environ.get('BOOK_JOB_SPOOL_DIR', os.path.join(CONFIG_DIR, 'book_job_spool'))
+BOOK_JOB_RETENTION_DAYS = int(os.environ.get('BOOK_JOB_RETENTION_DAYS', 7))
+
+ACTIONS = ('push_to_anx', 'send_to_kindle')
+ACTIVE_STATUSES = ('queued', 'processing')
+FINISHED_STATUSES = ('success', 'duplicate', 'error')
+
+_executor = JobExecutor(BOOK_JOB_WORKERS, 'book-job')
+
+
+def job_spool_dir(job_id):
+    """任务的临时目录，处理函数可以把准备好的文件放在这里，任务完成后删除"""
+    return os.path.join(BOOK_JOB_SPOOL_DIR, job_id)
+
+
+def create_book_job(user_id, action, books):
+    """
+    创建任务并登记书籍，books 为 [(book_id, title)]（重复的 ID 只保留一个）。
+    任务由当前进程执行，之后应在同一进程中调用 submit_books。
+    返回 (job_id, [(item_id, book_id, title)])。
+    """
+    job_id = str(uuid.uuid4())
+    items = []
+    seen = set()
+    with closing(get_db()) as db:
+        cleanup_old_jobs(db, 'book_jobs', BOOK_JOB_RETENTION_DAYS, child_table='book_job_items', spool_dir=BOOK_JOB_SPOOL_DIR)
+        db.execute(
+            "INSERT INTO book_jobs (job_id, user_id, action, owner) VALUES (?, ?, ?, ?)",
+            (job_id, user_id, action, current_owner())
+        )
+        for book_id, title in books:
+            if book_id in seen:
+                continue
+            seen.add(book_id)
+            cursor = db.execute(
+                "INSERT INTO book_job_items (job_id, book_id, title) VALUES (?, ?, ?)",
+                (job_id, book_id, title)
+            )
+            items.append((cursor.lastrowid, book_id, title))
+    return job_id, items
+
+
+def get_book_job_row(job_id):
+    with closing(get_db()) as db:
+        return db.execute("SELECT * FROM book_jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+
+def update_job_item(item_id, status, stage=None, message=None):
+    with closing(get_db()) as db:
+        db.execute(
+            "UPDATE book_job_items SET status = ?, stage = ?, message = COALESCE(?, message), "
+            "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (status, stage, message, item_id)
+        )
+
+
+def record_item_result(item_id, result):
+    """按处理结果 {'success', 'duplicate', 'message'/'error'} 写入最终状态"""
+    if not result.get('success'):
+        status = 'error'
+    elif result.get('duplicate'):
+        status = 'duplicate'
+    else:
+        status = 'success'
+    try:
+        update_job_item(item_id, status, message=result.get('message') or result.get('error'))
+    except Exception as e:
+        print(f"Failed to record book job result for item {item_id}: {e}")
+
+
+def _remove_job_spool(job):
+    shutil.rmtree(job_spool_dir(job['job_id']), ignore_errors=True)
+
+
+def _expire_orphans(db, jobs):
+    """执行任务的进程已经退出时，把未完成的书标记为中断并删除任务临时目录；返回有书被中断的任务"""
+    return expire_orphans(db, jobs, 'book_job_items', 'job_id', ACTIVE_STATUSES, on_expired=_remove_job_spool)
+
+
+def interrupt_orphaned_jobs():
+    """worker 启动时调用：执行进程已经退出的任务中未完成的书标记为中断"""
+    with closing(get_db()) as db:
+        _expire_orphans(db, db.execute(
+            "SELECT DISTINCT j.job_id, j.owner FROM book_jobs j JOIN book_job_items i ON i.job_id = j.job_id "
+            "WHERE i.status IN ('queued', 'processing')"
+        ).fetchall())
+
+
+def submit_books(job_id, items, process_book, on_finished=None):
+    """
+    把已登记的书交给线程池处理。
+    process_book(book_id, on_stage) 返回 {'success', 'message'/'error', 'duplicate'}；
+    返回 'pending': True 时这本书保持 processing 状态，由 on_finished 写入最终结果。
+    全部处理完后调用 on_finished(results)（每个结果带有 item_id 和 book_id），然后删除任务临时目录。
+    """
+    results = []
+    remaining = [len(items)]
+    results_lock = threading.Lock()
+
+    def finish():
+        try:
+            if on_finished:
+                on_finished(results)
+        except Exception as e:
+            print(f"Book job completion callback failed: {e}")
+            for result in results:
+                if result.get('pending'):
+                    record_item_result(result['item_id'], {'success': False, 'error': str(e)})
+        finally:
+            shutil.rmtree(job_spool_dir(job_id), ignore_errors=True)
+
+    if not items:
+        finish()
+        return
+
+    def run(item_id, book_id):
+        def on_stage(stage):
+            update_job_item(item_id, 'processing', stage=stage)
+
+        try:
+            on_stage('starting')
+            result = process_book(book_id, on_stage)
+        except Exception as e:
+            print(f"Book job item {book_id} failed: {e}")
+            result = {'success': False, 'error': str(e)}
+        result = dict(result, item_id=item_id, book_id=book_id)
+        if not result.get('pending'):
+            record_item_result(item_id, result)
+
+        with results_lock:
+            results.append(result)
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished:
+            finish()
+
+    for item_id, book_id, _title in items:
+        _executor.submit(run, item_id, book_id)
+
+
+def get_book_job(job_id):
+    """返回任务和每本书的状态，任务不存在时返回 None"""
+    with closing(get_db()) as db:
+        job = db.execute("SELECT * FROM book_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if not job:
+            return None
+        _expire_orphans(db, [job])
+        items = [dict(row) for row in db.execute(
+            "SELECT id, book_id, title, status, stage, message FROM book_job_items WHERE job_id = ? ORDER BY id",
+            (job_id,)
+        ).fetchall()]
+
+    return {
+        'job_id': job['job_id'],
+        'action': job['action'],
+        'created_at': job['created_at'],
+        'total': len(items),
+        'counts': status_counts(items, ACTIVE_STATUSES, FINISHED_STATUSES),
+        'finished': all(item['status'] in FINISHED_STATUSES for item in items),
+        'items': items,
+    }
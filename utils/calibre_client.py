@@ -0,0 +1,305 @@
+"""
+进程级共享的 Calibre HTTP 客户端
+
+原来每次访问 Calibre 都直接调用 requests.get/post 并新建 HTTPDigestAuth，
+每个请求都要重新建立 TCP/TLS 连接，还要先收到一次 401 质询才能带上摘要认证头。
+这里改为：
+
+- 每个进程一个 requests.Session，连接池保持长连接 (CALIBRE_POOL_SIZE)；
+- 复用同一个 HTTPDigestAuth 对象（见 utils.auth.get_calibre_auth），nonce 按线程保存，
+  之后的请求直接带上认证头，不再多一次 401 往返；
+- 按请求类型设置超时：metadata（元数据/搜索/封面）和 transfer（下载/上传）；
+- 幂等请求 (GET/HEAD) 在连接错误和 502/503/504 时重试 CALIBRE_RETRIES 次，POST 只在连接建立失败时重试；
+- 计数器：请求数、新建连接数、复用连接数和摘要认证质询次数，见 get_calibre_client_stats()；
+- 熔断器：连续 CALIBRE_BREAKER_FAILURES 次连接错误 / 超时 / 502-504 后打开，之后的请求立即抛出
+  CalibreUnavailable，不再占用 worker 等待超时；后台线程每 CALIBRE_BREAKER_PROBE_SECONDS 秒探测一次，
+  Calibre 恢复响应后关闭。状态写入 CONFIG_DIR/calibre_health.json，所有 worker 共享，
+  界面据此显示降级提示（见 get_calibre_health()）。
+
+调用方仍然捕获 requests.exceptions.* 异常，行为与原来一致（CalibreUnavailable 是 ConnectionError 的子类）。
+"""
+import json
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+import config_manager
+from config_manager import CONFIG_DIR
+from utils.auth import get_calibre_auth
+
+CALIBRE_POOL_SIZE = int(os.environ.get('CALIBRE_POOL_SIZE', 10))
+CALIBRE_RETRIES = int(os.environ.get('CALIBRE_RETRIES', 2))
+CALIBRE_CONNECT_TIMEOUT = float(os.environ.get('CALIBRE_CONNECT_TIMEOUT', 5))
+# 流式下载 / 代理书籍文件时每次读写的块大小
+STREAM_CHUNK_SIZE = int(os.environ.get('CALIBRE_STREAM_CHUNK_SIZE', 64 * 1024))
+
+# 请求类型 -> (连接超时, 读取超时)；读取超时是两次收到数据之间的最长间隔，不是总时长
+TIMEOUTS = {
+    'metadata': (CALIBRE_CONNECT_TIMEOUT, float(os.environ.get('CALIBRE_READ_TIMEOUT', 30))),
+    'transfer': (CALIBRE_CONNECT_TIMEOUT, float(os.environ.get('CALIBRE_TRANSFER_TIMEOUT', 300))),
+    'probe': (CALIBRE_CONNECT_TIMEOUT, 10),
+}
+
+BREAKER_FAILURES = int(os.environ.get('CALIBRE_BREAKER_FAILURES', 3))
+BREAKER_PROBE_SECONDS = float(os.environ.get('CALIBRE_BREAKER_PROBE_SECONDS', 10))
+HEALTH_PATH = os.environ.get('CALIBRE_HEALTH_PATH', os.path.join(CONFIG_DIR, 'calibre_health.json'))
+# 读取其它 worker 写入的熔断状态的最小间隔
+HEALTH_CHECK_INTERVAL_SECONDS = 1
+FAILURE_STATUSES = (502, 503, 504)
+
+_stats_lock = threading.Lock()
+_stats = {'requests': 0, 'connections_opened': 0, 'auth_challenges': 0, 'errors': 0, 'rejected': 0}
+
+
+class CalibreUnavailable(requests.exceptions.ConnectionError):
+    """熔断器打开期间不访问 Calibre，直接抛出此异常"""
+
+
+def _count(key, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _count('connections_opened')
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _count('connections_opened')
+        return super()._new_conn()
+
+
+class _CalibreAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+
+class CircuitBreaker:
+    """
+    Calibre 可用性熔断器。state 为 'closed'（正常）或 'open'（不可用，快速失败）。
+    状态按 CALIBRE_URL 区分，修改 Calibre 地址后从关闭状态重新开始。
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._health = {'state': 'closed', 'source': None, 'since': 0, 'last_error': None}
+        self._checked_at = 0
+        self._probe_thread = None
+
+    def _source(self):
+        return config_manager.config.get('CALIBRE_URL', '')
+
+    def _load_shared(self):
+        now = time.time()
+        if now - self._checked_at < HEALTH_CHECK_INTERVAL_SECONDS:
+            return
+        self._checked_at = now
+        try:
+            with open(HEALTH_PATH) as f:
+                shared = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            if shared.get('since', 0) > self._health['since']:
+                self._health = shared
+                if shared.get('state') == 'closed':
+                    self._failures = 0
+
+    def _set_state(self, state, last_error=None):
+        # 调用方持有 self._lock
+        self._health = {'state': state, 'source': self._source(), 'since': time.time(), 'last_error': last_error}
+        tmp_path = f"{HEALTH_PATH}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(HEALTH_PATH), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(self._health, f)
+            os.replace(tmp_path, HEALTH_PATH)
+        except OSError as e:
+            print(f"Failed to save Calibre health state: {e}")
+
+    def health(self):
+        self._load_shared()
+        health = dict(self._health)
+        if health['source'] != self._source():
+            return {'state': 'closed', 'source': self._source(), 'since': 0, 'last_error': None}
+        return health
+
+    def is_open(self):
+        return self.health()['state'] == 'open'
+
+    def before_request(self):
+        health = self.health()
+        if health['state'] == 'open':
+            self._ensure_probe()
+            _count('rejected')
+            raise CalibreUnavailable(f"Calibre server is unavailable (circuit open): {health['last_error']}")
+
+    def record_success(self):
+        self._failures = 0
+
+    def record_failure(self, error):
+        with self._lock:
+            self._failures += 1
+            already_open = self._health['state'] == 'open' and self._health['source'] == self._source()
+            if self._failures < BREAKER_FAILURES or already_open:
+                return
+            self._set_state('open', str(error))
+        print(f"Calibre circuit opened after {self._failures} consecutive failures: {error}")
+        self._ensure_probe()
+
+    def _ensure_probe(self):
+        # 每个进程最多一个探测线程；fork 出来的 worker 中没有父进程的线程
+        with self._lock:
+            if self._probe_thread is not None and self._probe_thread.is_alive():
+                return
+            self._probe_thread = threading.Thread(target=self._probe_loop, name='calibre-health-probe', daemon=True)
+            self._probe_thread.start()
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(BREAKER_PROBE_SECONDS)
+            if not self.is_open():
+                return
+            url = f"{self._source()}/ajax/library-info"
+            try:
+                # 探测请求绕过熔断器；任何非 5xx 的响应（包括 401）都说明服务器在正常处理请求
+                response = self._client.session.get(url, auth=get_calibre_auth(), timeout=TIMEOUTS['probe'])
+                response.close()
+                healthy = response.status_code not in FAILURE_STATUSES
+                error = f"HTTP {response.status_code}"
+            except requests.exceptions.RequestException as e:
+                healthy = False
+                error = str(e)
+            with self._lock:
+                if healthy:
+                    self._failures = 0
+                    self._set_state('closed')
+                elif self._health['state'] == 'open':
+                    self._health['last_error'] = error
+            if healthy:
+                print("Calibre server is reachable again, circuit closed")
+                return
+
+
+class CalibreClient:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self._session_pid = None
+        self.breaker = CircuitBreaker(self)
+
+    def _new_session(self):
+        session = requests.Session()
+        retry = Retry(
+            total=CALIBRE_RETRIES,
+            connect=CALIBRE_RETRIES,
+            read=CALIBRE_RETRIES,
+            status=CALIBRE_RETRIES,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            raise_on_status=False,
+        )
+        adapter = _CalibreAdapter(pool_connections=4, pool_maxsize=CALIBRE_POOL_SIZE, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @property
+    def session(self):
+        # gunicorn fork 之后不能继续使用父进程的连接
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            with self._lock:
+                if self._session is None or self._session_pid != pid:
+                    self._session = self._new_session()
+                    self._session_pid = pid
+        return self._session
+
+    def request(self, method, url, kind='metadata', **kwargs):
+        kwargs.setdefault('auth', get_calibre_auth())
+        kwargs.setdefault('timeout', TIMEOUTS[kind])
+        self.breaker.before_request()
+        _count('requests')
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            _count('errors')
+            self.breaker.record_failure(e)
+            raise
+        except requests.exceptions.RequestException:
+            _count('errors')
+            raise
+        if response.status_code in FAILURE_STATUSES:
+            self.breaker.record_failure(f"HTTP {response.status_code}")
+        else:
+            self.breaker.record_success()
+        challenges = sum(1 for r in response.history if r.status_code == 401)
+        if challenges:
+            _count('auth_challenges', challenges)
+        return response
+
+    def get(self, url, kind='metadata', **kwargs):
+        return self.request('GET', url, kind=kind, **kwargs)
+
+    def post(self, url, kind='metadata', **kwargs):
+        return self.request('POST', url, kind=kind, **kwargs)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+
+
+_client = CalibreClient()
+
+
+def get_calibre_client():
+    return _client
+
+
+def calibre_get(url, kind='metadata', **kwargs):
+    return _client.get(url, kind=kind, **kwargs)
+
+
+def calibre_post(url, kind='metadata', **kwargs):
+    return _client.post(url, kind=kind, **kwargs)
+
+
+def get_calibre_client_stats():
+    """返回计数器；connections_reused 为未新建连接的请求数（重试和认证质询也会发起请求，因此是近似值）"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['connections_reused'] = max(0, stats['requests'] + stats['auth_challenges'] - stats['connections_opened'])
+    return stats
+
+
+def get_calibre_health():
+    """
+    Calibre 可用性，供界面显示降级提示：
+    {'available': bool, 'since': 状态变化时间戳, 'last_error': 最近一次错误}
+    """
+    health = _client.breaker.health()
+    return {
+        'available': health['state'] != 'open',
+        'since': health['since'],
+        'last_error': health['last_error'],
+    }
+
+
+def calibre_is_degraded():
+    """熔断器打开时为 True，调用方应直接使用缓存数据，不要发起后台刷新"""
+    return _client.breaker.is_open()
@@ -0,0 +1,150 @@
+"""
+Calibre 书籍详情 (/ajax/book/{id}?fields=all) 的跨 worker 缓存
+
+一次下载 / 推送 / 生成有声书往往要多次调用 get_calibre_book_details 获取同一本书的详情。
+这里把结果保存在 CONFIG_DIR/calibre_details_cache.db 中，所有 gunicorn worker 共享：
+
+- 缓存时间在 CALIBRE_DETAILS_TTL 秒内直接返回，不访问 Calibre；
+- 超过 TTL 后只请求 fields=last_modified 做一次轻量的重新验证，未变化就继续使用缓存；
+- 超过 CALIBRE_DETAILS_MAX_AGE 秒或 last_modified 变化时重新获取完整详情；
+- 本服务修改书籍（编辑元数据、上传后设置 #library）后调用 invalidate_book_details 主动失效；
+- Calibre 无法访问（连接错误、超时、5xx 或熔断器打开）时返回缓存中的旧数据，不论是否过期。
+
+缓存键为 (Calibre 地址|书库 ID, book_id)，切换 Calibre 服务器或书库不会读到旧数据。
+"""
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+import requests
+import config_manager
+from config_manager import CONFIG_DIR
+from utils.calibre_client import calibre_get
+
+CACHE_PATH = os.environ.get('CALIBRE_DETAILS_CACHE_PATH', os.path.join(CONFIG_DIR, 'calibre_details_cache.db'))
+DETAILS_TTL = int(os.environ.get('CALIBRE_DETAILS_TTL', 300))
+DETAILS_MAX_AGE = int(os.environ.get('CALIBRE_DETAILS_MAX_AGE', 86400))
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS book_details (
+  library_key TEXT NOT NULL,
+  book_id INTEGER NOT NULL,
+  last_modified TEXT,
+  fetched_at REAL NOT NULL,
+  validated_at REAL NOT NULL,
+  data TEXT NOT NULL,
+  PRIMARY KEY (library_key, book_id)
+);
+"""
+
+stats = {'hits': 0, 'revalidated': 0, 'fetched': 0, 'stale': 0}
+
+
+def _connect():
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(CACHE_PATH, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.executescript(CACHE_SCHEMA)
+    return conn
+
+
+def _library_key():
+    config = config_manager.config
+    return f"{config.get('CALIBRE_URL', '')}|{config.get('CALIBRE_DEFAULT_LIBRARY_ID', 'Calibre_Library')}"
+
+
+def _book_url(book_id, fields):
+    return f"{config_manager.config['CALIBRE_URL']}/ajax/book/{book_id}?fields={fields}"
+
+
+def _fetch_last_modified(book_id):
+    response = calibre_get(_book_url(book_id, 'last_modified'))
+    response.raise_for_status()
+    return (response.json() or {}).get('last_modified')
+
+
+def _is_unavailable(error):
+    """Calibre 不可用（而不是书籍不存在或无权限）时才使用过期数据"""
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def _store(conn, library_key, book_id, details, now):
+    conn.execute("""
+        INSERT OR REPLACE INTO book_details (library_key, book_id, last_modified, fetched_at, validated_at, data)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (library_key, book_id, details.get('last_modified'), now, now, json.dumps(details, ensure_ascii=False)))
+
+
+def get_book_details(book_id):
+    """
+    返回书籍详情字典（每次都是新的对象，可以随意修改），请求失败或书籍不存在时返回 None。
+    """
+    library_key = _library_key()
+    now = time.time()
+    try:
+        book_id = int(book_id)
+    except (TypeError, ValueError):
+        return None
+
+    row = None
+    try:
+        with closing(_connect()) as conn:
+            row = conn.execute(
+                "SELECT last_modified, fetched_at, validated_at, data FROM book_details WHERE library_key = ? AND book_id = ?",
+                (library_key, book_id)
+            ).fetchone()
+            if row:
+                last_modified, fetched_at, validated_at, data = row
+                if now - validated_at < DETAILS_TTL:
+                    stats['hits'] += 1
+                    return json.loads(data)
+                if now - fetched_at < DETAILS_MAX_AGE and last_modified and _fetch_last_modified(book_id) == last_modified:
+                    conn.execute(
+                        "UPDATE book_details SET validated_at = ? WHERE library_key = ? AND book_id = ?",
+                        (now, library_key, book_id)
+                    )
+                    stats['revalidated'] += 1
+                    return json.loads(data)
+
+            response = calibre_get(_book_url(book_id, 'all'))
+            if response.status_code == 404:
+                conn.execute("DELETE FROM book_details WHERE library_key = ? AND book_id = ?", (library_key, book_id))
+            response.raise_for_status()
+            details = response.json()
+            stats['fetched'] += 1
+            if details:
+                _store(conn, library_key, book_id, details, now)
+            return details
+    except requests.exceptions.RequestException as e:
+        if row and _is_unavailable(e):
+            print(f"Calibre unavailable, serving cached details for book {book_id}: {e}")
+            stats['stale'] += 1
+            return json.loads(row[3])
+        print(f"Error getting book details for {book_id}: {e}")
+        return None
+    except sqlite3.Error as e:
+        # 缓存不可用时直接请求 Calibre
+        print(f"Calibre details cache unavailable: {e}")
+        try:
+            response = calibre_get(_book_url(book_id, 'all'))
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            print(f"Error getting book details for {book_id}: {e}")
+            return None
+
+
+def invalidate_book_details(book_ids):
+    """本服务修改了这些书后调用，下次读取时重新获取"""
+    try:
+        with closing(_connect()) as conn:
+            conn.executemany(
+                "DELETE FROM book_details WHERE library_key = ? AND book_id = ?",
+                [(_library_key(), int(book_id)) for book_id in book_ids]
+            )
+    except sqlite3.Error as e:
+        print(f"Failed to invalidate Calibre details cache for {book_ids}: {e}")
@@ -0,0 +1,444 @@
+"""
+Calibre 书籍元数据的本地镜像
+
+首页和 MCP 的书籍列表 / 搜索原来每次都要请求 Calibre 的 /ajax/search 和 /ajax/books?fields=all，
+页面速度完全取决于 Calibre 服务器。这里把 /ajax/books 返回的完整元数据保存在
+CONFIG_DIR/calibre_mirror.db 中（原样保存 JSON，模板看到的数据与直接请求 Calibre 相同），
+并抽出标题、作者、标签、丛书、#library、格式和 last_modified 等列用于排序和搜索。
+
+同步是增量的：
+- 每次同步先取回全部书籍 ID（只有 ID 列表，很轻），据此发现新增和删除的书籍；
+- 再用 last_modified:>=<水位线日期> 查询修改过的书籍，只抓取这些书的元数据；
+- 水位线是镜像中最大的 last_modified，往前多取一天以免时区和日期精度造成遗漏。
+
+读取时如果距上次同步超过 CALIBRE_MIRROR_SYNC_SECONDS，会在后台线程中同步，不阻塞请求；
+多个 worker 通过文件锁保证同一时间只有一个在同步。本服务自己修改了 Calibre 书籍后调用
+refresh_mirror_books 立即更新对应的书。
+只有简单的关键词搜索由镜像处理：和 Calibre 的全字段搜索一样匹配所有文本字段（包括简介、书号和自定义列），
+忽略大小写和重音；包含 Calibre 搜索语法（字段前缀、引号、布尔运算等）的查询仍交给 Calibre。
+"""
+import fcntl
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, timedelta
+import config_manager
+from config_manager import CONFIG_DIR
+from utils.calibre_client import calibre_get, calibre_is_degraded
+
+MIRROR_ENABLED = os.environ.get('CALIBRE_MIRROR_ENABLED', '1') not in ('0', 'false', 'False')
+MIRROR_PATH = os.environ.get('CALIBRE_MIRROR_PATH', os.path.join(CONFIG_DIR, 'calibre_mirror.db'))
+SYNC_INTERVAL_SECONDS = int(os.environ.get('CALIBRE_MIRROR_SYNC_SECONDS', 60))
+FETCH_CHUNK_SIZE = 100
+# 并行请求 /ajax/books 的块数上限；ID 不多时块会切得更小以便并行，但不小于 MIN_PARALLEL_CHUNK_SIZE
+FETCH_CONCURRENCY = int(os.environ.get('CALIBRE_FETCH_CONCURRENCY', 4))
+MIN_PARALLEL_CHUNK_SIZE = 25
+# search_text 的构造方式变化时递增
+SEARCH_TEXT_VERSION = '2'
+
+MIRROR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+  id INTEGER PRIMARY KEY,
+  title TEXT,
+  authors TEXT,
+  tags TEXT,
+  series TEXT,
+  library TEXT,
+  formats TEXT,
+  last_modified TEXT,
+  search_text TEXT,
+  data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_books_last_modified ON books(last_modified);
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+"""
+
+# 出现这些字符或关键字时说明使用了 Calibre 的搜索语法，交给 Calibre 处理
+_ADVANCED_QUERY = re.compile(r'[:"=~()<>#]|(^|\s)-|\b(and|or|not)\b', re.IGNORECASE)
+
+_sync_lock = threading.Lock()
+_sync_thread = None
+_last_sync_check = 0
+_fetch_executor = None
+_fetch_executor_pid = None
+_fetch_executor_lock = threading.Lock()
+
+
+def _connect():
+    os.makedirs(os.path.dirname(MIRROR_PATH), exist_ok=True)
+    conn = sqlite3.connect(MIRROR_PATH, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    # 镜像只有本服务使用，可以放心开启 WAL
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.executescript(MIRROR_SCHEMA)
+    return conn
+
+
+def _library_id():
+    return config_manager.config.get('CALIBRE_DEFAULT_LIBRARY_ID', 'Calibre_Library')
+
+
+def _source_key():
+    """CALIBRE_URL 或书库变化后镜像需要重建"""
+    return f"{config_manager.config.get('CALIBRE_URL', '')}|{_library_id()}"
+
+
+def _get_meta(conn):
+    return dict(conn.execute('SELECT key, value FROM meta').fetchall())
+
+
+def _set_meta(conn, values):
+    conn.executemany(
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        [(k, str(v)) for k, v in values.items()]
+    )
+
+
+def _field_value(book, key):
+    field = (book.get('user_metadata') or {}).get(key) or {}
+    return field.get('#value#') if isinstance(field, dict) else None
+
+
+def _search_text(book):
+    """
+    不带字段前缀的搜索匹配的文本：与 Calibre 的全字段搜索覆盖相同的字段（标题、作者、标签、丛书、出版社、
+    简介、格式、语言、书号和文本类自定义列），并像 Calibre 一样忽略大小写和重音
+    """
+    # completion_index 在模块级导入了本模块，这里延迟导入
+    from utils.completion_index import fold
+    values = [book.get('title'), book.get('series'), book.get('publisher'), book.get('comments')]
+    for key in ('authors', 'tags', 'languages', 'formats'):
+        values.extend(book.get(key) or [])
+    values.extend(f"{scheme}:{value}" for scheme, value in (book.get('identifiers') or {}).items())
+    for field in (book.get('user_metadata') or {}).values():
+        value = field.get('#value#') if isinstance(field, dict) else None
+        if isinstance(value, str):
+            values.append(value)
+        elif isinstance(value, (list, tuple)):
+            values.extend(v for v in value if isinstance(v, str))
+    return fold(' '.join(str(v) for v in values if v))
+
+
+def _ensure_search_text(conn, meta):
+    """search_text 的构造方式变化后，从保存的元数据重新计算已有的行（不需要请求 Calibre）"""
+    if meta.get('search_version') == SEARCH_TEXT_VERSION:
+        return
+    rows = conn.execute('SELECT id, data FROM books').fetchall()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany(
+            'UPDATE books SET search_text = ? WHERE id = ?',
+            [(_search_text(json.loads(row['data'])), row['id']) for row in rows]
+        )
+        _set_meta(conn, {'search_version': SEARCH_TEXT_VERSION})
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def _book_row(book_id, book):
+    authors = ' & '.join(book.get('authors') or [])
+    tags = ', '.join(book.get('tags') or [])
+    series = book.get('series') or ''
+    library = _field_value(book, '#library') or ''
+    format_metadata = book.get('format_metadata') or {}
+    formats = ','.join(format_metadata.keys()) if isinstance(format_metadata, dict) else ''
+    search_text = _search_text(book)
+    return (
+        book_id, book.get('title'), authors, tags, series, library, formats,
+        book.get('last_modified'), search_text, json.dumps(book, ensure_ascii=False)
+    )
+
+
+def _upsert_books(conn, books):
+    """books: {book_id: 元数据或 None}，None 表示 Calibre 中已不存在"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for book_id, book in books.items():
+            if book:
+                conn.execute("""
+                    INSERT OR REPLACE INTO books (id, title, authors, tags, series, library, formats, last_modified, search_text, data)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, _book_row(book_id, book))
+            else:
+                conn.execute('DELETE FROM books WHERE id = ?', (book_id,))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def search_book_ids(query, limit=10 ** 9):
+    """用 Calibre 搜索语法查询，按 ID 倒序返回最多 limit 个书籍 ID；失败时抛出 requests 异常"""
+    response = calibre_get(
+        f"{config_manager.config['CALIBRE_URL']}/ajax/search",
+        params={'query': query, 'num': limit, 'offset': 0, 'library_id': _library_id(), 'sort': 'id', 'sort_order': 'desc'}
+    )
+    response.raise_for_status()
+    return [int(i) for i in response.json().get('book_ids', [])]
+
+
+def _get_fetch_executor():
+    # gunicorn fork 之后线程池不可用，按进程重新创建
+    global _fetch_executor, _fetch_executor_pid
+    pid = os.getpid()
+    if _fetch_executor is None or _fetch_executor_pid != pid:
+        with _fetch_executor_lock:
+            if _fetch_executor is None or _fetch_executor_pid != pid:
+                _fetch_executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix='calibre-fetch')
+                _fetch_executor_pid = pid
+    return _fetch_executor
+
+
+def _fetch_chunk(chunk, fields):
+    response = calibre_get(
+        f"{config_manager.config['CALIBRE_URL']}/ajax/books",
+        params={'ids': ','.join(map(str, chunk)), 'library_id': _library_id(), 'fields': fields}
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_books(ids, fields='all'):
+    """
+    请求 /ajax/books，返回 {book_id: 元数据或 None}。
+    ID 较多时分块，最多 FETCH_CONCURRENCY 个块并行请求；任一块失败时抛出 requests 异常。
+    fields 为逗号分隔的字段名或 'all'。
+    """
+    ids = list(ids)
+    if not ids:
+        return {}
+    chunk_size = min(FETCH_CHUNK_SIZE, max(MIN_PARALLEL_CHUNK_SIZE, math.ceil(len(ids) / FETCH_CONCURRENCY)))
+    chunks = [ids[i:i + chunk_size] for i in range(0, len(ids), chunk_size)]
+    if len(chunks) == 1:
+        results = [_fetch_chunk(chunks[0], fields)]
+    else:
+        executor = _get_fetch_executor()
+        futures = [executor.submit(_fetch_chunk, chunk, fields) for chunk in chunks]
+        results = [future.result() for future in futures]
+
+    books = {}
+    for chunk, data in zip(chunks, results):
+        for book_id in chunk:
+            books[book_id] = data.get(str(book_id))
+    return books
+
+
+def sync_mirror():
+    """
+    与 Calibre 增量同步一次。其它进程正在同步时直接返回 False。
+    同步失败时抛出 requests / sqlite3 异常，镜像保持上一次同步的状态。
+    """
+    lock_path = MIRROR_PATH + '.lock'
+    os.makedirs(os.path.dirname(MIRROR_PATH), exist_ok=True)
+    with open(lock_path, 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        try:
+            with closing(_connect()) as conn:
+                meta = _get_meta(conn)
+                source = _source_key()
+                if meta.get('source') != source:
+                    conn.execute('DELETE FROM books')
+                    conn.execute('DELETE FROM meta')
+                    meta = {}
+
+                server_ids = set(search_book_ids(''))
+                local_ids = {row[0] for row in conn.execute('SELECT id FROM books')}
+
+                changed = set()
+                watermark = meta.get('watermark')
+                if watermark:
+                    since = (datetime.fromisoformat(watermark[:10]) - timedelta(days=1)).strftime('%Y-%m-%d')
+                    changed = set(search_book_ids(f'last_modified:>={since}'))
+
+                to_fetch = (server_ids - local_ids) | (changed & server_ids)
+                removed = local_ids - server_ids
+
+                fetched = fetch_books(sorted(to_fetch, reverse=True))
+                fetched.update({book_id: None for book_id in removed})
+                # 分批写入，每批一个短事务
+                items = list(fetched.items())
+                for i in range(0, len(items), 500):
+                    _upsert_books(conn, dict(items[i:i + 500]))
+
+                new_watermark = conn.execute('SELECT MAX(last_modified) FROM books').fetchone()[0]
+                now = time.time()
+                values = {
+                    'source': source,
+                    'watermark': new_watermark or '',
+                    'synced_at': now,
+                    'book_count': len(server_ids),
+                }
+                if fetched or not meta.get('changed_at'):
+                    # 只有内容真的变化时才更新，补全索引等据此判断是否需要刷新
+                    values['changed_at'] = now
+                _set_meta(conn, values)
+                print(f"Calibre mirror synced: {len(to_fetch)} fetched, {len(removed)} removed, {len(server_ids)} total")
+                return True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _sync_in_background():
+    global _sync_thread
+    try:
+        sync_mirror()
+    except Exception as e:
+        print(f"Calibre mirror sync failed: {e}")
+    finally:
+        with _sync_lock:
+            _sync_thread = None
+
+
+def maybe_sync_async():
+    """距上次同步超过 SYNC_INTERVAL_SECONDS 时在后台线程中同步（每个进程最多一个同步线程）"""
+    global _sync_thread, _last_sync_check
+    # Calibre 不可用时继续使用镜像中的数据，等熔断器关闭后再同步
+    if not MIRROR_ENABLED or calibre_is_degraded():
+        return
+    now = time.time()
+    # 其它 worker 可能刚同步过，这里至少间隔几秒再去检查 meta
+    if now - _last_sync_check < min(5, SYNC_INTERVAL_SECONDS):
+        return
+    _last_sync_check = now
+    try:
+        with closing(_connect()) as conn:
+            meta = _get_meta(conn)
+    except sqlite3.Error as e:
+        print(f"Calibre mirror unavailable: {e}")
+        return
+    if meta.get('source') == _source_key() and now - float(meta.get('synced_at', 0)) < SYNC_INTERVAL_SECONDS:
+        return
+    with _sync_lock:
+        if _sync_thread is not None:
+            return
+        _sync_thread = threading.Thread(target=_sync_in_background, name='calibre-mirror-sync', daemon=True)
+        _sync_thread.start()
+
+
+def is_simple_query(search_query):
+    return not _ADVANCED_QUERY.search(search_query or '')
+
+
+def query_mirror(search_query='', page=1, page_size=20):
+    """
+    从镜像中按 ID 倒序分页查询书籍，返回 (books, total)。
+    镜像未启用、尚未完成首次同步或查询使用了 Calibre 搜索语法时返回 None，由调用方请求 Calibre。
+    """
+    if not MIRROR_ENABLED or not is_simple_query(search_query):
+        return None
+    from utils.completion_index import fold
+    maybe_sync_async()
+    try:
+        with closing(_connect()) as conn:
+            meta = _get_meta(conn)
+            if meta.get('source') != _source_key():
+                return None
+            _ensure_search_text(conn, meta)
+            where = []
+            params = []
+            for word in fold(search_query or '').split():
+                where.append('instr(search_text, ?) > 0')
+                params.append(word)
+            where_sql = f"WHERE {' AND '.join(where)}" if where else ''
+            total = conn.execute(f"SELECT COUNT(*) FROM books {where_sql}", params).fetchone()[0]
+            offset = max(page - 1, 0) * page_size
+            rows = conn.execute(
+                f"SELECT id, data FROM books {where_sql} ORDER BY id DESC LIMIT ? OFFSET ?",
+                params + [page_size, offset]
+            ).fetchall()
+    except sqlite3.Error as e:
+        print(f"Calibre mirror query failed, falling back to Calibre: {e}")
+        return None
+
+    books = []
+    for row in rows:
+        book = json.loads(row['data'])
+        book['id'] = row['id']
+        books.append(book)
+    return books, total
+
+
+def get_mirrored_last_modified(book_id):
+    """返回镜像中书籍的 last_modified，镜像不可用或没有这本书时返回 None"""
+    if not MIRROR_ENABLED:
+        return None
+    try:
+        with closing(_connect()) as conn:
+            if _get_meta(conn).get('source') != _source_key():
+                return None
+            row = conn.execute('SELECT last_modified FROM books WHERE id = ?', (book_id,)).fetchone()
+    except sqlite3.Error:
+        return None
+    return row['last_modified'] if row else None
+
+
+def get_mirror_changed_at():
+    """镜像内容最后一次变化的时间戳；镜像未启用或不可用时返回 0"""
+    if not MIRROR_ENABLED:
+        return 0
+    try:
+        with closing(_connect()) as conn:
+            meta = _get_meta(conn)
+    except sqlite3.Error:
+        return 0
+    if meta.get('source') != _source_key():
+        return 0
+    return float(meta.get('changed_at') or 0)
+
+
+def get_books_modified_since(since=None):
+    """
+    返回镜像中 last_modified 晚于 since 的书籍 [(id, last_modified)]，按 last_modified 排序；
+    since 为 None 时不返回书籍，只用于取得当前水位线。第二项是当前最大的 last_modified（镜像为空时为 None）。
+    镜像未启用或不可用时返回 None。
+    """
+    if not MIRROR_ENABLED:
+        return None
+    try:
+        with closing(_connect()) as conn:
+            if _get_meta(conn).get('source') != _source_key():
+                return None
+            latest = conn.execute('SELECT MAX(last_modified) FROM books').fetchone()[0]
+            if since is None:
+                return [], latest
+            rows = conn.execute(
+                'SELECT id, last_modified FROM books WHERE last_modified > ? ORDER BY last_modified',
+                (since,)
+            ).fetchall()
+    except sqlite3.Error:
+        return None
+    return [(row['id'], row['last_modified']) for row in rows], latest
+
+
+def refresh_mirror_books(book_ids):
+    """本服务修改了 Calibre 中的书籍后调用，立即更新镜像中的这些书（失败时等下次同步）"""
+    if not MIRROR_ENABLED or not book_ids:
+        return
+    try:
+        with closing(_connect()) as conn:
+            if _get_meta(conn).get('source') != _source_key():
+                return
+            _upsert_books(conn, fetch_books(book_ids))
+            _set_meta(conn, {'changed_at': time.time()})
+    except Exception as e:
+        print(f"Failed to refresh Calibre mirror for books {book_ids}: {e}")
+
+
+if __name__ == '__main__':
+    # 手动同步：python -m utils.calibre_mirror
+    sync_mirror()
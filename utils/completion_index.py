@@ -0,0 +1,249 @@
+"""
+Calibre 元数据字段（作者、出版社、标签、#library）的补全索引
+
+原来的补全接口用进程内永不过期的 lru_cache 保存 /interface-data/field-names 的结果，
+新作者和标签要重启后才出现；每次按键还要对所有条目做一次 `query in item.lower()` 线性扫描。
+这里改为：
+
+- 字段的全部取值保存在 CONFIG_DIR/calibre_completions.db 中，所有 worker 共享；
+  超过 CALIBRE_COMPLETIONS_TTL 秒或元数据镜像有变化后，由一个 worker 在后台重新获取；
+- 每个 worker 在内存中为每个字段建立 CompletionIndex：
+  * 折叠大小写和重音后排序的数组，前缀匹配用二分查找；
+  * 词首索引（每个单词开头的后缀），匹配 "tolk" -> "J. R. R. Tolkien"；
+  * 三元组倒排索引，三个字符以上的子串匹配只检查最短倒排列表中的条目；
+- 按键路径上只有字典查找和上述搜索，数据库和镜像状态每隔几秒才检查一次。
+"""
+import bisect
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from contextlib import closing
+from urllib.parse import quote
+import requests
+import config_manager
+from config_manager import CONFIG_DIR
+from utils.calibre_client import calibre_get, calibre_is_degraded
+from utils.calibre_mirror import get_mirror_changed_at
+
+COMPLETIONS_PATH = os.environ.get('CALIBRE_COMPLETIONS_PATH', os.path.join(CONFIG_DIR, 'calibre_completions.db'))
+COMPLETIONS_TTL = int(os.environ.get('CALIBRE_COMPLETIONS_TTL', 600))
+# 按键路径上检查共享数据库和镜像状态的最小间隔
+CHECK_INTERVAL_SECONDS = 3
+
+SUPPORTED_FIELDS = ('authors', 'publisher', 'tags', '#library')
+
+COMPLETIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS field_values (
+  library_key TEXT NOT NULL,
+  field TEXT NOT NULL,
+  items TEXT NOT NULL,
+  fetched_at REAL NOT NULL,
+  PRIMARY KEY (library_key, field)
+);
+"""
+
+
+def fold(text):
+    """忽略大小写和重音：NFKD 分解后去掉组合字符，再 casefold"""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+class CompletionIndex:
+    """一个字段全部取值的内存索引，构建后只读，可以在线程间共享"""
+
+    def __init__(self, items):
+        pairs = sorted({(fold(item), item) for item in items if isinstance(item, str) and item})
+        self.folded = [f for f, _item in pairs]
+        self.items = [item for _f, item in pairs]
+
+        word_starts = []
+        trigrams = {}
+        for i, folded in enumerate(self.folded):
+            for pos in range(1, len(folded)):
+                if not folded[pos - 1].isalnum() and folded[pos].isalnum():
+                    word_starts.append((folded[pos:], i))
+            seen = set()
+            for pos in range(len(folded) - 2):
+                gram = folded[pos:pos + 3]
+                if gram not in seen:
+                    seen.add(gram)
+                    trigrams.setdefault(gram, []).append(i)
+        word_starts.sort()
+        self.word_keys = [key for key, _i in word_starts]
+        self.word_ids = [i for _key, i in word_starts]
+        # 倒排列表中的下标按字母顺序递增
+        self.trigrams = trigrams
+
+    def __len__(self):
+        return len(self.items)
+
+    def search(self, query, limit=20):
+        """先返回前缀匹配，再返回词首匹配和子串匹配，各部分内按字母顺序"""
+        q = fold(query.strip())
+        if not q:
+            return self.items[:limit]
+
+        found = []
+        seen = set()
+
+        def add(i):
+            if i not in seen:
+                seen.add(i)
+                found.append(i)
+            return len(found) >= limit
+
+        pos = bisect.bisect_left(self.folded, q)
+        while pos < len(self.folded) and self.folded[pos].startswith(q):
+            if add(pos):
+                return [self.items[i] for i in found]
+            pos += 1
+
+        pos = bisect.bisect_left(self.word_keys, q)
+        word_matches = []
+        while pos < len(self.word_keys) and self.word_keys[pos].startswith(q) and len(word_matches) < limit * 2:
+            word_matches.append(self.word_ids[pos])
+            pos += 1
+        for i in sorted(set(word_matches)):
+            if add(i):
+                return [self.items[i] for i in found]
+
+        if len(q) >= 3:
+            postings = [self.trigrams.get(q[p:p + 3]) for p in range(len(q) - 2)]
+            if all(postings):
+                for i in min(postings, key=len):
+                    if q in self.folded[i] and add(i):
+                        break
+
+        return [self.items[i] for i in found]
+
+
+_indexes = {}  # (library_key, field) -> {'index', 'fetched_at', 'checked_at'}
+_indexes_lock = threading.Lock()
+_refreshing = set()
+
+
+def _connect():
+    os.makedirs(os.path.dirname(COMPLETIONS_PATH), exist_ok=True)
+    conn = sqlite3.connect(COMPLETIONS_PATH, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.executescript(COMPLETIONS_SCHEMA)
+    return conn
+
+
+def _library_id():
+    return config_manager.config.get('CALIBRE_DEFAULT_LIBRARY_ID', 'Calibre_Library')
+
+
+def _library_key():
+    return f"{config_manager.config.get('CALIBRE_URL', '')}|{_library_id()}"
+
+
+def _fetch_field(field):
+    url = f"{config_manager.config['CALIBRE_URL']}/interface-data/field-names/{quote(field)}"
+    response = calibre_get(url, params={'library_id': _library_id()})
+    response.raise_for_status()
+    return response.json() or []
+
+
+def refresh_field(field):
+    """从 Calibre 重新获取字段的全部取值并写入共享数据库；失败时抛出 requests 异常"""
+    items = _fetch_field(field)
+    with closing(_connect()) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO field_values (library_key, field, items, fetched_at) VALUES (?, ?, ?, ?)",
+            (_library_key(), field, json.dumps(items, ensure_ascii=False), time.time())
+        )
+    return items
+
+
+def _refresh_in_background(field):
+    key = (_library_key(), field)
+    with _indexes_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def run():
+        lock_path = COMPLETIONS_PATH + '.lock'
+        try:
+            with open(lock_path, 'w') as lock_file:
+                try:
+                    # 其它 worker 正在刷新时跳过，稍后从数据库读取它的结果
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                try:
+                    refresh_field(field)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        except (requests.exceptions.RequestException, sqlite3.Error, OSError) as e:
+            print(f"Failed to refresh completions for field '{field}': {e}")
+        finally:
+            with _indexes_lock:
+                _refreshing.discard(key)
+
+    threading.Thread(target=run, name='calibre-completions-refresh', daemon=True).start()
+
+
+def _load_stored(library_key, field, with_items=True):
+    with closing(_connect()) as conn:
+        if with_items:
+            return conn.execute(
+                "SELECT items, fetched_at FROM field_values WHERE library_key = ? AND field = ?",
+                (library_key, field)
+            ).fetchone()
+        return conn.execute(
+            "SELECT NULL, fetched_at FROM field_values WHERE library_key = ? AND field = ?",
+            (library_key, field)
+        ).fetchone()
+
+
+def get_completion_index(field):
+    """返回字段的 CompletionIndex；首次使用时同步获取，之后过期数据在后台刷新。无法获取时返回 None"""
+    library_key = _library_key()
+    key = (library_key, field)
+    now = time.time()
+    entry = _indexes.get(key)
+    if entry and now - entry['checked_at'] < CHECK_INTERVAL_SECONDS:
+        return entry['index']
+
+    try:
+        row = _load_stored(library_key, field, with_items=entry is None)
+        if entry and row and row[1] != entry['fetched_at']:
+            # 其它 worker 已经刷新过，重新读取并建立索引
+            row = _load_stored(library_key, field)
+            entry = None
+        if row is None:
+            refresh_field(field)
+            row = _load_stored(library_key, field)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Could not fetch completions for field '{field}': {e}")
+        return entry['index'] if entry else None
+    except sqlite3.Error as e:
+        print(f"Completion index unavailable: {e}")
+        return entry['index'] if entry else None
+
+    fetched_at = row[1]
+    if entry is None:
+        entry = {'index': CompletionIndex(json.loads(row[0])), 'fetched_at': fetched_at}
+    entry['checked_at'] = now
+    with _indexes_lock:
+        _indexes[key] = entry
+
+    stale = now - fetched_at > COMPLETIONS_TTL or get_mirror_changed_at() > fetched_at
+    if stale and not calibre_is_degraded():
+        _refresh_in_background(field)
+    return entry['index']
+
+
+def get_completions(field, query, limit=20):
+    index = get_completion_index(field)
+    if index is None:
+        return []
+    return index.search(query, limit=limit)
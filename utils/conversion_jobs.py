@@ -0,0 +1,353 @@
+"""
+ebook-converter 转换任务
+
+转换原来在请求处理函数中同步运行 subprocess.run(..., timeout=3600)，几个并发的转换就能占满所有
+gunicorn worker。这里改为：
+
+- 需要转换的请求在 conversion_jobs 表中登记一个任务后立即返回 202 和任务 ID，任务在当前进程的
+  线程池中执行，结果（处理过的 EPUB）写入 utils.epub_cache，客户端等任务完成后重新请求即可直接拿到；
+- 同时运行的 ebook-converter 进程不超过 CONVERSION_WORKERS 个（默认等于 CPU 核数），槽位是
+  CONVERSION_SLOT_DIR 中的文件锁 (flock)，对所有 gunicorn worker 共同生效；
+- 每个用户同时运行的转换不超过 CONVERSION_USER_LIMIT 个，未完成的任务不超过 CONVERSION_USER_MAX_QUEUED 个；
+- 任务可以取消（排队中直接取消，运行中结束 ebook-converter 进程）；进度从 ebook-converter 输出的百分比解析，
+  写入 app.db，任何 worker 都能回答查询。执行任务的进程退出后（owner 见 utils.job_owner），它未完成的任务
+  在下次查询和 worker 启动时标记为中断。
+
+不登记任务的同步转换（上传导入）也通过 run_converter 占用同一组槽位。请求处理函数中的同步等待
+（等待槽位、等待任务完成）最多 CONVERSION_SYNC_WAIT_SECONDS 秒，超时后返回错误，不会一直占住 gunicorn worker；
+后台线程（批量任务、有声书生成、预热）没有请求上下文，一直等到完成。
+"""
+import fcntl
+import os
+import re
+import subprocess
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import closing, contextmanager
+from flask import has_request_context
+from config_manager import CONFIG_DIR
+from database import get_db
+from utils.job_owner import current_owner
+from utils.job_runtime import JobExecutor, cleanup_old_jobs, expire_orphans
+
+CONVERSION_WORKERS = int(os.environ.get('CONVERSION_WORKERS', 0)) or os.cpu_count() or 1
+CONVERSION_USER_LIMIT = int(os.environ.get('CONVERSION_USER_LIMIT', 2))
+CONVERSION_USER_MAX_QUEUED = int(os.environ.get('CONVERSION_USER_MAX_QUEUED', 20))
+CONVERSION_TIMEOUT = int(os.environ.get('CONVERSION_TIMEOUT', 3600))
+CONVERSION_SLOT_DIR = os.environ.get('CONVERSION_SLOT_DIR', os.path.join(CONFIG_DIR, 'conversion_slots'))
+CONVERSION_JOB_RETENTION_DAYS = int(os.environ.get('CONVERSION_JOB_RETENTION_DAYS', 7))
+# 每个进程执行任务的线程数。线程大部分时间在下载或等待槽位，实际的转换并发由槽位限制
+CONVERSION_JOB_THREADS = int(os.environ.get('CONVERSION_JOB_THREADS', 32))
+# 请求中同步等待槽位或任务完成的上限，超过后放弃（任务继续在后台运行）
+CONVERSION_SYNC_WAIT_SECONDS = int(os.environ.get('CONVERSION_SYNC_WAIT_SECONDS', 120))
+
+ACTIVE_STATUSES = ('queued', 'running')
+FINISHED_STATUSES = ('success', 'error', 'cancelled')
+POLL_INTERVAL = 0.5
+
+# ebook-converter 的进度行形如 "34% Converting input to HTML..."
+_PROGRESS_RE = re.compile(r'^\s*(\d{1,3})%\s*(.*)$')
+
+_executor = JobExecutor(CONVERSION_JOB_THREADS, 'conversion')
+
+
+class ConversionCancelled(Exception):
+    """任务已被取消"""
+
+
+class ConversionFailed(Exception):
+    """ebook-converter 失败或超时，消息中带有输出的最后几行"""
+
+
+class ConversionQueueFull(Exception):
+    """用户未完成的转换任务过多"""
+
+
+class ConversionBusy(ConversionFailed):
+    """在等待上限内没有空闲的转换槽位"""
+
+
+def sync_wait_timeout():
+    """同步等待的上限：请求处理函数中为 CONVERSION_SYNC_WAIT_SECONDS，后台线程中为 None（一直等待）"""
+    return CONVERSION_SYNC_WAIT_SECONDS if has_request_context() else None
+
+
+@contextmanager
+def _converter_slot(check_cancelled=None, wait_timeout=None):
+    """
+    占用一个全局转换槽位，没有空闲槽位时等待；check_cancelled() 可以抛出异常放弃等待，
+    wait_timeout 秒后仍没有空闲槽位时抛出 ConversionBusy（None 表示一直等待）。
+    """
+    os.makedirs(CONVERSION_SLOT_DIR, exist_ok=True)
+    deadline = time.monotonic() + wait_timeout if wait_timeout is not None else None
+    while True:
+        for index in range(CONVERSION_WORKERS):
+            fd = os.open(os.path.join(CONVERSION_SLOT_DIR, f'slot-{index}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            try:
+                yield index
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+            return
+        if check_cancelled:
+            check_cancelled()
+        if deadline is not None and time.monotonic() > deadline:
+            raise ConversionBusy(f"No free conversion slot after waiting {wait_timeout} seconds")
+        time.sleep(POLL_INTERVAL)
+
+
+def _run_process(source_path, dest_path, timeout, job=None):
+    """运行 ebook-converter，job 不为 None 时报告进度并响应取消"""
+    process = subprocess.Popen(
+        ['ebook-converter', source_path, dest_path],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace'
+    )
+    tail = deque(maxlen=20)
+
+    def read_output():
+        for line in process.stdout:
+            line = line.rstrip()
+            tail.append(line)
+            match = _PROGRESS_RE.match(line)
+            if job and match:
+                job.report_progress(int(match.group(1)), match.group(2))
+
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                process.wait(timeout=POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if time.monotonic() > deadline:
+                raise ConversionFailed(f"ebook-converter timed out after {timeout} seconds")
+            if job:
+                job.check_cancelled()
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    finally:
+        reader.join(timeout=5)
+
+    if process.returncode != 0:
+        output = '\n'.join(line for line in tail if line)
+        raise ConversionFailed(output or f"ebook-converter exited with code {process.returncode}")
+
+
+def run_converter(source_path, dest_path, timeout=CONVERSION_TIMEOUT):
+    """
+    不登记任务的同步转换，占用一个全局槽位；失败时抛出 ConversionFailed，
+    在请求中等待槽位超过 sync_wait_timeout() 时抛出 ConversionBusy。
+    """
+    with _converter_slot(wait_timeout=sync_wait_timeout()):
+        _run_process(source_path, dest_path, timeout)
+
+
+def _expire_orphans(db, rows):
+    """把执行进程已经退出的未完成任务标记为中断，返回仍然有效的行"""
+    expired = {row['job_id'] for row in expire_orphans(db, rows, 'conversion_jobs', 'job_id', ACTIVE_STATUSES)}
+    return [row for row in rows if row['job_id'] not in expired]
+
+
+def interrupt_orphaned_jobs():
+    """worker 启动时调用：执行进程已经退出（包括容器重启前）的未完成任务标记为中断"""
+    with closing(get_db()) as db:
+        _expire_orphans(db, db.execute(
+            "SELECT job_id, status, owner FROM conversion_jobs WHERE status IN ('queued', 'running')"
+        ).fetchall())
+
+
+def _update_job(job_id, **fields):
+    assignments = ', '.join(f"{name} = ?" for name in fields)
+    with closing(get_db()) as db:
+        db.execute(
+            f"UPDATE conversion_jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE job_id = ?",
+            tuple(fields.values()) + (job_id,)
+        )
+
+
+def _claim_running(job_id, user_id):
+    """在用户并发上限内把任务标记为 running，超出上限时返回 False"""
+    with closing(get_db()) as db:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if user_id is not None:
+                rows = db.execute(
+                    "SELECT job_id, status, owner FROM conversion_jobs WHERE user_id = ? AND status = 'running'",
+                    (user_id,)
+                ).fetchall()
+                if len(_expire_orphans(db, rows)) >= CONVERSION_USER_LIMIT:
+                    db.execute('COMMIT')
+                    return False
+            db.execute(
+                "UPDATE conversion_jobs SET status = 'running', stage = 'converting', updated_at = CURRENT_TIMESTAMP "
+                "WHERE job_id = ? AND status = 'queued'",
+                (job_id,)
+            )
+            db.execute('COMMIT')
+            return True
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+
+class ConversionJob:
+    """传给任务函数的句柄：报告当前步骤、运行转换、检查是否已取消"""
+
+    def __init__(self, job_id, user_id):
+        self.job_id = job_id
+        self.user_id = user_id
+        self._progress = None
+
+    def check_cancelled(self):
+        with closing(get_db()) as db:
+            row = db.execute("SELECT cancel_requested FROM conversion_jobs WHERE job_id = ?", (self.job_id,)).fetchone()
+        if not row or row['cancel_requested']:
+            raise ConversionCancelled()
+
+    def stage(self, stage):
+        self.check_cancelled()
+        _update_job(self.job_id, stage=stage)
+
+    def report_progress(self, percent, message=None):
+        percent = max(0, min(percent, 100))
+        if percent == self._progress:
+            return
+        self._progress = percent
+        try:
+            _update_job(self.job_id, progress=percent, message=(message or None))
+        except Exception as e:
+            print(f"Failed to record progress for conversion job {self.job_id}: {e}")
+
+    def convert(self, source_path, dest_path, timeout=CONVERSION_TIMEOUT):
+        """等待全局槽位和用户并发名额，然后运行 ebook-converter"""
+        while True:
+            self.check_cancelled()
+            with _converter_slot(self.check_cancelled):
+                if _claim_running(self.job_id, self.user_id):
+                    _run_process(source_path, dest_path, timeout, job=self)
+                    return
+            self.stage('waiting')
+            time.sleep(POLL_INTERVAL)
+
+
+def _finish_job(job_id, status, message=None):
+    with closing(get_db()) as db:
+        db.execute(
+            "UPDATE conversion_jobs SET status = ?, stage = NULL, message = ?, "
+            "progress = CASE WHEN ? = 'success' THEN 100 ELSE progress END, updated_at = CURRENT_TIMESTAMP "
+            "WHERE job_id = ? AND status IN ('queued', 'running')",
+            (status, message, status, job_id)
+        )
+
+
+def _run_job(job_id, user_id, work):
+    job = ConversionJob(job_id, user_id)
+    try:
+        job.check_cancelled()
+        work(job)
+    except ConversionCancelled:
+        _finish_job(job_id, 'cancelled')
+    except Exception as e:
+        print(f"Conversion job {job_id} failed: {e}")
+        _finish_job(job_id, 'error', message=str(e)[:2000])
+    else:
+        _finish_job(job_id, 'success')
+
+
+def _job_dict(row):
+    job = dict(row)
+    job.pop('cancel_requested', None)
+    job.pop('owner', None)
+    job.pop('owner_pid', None)
+    job['finished'] = job['status'] in FINISHED_STATUSES
+    return job
+
+
+def submit_conversion(user_id, cache_key, work, book_type='calibre', book_id=None, title=None):
+    """
+    登记并启动一个转换任务，work(job) 在线程池中执行，正常返回即为成功，结果由 work 写入缓存。
+    同一用户已有相同 cache_key 的未完成任务时直接返回该任务。
+    返回任务字典；用户未完成的任务过多时抛出 ConversionQueueFull。
+    """
+    with closing(get_db()) as db:
+        cleanup_old_jobs(db, 'conversion_jobs', CONVERSION_JOB_RETENTION_DAYS, time_column='updated_at',
+                         condition="status IN ('success', 'error', 'cancelled')")
+        if user_id is not None:
+            active = _expire_orphans(db, db.execute(
+                "SELECT * FROM conversion_jobs WHERE user_id = ? AND status IN ('queued', 'running') ORDER BY created_at",
+                (user_id,)
+            ).fetchall())
+            for row in active:
+                if cache_key and row['cache_key'] == cache_key:
+                    return _job_dict(row)
+            if len(active) >= CONVERSION_USER_MAX_QUEUED:
+                raise ConversionQueueFull()
+
+        job_id = str(uuid.uuid4())
+        db.execute(
+            "INSERT INTO conversion_jobs (job_id, user_id, cache_key, book_type, book_id, title, stage, owner) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+            (job_id, user_id, cache_key, book_type, book_id, title, current_owner())
+        )
+        row = db.execute("SELECT * FROM conversion_jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+    _executor.submit(_run_job, job_id, user_id, work)
+    return _job_dict(row)
+
+
+def get_conversion_job(job_id):
+    """返回任务状态字典，任务不存在时返回 None"""
+    with closing(get_db()) as db:
+        row = db.execute("SELECT * FROM conversion_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if not row:
+            return None
+        if not _expire_orphans(db, [row]):
+            row = db.execute("SELECT * FROM conversion_jobs WHERE job_id = ?", (job_id,)).fetchone()
+    return _job_dict(row)
+
+
+def cancel_conversion_job(job_id):
+    """取消任务：排队中的任务立即取消，运行中的任务由执行线程结束转换进程。返回任务当前状态"""
+    with closing(get_db()) as db:
+        db.execute(
+            "UPDATE conversion_jobs SET cancel_requested = 1, "
+            "status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END, "
+            "stage = CASE WHEN status = 'queued' THEN NULL ELSE stage END, updated_at = CURRENT_TIMESTAMP "
+            "WHERE job_id = ? AND status IN ('queued', 'running')",
+            (job_id,)
+        )
+    return get_conversion_job(job_id)
+
+
+def has_active_conversions():
+    """是否有排队或正在运行的转换任务（执行进程已退出的任务不算）"""
+    with closing(get_db()) as db:
+        rows = db.execute(
+            "SELECT job_id, status, owner FROM conversion_jobs WHERE status IN ('queued', 'running')"
+        ).fetchall()
+        return bool(_expire_orphans(db, rows))
+
+
+def wait_for_conversion_job(job_id, timeout=None):
+    """
+    等待任务结束并返回最终状态；超时时返回当时的状态（finished 为 False），timeout=None 时一直等待。
+    请求处理函数中应传入 sync_wait_timeout()。
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        job = get_conversion_job(job_id)
+        if not job or job['finished'] or (deadline and time.monotonic() > deadline):
+            return job
+        time.sleep(POLL_INTERVAL)
@@ -0,0 +1,315 @@
+"""
+封面缩略图服务
+
+书库页面一次会加载几十张封面，原来 /calibre_cover 每次都从 Calibre 代理原图，
+/anx_cover 也直接发送原始文件。这里把封面按内容哈希 (sha1) 保存在 COVER_CACHE_DIR 中，
+并按需生成固定宽度 (THUMBNAIL_WIDTHS) 的 JPEG / WebP 缩略图：
+
+- 原图保存为 <sha>.src，缩略图为 <sha>-<宽度>.<jpg|webp>，生成一次后直接从磁盘发送；
+- Calibre 封面用 (书库, book_id, last_modified) 作为版本键，记录在 index.db 中，版本不变时不再请求 Calibre；
+  last_modified 优先从本地镜像读取，其次来自书籍详情缓存；Calibre 不可用时返回这本书最近缓存过的封面；
+- Anx 封面用文件的 (路径, mtime, 大小) 作为版本键，只在文件变化时重新计算哈希；
+- 响应带 ETag / Last-Modified，支持 304；URL 中带有与当前版本一致的 v 参数时使用
+  Cache-Control: immutable，否则要求浏览器每次重新验证；
+- 原图无法解码（损坏或 Pillow 不支持的格式）时不生成缩略图，直接发送原图；
+- 总大小超过 COVER_CACHE_MAX_MB 时按最近使用时间删除封面（原图和它的全部缩略图），
+  原图文件的 mtime 记录最近使用时间。
+"""
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+from flask import request, send_file
+from PIL import Image, UnidentifiedImageError
+import config_manager
+from config_manager import CONFIG_DIR
+from utils.calibre_details_cache import get_book_details
+from utils.calibre_mirror import get_mirrored_last_modified
+from utils.covers import get_calibre_cover_data
+
+COVER_CACHE_DIR = os.environ.get('COVER_CACHE_DIR', os.path.join(CONFIG_DIR, 'cover_cache'))
+THUMBNAIL_WIDTHS = (150, 300, 600)
+THUMBNAIL_QUALITY = int(os.environ.get('COVER_THUMBNAIL_QUALITY', 80))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+COVER_CACHE_MAX_BYTES = int(os.environ.get('COVER_CACHE_MAX_MB', 512)) * 1024 * 1024
+# 每个进程最多每隔这么多秒检查一次缓存大小；发送时原图的 mtime 超过 TOUCH_SECONDS 才更新
+EVICT_CHECK_SECONDS = 300
+TOUCH_SECONDS = 3600
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+
+_anx_hashes = OrderedDict()  # (path, mtime_ns, size) -> sha
+_anx_hashes_lock = threading.Lock()
+_ANX_HASHES_MAX = 4096
+_last_evict_check = 0
+
+stats = {'evicted': 0, 'decode_errors': 0}
+
+
+def _connect_index():
+    os.makedirs(COVER_CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(COVER_CACHE_DIR, 'index.db'), isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('CREATE TABLE IF NOT EXISTS sources (source_key TEXT PRIMARY KEY, sha TEXT NOT NULL, created_at REAL)')
+    return conn
+
+
+def _path(sha, suffix):
+    return os.path.join(COVER_CACHE_DIR, sha[:2], f"{sha}{suffix}")
+
+
+def _atomic_write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def pick_width(value):
+    """把请求的宽度对齐到 THUMBNAIL_WIDTHS 中不小于它的最小值；没有传入时返回 None（原图）"""
+    try:
+        width = int(value)
+    except (TypeError, ValueError):
+        return None
+    for allowed in THUMBNAIL_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return THUMBNAIL_WIDTHS[-1]
+
+
+def pick_format():
+    return 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpg'
+
+
+def store_source(data):
+    """保存原图并返回内容哈希"""
+    sha = hashlib.sha1(data).hexdigest()
+    path = _path(sha, '.src')
+    if not os.path.exists(path):
+        _atomic_write(path, data)
+        _maybe_evict(keep_sha=sha)
+    return sha
+
+
+def _source_mimetype(data):
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'image/jpeg'
+
+
+def get_variant_path(sha, width, fmt):
+    """返回缩略图路径，不存在时从原图生成；原图不存在或无法解码时返回 None"""
+    path = _path(sha, f"-{width}.{fmt}")
+    if os.path.exists(path):
+        return path
+    src_path = _path(sha, '.src')
+    if not os.path.exists(src_path):
+        return None
+    pil_format, _mimetype = FORMATS[fmt]
+    try:
+        with Image.open(src_path) as img:
+            img.load()
+            if img.width > width:
+                height = max(1, round(img.height * width / img.width))
+                img = img.resize((width, height), Image.LANCZOS)
+            if pil_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            elif pil_format == 'WEBP' and img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+            buffer = io.BytesIO()
+            img.save(buffer, pil_format, quality=THUMBNAIL_QUALITY)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        stats['decode_errors'] += 1
+        print(f"Could not create {width}px {fmt} thumbnail for cover {sha}: {e}")
+        return None
+    _atomic_write(path, buffer.getvalue())
+    _maybe_evict(keep_sha=sha)
+    return path
+
+
+def _touch(src_path):
+    """记录原图的最近使用时间，LRU 淘汰按它排序"""
+    try:
+        if time.time() - os.path.getmtime(src_path) > TOUCH_SECONDS:
+            os.utime(src_path)
+    except OSError:
+        pass
+
+
+def _maybe_evict(keep_sha=None):
+    """写入新文件后检查缓存大小，每个进程最多每 EVICT_CHECK_SECONDS 秒一次"""
+    global _last_evict_check
+    now = time.time()
+    if now - _last_evict_check < EVICT_CHECK_SECONDS:
+        return
+    _last_evict_check = now
+    try:
+        _evict(keep_sha)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Cover cache eviction failed: {e}")
+
+
+def _evict(keep_sha=None):
+    """总大小超过 COVER_CACHE_MAX_BYTES 时，按原图的 mtime 从旧到新删除封面及其缩略图，刚写入的封面除外"""
+    entries = {}  # sha -> [size, last_used, paths]
+    total = 0
+    for prefix in os.listdir(COVER_CACHE_DIR):
+        subdir = os.path.join(COVER_CACHE_DIR, prefix)
+        if len(prefix) != 2 or not os.path.isdir(subdir):
+            continue
+        for name in os.listdir(subdir):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(subdir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            sha = name.split('.', 1)[0].split('-', 1)[0]
+            entry = entries.setdefault(sha, [0, 0, []])
+            entry[0] += st.st_size
+            entry[2].append(path)
+            if name.endswith('.src'):
+                entry[1] = st.st_mtime
+            total += st.st_size
+    if total <= COVER_CACHE_MAX_BYTES:
+        return
+    evicted = []
+    for sha, (size, _last_used, paths) in sorted(entries.items(), key=lambda item: item[1][1]):
+        if total <= COVER_CACHE_MAX_BYTES:
+            break
+        if sha == keep_sha:
+            continue
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+        evicted.append(sha)
+    with closing(_connect_index()) as conn:
+        conn.executemany('DELETE FROM sources WHERE sha = ?', [(sha,) for sha in evicted])
+    stats['evicted'] += len(evicted)
+
+
+def _lookup(source_key):
+    with closing(_connect_index()) as conn:
+        row = conn.execute('SELECT sha FROM sources WHERE source_key = ?', (source_key,)).fetchone()
+    if row and os.path.exists(_path(row[0], '.src')):
+        return row[0]
+    return None
+
+
+def _remember(source_key, sha):
+    with closing(_connect_index()) as conn:
+        conn.execute('INSERT OR REPLACE INTO sources (source_key, sha, created_at) VALUES (?, ?, ?)', (source_key, sha, time.time()))
+
+
+def calibre_cover_version(book_id):
+    """Calibre 书籍的 last_modified，封面修改时它也会变化"""
+    version = get_mirrored_last_modified(book_id)
+    if version:
+        return version
+    details = get_book_details(book_id)
+    return details.get('last_modified') if details else None
+
+
+def _calibre_source_prefix(book_id):
+    config = config_manager.config
+    return f"calibre|{config.get('CALIBRE_URL', '')}|{config.get('CALIBRE_DEFAULT_LIBRARY_ID', 'Calibre_Library')}|{book_id}|"
+
+
+def resolve_calibre_cover(book_id, version):
+    """返回 Calibre 封面的内容哈希，需要时从 Calibre 下载一次"""
+    source_key = f"{_calibre_source_prefix(book_id)}{version}"
+    if version:
+        sha = _lookup(source_key)
+        if sha:
+            return sha
+    data = get_calibre_cover_data(book_id)
+    if not data:
+        return None
+    sha = store_source(data)
+    if version:
+        _remember(source_key, sha)
+    return sha
+
+
+def latest_calibre_cover(book_id):
+    """这本书最近缓存的任意版本封面的哈希，Calibre 不可用时作为过期数据返回；没有时返回 None"""
+    prefix = _calibre_source_prefix(book_id)
+    with closing(_connect_index()) as conn:
+        rows = conn.execute(
+            'SELECT sha FROM sources WHERE substr(source_key, 1, ?) = ? ORDER BY created_at DESC',
+            (len(prefix), prefix)
+        ).fetchall()
+    for row in rows:
+        if os.path.exists(_path(row[0], '.src')):
+            return row[0]
+    return None
+
+
+def resolve_file_cover(path):
+    """返回本地封面文件的内容哈希；文件不存在时返回 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_mtime_ns, st.st_size)
+    with _anx_hashes_lock:
+        sha = _anx_hashes.get(key)
+        if sha:
+            _anx_hashes.move_to_end(key)
+    if sha and os.path.exists(_path(sha, '.src')):
+        return sha
+    with open(path, 'rb') as f:
+        sha = store_source(f.read())
+    with _anx_hashes_lock:
+        _anx_hashes[key] = sha
+        while len(_anx_hashes) > _ANX_HASHES_MAX:
+            _anx_hashes.popitem(last=False)
+    return sha
+
+
+def cover_response(sha, width=None, fmt=None, immutable=False):
+    """发送原图或缩略图，带 ETag / Last-Modified，并处理 If-None-Match / If-Modified-Since"""
+    src_path = _path(sha, '.src')
+    _touch(src_path)
+    path = None
+    if width:
+        fmt = fmt or pick_format()
+        path = get_variant_path(sha, width, fmt)
+    if path:
+        mimetype = FORMATS[fmt][1]
+        etag = f"{sha}-{width}-{fmt}"
+    else:
+        # 没有要求缩略图，或原图无法生成缩略图时发送原图
+        width = None
+        path = src_path
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            mimetype = _source_mimetype(f.read(16))
+        etag = sha
+
+    response = send_file(path, mimetype=mimetype, etag=etag, conditional=True, max_age=0)
+    if immutable:
+        response.headers['Cache-Control'] = f'private, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    if width:
+        response.vary.add('Accept')
+    return response
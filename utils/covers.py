@@ -1,18 +1,17 @@
 import os
 import requests
 from contextlib import closing
-import sqlite3
 
 import config_manager
-from utils.auth import get_calibre_auth
-from anx_library import get_anx_user_dirs
+from utils.calibre_client import calibre_get
+from anx_library import get_anx_user_dirs, get_anx_db
 
 def get_calibre_cover_data(book_id):
     """获取指定 Calibre 书籍的封面二进制数据"""
     config = config_manager.config
     url = f"{config['CALIBRE_URL']}/get/cover/{book_id}"
     try:
-        response = requests.get(url, auth=get_calibre_auth(), stream=True)
+        response = calibre_get(url, stream=True)
         response.raise_for_status()
         return response.content
     except requests.exceptions.RequestException as e:
@@ -25,8 +24,7 @@ def get_anx_cover_data(username, book_id) -> bytes | None:
     if not dirs or not os.path.exists(dirs["db_path"]):
         return None
     
-    with closing(sqlite3.connect(dirs["db_path"])) as db:
-        db.row_factory = sqlite3.Row
+    with closing(get_anx_db(username)) as db:
         book_row = db.execute("SELECT cover_path FROM tb_books WHERE id = ?", (book_id,)).fetchone()
         if not book_row or not book_row['cover_path']:
             return None
@@ -0,0 +1,175 @@
+"""
+处理过的 EPUB（转换 + Kindle 修复）的持久缓存
+
+下载（强制 EPUB）、发送到 Kindle、推送到 Anx、生成有声书、章节解析、元数据和 LLM 对话都要通过
+_get_processed_epub_for_book 拿到处理过的 EPUB，原来每次都重新下载、重新运行 ebook-converter
+（最长 3600 秒）和 fix_epub_for_kindle。这里把结果保存在 EPUB_CACHE_DIR 中，所有 worker 共享：
+
+- 缓存键由 (Calibre 地址|书库, book_id, 源格式, 源格式的大小和 mtime, 强制语言, 修复器版本) 组成，
+  大小和 mtime 来自书籍详情的 format_metadata，Calibre 中的文件变化后自然换成新键；
+  Anx 书库中的文件用 (路径, 大小, mtime, 强制语言, 修复器版本) 作为键；
+- 文件按内容哈希 (sha1) 命名为 <sha>.epub，不同的键得到相同内容时只保存一份；
+- index.db 记录每个键的最近使用时间，总大小超过 EPUB_CACHE_MAX_MB 时按 LRU 删除最久未用的条目。
+
+缓存中的文件只读，调用方需要修改或移走时应先复制。
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import closing
+import config_manager
+from config_manager import CONFIG_DIR
+
+EPUB_CACHE_DIR = os.environ.get('EPUB_CACHE_DIR', os.path.join(CONFIG_DIR, 'epub_cache'))
+EPUB_CACHE_MAX_BYTES = int(os.environ.get('EPUB_CACHE_MAX_MB', 2048)) * 1024 * 1024
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+  cache_key TEXT PRIMARY KEY,
+  sha TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  created_at REAL NOT NULL,
+  last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_artifacts_last_used ON artifacts(last_used);
+CREATE INDEX IF NOT EXISTS idx_artifacts_sha ON artifacts(sha);
+"""
+
+stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+
+
+def _connect():
+    os.makedirs(EPUB_CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(EPUB_CACHE_DIR, 'index.db'), isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.executescript(INDEX_SCHEMA)
+    return conn
+
+
+def _path(sha):
+    return os.path.join(EPUB_CACHE_DIR, sha[:2], f"{sha}.epub")
+
+
+def calibre_artifact_key(book_id, details, source_format, language, fixer_version):
+    """
+    处理过的 Calibre 书籍的缓存键；format_metadata 中没有源格式的大小和 mtime 时返回 None（不缓存）。
+    """
+    fmt = source_format.lower()
+    format_metadata = {k.lower(): v for k, v in (details.get('format_metadata') or {}).items()}
+    info = format_metadata.get(fmt) or {}
+    if not info.get('size') or not info.get('mtime'):
+        return None
+    config = config_manager.config
+    library_key = f"{config.get('CALIBRE_URL', '')}|{config.get('CALIBRE_DEFAULT_LIBRARY_ID', 'Calibre_Library')}"
+    return f"calibre|{library_key}|{book_id}|{fmt}|{info['size']}|{info['mtime']}|{language}|fixer-v{fixer_version}"
+
+
+def file_artifact_key(path, language, fixer_version):
+    """本地书籍文件（Anx 书库）处理结果的缓存键，文件被替换或修改后换成新键；文件不存在时返回 None"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"file|{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}|{language}|fixer-v{fixer_version}"
+
+
+def get_artifact(cache_key):
+    """返回缓存文件的路径并更新最近使用时间；没有缓存或文件已被删除时返回 None"""
+    if not cache_key:
+        return None
+    try:
+        with closing(_connect()) as conn:
+            row = conn.execute("SELECT sha FROM artifacts WHERE cache_key = ?", (cache_key,)).fetchone()
+            if row and os.path.exists(_path(row[0])):
+                conn.execute("UPDATE artifacts SET last_used = ? WHERE cache_key = ?", (time.time(), cache_key))
+                stats['hits'] += 1
+                return _path(row[0])
+            if row:
+                conn.execute("DELETE FROM artifacts WHERE cache_key = ?", (cache_key,))
+    except sqlite3.Error as e:
+        print(f"EPUB cache unavailable: {e}")
+        return None
+    stats['misses'] += 1
+    return None
+
+
+def has_artifact(cache_key):
+    """只检查是否有缓存，不更新使用时间和统计"""
+    if not cache_key:
+        return False
+    try:
+        with closing(_connect()) as conn:
+            row = conn.execute("SELECT sha FROM artifacts WHERE cache_key = ?", (cache_key,)).fetchone()
+    except sqlite3.Error as e:
+        print(f"EPUB cache unavailable: {e}")
+        return False
+    return bool(row) and os.path.exists(_path(row[0]))
+
+
+def _file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def store_artifact(cache_key, source_path, move=False):
+    """
+    把处理好的 EPUB 放入缓存并返回缓存中的路径。move=True 时移动 source_path（它必须是调用方的临时文件）。
+    缓存不可用时返回 None，调用方继续使用 source_path。
+    """
+    if not cache_key:
+        return None
+    try:
+        sha = _file_sha1(source_path)
+        path = _path(sha)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            if move:
+                shutil.move(source_path, tmp_path)
+            else:
+                shutil.copyfile(source_path, tmp_path)
+            os.replace(tmp_path, path)
+        elif move:
+            os.remove(source_path)
+        size = os.path.getsize(path)
+        now = time.time()
+        with closing(_connect()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO artifacts (cache_key, sha, size, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (cache_key, sha, size, now, now)
+            )
+            stats['stored'] += 1
+            _evict(conn, keep_sha=sha)
+        return path
+    except (OSError, sqlite3.Error) as e:
+        print(f"Failed to store processed EPUB in cache: {e}")
+        return None
+
+
+def _evict(conn, keep_sha=None):
+    """总大小（每个内容文件只算一次）超过上限时，按最近使用时间从旧到新删除，刚写入的文件除外"""
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT sha, MAX(size) AS size FROM artifacts GROUP BY sha)").fetchone()[0]
+    if total <= EPUB_CACHE_MAX_BYTES:
+        return
+    rows = conn.execute(
+        "SELECT sha, MAX(size), MAX(last_used) AS used FROM artifacts GROUP BY sha ORDER BY used"
+    ).fetchall()
+    for sha, size, _used in rows:
+        if total <= EPUB_CACHE_MAX_BYTES:
+            break
+        if sha == keep_sha:
+            continue
+        conn.execute("DELETE FROM artifacts WHERE sha = ?", (sha,))
+        try:
+            os.remove(_path(sha))
+        except OSError:
+            pass
+        total -= size
+        stats['evicted'] += 1
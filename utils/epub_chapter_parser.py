@@ -13,6 +13,7 @@ from bs4 import BeautifulSoup
 
 # This is a key dependency from another utils file
 from .epub_utils import _process_entire_epub
+from .single_flight import single_flight
 
 # 延迟导入以避免循环依赖
 def _get_processed_epub_for_book(*args, **kwargs):
@@ -237,14 +238,40 @@ def get_parsed_chapters(library_type: str, book_id: int, user_dict: Dict[str, An
     cache_path = os.path.join(CACHE_DIR, cache_key)
 
     # 1. 检查缓存
-    if os.path.exists(cache_path):
-        try:
-            with open(cache_path, 'r', encoding='utf-8') as f:
-                logger.info(f"Cache hit for {library_type}-{book_id}. Loading from cache.")
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
-            logger.warning(f"Failed to read cache file {cache_path}. Re-parsing.")
+    chapters = _read_chapter_cache(cache_path, library_type, book_id)
+    if chapters is not None:
+        return chapters
+
+    # 同一本书同时只解析一次，其余请求等待后直接读取缓存
+    with single_flight(f"chapters|{cache_key}") as waited:
+        if waited:
+            chapters = _read_chapter_cache(cache_path, library_type, book_id)
+            if chapters is not None:
+                return chapters
+        return _parse_and_cache_chapters(library_type, book_id, user_dict, cache_path)
+
+
+def drop_cached_chapters(library_type: str, book_id: int, user_id: int) -> None:
+    """删除过期的章节缓存（书籍文件变化后调用），下次 get_parsed_chapters 会重新解析"""
+    try:
+        os.remove(os.path.join(CACHE_DIR, f"{library_type}-{book_id}-user{user_id}.json"))
+    except FileNotFoundError:
+        pass
+
+
+def _read_chapter_cache(cache_path: str, library_type: str, book_id: int):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            logger.info(f"Cache hit for {library_type}-{book_id}. Loading from cache.")
+            return json.load(f)
+    except (json.JSONDecodeError, IOError):
+        logger.warning(f"Failed to read cache file {cache_path}. Re-parsing.")
+        return None
+
 
+def _parse_and_cache_chapters(library_type: str, book_id: int, user_dict: Dict[str, Any], cache_path: str) -> List[Tuple[str, str]]:
     # 2. 获取标准化的 EPUB 内容
     logger.info(f"Cache miss for {library_type}-{book_id}. Processing book.")
     epub_content, epub_filename, _ = (None, None, None)
@@ -252,8 +279,10 @@ def get_parsed_chapters(library_type: str, book_id: int, user_dict: Dict[str, An
         language = (user_dict.get('language') or 'zh').split('_')[0]
         epub_content, epub_filename, _ = _get_processed_epub_for_book(book_id, user_dict, language=language)
     elif library_type == 'anx':
-        epub_content, epub_filename, _ = _get_processed_epub_for_anx_book(book_id, user_dict['username'])
+        epub_content, epub_filename, _ = _get_processed_epub_for_anx_book(book_id, user_dict['username'], user_id=user_dict.get('id'))
     
+    if epub_filename == 'CONVERSION_PENDING':
+        raise ValueError(f"{library_type}-{book_id} is still being converted to EPUB. Please try again later.")
     if not epub_content or epub_filename is None:
         raise ValueError(f"Failed to get processed EPUB for {library_type}-{book_id}. Reason: {epub_filename or 'Unknown'}")
 
@@ -271,8 +300,11 @@ def get_parsed_chapters(library_type: str, book_id: int, user_dict: Dict[str, An
 
     # 4. 写入缓存
     try:
-        with open(cache_path, 'w', encoding='utf-8') as f:
+        # 先写临时文件再替换，其他 worker 不会读到写了一半的缓存
+        temp_cache_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_cache_path, 'w', encoding='utf-8') as f:
             json.dump(chapters, f, ensure_ascii=False)
+        os.replace(temp_cache_path, cache_path)
         logger.info(f"Successfully cached parsed content for {library_type}-{book_id}.")
     except IOError as e:
         logger.error(f"Failed to write to cache file {cache_path}: {e}")
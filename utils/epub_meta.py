@@ -85,9 +85,9 @@ def get_metadata(library_type: str, book_id: int, user_dict: Dict[str, Any]) ->
         final_meta['title'] = db_meta.get('title', 'Untitled')
         final_meta['authors'] = db_meta.get('authors', ['Unknown Author'])
     elif library_type == 'anx':
-        from anx_library import get_anx_book_details
+        from anx_library import get_anx_books_by_ids
         from .epub_chapter_parser import extract_text_from_html
-        db_meta = get_anx_book_details(user_dict.get('username'), book_id, as_dict=True) or {}
+        db_meta = get_anx_books_by_ids(user_dict.get('username'), [book_id], columns=('title', 'author', 'description')).get(book_id) or {}
 
         # 清理 description 字段的 HTML
         if 'description' in db_meta:
@@ -103,7 +103,7 @@ def get_metadata(library_type: str, book_id: int, user_dict: Dict[str, Any]) ->
         language = (user_dict.get('language') or 'zh').split('_')[0]
         epub_content, _unused1, _unused2 = _get_processed_epub_for_book(book_id, user_dict, language=language)
     elif library_type == 'anx':
-        epub_content, _unused1, _unused2 = _get_processed_epub_for_anx_book(book_id, user_dict['username'])
+        epub_content, _unused1, _unused2 = _get_processed_epub_for_anx_book(book_id, user_dict['username'], user_id=user_dict.get('id'))
 
     if epub_content:
         with tempfile.NamedTemporaryFile(suffix='.epub', delete=True) as temp_file:
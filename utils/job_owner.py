@@ -0,0 +1,64 @@
+"""
+后台任务执行进程的标识
+
+转换、批量上传和批量推送任务只在登记它们的 worker 的线程池中执行，这个 worker 退出后任务永远不会完成。
+任务行记录执行进程的 owner，读取时据此判断任务是否已中断。
+
+只记录 pid 不够：容器重启后 gunicorn 的 worker 通常拿到同样的小 pid，旧任务看起来仍然活着。
+owner 是 "pid:进程启动时间"，启动时间取自 /proc/<pid>/stat，能区分复用同一 pid 的新进程；
+没有 /proc 时退化为随机标识，只能按 pid 判断。
+"""
+import os
+import uuid
+
+_owner = None
+_owner_pid = None
+
+
+def _start_time(pid):
+    """进程启动时间（/proc/<pid>/stat 的第 22 列，开机后的时钟滴答数）；读取失败时返回 None"""
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # 第 2 列是括号中的进程名，可能包含空格，从最后一个右括号之后开始数（第 3 列起）
+    fields = stat[stat.rfind(')') + 2:].split()
+    return fields[19] if len(fields) > 19 else None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def current_owner():
+    """当前进程的 owner；fork 之后重新计算"""
+    global _owner, _owner_pid
+    pid = os.getpid()
+    if _owner is None or _owner_pid != pid:
+        _owner = f"{pid}:{_start_time(pid) or uuid.uuid4().hex}"
+        _owner_pid = pid
+    return _owner
+
+
+def owner_alive(owner):
+    """owner 对应的进程是否还在运行；没有记录 owner 的旧任务视为已中断"""
+    if not owner:
+        return False
+    if owner == current_owner():
+        return True
+    pid, _, start = owner.partition(':')
+    try:
+        pid = int(pid)
+    except ValueError:
+        return False
+    if not _pid_alive(pid):
+        return False
+    actual = _start_time(pid)
+    return actual is None or actual == start
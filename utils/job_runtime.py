@@ -0,0 +1,93 @@
+"""
+后台任务模块共用的部分
+
+批量上传 (utils.upload_jobs)、批量推送 / 发送 (utils.book_jobs) 和格式转换 (utils.conversion_jobs)
+都是"在 app.db 中登记任务，在当前进程的线程池中执行，任何 worker 都能查询状态"的模式，这里放它们共用的：
+
+- JobExecutor：每个进程一个有界线程池，gunicorn fork 之后在新进程中重新创建；
+- cleanup_old_jobs：创建新任务时顺带删除超过保留天数的任务记录和临时目录；
+- expire_orphans：执行进程已经退出（owner 见 utils.job_owner）的未完成任务标记为中断；
+- status_counts：查询接口返回的各状态数量。
+"""
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.job_owner import owner_alive
+
+INTERRUPTED_MESSAGE = 'Processing was interrupted because the server process exited.'
+
+
+class JobExecutor:
+    """按进程创建的线程池；线程不会被 fork 继承，进程变化后重新创建"""
+
+    def __init__(self, max_workers, thread_name_prefix):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        pid = os.getpid()
+        if self._executor is None or self._pid != pid:
+            with self._lock:
+                if self._executor is None or self._pid != pid:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.thread_name_prefix)
+                    self._pid = pid
+        return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        return self.get().submit(fn, *args, **kwargs)
+
+
+def cleanup_old_jobs(db, table, retention_days, child_table=None, spool_dir=None, time_column='created_at', condition=None):
+    """
+    删除 table 中 time_column 早于 retention_days 天的任务（condition 为额外的 SQL 条件），
+    连同 child_table 中同一 job_id 的行和 spool_dir/<job_id> 临时目录。
+    """
+    where = f"{time_column} < datetime('now', ?)"
+    if condition:
+        where += f" AND {condition}"
+    old_jobs = [row['job_id'] for row in db.execute(
+        f"SELECT job_id FROM {table} WHERE {where}", (f'-{retention_days} days',)
+    ).fetchall()]
+    for job_id in old_jobs:
+        if child_table:
+            db.execute(f"DELETE FROM {child_table} WHERE job_id = ?", (job_id,))
+        db.execute(f"DELETE FROM {table} WHERE job_id = ?", (job_id,))
+        if spool_dir:
+            shutil.rmtree(os.path.join(spool_dir, job_id), ignore_errors=True)
+
+
+def expire_orphans(db, rows, table, key_column, active_statuses, on_expired=None, message=INTERRUPTED_MESSAGE):
+    """
+    rows 中 owner 对应的进程已经退出的任务：把 table 中 key_column 等于该行同名列、状态仍在 active_statuses 中的行
+    标记为 error（带中断说明），并调用 on_expired(row) 清理它的临时文件。
+    行中有 status 列时只检查未完成的行。返回确实被中断的行。
+    """
+    placeholders = ', '.join('?' for _ in active_statuses)
+    expired = []
+    for row in rows:
+        if 'status' in row.keys() and row['status'] not in active_statuses:
+            continue
+        if owner_alive(row['owner']):
+            continue
+        cursor = db.execute(
+            f"UPDATE {table} SET status = 'error', stage = NULL, message = ?, updated_at = CURRENT_TIMESTAMP "
+            f"WHERE {key_column} = ? AND status IN ({placeholders})",
+            (message, row[key_column]) + tuple(active_statuses)
+        )
+        if cursor.rowcount:
+            if on_expired:
+                on_expired(row)
+            expired.append(row)
+    return expired
+
+
+def status_counts(entries, active_statuses, finished_statuses):
+    """每个状态的数量，没有出现的状态为 0"""
+    counts = {status: 0 for status in tuple(active_statuses) + tuple(finished_statuses)}
+    for entry in entries:
+        counts[entry['status']] = counts.get(entry['status'], 0) + 1
+    return counts
@@ -0,0 +1,380 @@
+"""
+空闲时预热新书的派生结果（全局设置 ENABLE_PREWARM，默认关闭）
+
+新加入的书第一次被阅读、推送或生成有声书时，要付出下载、ebook-converter 转换、Kindle 修复、章节解析和
+封面缩略图的全部代价。开启后由一个后台线程在服务器空闲时提前完成这些步骤：
+
+- 新书的发现不依赖各个入口（网页上传、批量上传任务、WebDAV 导入目录、直接在 Calibre 中添加或修改）：
+  Calibre 书籍取本地镜像中 last_modified 晚于水位线的书（网页上传会立即刷新镜像，其他来源在下一次
+  增量同步后出现），Anx 书籍取每个用户书库中 id 大于水位线的书。第一次运行只记录水位线，不预热已有的书库；
+- 每本书依次生成：书库页面使用的封面缩略图；每种用户设置组合（语言、格式优先级）下处理过的 EPUB
+  （写入 utils.epub_cache）；每个用户的章节缓存（MCP 的字数统计直接由它计算）；
+- 所有 worker 中只有拿到 prewarm.lock 文件锁的一个线程在预热，一次处理一本书的一个步骤。线程以
+  PREWARM_NICE 的优先级运行（Linux 上 setpriority 只作用于当前线程，它启动的 ebook-converter 也继承这一优先级）；
+  最近 PREWARM_IDLE_SECONDS 秒内有请求或有转换任务时，下一步等到空闲再开始；
+- 队列和水位线保存在 CONFIG_DIR/prewarm.db 中，失败的书最多尝试 PREWARM_MAX_ATTEMPTS 次。
+"""
+import fcntl
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import closing
+import config_manager
+from config_manager import CONFIG_DIR
+from database import get_db
+
+PREWARM_PATH = os.environ.get('PREWARM_PATH', os.path.join(CONFIG_DIR, 'prewarm.db'))
+PREWARM_IDLE_SECONDS = int(os.environ.get('PREWARM_IDLE_SECONDS', 120))
+PREWARM_SCAN_SECONDS = int(os.environ.get('PREWARM_SCAN_SECONDS', 60))
+PREWARM_MAX_ATTEMPTS = int(os.environ.get('PREWARM_MAX_ATTEMPTS', 3))
+PREWARM_NICE = int(os.environ.get('PREWARM_NICE', 19))
+# 书库和统计页面的封面使用 w=150 和 2x 的 w=300
+PREWARM_COVER_WIDTHS = (150, 300)
+PREWARM_COVER_FORMATS = ('webp', 'jpg')
+ACTIVITY_PATH = os.path.join(CONFIG_DIR, 'prewarm_activity')
+# 每个进程最多每隔这么多秒更新一次活动时间，避免每个请求都写文件
+ACTIVITY_TOUCH_SECONDS = 5
+IDLE_POLL_SECONDS = 5
+
+PREWARM_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue (
+  item_key TEXT PRIMARY KEY,
+  library_type TEXT NOT NULL,
+  book_id INTEGER NOT NULL,
+  username TEXT,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  last_error TEXT,
+  enqueued_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS warmed (
+  item_key TEXT PRIMARY KEY,
+  epub_keys TEXT,
+  warmed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+"""
+
+stats = {'enqueued': 0, 'warmed': 0, 'failed': 0}
+
+_thread = None
+_thread_pid = None
+_thread_lock = threading.Lock()
+_activity_touched = 0
+
+
+class _Disabled(Exception):
+    """预热在运行中被关闭"""
+
+
+def _enabled():
+    return bool(config_manager.config.get('ENABLE_PREWARM', False))
+
+
+def _connect():
+    os.makedirs(os.path.dirname(PREWARM_PATH), exist_ok=True)
+    conn = sqlite3.connect(PREWARM_PATH, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.executescript(PREWARM_SCHEMA)
+    return conn
+
+
+def note_activity():
+    """每个请求调用：记录最近一次请求的时间，所有 worker 共用 ACTIVITY_PATH 的 mtime"""
+    global _activity_touched
+    now = time.time()
+    if now - _activity_touched < ACTIVITY_TOUCH_SECONDS:
+        return
+    _activity_touched = now
+    try:
+        with open(ACTIVITY_PATH, 'a'):
+            pass
+        os.utime(ACTIVITY_PATH, (now, now))
+    except OSError:
+        pass
+
+
+def is_idle():
+    """最近 PREWARM_IDLE_SECONDS 秒内没有请求，并且没有排队或运行中的转换任务"""
+    try:
+        last_activity = os.path.getmtime(ACTIVITY_PATH)
+    except OSError:
+        last_activity = 0
+    if time.time() - last_activity < PREWARM_IDLE_SECONDS:
+        return False
+    from utils.conversion_jobs import has_active_conversions
+    return not has_active_conversions()
+
+
+def _wait_until_idle():
+    while not is_idle():
+        if not _enabled():
+            raise _Disabled()
+        time.sleep(IDLE_POLL_SECONDS)
+
+
+def maybe_start(app):
+    """开启预热时确保当前进程有预热线程；各进程的线程争夺同一个文件锁，只有一个真正工作"""
+    global _thread, _thread_pid
+    pid = os.getpid()
+    if _thread_pid == pid and _thread is not None and _thread.is_alive():
+        return
+    if not _enabled():
+        return
+    with _thread_lock:
+        if _thread_pid == pid and _thread is not None and _thread.is_alive():
+            return
+        _thread = threading.Thread(target=_run, args=(app,), name='prewarm', daemon=True)
+        _thread_pid = pid
+        _thread.start()
+
+
+def _run(app):
+    try:
+        # Linux 上线程有自己的 nice 值，只降低预热线程（以及它启动的子进程）的优先级
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), PREWARM_NICE)
+    except (AttributeError, OSError) as e:
+        print(f"Could not lower pre-warm thread priority: {e}")
+
+    with open(f"{PREWARM_PATH}.lock", 'w') as lock_file:
+        while True:
+            if not _enabled():
+                return
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(PREWARM_SCAN_SECONDS)
+        try:
+            with app.app_context():
+                _loop()
+        except _Disabled:
+            pass
+        except Exception as e:
+            print(f"Pre-warm thread stopped: {e}")
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _loop():
+    last_scan = 0
+    while _enabled():
+        if time.time() - last_scan >= PREWARM_SCAN_SECONDS:
+            last_scan = time.time()
+            try:
+                _scan()
+            except Exception as e:
+                print(f"Pre-warm scan failed: {e}")
+        item = _next_item() if is_idle() else None
+        if item is None:
+            time.sleep(IDLE_POLL_SECONDS)
+            continue
+        _warm_item(item)
+
+
+# --- 发现新书 ---
+
+def _enqueue(conn, items):
+    now = time.time()
+    conn.executemany(
+        "INSERT INTO queue (item_key, library_type, book_id, username, enqueued_at) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(item_key) DO UPDATE SET attempts = 0, last_error = NULL, enqueued_at = excluded.enqueued_at",
+        [(_item_key(library_type, book_id, username), library_type, book_id, username, now)
+         for library_type, book_id, username in items]
+    )
+    stats['enqueued'] += len(items)
+
+
+def _item_key(library_type, book_id, username=None):
+    return f"anx:{username}:{book_id}" if library_type == 'anx' else f"calibre:{book_id}"
+
+
+def _set_state(conn, key, value):
+    conn.execute(
+        "INSERT INTO state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, str(value))
+    )
+
+
+def _scan():
+    with closing(_connect()) as conn:
+        state = dict(conn.execute('SELECT key, value FROM state').fetchall())
+        _scan_calibre(conn, state)
+        for user in _users():
+            _scan_anx(conn, state, user['username'])
+
+
+def _scan_calibre(conn, state):
+    from utils.calibre_mirror import get_books_modified_since
+    result = get_books_modified_since(state.get('calibre_watermark'))
+    if result is None:
+        return
+    changed, latest = result
+    if changed:
+        _enqueue(conn, [('calibre', book_id, None) for book_id, _last_modified in changed])
+    # 镜像为空时记录空水位线，之后加入的书都算新书
+    if state.get('calibre_watermark') is None or (latest and latest != state['calibre_watermark']):
+        _set_state(conn, 'calibre_watermark', latest or '')
+
+
+def _scan_anx(conn, state, username):
+    from anx_library import get_anx_db, get_anx_user_dirs
+    dirs = get_anx_user_dirs(username)
+    if not dirs or not os.path.exists(dirs['db_path']):
+        return
+    state_key = f"anx_watermark:{username}"
+    watermark = state.get(state_key)
+    with closing(get_anx_db(username)) as anx_conn:
+        latest = anx_conn.execute('SELECT MAX(id) FROM tb_books').fetchone()[0] or 0
+        if watermark is not None:
+            rows = anx_conn.execute(
+                'SELECT id FROM tb_books WHERE id > ? AND is_deleted = 0 ORDER BY id', (int(watermark),)
+            ).fetchall()
+            if rows:
+                _enqueue(conn, [('anx', row['id'], username) for row in rows])
+    if watermark is None or latest > int(watermark):
+        _set_state(conn, state_key, latest)
+
+
+def _next_item():
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            'SELECT * FROM queue WHERE attempts < ? ORDER BY enqueued_at, item_key LIMIT 1', (PREWARM_MAX_ATTEMPTS,)
+        ).fetchone()
+    return dict(row) if row else None
+
+
+# --- 预热 ---
+
+def _users():
+    with closing(get_db()) as db:
+        rows = db.execute(
+            'SELECT id, username, language, send_format_priority, force_epub_conversion, kindle_email FROM users ORDER BY id'
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def _language(user):
+    return (user.get('language') or 'zh').split('_')[0]
+
+
+def _warm_item(item):
+    try:
+        if item['library_type'] == 'anx':
+            epub_keys = _warm_anx(item['username'], item['book_id'])
+        else:
+            epub_keys = _warm_calibre(item['book_id'])
+    except _Disabled:
+        raise
+    except Exception as e:
+        stats['failed'] += 1
+        print(f"Failed to pre-warm {item['item_key']}: {e}")
+        with closing(_connect()) as conn:
+            conn.execute(
+                'UPDATE queue SET attempts = attempts + 1, last_error = ? WHERE item_key = ?',
+                (str(e), item['item_key'])
+            )
+        return
+    stats['warmed'] += 1
+    with closing(_connect()) as conn:
+        conn.execute('DELETE FROM queue WHERE item_key = ?', (item['item_key'],))
+        if epub_keys is not None:
+            conn.execute(
+                'INSERT OR REPLACE INTO warmed (item_key, epub_keys, warmed_at) VALUES (?, ?, ?)',
+                (item['item_key'], json.dumps(epub_keys), time.time())
+            )
+
+
+def _warm_cover_variants(sha):
+    from utils.cover_thumbnails import get_variant_path
+    for width in PREWARM_COVER_WIDTHS:
+        for fmt in PREWARM_COVER_FORMATS:
+            get_variant_path(sha, width, fmt)
+
+
+def _warmed_epub_keys(item_key):
+    with closing(_connect()) as conn:
+        row = conn.execute('SELECT epub_keys FROM warmed WHERE item_key = ?', (item_key,)).fetchone()
+    return json.loads(row['epub_keys']) if row and row['epub_keys'] else {}
+
+
+def _warm_calibre(book_id):
+    """预热一本 Calibre 书，返回 {用户 ID: 处理过的 EPUB 缓存键}，书已被删除时返回 None"""
+    from blueprints.api.books import _calibre_epub_plan, _build_and_cache_processed_epub
+    from utils.cover_thumbnails import calibre_cover_version, resolve_calibre_cover
+    from utils.epub_cache import has_artifact
+    from utils.epub_chapter_parser import drop_cached_chapters, get_parsed_chapters
+
+    _wait_until_idle()
+    sha = resolve_calibre_cover(book_id, calibre_cover_version(book_id))
+    if sha:
+        _warm_cover_variants(sha)
+
+    # 处理过的 EPUB 只与语言和格式优先级有关，每种组合做一次
+    users = _users()
+    combo_keys = {}
+    for user in users:
+        combo = (_language(user), user.get('send_format_priority') or '[]')
+        if combo in combo_keys:
+            continue
+        _wait_until_idle()
+        details, needs_conversion, source_format, cache_key = _calibre_epub_plan(book_id, user, combo[0])
+        if not details:
+            return None
+        combo_keys[combo] = None
+        if not source_format or not cache_key:
+            continue
+        if needs_conversion and not shutil.which('ebook-converter'):
+            continue
+        if not has_artifact(cache_key) and not _build_and_cache_processed_epub(book_id, source_format, combo[0], cache_key):
+            raise RuntimeError('Failed to store the processed EPUB in the cache.')
+        combo_keys[combo] = cache_key
+
+    # 章节缓存不带版本，书籍文件变化（处理过的 EPUB 换了缓存键）后先删除旧的
+    previous = _warmed_epub_keys(_item_key('calibre', book_id))
+    epub_keys = {}
+    for user in users:
+        cache_key = combo_keys.get((_language(user), user.get('send_format_priority') or '[]'))
+        if not cache_key:
+            continue
+        _wait_until_idle()
+        if previous.get(str(user['id'])) not in (None, cache_key):
+            drop_cached_chapters('calibre', book_id, user['id'])
+        get_parsed_chapters('calibre', book_id, user)
+        epub_keys[str(user['id'])] = cache_key
+    return epub_keys
+
+
+def _warm_anx(username, book_id):
+    """预热一本 Anx 书；用户或书已被删除时直接跳过"""
+    from anx_library import get_anx_books_by_ids, get_anx_user_dirs
+    from utils.cover_thumbnails import resolve_file_cover
+    from utils.epub_chapter_parser import get_parsed_chapters
+
+    user = next((u for u in _users() if u['username'] == username), None)
+    dirs = get_anx_user_dirs(username)
+    if not user or not dirs or not os.path.exists(dirs['db_path']):
+        return None
+    book = get_anx_books_by_ids(username, [book_id], columns=('cover_path', 'file_path')).get(book_id)
+    if not book:
+        return None
+
+    _wait_until_idle()
+    if book.get('cover_path'):
+        sha = resolve_file_cover(os.path.join(dirs['workspace'], book['cover_path']))
+        if sha:
+            _warm_cover_variants(sha)
+
+    file_path = book.get('file_path') or ''
+    if file_path.lower().endswith('.epub') or shutil.which('ebook-converter'):
+        _wait_until_idle()
+        get_parsed_chapters('anx', book_id, user)
+    return None
+
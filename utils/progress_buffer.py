@@ -0,0 +1,255 @@
+"""
+阅读进度 / 阅读时长的写回缓冲 (write-behind)
+
+在线阅读器、有声书播放器和 KOReader 每隔几秒就会上报一次进度，原来每次都要在用户的
+Anx 数据库里 SELECT + UPDATE 并提交一次（一次 fsync）。这里先把更新合并在 app.db 的两张表中：
+
+- pending_progress：每本书只保留最新的 (cfi, percentage, update_time)；
+- pending_reading_time：按 (book_id, date) 累加增量；
+
+缓冲放在 app.db 而不是进程内存中，所有 gunicorn worker 看到的是同一份：请求到了哪个 worker、
+哪个 worker 的线程先刷新都不会让旧进度覆盖新进度，任何 worker 读取或 flush 时都能看到全部改动。
+
+每个 worker 的后台线程每隔 ANX_PROGRESS_FLUSH_SECONDS 秒尝试把缓冲写入各用户的 Anx 数据库
+（每个用户一个事务），同一时间只有拿到 progress_flush.lock 文件锁的一个在写，进程退出时 (atexit)
+也会写入。ANX_PROGRESS_FLUSH_SECONDS=0 时退回到每次立即写入。
+
+读取时：单本书的进度通过 get_progress / get_pending_reading_time 叠加缓冲中的值，
+需要整库数据的地方（书库列表、统计、WebDAV 同步 database7.db）先调用 flush(username)。
+"""
+import atexit
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from datetime import datetime
+from config_manager import CONFIG_DIR
+from database import get_db
+from utils.anx_aggregates import mark_reading_time_changed, get_source_id, note_own_write
+
+FLUSH_INTERVAL = float(os.environ.get('ANX_PROGRESS_FLUSH_SECONDS', 5))
+FLUSH_LOCK_PATH = os.path.join(CONFIG_DIR, 'progress_flush.lock')
+
+
+class ProgressBuffer:
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self.stats = {'updates': 0, 'flushes': 0, 'rows_written': 0, 'errors': 0}
+
+    # --- 写入 ---
+
+    def record_progress(self, username, book_id, cfi, percentage, update_time=None):
+        if update_time is None:
+            update_time = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')
+        with closing(get_db()) as db:
+            db.execute("""
+                INSERT INTO pending_progress (username, book_id, cfi, percentage, update_time) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(username, book_id) DO UPDATE SET
+                    cfi = excluded.cfi, percentage = excluded.percentage, update_time = excluded.update_time
+            """, (username, book_id, cfi, percentage, update_time))
+        self.stats['updates'] += 1
+        self._after_update(username)
+
+    def add_reading_time(self, username, book_id, date, seconds):
+        if not seconds:
+            return
+        with closing(get_db()) as db:
+            db.execute("""
+                INSERT INTO pending_reading_time (username, book_id, date, seconds) VALUES (?, ?, ?, ?)
+                ON CONFLICT(username, book_id, date) DO UPDATE SET seconds = seconds + excluded.seconds
+            """, (username, book_id, date, seconds))
+        self.stats['updates'] += 1
+        self._after_update(username)
+
+    def _after_update(self, username):
+        if self.flush_interval <= 0:
+            self.flush(username)
+        else:
+            self._ensure_thread()
+
+    # --- 读取 ---
+
+    def get_progress(self, username, book_id):
+        """返回缓冲中尚未写入的 (cfi, percentage, update_time)，没有时返回 None"""
+        with closing(get_db()) as db:
+            row = db.execute(
+                "SELECT cfi, percentage, update_time FROM pending_progress WHERE username = ? AND book_id = ?",
+                (username, book_id)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def get_pending_reading_time(self, username, book_id=None):
+        """返回缓冲中尚未写入的阅读时长 {(book_id, date): seconds}"""
+        query = "SELECT book_id, date, seconds FROM pending_reading_time WHERE username = ?"
+        params = [username]
+        if book_id is not None:
+            query += " AND book_id = ?"
+            params.append(book_id)
+        with closing(get_db()) as db:
+            rows = db.execute(query, params).fetchall()
+        return {(row['book_id'], row['date']): row['seconds'] for row in rows}
+
+    # --- 写入数据库 ---
+
+    def flush(self, username=None, wait=True):
+        """
+        把缓冲写入 Anx 数据库；username 为 None 时写入所有用户。
+        wait=False 时如果其它进程或线程正在写入则直接返回（后台线程使用），否则等它写完再写。
+        """
+        os.makedirs(os.path.dirname(FLUSH_LOCK_PATH), exist_ok=True)
+        with open(FLUSH_LOCK_PATH, 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                if username is not None:
+                    usernames = [username]
+                else:
+                    with closing(get_db()) as db:
+                        usernames = [row[0] for row in db.execute(
+                            "SELECT username FROM pending_progress UNION SELECT username FROM pending_reading_time"
+                        ).fetchall()]
+                for name in usernames:
+                    self._flush_user(name)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _flush_user(self, username):
+        """调用方持有 progress_flush.lock，同一时间只有一个 flush 在写入同一批增量"""
+        with closing(get_db()) as db:
+            progress = {
+                row['book_id']: (row['cfi'], row['percentage'], row['update_time'])
+                for row in db.execute(
+                    "SELECT book_id, cfi, percentage, update_time FROM pending_progress WHERE username = ?", (username,)
+                ).fetchall()
+            }
+            reading = {
+                (row['book_id'], row['date']): row['seconds']
+                for row in db.execute(
+                    "SELECT book_id, date, seconds FROM pending_reading_time WHERE username = ?", (username,)
+                ).fetchall()
+            }
+        if not progress and not reading:
+            return
+
+        try:
+            self._write(username, progress, reading)
+        except Exception as e:
+            # 写入失败时保留缓冲，下个周期重试
+            self.stats['errors'] += 1
+            print(f"Failed to flush reading progress for user {username}: {e}")
+            return
+
+        # 写入期间可能有新的更新，只移除已经写入的部分；在此之前读取方仍能从缓冲看到这些值
+        with closing(get_db()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.executemany(
+                    "DELETE FROM pending_progress WHERE username = ? AND book_id = ? "
+                    "AND cfi IS ? AND percentage IS ? AND update_time IS ?",
+                    [(username, book_id, *value) for book_id, value in progress.items()]
+                )
+                db.executemany(
+                    "UPDATE pending_reading_time SET seconds = seconds - ? WHERE username = ? AND book_id = ? AND date = ?",
+                    [(seconds, username, book_id, date) for (book_id, date), seconds in reading.items()]
+                )
+                db.execute("DELETE FROM pending_reading_time WHERE username = ? AND seconds <= 0", (username,))
+                db.execute('COMMIT')
+            except sqlite3.Error:
+                db.execute('ROLLBACK')
+                raise
+        self.stats['flushes'] += 1
+        self.stats['rows_written'] += len(progress) + len(reading)
+
+        for book_id, date in reading:
+            mark_reading_time_changed(username, book_id, date)
+
+    def _write(self, username, progress, reading):
+        # anx_library 会在读取前调用 flush，这里延迟导入以避免循环导入
+        from anx_library import get_anx_user_dirs, get_anx_db
+        dirs = get_anx_user_dirs(username)
+        if not dirs or not os.path.exists(dirs["db_path"]):
+            # 用户或书库已被删除，直接丢弃
+            return
+        source_before = get_source_id(dirs["db_path"])
+        with closing(get_anx_db(username)) as db:
+            try:
+                for book_id, (cfi, percentage, update_time) in progress.items():
+                    # 缓冲中每本书只有最新的一次进度，直接写入。不按 update_time 比较：
+                    # Anx 应用写入的时间格式和时区与服务端不同，字符串比较会丢掉更新的进度
+                    db.execute("""
+                        UPDATE tb_books
+                        SET last_read_position = ?, reading_percentage = ?, update_time = ?
+                        WHERE id = ?
+                    """, (cfi, percentage, update_time, book_id))
+                for (book_id, date), seconds in reading.items():
+                    cursor = db.execute(
+                        "UPDATE tb_reading_time SET reading_time = reading_time + ? WHERE book_id = ? AND date = ?",
+                        (seconds, book_id, date)
+                    )
+                    if cursor.rowcount == 0:
+                        db.execute("INSERT INTO tb_reading_time (book_id, date, reading_time) VALUES (?, ?, ?)", (book_id, date, seconds))
+                db.commit()
+            except sqlite3.Error:
+                db.rollback()
+                raise
+        note_own_write(username, dirs["db_path"], source_before)
+
+    # --- 后台线程 ---
+
+    def _ensure_thread(self):
+        pid = os.getpid()
+        if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='anx-progress-flush', daemon=True)
+            self._thread_pid = pid
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush(wait=False)
+            except Exception as e:
+                print(f"Progress flush loop error: {e}")
+
+
+_buffer = ProgressBuffer(FLUSH_INTERVAL)
+atexit.register(_buffer.flush)
+
+def get_progress_buffer():
+    return _buffer
+
+def record_progress(username, book_id, cfi, percentage, update_time=None):
+    _buffer.record_progress(username, book_id, cfi, percentage, update_time)
+
+def add_reading_time(username, book_id, date, seconds):
+    _buffer.add_reading_time(username, book_id, date, seconds)
+
+def get_buffered_progress(username, book_id):
+    return _buffer.get_progress(username, book_id)
+
+def get_pending_reading_time(username, book_id=None):
+    return _buffer.get_pending_reading_time(username, book_id)
+
+def flush_progress(username=None):
+    _buffer.flush(username)
+
+def overlay_progress(username, book):
+    """
+    返回叠加了缓冲中最新进度的书籍字典（book 可以是 sqlite3.Row 或 dict）。
+    """
+    book = dict(book)
+    pending = _buffer.get_progress(username, book['id'])
+    if pending:
+        book['last_read_position'], book['reading_percentage'], book['update_time'] = pending
+    return book
@@ -0,0 +1,82 @@
+"""
+跨进程的 single-flight 锁
+
+网页、KOReader 插件、MCP 客户端等同时需要同一本书的同一个派生结果（处理过的 EPUB、章节解析）时，
+原来每个请求都在自己的临时目录中下载、转换、修复一遍。这里让同一个 key 同时只有一个请求在做，
+其余请求等它完成后直接读取它写入的缓存，不再重复几分钟的转换。
+
+锁是 SINGLE_FLIGHT_DIR 中以 key 的哈希命名的文件锁 (flock)，对所有 gunicorn worker 生效；
+持有者所在进程退出时由内核自动释放，不会留下过期的租约。持有者完成后在解锁前删除锁文件，
+目录中只剩下正在处理的 key；等待者拿到锁后确认文件仍是路径上的那个，否则重新打开。
+"""
+import fcntl
+import hashlib
+import os
+import time
+from contextlib import contextmanager
+from config_manager import CONFIG_DIR
+
+SINGLE_FLIGHT_DIR = os.environ.get('SINGLE_FLIGHT_DIR', os.path.join(CONFIG_DIR, 'single_flight'))
+# 等待的上限要长于一次转换的超时时间，超过后不再等待，宁可重复处理也不无限阻塞
+SINGLE_FLIGHT_TIMEOUT = int(os.environ.get('SINGLE_FLIGHT_TIMEOUT', 3900))
+POLL_INTERVAL = 0.2
+
+stats = {'leaders': 0, 'followers': 0, 'timeouts': 0}
+
+
+@contextmanager
+def single_flight(key, check_cancelled=None, on_wait=None, timeout=SINGLE_FLIGHT_TIMEOUT):
+    """
+    同一 key 同时只有一个持有者，其余调用方在这里等待。
+    产出 waited：为 True 表示进入前等待过别人，调用方应先检查缓存中是否已有结果。
+    等待期间定期调用 check_cancelled()（可以抛出异常放弃等待），第一次需要等待时调用 on_wait()。
+    """
+    os.makedirs(SINGLE_FLIGHT_DIR, exist_ok=True)
+    path = os.path.join(SINGLE_FLIGHT_DIR, f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.lock")
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    locked = False
+    waited = False
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if _is_current_file(fd, path):
+                    locked = True
+                    break
+                # 上一个持有者已经删除了这个文件，锁住的是旧文件，换成路径上的新文件重新加锁
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                continue
+            except BlockingIOError:
+                pass
+            if not waited:
+                waited = True
+                if on_wait:
+                    on_wait()
+            if check_cancelled:
+                check_cancelled()
+            if time.monotonic() > deadline:
+                print(f"Gave up waiting for in-flight work on '{key}' after {timeout} seconds.")
+                stats['timeouts'] += 1
+                break
+            time.sleep(POLL_INTERVAL)
+        stats['followers' if waited else 'leaders'] += 1
+        yield waited
+    finally:
+        if locked:
+            # 先删除再解锁：等待者拿到锁后发现文件已不在路径上，会重新打开
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _is_current_file(fd, path):
+    try:
+        return os.fstat(fd).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
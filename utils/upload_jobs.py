@@ -0,0 +1,178 @@
+"""
+批量上传任务
+
+原来的上传接口在一个请求中逐个处理文件，前端也是一个文件一个请求地串行上传，
+几百本书的拖放导入要花很长时间。这里改为：
+
+- 请求只负责把文件分块写入 UPLOAD_SPOOL_DIR/<job_id>/（不读入内存），登记到 upload_job_files 后立即返回；
+- 每个进程一个有界线程池 (UPLOAD_WORKERS) 并行处理文件（转换、元数据、MD5、封面、上传到 Calibre 等）；
+- 每个文件的状态 (queued / processing / success / duplicate / error) 和当前步骤写入 app.db，
+  任何 worker 都可以回答 GET /api/upload_jobs/<job_id> 的查询；
+- 同一个任务可以分多次请求追加文件，前端按批次上传，上传下一批时服务端已在处理上一批；
+- 每个文件记录处理它的进程 (owner，见 utils.job_owner)。这个进程退出后（worker 重启、容器重启），
+  未完成的文件在下次查询和 worker 启动时标记为中断，暂存文件随之删除。
+
+任务记录保留 UPLOAD_JOB_RETENTION_DAYS 天，创建新任务时顺带清理。
+"""
+import os
+import threading
+import uuid
+from contextlib import closing
+from werkzeug.utils import secure_filename
+from config_manager import CONFIG_DIR
+from database import get_db
+from utils.job_owner import current_owner
+from utils.job_runtime import JobExecutor, cleanup_old_jobs, expire_orphans, status_counts
+
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+UPLOAD_SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR', os.path.join(CONFIG_DIR, 'upload_spool'))
+UPLOAD_JOB_RETENTION_DAYS = int(os.environ.get('UPLOAD_JOB_RETENTION_DAYS', 7))
+
+FINISHED_STATUSES = ('success', 'duplicate', 'error')
+ACTIVE_STATUSES = ('queued', 'processing')
+
+_executor = JobExecutor(UPLOAD_WORKERS, 'upload-job')
+
+
+def _job_dir(job_id):
+    return os.path.join(UPLOAD_SPOOL_DIR, job_id)
+
+
+def create_upload_job(user_id, target):
+    """创建任务并返回 job_id；target 为 'calibre' 或 'anx'"""
+    job_id = str(uuid.uuid4())
+    with closing(get_db()) as db:
+        cleanup_old_jobs(db, 'upload_jobs', UPLOAD_JOB_RETENTION_DAYS, child_table='upload_job_files', spool_dir=UPLOAD_SPOOL_DIR)
+        db.execute("INSERT INTO upload_jobs (job_id, user_id, target) VALUES (?, ?, ?)", (job_id, user_id, target))
+    return job_id
+
+
+def get_upload_job_row(job_id):
+    with closing(get_db()) as db:
+        return db.execute("SELECT * FROM upload_jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+
+def spool_files(job_id, files):
+    """
+    把上传的 FileStorage 逐个分块写入任务目录并登记，返回 [(file_id, 路径, 原始文件名, mimetype)]。
+    """
+    job_dir = _job_dir(job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    spooled = []
+    with closing(get_db()) as db:
+        for file in files:
+            if not file or not file.filename:
+                continue
+            original_filename = os.path.basename(file.filename)
+            path = os.path.join(job_dir, f"{uuid.uuid4().hex}-{secure_filename(original_filename) or 'book'}")
+            file.save(path)
+            cursor = db.execute(
+                "INSERT INTO upload_job_files (job_id, filename, size, spool_path, owner) VALUES (?, ?, ?, ?, ?)",
+                (job_id, original_filename, os.path.getsize(path), path, current_owner())
+            )
+            spooled.append((cursor.lastrowid, path, original_filename, file.mimetype))
+    return spooled
+
+
+def update_job_file(file_id, status, stage=None, message=None, book_id=None):
+    with closing(get_db()) as db:
+        db.execute(
+            "UPDATE upload_job_files SET status = ?, stage = ?, message = COALESCE(?, message), "
+            "book_id = COALESCE(?, book_id), updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (status, stage, message, book_id, file_id)
+        )
+
+
+def _remove_spool_file(row):
+    if row['spool_path'] and os.path.exists(row['spool_path']):
+        os.unlink(row['spool_path'])
+
+
+def _expire_orphans(db, rows):
+    """把处理进程已经退出的未完成文件标记为中断并删除暂存文件，返回被中断的文件数"""
+    return len(expire_orphans(db, rows, 'upload_job_files', 'id', ACTIVE_STATUSES, on_expired=_remove_spool_file))
+
+
+def interrupt_orphaned_jobs():
+    """worker 启动时调用：处理进程已经退出的未完成文件标记为中断"""
+    with closing(get_db()) as db:
+        _expire_orphans(db, db.execute(
+            "SELECT id, status, spool_path, owner FROM upload_job_files WHERE status IN ('queued', 'processing')"
+        ).fetchall())
+
+
+def submit_files(spooled, process_file, on_finished=None):
+    """
+    把已登记的文件交给线程池处理。
+    process_file(path, filename, mimetype, on_stage) 返回 {'success', 'message'/'error', 'book_id', 'duplicate'}；
+    文件处理完后删除（process_file 可以先移动它）。全部完成后调用 on_finished(results)。
+    """
+    if not spooled:
+        if on_finished:
+            on_finished([])
+        return
+
+    results = []
+    remaining = [len(spooled)]
+    results_lock = threading.Lock()
+
+    def run(file_id, path, filename, mimetype):
+        def on_stage(stage):
+            update_job_file(file_id, 'processing', stage=stage)
+
+        try:
+            on_stage('starting')
+            result = process_file(path, filename, mimetype, on_stage)
+        except Exception as e:
+            print(f"Upload job file {filename} failed: {e}")
+            result = {'success': False, 'error': str(e)}
+        finally:
+            if os.path.exists(path):
+                os.unlink(path)
+
+        if not result.get('success'):
+            status = 'error'
+        elif result.get('duplicate'):
+            status = 'duplicate'
+        else:
+            status = 'success'
+        try:
+            update_job_file(file_id, status, message=result.get('message') or result.get('error'), book_id=result.get('book_id'))
+        except Exception as e:
+            print(f"Failed to record upload job result for {filename}: {e}")
+
+        with results_lock:
+            results.append(result)
+            remaining[0] -= 1
+            finished = remaining[0] == 0
+        if finished and on_finished:
+            try:
+                on_finished(results)
+            except Exception as e:
+                print(f"Upload job completion callback failed: {e}")
+
+    for file_id, path, filename, mimetype in spooled:
+        _executor.submit(run, file_id, path, filename, mimetype)
+
+
+def get_upload_job(job_id):
+    """返回任务和每个文件的状态，任务不存在时返回 None"""
+    with closing(get_db()) as db:
+        job = db.execute("SELECT * FROM upload_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if not job:
+            return None
+        query = "SELECT * FROM upload_job_files WHERE job_id = ? ORDER BY id"
+        rows = db.execute(query, (job_id,)).fetchall()
+        if _expire_orphans(db, rows):
+            rows = db.execute(query, (job_id,)).fetchall()
+    files = [{key: row[key] for key in ('id', 'filename', 'size', 'status', 'stage', 'message', 'book_id')} for row in rows]
+
+    return {
+        'job_id': job['job_id'],
+        'target': job['target'],
+        'created_at': job['created_at'],
+        'total': len(files),
+        'counts': status_counts(files, ACTIVE_STATUSES, FINISHED_STATUSES),
+        'finished': all(f['status'] in FINISHED_STATUSES for f in files),
+        'files': files,
+    }
@@ -0,0 +1,110 @@
+"""
+users 表的进程内缓存
+每个请求都需要"是否已初始化"标志和当前登录用户的记录，这里把它们缓存在内存中。
+缓存按 users 表的"代数"(generation) 失效：所有写 users 表的地方在提交后调用
+bump_users_generation()，代数保存在 app.db 旁边的一个小文件中，
+因此多个 gunicorn worker 之间也能看到彼此的修改，而检查代数只需要一次 stat，不访问数据库。
+"""
+import os
+import threading
+import time
+from contextlib import closing
+import database
+from config_manager import DATABASE_PATH
+
+GENERATION_FILE = os.path.join(os.path.dirname(DATABASE_PATH), 'users.generation')
+
+_MISSING = object()
+
+
+def _read_generation():
+    """返回代数文件的 (inode, mtime_ns, size)；文件不存在时返回 None"""
+    try:
+        st = os.stat(GENERATION_FILE)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def bump_users_generation():
+    """在修改 users 表之后调用，使所有进程中的用户缓存失效。"""
+    tmp_path = f"{GENERATION_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(str(time.time_ns()))
+        # os.replace 是原子操作，并且会产生新的 inode，读取方据此判断代数变化
+        os.replace(tmp_path, GENERATION_FILE)
+    except OSError as e:
+        print(f"Failed to bump users generation: {e}")
+    # 即使文件写入失败，本进程的缓存也必须立即失效
+    _cache.invalidate()
+
+
+class UserCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = _MISSING
+        self._has_users = None
+        self._rows = {}
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def invalidate(self):
+        with self._lock:
+            self._generation = _MISSING
+            self._has_users = None
+            self._rows = {}
+            self.stats['invalidations'] += 1
+
+    def _check_generation(self):
+        """代数变化时清空缓存。必须在持有锁时调用，返回当前代数。"""
+        generation = _read_generation()
+        if generation is None or generation != self._generation:
+            if self._generation is not _MISSING:
+                self.stats['invalidations'] += 1
+            self._has_users = None
+            self._rows = {}
+            self._generation = generation
+        return generation
+
+    def has_users(self):
+        with self._lock:
+            generation = self._check_generation()
+            if self._has_users is not None:
+                self.stats['hits'] += 1
+                return self._has_users
+        with closing(database.get_db()) as db:
+            has_users = db.execute('SELECT 1 FROM users LIMIT 1').fetchone() is not None
+        with self._lock:
+            self.stats['misses'] += 1
+            if self._generation == generation and self._generation is not _MISSING:
+                self._has_users = has_users
+        return has_users
+
+    def get_user_row(self, user_id):
+        """返回 users 表中的一行 (sqlite3.Row)，用户不存在时返回 None"""
+        with self._lock:
+            generation = self._check_generation()
+            row = self._rows.get(user_id, _MISSING)
+            if row is not _MISSING:
+                self.stats['hits'] += 1
+                return row
+        with closing(database.get_db()) as db:
+            row = db.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        with self._lock:
+            self.stats['misses'] += 1
+            # 查询期间如果代数已经变化，就不要把可能过期的结果放进新一代的缓存
+            if self._generation == generation and self._generation is not _MISSING:
+                self._rows[user_id] = row
+        return row
+
+
+_cache = UserCache()
+
+def get_user_cache():
+    return _cache
+
+def has_users():
+    return _cache.has_users()
+
+def get_user_row(user_id):
+    return _cache.get_user_row(user_id)